@@ -1,11 +1,6 @@
 import argparse
 import sys
-import errno
-import os
 import math
-from multiprocessing import Process, Queue
-import time
-import traceback
 import logging
 log = logging.getLogger(__name__)
 
@@ -21,6 +16,8 @@ import hicmatrix.HiCMatrix as hm
 from hicexplorer import utilities
 from hicexplorer._version import __version__
 from .lib import Viewpoint
+from .lib import viewpointStore
+from .lib import workQueue
 
 
 def parse_arguments(args=None):
@@ -66,15 +63,15 @@ If the `--targetFileFolder` flag is not set in batch mode, it is assumed the `--
                            default='_aggregate_target.txt')
 
     parserOpt.add_argument('--interactionFileFolder', '-iff',
-                           help='Folder where the interaction files are stored. Applies only for batch mode'
+                           help='Folder or viewpoint store (see chicViewpoint) where the interaction files are stored. Applies only for batch mode'
                            ' (Default: %(default)s).',
                            required=False,
                            default='.')
     parserOpt.add_argument('--targetFileFolder', '-tff',
-                           help='Folder where the target files are stored. Applies only for batch mode.',
+                           help='Folder or viewpoint store (see chicSignificantInteractions) where the target files are stored. Applies only for batch mode.',
                            required=False)
     parserOpt.add_argument('--outputFolder', '-o',
-                           help='Output folder containing the files'
+                           help='Output folder containing the files. If the name ends with \'.hdf5\' or \'.h5\', they are stored in a single HDF5 file instead'
                            ' (Default: %(default)s).',
                            required=False,
                            default='aggregatedFiles')
@@ -156,7 +153,7 @@ def filter_scores_target_list(pScoresDictionary, pTargetList=None, pTargetInterv
 
 def write(pOutFileName, pHeader, pNeighborhoods, pInteractionLines):
 
-    with open(pOutFileName, 'w') as file:
+    with viewpointStore.openFile(pOutFileName, 'w') as file:
         file.write('# Aggregated file, created with HiCExplorer\'s chicAggregateStatistic version {}\n'.format(__version__))
         file.write(pHeader)
         # file.write(
@@ -176,148 +173,92 @@ def write(pOutFileName, pHeader, pNeighborhoods, pInteractionLines):
                 file.write(new_line)
 
 
-def run_target_list_compilation(pInteractionFilesList, pTargetList, pArgs, pViewpointObj, pQueue=None, pOneTarget=False):
+def run_target_list_compilation(pInteractionFilesList, pTargetList, pArgs, pViewpointObj, pOneTarget=False):
     outfile_names = []
     target_regions_intervaltree = None
     log.debug('size: interactionFileList: {} '.format(pInteractionFilesList))
     log.debug('size: pTargetList: {} '.format(pTargetList))
     log.debug('pOneTarget: {} '.format(pOneTarget))
 
-    try:
-        if pArgs.batchMode and len(pTargetList) == 1 and pOneTarget == True:
-            target_regions = utilities.readBed(pTargetList[0])
-            hicmatrix = hm.hiCMatrix()
-            target_regions_intervaltree = hicmatrix.intervalListToIntervalTree(target_regions)[0]
-
-        for i, interactionFile in enumerate(pInteractionFilesList):
-            for sample in interactionFile:
-                if pArgs.interactionFileFolder != '.':
-                    absolute_sample_path = pArgs.interactionFileFolder + '/' + sample
-                else:
-                    absolute_sample_path = sample
-                header, interaction_data, interaction_file_data = pViewpointObj.readInteractionFileForAggregateStatistics(
-                    absolute_sample_path)
-                log.debug('len(pTargetList) {}'.format(len(pTargetList)))
-                if pArgs.batchMode and len(pTargetList) >= 1 and pOneTarget == False:
-                    if pArgs.targetFileFolder != '.':
-                        target_file = pArgs.targetFileFolder + '/' + pTargetList[i]
-                        log.debug('194')
-                    else:
-                        target_file = pTargetList[i]
-                        log.debug('197')
-
-                elif pArgs.batchMode and len(pTargetList) == 1 and pOneTarget == True:
-                    target_file = None
-                    log.debug('201')
+    if pArgs.batchMode and len(pTargetList) == 1 and pOneTarget == True:
+        target_regions = utilities.readBed(pTargetList[0])
+        hicmatrix = hm.hiCMatrix()
+        target_regions_intervaltree = hicmatrix.intervalListToIntervalTree(target_regions)[0]
 
+    for i, interactionFile in enumerate(pInteractionFilesList):
+        for sample in interactionFile:
+            if pArgs.interactionFileFolder != '.':
+                absolute_sample_path = pArgs.interactionFileFolder + '/' + sample
+            else:
+                absolute_sample_path = sample
+            header, interaction_data, interaction_file_data = pViewpointObj.readInteractionFileForAggregateStatistics(
+                absolute_sample_path)
+            log.debug('len(pTargetList) {}'.format(len(pTargetList)))
+            if pArgs.batchMode and len(pTargetList) >= 1 and pOneTarget == False:
+                if pArgs.targetFileFolder != '.':
+                    target_file = pArgs.targetFileFolder + '/' + pTargetList[i]
+                    log.debug('194')
                 else:
                     target_file = pTargetList[i]
-                    log.debug('205')
+                    log.debug('197')
+
+            elif pArgs.batchMode and len(pTargetList) == 1 and pOneTarget == True:
+                target_file = None
+                log.debug('201')
 
-                accepted_scores = filter_scores_target_list(interaction_file_data, pTargetList=target_file, pTargetIntervalTree=target_regions_intervaltree)
+            else:
+                target_file = pTargetList[i]
+                log.debug('205')
 
-                if len(accepted_scores) == 0:
-                    # do not call 'break' or 'continue'
-                    # with this an empty file is written and no track of 'no significant interactions' detected files needs to be recorded.
-                    if pArgs.batchMode:
-                        with open('errorLog.txt', 'a+') as errorlog:
-                            errorlog.write('Failed for: {} and {}.\n'.format(interactionFile[0], interactionFile[1]))
-                    else:
-                        log.info('No target regions found')
-                outFileName = '.'.join(sample.split('/')[-1].split('.')[:-1]) + '_' + pArgs.outFileNameSuffix
+            accepted_scores = filter_scores_target_list(interaction_file_data, pTargetList=target_file, pTargetIntervalTree=target_regions_intervaltree)
 
+            if len(accepted_scores) == 0:
+                # do not call 'break' or 'continue'
+                # with this an empty file is written and no track of 'no significant interactions' detected files needs to be recorded.
                 if pArgs.batchMode:
-                    outfile_names.append(outFileName)
-                if pArgs.outputFolder != '.':
-                    outFileName = pArgs.outputFolder + '/' + outFileName
+                    with open('errorLog.txt', 'a+') as errorlog:
+                        errorlog.write('Failed for: {} and {}.\n'.format(interactionFile[0], interactionFile[1]))
+                else:
+                    log.info('No target regions found')
+            outFileName = '.'.join(sample.split('/')[-1].split('.')[:-1]) + '_' + pArgs.outFileNameSuffix
 
-                write(outFileName, header, accepted_scores,
-                      interaction_file_data)
-    except Exception as exp:
-        pQueue.put('Fail: ' + str(exp) + traceback.format_exc())
-        return
-    if pQueue is None:
-        return
-    pQueue.put(outfile_names)
-    return
+            if pArgs.batchMode:
+                outfile_names.append(outFileName)
+            if pArgs.outputFolder != '.':
+                outFileName = pArgs.outputFolder + '/' + outFileName
+
+            write(outFileName, header, accepted_scores,
+                  interaction_file_data)
+    viewpointStore.flush()
+    return outfile_names
 
 
 def call_multi_core(pInteractionFilesList, pTargetFileList, pFunctionName, pArgs, pViewpointObj):
-    if len(pInteractionFilesList) < pArgs.threads:
-        pArgs.threads = len(pInteractionFilesList)
-    outfile_names = [None] * pArgs.threads
-    interactionFilesPerThread = len(pInteractionFilesList) // pArgs.threads
-
-    all_data_collected = False
-    queue = [None] * pArgs.threads
-    process = [None] * pArgs.threads
-    thread_done = [False] * pArgs.threads
     one_target = True if len(pTargetFileList) == 1 else False
-    fail_flag = False
-    fail_message = ''
-    for i in range(pArgs.threads):
-
-        if i < pArgs.threads - 1:
-            interactionFileListThread = pInteractionFilesList[i * interactionFilesPerThread:(i + 1) * interactionFilesPerThread]
-            if len(pTargetFileList) == 1:
-                targetFileListThread = pTargetFileList
-            else:
-                targetFileListThread = pTargetFileList[i * interactionFilesPerThread:(i + 1) * interactionFilesPerThread]
-        else:
-            interactionFileListThread = pInteractionFilesList[i * interactionFilesPerThread:]
-            if len(pTargetFileList) == 1:
-                targetFileListThread = pTargetFileList
-            else:
-                targetFileListThread = pTargetFileList[i * interactionFilesPerThread:]
-
-        queue[i] = Queue()
-        process[i] = Process(target=pFunctionName, kwargs=dict(
-            pInteractionFilesList=interactionFileListThread,
-            pTargetList=targetFileListThread,
-            pArgs=pArgs,
-            pViewpointObj=pViewpointObj,
-            pQueue=queue[i],
-            pOneTarget=one_target
-        )
-        )
-
-        process[i].start()
-
-    while not all_data_collected:
-        for i in range(pArgs.threads):
-            if queue[i] is not None and not queue[i].empty():
-                background_data_thread = queue[i].get()
-                if 'Fail:' in background_data_thread:
-                    fail_flag = True
-                    fail_message = background_data_thread[6:]
-                outfile_names[i] = background_data_thread
-                queue[i] = None
-                process[i].join()
-                process[i].terminate()
-                process[i] = None
-                thread_done[i] = True
-        all_data_collected = True
-        for thread in thread_done:
-            if not thread:
-                all_data_collected = False
-        time.sleep(1)
-    if fail_flag:
-        log.error(fail_message)
+    kwargs = dict(
+        pArgs=pArgs,
+        pViewpointObj=pViewpointObj,
+        pOneTarget=one_target
+    )
+    # a single target file is used for all interaction files, otherwise there is one per interaction file
+    if one_target:
+        item_lists = [pInteractionFilesList]
+        kwargs['pTargetList'] = pTargetFileList
+    else:
+        item_lists = [pInteractionFilesList, pTargetFileList]
+    try:
+        results = workQueue.runParallel(pFunctionName, item_lists, pArgs.threads, pKwargs=kwargs, pName='chicAggregateStatistic')
+    except workQueue.WorkQueueError as exp:
+        log.error(exp)
         exit(1)
-    outfile_names = [item for sublist in outfile_names for item in sublist]
-    return outfile_names
+    return workQueue.flatten(results)
 
 
 def main(args=None):
     args = parse_arguments().parse_args(args)
     viewpointObj = Viewpoint()
     outfile_names = []
-    if not os.path.exists(args.outputFolder):
-        try:
-            os.makedirs(args.outputFolder)
-        except OSError as exc:  # Guard against race condition
-            if exc.errno != errno.EEXIST:
-                raise
+    viewpointStore.createFolder(args.outputFolder)
 
     interactionFileList = []
     targetFileList = []
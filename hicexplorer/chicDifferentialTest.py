@@ -1,10 +1,6 @@
 import argparse
 import sys
-import errno
-import os
 import math
-from multiprocessing import Process, Queue
-import time
 import logging
 log = logging.getLogger(__name__)
 
@@ -15,6 +11,8 @@ import hicmatrix.HiCMatrix as hm
 from hicexplorer import utilities
 from hicexplorer._version import __version__
 from .lib import Viewpoint
+from .lib import viewpointStore
+from .lib import workQueue
 
 
 def parse_arguments(args=None):
@@ -58,12 +56,12 @@ This will create, as in the non-batch mode, three files per aggregated file and
     parserOpt = parser.add_argument_group('Optional arguments')
 
     parserOpt.add_argument('--interactionFileFolder', '-iff',
-                           help='Folder where the interaction files are stored. Applies only for batch mode'
+                           help='Folder or viewpoint store (see chicAggregateStatistic) where the interaction files are stored. Applies only for batch mode'
                            ' (Default: %(default)s).',
                            required=False,
                            default='.')
     parserOpt.add_argument('--outputFolder', '-o',
-                           help='Output folder of the files'
+                           help='Output folder of the files. If the name ends with \'.hdf5\' or \'.h5\', they are stored in a single HDF5 file instead'
                            ' (Default: %(default)s).',
                            required=False,
                            default='differentialResults')
@@ -99,7 +97,17 @@ def readInteractionFile(pInteractionFile):
     line_content = []
     data = []
 
-    with open(pInteractionFile, 'r') as file:
+    if viewpointStore.isInStore(pInteractionFile):
+        header, columns = viewpointStore.readColumns(pInteractionFile, [-1])
+        header = header.splitlines(True)
+        if columns is not None and len(header) >= 3:
+            sum_of_all_interactions = float(header[1].strip().split('\t')[-1].split(' ')[-1])
+            # writeResult uses only the first six fields of a line
+            line_content = np.stack(viewpointStore.readColumns(pInteractionFile, range(6), pDecode=True)[1], axis=1).tolist()
+            data = [[sum_of_all_interactions, value] for value in columns[0].astype(float).tolist()]
+            return header[1] + header[2], line_content, data
+
+    with viewpointStore.openFile(pInteractionFile, 'r') as file:
         file.readline()
         header = file.readline()
         sum_of_all_interactions = float(
@@ -171,7 +179,7 @@ def fisher_exact_test(pDataFile1, pDataFile2, pAlpha):
 
 def writeResult(pOutFileName, pData, pHeaderOld, pHeaderNew, pAlpha, pTest):
 
-    with open(pOutFileName, 'w') as file:
+    with viewpointStore.openFile(pOutFileName, 'w') as file:
         header = '# Differential analysis result file of HiCExplorer\'s chicDifferentialTest version '
         header += str(__version__)
         header += '\n'
@@ -210,99 +218,86 @@ def writeResult(pOutFileName, pData, pHeaderOld, pHeaderNew, pAlpha, pTest):
                 file.write(line)
 
 
-def run_statistical_tests(pInteractionFilesList, pArgs, pQueue=None):
+def run_statistical_tests(pInteractionFilesList, pArgs):
     rejected_names = []
-    try:
-        for interactionFile in pInteractionFilesList:
+    for interactionFile in pInteractionFilesList:
 
-            sample_prefix = interactionFile[0].split(
-                '/')[-1].split('_')[0] + '_' + interactionFile[1].split('/')[-1].split('_')[0]
+        sample_prefix = interactionFile[0].split(
+            '/')[-1].split('_')[0] + '_' + interactionFile[1].split('/')[-1].split('_')[0]
 
-            region_prefix = '_'.join(
-                interactionFile[0].split('/')[-1].split('_')[1:6])
+        region_prefix = '_'.join(
+            interactionFile[0].split('/')[-1].split('_')[1:6])
 
-            outFileName = sample_prefix + '_' + region_prefix
-            rejected_name_output_file = outFileName + '_H0_rejected.txt'
+        outFileName = sample_prefix + '_' + region_prefix
+        rejected_name_output_file = outFileName + '_H0_rejected.txt'
 
-            if pArgs.outputFolder != '.':
-                outFileName_accepted = pArgs.outputFolder + \
-                    '/' + outFileName + '_H0_accepted.txt'
-                outFileName_rejected = pArgs.outputFolder + \
-                    '/' + outFileName + '_H0_rejected.txt'
-                outFileName = pArgs.outputFolder + '/' + outFileName + '_results.txt'
-            else:
-                outFileName_accepted = outFileName + '_H0_accepted.txt'
-                outFileName_rejected = outFileName + '_H0_rejected.txt'
-                outFileName = outFileName + '_results.txt'
+        if pArgs.outputFolder != '.':
+            outFileName_accepted = pArgs.outputFolder + \
+                '/' + outFileName + '_H0_accepted.txt'
+            outFileName_rejected = pArgs.outputFolder + \
+                '/' + outFileName + '_H0_rejected.txt'
+            outFileName = pArgs.outputFolder + '/' + outFileName + '_results.txt'
+        else:
+            outFileName_accepted = outFileName + '_H0_accepted.txt'
+            outFileName_rejected = outFileName + '_H0_rejected.txt'
+            outFileName = outFileName + '_results.txt'
 
-            if pArgs.interactionFileFolder != '.':
-                absolute_sample_path1 = pArgs.interactionFileFolder + '/' + interactionFile[0]
-                absolute_sample_path2 = pArgs.interactionFileFolder + '/' + interactionFile[1]
+        if pArgs.interactionFileFolder != '.':
+            absolute_sample_path1 = pArgs.interactionFileFolder + '/' + interactionFile[0]
+            absolute_sample_path2 = pArgs.interactionFileFolder + '/' + interactionFile[1]
 
-            else:
-                absolute_sample_path1 = interactionFile[0]
-                absolute_sample_path2 = interactionFile[1]
-
-            header1, line_content1, data1 = readInteractionFile(absolute_sample_path1)
-            header2, line_content2, data2 = readInteractionFile(absolute_sample_path2)
-
-            if len(line_content1) == 0 or len(line_content2) == 0:
-                writeResult(outFileName, None, header1, header2,
-                            pArgs.alpha, pArgs.statisticTest)
-                writeResult(outFileName_accepted, None, header1, header2,
-                            pArgs.alpha, pArgs.statisticTest)
-                writeResult(outFileName_rejected, None, header1, header2,
-                            pArgs.alpha, pArgs.statisticTest)
-                rejected_names.append(rejected_name_output_file)
-                continue
-            if pArgs.statisticTest == 'chi2':
-                test_result, accepted, rejected = chisquare_test(
-                    data1, data2, pArgs.alpha)
-            elif pArgs.statisticTest == 'fisher':
-                test_result, accepted, rejected = fisher_exact_test(
-                    data1, data2, pArgs.alpha)
-
-            write_out_lines = []
-            for i, result in enumerate(test_result):
-                write_out_lines.append(
-                    [line_content1[i], line_content2[i], result, data1[i], data2[i]])
-
-            write_out_lines_accepted = []
-            for result in accepted:
-                write_out_lines_accepted.append(
-                    [line_content1[result[0]], line_content2[result[0]], result[1], data1[result[0]], data2[result[0]]])
-
-            write_out_lines_rejected = []
-            for result in rejected:
-                write_out_lines_rejected.append(
-                    [line_content1[result[0]], line_content2[result[0]], result[1], data1[result[0]], data2[result[0]]])
-
-            writeResult(outFileName, write_out_lines, header1, header2,
+        else:
+            absolute_sample_path1 = interactionFile[0]
+            absolute_sample_path2 = interactionFile[1]
+
+        header1, line_content1, data1 = readInteractionFile(absolute_sample_path1)
+        header2, line_content2, data2 = readInteractionFile(absolute_sample_path2)
+
+        if len(line_content1) == 0 or len(line_content2) == 0:
+            writeResult(outFileName, None, header1, header2,
                         pArgs.alpha, pArgs.statisticTest)
-            writeResult(outFileName_accepted, write_out_lines_accepted, header1, header2,
+            writeResult(outFileName_accepted, None, header1, header2,
                         pArgs.alpha, pArgs.statisticTest)
-            writeResult(outFileName_rejected, write_out_lines_rejected, header1, header2,
+            writeResult(outFileName_rejected, None, header1, header2,
                         pArgs.alpha, pArgs.statisticTest)
             rejected_names.append(rejected_name_output_file)
-
-    except Exception as exp:
-        pQueue.put('Fail: ' + str(exp))
-        return
-
-    if pQueue is None:
-        return
-    pQueue.put(rejected_names)
-    return
+            continue
+        if pArgs.statisticTest == 'chi2':
+            test_result, accepted, rejected = chisquare_test(
+                data1, data2, pArgs.alpha)
+        elif pArgs.statisticTest == 'fisher':
+            test_result, accepted, rejected = fisher_exact_test(
+                data1, data2, pArgs.alpha)
+
+        write_out_lines = []
+        for i, result in enumerate(test_result):
+            write_out_lines.append(
+                [line_content1[i], line_content2[i], result, data1[i], data2[i]])
+
+        write_out_lines_accepted = []
+        for result in accepted:
+            write_out_lines_accepted.append(
+                [line_content1[result[0]], line_content2[result[0]], result[1], data1[result[0]], data2[result[0]]])
+
+        write_out_lines_rejected = []
+        for result in rejected:
+            write_out_lines_rejected.append(
+                [line_content1[result[0]], line_content2[result[0]], result[1], data1[result[0]], data2[result[0]]])
+
+        writeResult(outFileName, write_out_lines, header1, header2,
+                    pArgs.alpha, pArgs.statisticTest)
+        writeResult(outFileName_accepted, write_out_lines_accepted, header1, header2,
+                    pArgs.alpha, pArgs.statisticTest)
+        writeResult(outFileName_rejected, write_out_lines_rejected, header1, header2,
+                    pArgs.alpha, pArgs.statisticTest)
+        rejected_names.append(rejected_name_output_file)
+    viewpointStore.flush()
+    return rejected_names
 
 
 def main(args=None):
     args = parse_arguments().parse_args(args)
-    if not os.path.exists(args.outputFolder):
-        try:
-            os.makedirs(args.outputFolder)
-        except OSError as exc:  # Guard against race condition
-            if exc.errno != errno.EEXIST:
-                raise
+    viewpointStore.createFolder(args.outputFolder)
     interactionFileList = []
     if args.batchMode:
         with open(args.interactionFile[0], 'r') as interactionFile:
@@ -323,60 +318,19 @@ def main(args=None):
                     (args.interactionFile[i], args.interactionFile[i + 1]))
                 i += 2
 
-    fail_flag = False
-    fail_message = ''
     if args.batchMode:
-        rejected_file_names = [None] * args.threads
-        interactionFilesPerThread = len(interactionFileList) // args.threads
-        all_data_collected = False
-        queue = [None] * args.threads
-        process = [None] * args.threads
-        thread_done = [False] * args.threads
-        length_of_threads = 0
-        for i in range(args.threads):
-
-            if i < args.threads - 1:
-                interactionFileListThread = interactionFileList[i * interactionFilesPerThread:(i + 1) * interactionFilesPerThread]
-            else:
-                interactionFileListThread = interactionFileList[i * interactionFilesPerThread:]
-            length_of_threads += len(interactionFileListThread)
-            queue[i] = Queue()
-            process[i] = Process(target=run_statistical_tests, kwargs=dict(
-                pInteractionFilesList=interactionFileListThread,
-                pArgs=args,
-                pQueue=queue[i]
-            )
-            )
-
-            process[i].start()
-        log.debug('length_of_threads {}'.format(length_of_threads))
-        while not all_data_collected:
-            for i in range(args.threads):
-                if queue[i] is not None and not queue[i].empty():
-                    background_data_thread = queue[i].get()
-                    if 'Fail:' in background_data_thread:
-                        fail_flag = True
-                        fail_message = background_data_thread[6:]
-                    rejected_file_names[i] = background_data_thread
-                    queue[i] = None
-                    process[i].join()
-                    process[i].terminate()
-                    process[i] = None
-                    thread_done[i] = True
-            all_data_collected = True
-            for thread in thread_done:
-                if not thread:
-                    all_data_collected = False
-            time.sleep(1)
-        if fail_flag:
-            log.error(fail_message)
+        try:
+            rejected_file_names = workQueue.runParallel(run_statistical_tests, [interactionFileList], args.threads,
+                                                        pKwargs=dict(pArgs=args), pName='chicDifferentialTest')
+        except workQueue.WorkQueueError as exp:
+            log.error(exp)
             exit(1)
     else:
         run_statistical_tests(interactionFileList, args)
 
     if args.batchMode:
         log.debug('rejected_file_names {}'.format(len(rejected_file_names)))
-        rejected_file_names = [item for sublist in rejected_file_names for item in sublist]
+        rejected_file_names = workQueue.flatten(rejected_file_names)
         log.debug('rejected_file_names II {}'.format(len(rejected_file_names)))
 
         with open(args.rejectedFileNamesToFile, 'w') as nameListFile:
@@ -3,8 +3,6 @@ import sys
 import os
 import errno
 import math
-from multiprocessing import Process, Queue
-import time
 import logging
 log = logging.getLogger(__name__)
 
@@ -18,6 +16,7 @@ import hicmatrix.HiCMatrix as hm
 from hicexplorer import utilities
 from hicexplorer._version import __version__
 from .lib import Viewpoint
+from .lib import workQueue
 
 
 def parse_arguments(args=None):
@@ -57,7 +56,7 @@ In batch mode the list of file names and the folders containing the files need t
                            help='path to the background file which should be used for plotting',
                            required=False)
     parserOpt.add_argument('--interactionFileFolder', '-iff',
-                           help='Folder where the interaction files are stored. Applies only for batch mode'
+                           help='Folder or viewpoint store (see chicViewpoint) where the interaction files are stored. Applies only for batch mode'
                            ' (Default: %(default)s).',
                            required=False,
                            default='.')
@@ -66,12 +65,12 @@ In batch mode the list of file names and the folders containing the files need t
                            required=False,
                            nargs='+')
     parserOpt.add_argument('--significantInteractionFileFolder', '-siff',
-                           help='Folder where the files with detected significant interactions are stored. Applies only for batch mode'
+                           help='Folder or viewpoint store (see chicSignificantInteractions) where the files with detected significant interactions are stored. Applies only for batch mode'
                            ' (Default: %(default)s).',
                            required=False,
                            default='.')
     parserOpt.add_argument('--differentialTestResultsFolder', '-diff',
-                           help='Folder where the H0 rejected files are stored. Applies only for batch mode'
+                           help='Folder or viewpoint store (see chicDifferentialTest) where the H0 rejected files are stored. Applies only for batch mode'
                            ' (Default: %(default)s).',
                            required=False,
                            default='.')
@@ -173,171 +172,163 @@ In batch mode the list of file names and the folders containing the files need t
     return parser
 
 
-def plot_images(pInteractionFileList, pHighlightDifferentialRegionsFileList, pBackgroundData, pArgs, pViewpointObj, pSignificantRegionsFileList, pQueue=None):
-    try:
-        for j, interactionFile in enumerate(pInteractionFileList):
-            number_of_rows_plot = len(interactionFile)
-            matplotlib.rcParams.update({'font.size': 9})
-            fig = plt.figure(figsize=(9.4, 4.8))
+def plot_images(pInteractionFileList, pHighlightDifferentialRegionsFileList, pSignificantRegionsFileList, pBackgroundData, pArgs, pViewpointObj):
+    for j, interactionFile in enumerate(pInteractionFileList):
+        number_of_rows_plot = len(interactionFile)
+        matplotlib.rcParams.update({'font.size': 9})
+        fig = plt.figure(figsize=(9.4, 4.8))
+
+        z_score_heights = [0.07] * number_of_rows_plot
+        viewpoint_height_ratio = 0.95 - (0.07 * number_of_rows_plot)
+        if viewpoint_height_ratio < 0.4:
+            viewpoint_height_ratio = 0.4
+            _ratio = 0.6 / number_of_rows_plot
+            z_score_heights = [_ratio] * number_of_rows_plot
+
+        if pArgs.pValue:
+            gs = gridspec.GridSpec(1 + len(interactionFile), 2, height_ratios=[0.95 - (0.07 * number_of_rows_plot), *z_score_heights], width_ratios=[0.75, 0.25])
+            gs.update(hspace=0.5, wspace=0.05)
+            ax1 = plt.subplot(gs[0, 0])
+            ax1.margins(x=0)
+        else:
+            ax1 = plt.gca()
+        colors = pArgs.colorList
+        background_plot = True
+        data_plot_label = None
+        gene = ''
+        for i, interactionFile_ in enumerate(interactionFile):
+            if pArgs.interactionFileFolder != '.':
+                absolute_path_interactionFile_ = pArgs.interactionFileFolder + '/' + interactionFile_
+            else:
+                absolute_path_interactionFile_ = interactionFile_
 
-            z_score_heights = [0.07] * number_of_rows_plot
-            viewpoint_height_ratio = 0.95 - (0.07 * number_of_rows_plot)
-            if viewpoint_height_ratio < 0.4:
-                viewpoint_height_ratio = 0.4
-                _ratio = 0.6 / number_of_rows_plot
-                z_score_heights = [_ratio] * number_of_rows_plot
+            header, data, background_data_plot, p_values, viewpoint_index_start, viewpoint_index_end = pViewpointObj.getDataForPlotting(absolute_path_interactionFile_, pArgs.range, pBackgroundData, pArgs.binResolution)
+            # log.debug('data {}'.format(data))
+            if len(data) <= 1 or len(p_values) <= 1:
+                log.warning('Only one data point in given range, no plot is created! Interaction file {} Range {}'.format(interactionFile_, pArgs.range))
+                continue
+            matrix_name, viewpoint, upstream_range, downstream_range, gene, _ = header.strip().split('\t')
+            log.debug('Matrix_name {}'.format(matrix_name))
+            matrix_name = os.path.basename(matrix_name)
+
+            matrix_name = matrix_name.split('.')[0]
+            log.debug('matrix_name {}'.format(matrix_name))
+            # number_of_data_points = len(data)
+            highlight_differential_regions = None
+            significant_p_values = None
+            significant_regions = None
+            if pArgs.differentialTestResult:
+                if pArgs.differentialTestResultsFolder != '.':
+                    differentialFilePath = pArgs.differentialTestResultsFolder + '/' + pHighlightDifferentialRegionsFileList[j]
+                else:
+                    differentialFilePath = pHighlightDifferentialRegionsFileList[j]
 
-            if pArgs.pValue:
-                gs = gridspec.GridSpec(1 + len(interactionFile), 2, height_ratios=[0.95 - (0.07 * number_of_rows_plot), *z_score_heights], width_ratios=[0.75, 0.25])
-                gs.update(hspace=0.5, wspace=0.05)
-                ax1 = plt.subplot(gs[0, 0])
-                ax1.margins(x=0)
-            else:
-                ax1 = plt.gca()
-            colors = pArgs.colorList
-            background_plot = True
-            data_plot_label = None
-            gene = ''
-            for i, interactionFile_ in enumerate(interactionFile):
-                if pArgs.interactionFileFolder != '.':
-                    absolute_path_interactionFile_ = pArgs.interactionFileFolder + '/' + interactionFile_
+                highlight_differential_regions = pViewpointObj.readRejectedFile(differentialFilePath, viewpoint_index_start, viewpoint_index_end, pArgs.binResolution, pArgs.range, viewpoint)
+            if pArgs.significantInteractions:
+                if pArgs.significantInteractionFileFolder != '.':
+                    significantInteractionsFilePath = pArgs.significantInteractionFileFolder + '/' + pSignificantRegionsFileList[j][i]
                 else:
-                    absolute_path_interactionFile_ = interactionFile_
-
-                header, data, background_data_plot, p_values, viewpoint_index_start, viewpoint_index_end = pViewpointObj.getDataForPlotting(absolute_path_interactionFile_, pArgs.range, pBackgroundData, pArgs.binResolution)
-                # log.debug('data {}'.format(data))
-                if len(data) <= 1 or len(p_values) <= 1:
-                    log.warning('Only one data point in given range, no plot is created! Interaction file {} Range {}'.format(interactionFile_, pArgs.range))
-                    continue
-                matrix_name, viewpoint, upstream_range, downstream_range, gene, _ = header.strip().split('\t')
-                log.debug('Matrix_name {}'.format(matrix_name))
-                matrix_name = os.path.basename(matrix_name)
-
-                matrix_name = matrix_name.split('.')[0]
-                log.debug('matrix_name {}'.format(matrix_name))
-                # number_of_data_points = len(data)
-                highlight_differential_regions = None
-                significant_p_values = None
+                    significantInteractionsFilePath = pSignificantRegionsFileList[j][i]
+                significant_regions, significant_p_values = pViewpointObj.readSignificantRegionsFile(significantInteractionsFilePath, viewpoint_index_start, viewpoint_index_end, pArgs.binResolution, pArgs.range, viewpoint)
+            if not pArgs.plotSignificantInteractions:
                 significant_regions = None
-                if pArgs.differentialTestResult:
-                    if pArgs.differentialTestResultsFolder != '.':
-                        differentialFilePath = pArgs.differentialTestResultsFolder + '/' + pHighlightDifferentialRegionsFileList[j]
-                    else:
-                        differentialFilePath = pHighlightDifferentialRegionsFileList[j]
-
-                    highlight_differential_regions = pViewpointObj.readRejectedFile(differentialFilePath, viewpoint_index_start, viewpoint_index_end, pArgs.binResolution, pArgs.range, viewpoint)
-                if pArgs.significantInteractions:
-                    if pArgs.significantInteractionFileFolder != '.':
-                        significantInteractionsFilePath = pArgs.significantInteractionFileFolder + '/' + pSignificantRegionsFileList[j][i]
-                    else:
-                        significantInteractionsFilePath = pSignificantRegionsFileList[j][i]
-                    significant_regions, significant_p_values = pViewpointObj.readSignificantRegionsFile(significantInteractionsFilePath, viewpoint_index_start, viewpoint_index_end, pArgs.binResolution, pArgs.range, viewpoint)
-                if not pArgs.plotSignificantInteractions:
-                    significant_regions = None
-                if data_plot_label:
-                    data_plot_label += pViewpointObj.plotViewpoint(pAxis=ax1, pData=data, pColor=colors[i % len(colors)], pLabelName=gene + ': ' + matrix_name, pHighlightRegion=highlight_differential_regions, pHighlightSignificantRegion=significant_regions)
-                else:
-                    data_plot_label = pViewpointObj.plotViewpoint(pAxis=ax1, pData=data, pColor=colors[i % len(colors)], pLabelName=gene + ': ' + matrix_name, pHighlightRegion=highlight_differential_regions, pHighlightSignificantRegion=significant_regions)
-
-                if background_plot:
-                    # log.debug('background_data_plot {}'.format(len(background_data_plot)))
-                    if background_data_plot is not None:
-                        data_plot_label += pViewpointObj.plotBackgroundModel(pAxis=ax1, pBackgroundData=background_data_plot, pXFold=pArgs.xFold)
-                    background_plot = False
-                if pArgs.truncateZeroPvalues:
-                    p_values = np.array(p_values, dtype=np.float32)
-                    mask = p_values == 0.0
-                    p_values[mask] = 1.0
-                if pArgs.minPValue is not None or pArgs.maxPValue is not None:
-
-                    p_values = np.array(p_values, dtype=np.float32)
-                    if significant_p_values:
-                        for location in significant_p_values:
-                            for x in range(location[0], location[1]):
-                                if x < len(p_values):
-                                    p_values[x] = location[2]
-                    p_values.clip(pArgs.minPValue, pArgs.maxPValue, p_values)
-
-                if pArgs.pValue:
-                    pViewpointObj.plotPValue(pAxis=plt.subplot(gs[1 + i, 0]), pAxisLabel=plt.subplot(gs[1 + i, 1]), pPValueData=p_values,
-                                             pLabelText=gene + ': ' + matrix_name, pCmap=pArgs.colorMapPvalue,
-                                             pFigure=fig, pValueSignificanceLevels=pArgs.pValueSignificanceLevels)
-
-            if data_plot_label is not None:
-
-                ticks = []
-                x_labels = []
-
-                if pArgs.range[0] + pArgs.range[1] <= 2e6:
-                    divisor_legend = 1e3
-                    mod_legend = 2e5
-
-                    if pArgs.range[0] + pArgs.range[1] <= 1e4:
-                        mod_legend = 5e3
-                    elif pArgs.range[0] + pArgs.range[1] <= 5e4:
-                        mod_legend = 1e4
-                    elif pArgs.range[0] + pArgs.range[1] <= 1e5:
-                        mod_legend = 5e4
-                    elif pArgs.range[0] + pArgs.range[1] <= 5e5:
-                        mod_legend = 1e5
-                    log.debug('divisor_legend {}'.format(divisor_legend))
-
-                    unit = 'kb'
-                elif pArgs.range[0] + pArgs.range[1] > 2e6:
-                    divisor_legend = 1e6
-                    mod_legend = 1e6
-                    unit = 'Mb'
-
-                for k, j in zip(range((pArgs.range[0])), range(pArgs.range[0], 1, -1)):
-                    if j % mod_legend == 0:
-                        x_labels.append(str(-int(j) // int(divisor_legend)) + unit)
-                        ticks.append(k // pArgs.binResolution)
-                x_labels.append('RP')
-                ticks.append(pArgs.range[0] // pArgs.binResolution)
-
-                referencepoint_index = ticks[-1]
-                for k, j in zip(range(pArgs.range[1]), range(1, pArgs.range[1] + 1, 1)):
-                    if j % mod_legend == 0:
-                        x_labels.append(str(int(j) // int(divisor_legend)) + unit)
-                        ticks.append(referencepoint_index + (k // pArgs.binResolution))
-
-                # log.debug('labels: {}'.format(x_labels))
-                ax1.set_ylabel('Number of interactions')
-                ax1.set_xticks(ticks)
-                ax1.set_xticklabels(x_labels)
-
-                # multiple legends in one figure
-                data_legend = [label.get_label() for label in data_plot_label]
-                ax1.legend(data_plot_label, data_legend, loc=0)
-
-                sample_prefix = ""
-                if pArgs.outFileName:
-                    if pArgs.outputFolder != '.':
-                        outFileName = pArgs.outputFolder + '/' + pArgs.outFileName
-                    else:
-                        outFileName = pArgs.outFileName
+            if data_plot_label:
+                data_plot_label += pViewpointObj.plotViewpoint(pAxis=ax1, pData=data, pColor=colors[i % len(colors)], pLabelName=gene + ': ' + matrix_name, pHighlightRegion=highlight_differential_regions, pHighlightSignificantRegion=significant_regions)
+            else:
+                data_plot_label = pViewpointObj.plotViewpoint(pAxis=ax1, pData=data, pColor=colors[i % len(colors)], pLabelName=gene + ': ' + matrix_name, pHighlightRegion=highlight_differential_regions, pHighlightSignificantRegion=significant_regions)
+
+            if background_plot:
+                # log.debug('background_data_plot {}'.format(len(background_data_plot)))
+                if background_data_plot is not None:
+                    data_plot_label += pViewpointObj.plotBackgroundModel(pAxis=ax1, pBackgroundData=background_data_plot, pXFold=pArgs.xFold)
+                background_plot = False
+            if pArgs.truncateZeroPvalues:
+                p_values = np.array(p_values, dtype=np.float32)
+                mask = p_values == 0.0
+                p_values[mask] = 1.0
+            if pArgs.minPValue is not None or pArgs.maxPValue is not None:
+
+                p_values = np.array(p_values, dtype=np.float32)
+                if significant_p_values:
+                    for location in significant_p_values:
+                        for x in range(location[0], location[1]):
+                            if x < len(p_values):
+                                p_values[x] = location[2]
+                p_values.clip(pArgs.minPValue, pArgs.maxPValue, p_values)
 
+            if pArgs.pValue:
+                pViewpointObj.plotPValue(pAxis=plt.subplot(gs[1 + i, 0]), pAxisLabel=plt.subplot(gs[1 + i, 1]), pPValueData=p_values,
+                                         pLabelText=gene + ': ' + matrix_name, pCmap=pArgs.colorMapPvalue,
+                                         pFigure=fig, pValueSignificanceLevels=pArgs.pValueSignificanceLevels)
+
+        if data_plot_label is not None:
+
+            ticks = []
+            x_labels = []
+
+            if pArgs.range[0] + pArgs.range[1] <= 2e6:
+                divisor_legend = 1e3
+                mod_legend = 2e5
+
+                if pArgs.range[0] + pArgs.range[1] <= 1e4:
+                    mod_legend = 5e3
+                elif pArgs.range[0] + pArgs.range[1] <= 5e4:
+                    mod_legend = 1e4
+                elif pArgs.range[0] + pArgs.range[1] <= 1e5:
+                    mod_legend = 5e4
+                elif pArgs.range[0] + pArgs.range[1] <= 5e5:
+                    mod_legend = 1e5
+                log.debug('divisor_legend {}'.format(divisor_legend))
+
+                unit = 'kb'
+            elif pArgs.range[0] + pArgs.range[1] > 2e6:
+                divisor_legend = 1e6
+                mod_legend = 1e6
+                unit = 'Mb'
+
+            for k, j in zip(range((pArgs.range[0])), range(pArgs.range[0], 1, -1)):
+                if j % mod_legend == 0:
+                    x_labels.append(str(-int(j) // int(divisor_legend)) + unit)
+                    ticks.append(k // pArgs.binResolution)
+            x_labels.append('RP')
+            ticks.append(pArgs.range[0] // pArgs.binResolution)
+
+            referencepoint_index = ticks[-1]
+            for k, j in zip(range(pArgs.range[1]), range(1, pArgs.range[1] + 1, 1)):
+                if j % mod_legend == 0:
+                    x_labels.append(str(int(j) // int(divisor_legend)) + unit)
+                    ticks.append(referencepoint_index + (k // pArgs.binResolution))
+
+            # log.debug('labels: {}'.format(x_labels))
+            ax1.set_ylabel('Number of interactions')
+            ax1.set_xticks(ticks)
+            ax1.set_xticklabels(x_labels)
+
+            # multiple legends in one figure
+            data_legend = [label.get_label() for label in data_plot_label]
+            ax1.legend(data_plot_label, data_legend, loc=0)
+
+            sample_prefix = ""
+            if pArgs.outFileName:
+                if pArgs.outputFolder != '.':
+                    outFileName = pArgs.outputFolder + '/' + pArgs.outFileName
                 else:
-                    for interactionFile_ in interactionFile:
-                        sample_prefix += interactionFile_.split('/')[-1].split('_')[0] + '_'
-                    if sample_prefix.endswith('_'):
-                        sample_prefix = sample_prefix[:-1]
-                    region_prefix = '_'.join(interactionFile[0].split('/')[-1].split('_')[1:4])
-                    outFileName = gene + '_' + sample_prefix + '_' + region_prefix
-                    if pArgs.outputFolder != '.':
-                        outFileName = pArgs.outputFolder + '/' + outFileName
-
-                if pArgs.outputFormat != outFileName.split('.')[-1]:
-                    outFileName = outFileName + '.' + pArgs.outputFormat
-                plt.savefig(outFileName, dpi=pArgs.dpi)
-            plt.close(fig)
-    except Exception as exp:
-        pQueue.put('Fail: ' + str(exp))
-        return
-    if pQueue is None:
-        return
-    pQueue.put('done')
-    return
+                    outFileName = pArgs.outFileName
+
+            else:
+                for interactionFile_ in interactionFile:
+                    sample_prefix += interactionFile_.split('/')[-1].split('_')[0] + '_'
+                if sample_prefix.endswith('_'):
+                    sample_prefix = sample_prefix[:-1]
+                region_prefix = '_'.join(interactionFile[0].split('/')[-1].split('_')[1:4])
+                outFileName = gene + '_' + sample_prefix + '_' + region_prefix
+                if pArgs.outputFolder != '.':
+                    outFileName = pArgs.outputFolder + '/' + outFileName
+
+            if pArgs.outputFormat != outFileName.split('.')[-1]:
+                outFileName = outFileName + '.' + pArgs.outputFormat
+            plt.savefig(outFileName, dpi=pArgs.dpi)
+        plt.close(fig)
 
 
 def main(args=None):
@@ -403,59 +394,14 @@ def main(args=None):
                             lines.append(file_)
                     if len(lines) > 0:
                         highlightSignificantRegionsFileList.append(lines)
-        interactionFilesPerThread = len(interactionFileList) // args.threads
-        highlightSignificantRegionsFileListThread = len(highlightSignificantRegionsFileList) // args.threads
-
-        all_data_collected = False
-        queue = [None] * args.threads
-        process = [None] * args.threads
-        thread_done = [False] * args.threads
-        fail_flag = False
-        fail_message = ''
-
-        for i in range(args.threads):
-
-            if i < args.threads - 1:
-                interactionFileListThread = interactionFileList[i * interactionFilesPerThread:(i + 1) * interactionFilesPerThread]
-                highlightDifferentialRegionsFileListThread = highlightDifferentialRegionsFileList[i * interactionFilesPerThread:(i + 1) * interactionFilesPerThread]
-                highlightSignificantRegionsFileListThread = highlightSignificantRegionsFileList[i * interactionFilesPerThread:(i + 1) * interactionFilesPerThread]
-            else:
-                interactionFileListThread = interactionFileList[i * interactionFilesPerThread:]
-                highlightDifferentialRegionsFileListThread = highlightDifferentialRegionsFileList[i * interactionFilesPerThread:]
-                highlightSignificantRegionsFileListThread = highlightSignificantRegionsFileList[i * interactionFilesPerThread:]
-            queue[i] = Queue()
-            process[i] = Process(target=plot_images, kwargs=dict(
-                pInteractionFileList=interactionFileListThread,
-                pHighlightDifferentialRegionsFileList=highlightDifferentialRegionsFileListThread,
-                pBackgroundData=background_data,
-                pArgs=args,
-                pViewpointObj=viewpointObj,
-                pSignificantRegionsFileList=highlightSignificantRegionsFileListThread,
-                pQueue=queue[i]
-            )
-            )
-
-            process[i].start()
-
-        while not all_data_collected:
-            for i in range(args.threads):
-                if queue[i] is not None and not queue[i].empty():
-                    return_content = queue[i].get()
-                    if 'Fail:' in return_content:
-                        fail_flag = True
-                        fail_message = return_content[6:]
-                    queue[i] = None
-                    process[i].join()
-                    process[i].terminate()
-                    process[i] = None
-                    thread_done[i] = True
-            all_data_collected = True
-            for thread in thread_done:
-                if not thread:
-                    all_data_collected = False
-            time.sleep(1)
-        if fail_flag:
-            log.error(fail_message)
+        try:
+            workQueue.runParallel(plot_images, [interactionFileList, highlightDifferentialRegionsFileList, highlightSignificantRegionsFileList],
+                                  args.threads, pKwargs=dict(pBackgroundData=background_data,
+                                                             pArgs=args,
+                                                             pViewpointObj=viewpointObj),
+                                  pName='chicPlotViewpoint')
+        except workQueue.WorkQueueError as exp:
+            log.error(exp)
             exit(1)
     else:
         interactionFileList = [args.interactionFile]
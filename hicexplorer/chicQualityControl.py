@@ -1,7 +1,5 @@
 import argparse
 import math
-from multiprocessing import Process, Queue
-import time
 import os
 import logging
 logging.getLogger('hicmatrix').setLevel(logging.CRITICAL)
@@ -15,6 +13,7 @@ import matplotlib.pyplot as plt
 from hicmatrix import HiCMatrix as hm
 from hicexplorer._version import __version__
 from .lib import Viewpoint
+from .lib import workQueue
 
 
 def parse_arguments(args=None):
@@ -94,33 +93,27 @@ $ chicQualityControl -m matrix1.h5 matrix2.h5 -rp referencePointsFile.bed --rang
     return parser
 
 
-def compute_sparsity(pReferencePoints, pViewpointObj, pArgs, pQueue):
+def compute_sparsity(pReferencePoints, pViewpointObj, pArgs):
 
     sparsity_list = []
-    try:
-        chromosome_names = pViewpointObj.hicMatrix.getChrNames()
+    chromosome_names = pViewpointObj.hicMatrix.getChrNames()
 
-        for i, referencePoint in enumerate(pReferencePoints):
+    for i, referencePoint in enumerate(pReferencePoints):
 
-            if referencePoint is not None and referencePoint[0] in chromosome_names:
+        if referencePoint is not None and referencePoint[0] in chromosome_names:
 
-                region_start, region_end, _ = pViewpointObj.calculateViewpointRange(
-                    referencePoint, (pArgs.fixateRange, pArgs.fixateRange))
-                try:
-                    data_list, _ = pViewpointObj.computeViewpoint(
-                        referencePoint, referencePoint[0], region_start, region_end)
-                    sparsity = (np.count_nonzero(data_list) / len(data_list))
-                except (TypeError, IndexError):
-                    sparsity = -1.0
-                sparsity_list.append(sparsity)
-            else:
-                sparsity_list.append(-1.0)
-    except Exception as exp:
-        pQueue.put('Fail: ' + str(exp))
-        return
-
-    pQueue.put(sparsity_list)
-    return
+            region_start, region_end, _ = pViewpointObj.calculateViewpointRange(
+                referencePoint, (pArgs.fixateRange, pArgs.fixateRange))
+            try:
+                data_list, _ = pViewpointObj.computeViewpoint(
+                    referencePoint, referencePoint[0], region_start, region_end)
+                sparsity = (np.count_nonzero(data_list) / len(data_list))
+            except (TypeError, IndexError):
+                sparsity = -1.0
+            sparsity_list.append(sparsity)
+        else:
+            sparsity_list.append(-1.0)
+    return sparsity_list
 
 
 def main(args=None):
@@ -132,71 +125,24 @@ def main(args=None):
 
     # compute for each viewpoint the sparsity and consider these as bad with a sparsity less than given.
 
-    referencePointsPerThread = len(referencePoints) // args.threads
-    queue = [None] * args.threads
-    process = [None] * args.threads
     sparsity = []
-    fail_flag = False
-    fail_message = ''
-    for j, matrix in enumerate(args.matrices):
-        sparsity_local = [None] * args.threads
+    for matrix in args.matrices:
         hic_ma = hm.hiCMatrix(matrix)
         viewpointObj.hicMatrix = hic_ma
 
-        all_data_collected = False
-        thread_done = [False] * args.threads
-        for i in range(args.threads):
-
-            if i < args.threads - 1:
-                referencePointsThread = referencePoints[i * referencePointsPerThread:(i + 1) * referencePointsPerThread]
-            else:
-                referencePointsThread = referencePoints[i * referencePointsPerThread:]
-            if len(referencePointsThread) == 0:
-                process[i] = None
-                queue[i] = None
-                sparsity_local[i] = []
-                continue
-            else:
-                queue[i] = Queue()
-                process[i] = Process(target=compute_sparsity, kwargs=dict(
-                    pReferencePoints=referencePointsThread,
+        try:
+            sparsity_local = workQueue.flatten(workQueue.runParallel(
+                compute_sparsity, [referencePoints], args.threads, pKwargs=dict(
                     pViewpointObj=viewpointObj,
-                    pArgs=args,
-                    pQueue=queue[i]
-                )
-                )
-
-                process[i].start()
-                log.debug('process started {}'.format(i))
-
-        while not all_data_collected:
-            for i in range(args.threads):
-                if queue[i] is not None and not queue[i].empty():
-                    sparsity_ = queue[i].get()
-                    if 'Fail:' in sparsity_:
-                        fail_flag = True
-                        fail_message = sparsity_[6:]
-                    log.debug('process computed: {}'.format(i))
-                    sparsity_local[i] = sparsity_
-                    queue[i] = None
-                    process[i].join()
-                    process[i].terminate()
-                    process[i] = None
-                    thread_done[i] = True
-            all_data_collected = True
-            for thread in thread_done:
-                if not thread:
-                    all_data_collected = False
-            time.sleep(1)
+                    pArgs=args
+                ), pName='chicQualityControl {}'.format(matrix)))
+        except workQueue.WorkQueueError as exp:
+            log.error(exp)
+            exit(1)
 
         del hic_ma
         del viewpointObj.hicMatrix
 
-        # merge sparsity data per matrix from each thread to one list
-        if fail_flag:
-            log.error(fail_message)
-            exit(1)
-        sparsity_local = [item for sublist in sparsity_local for item in sublist]
         sparsity.append(sparsity_local)
 
     # sparsity = np.array(sparsity)
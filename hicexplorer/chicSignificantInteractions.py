@@ -1,10 +1,6 @@
 import argparse
 import sys
-import os
-import errno
 import math
-from multiprocessing import Process, Queue
-import time
 import logging
 log = logging.getLogger(__name__)
 
@@ -15,6 +11,8 @@ import hicmatrix.HiCMatrix as hm
 from hicexplorer import utilities
 from hicexplorer._version import __version__
 from .lib import Viewpoint
+from .lib import viewpointStore
+from .lib import workQueue
 from hicexplorer.lib import cnb
 
 
@@ -85,17 +83,17 @@ This file is created by `chicViewpoint` and the parameter `--writeFileNamesToFil
                            default='_significant_interactions.txt')
 
     parserOpt.add_argument('--interactionFileFolder', '-iff',
-                           help='Folder where the interaction files are stored. Applies only for batch mode'
+                           help='Folder or viewpoint store (see chicViewpoint) where the interaction files are stored. Applies only for batch mode'
                            ' (Default: %(default)s).',
                            required=False,
                            default='.')
     parserOpt.add_argument('--targetFolder', '-tf',
-                           help='Folder where the target files are stored'
+                           help='Folder where the target files are stored. If the name ends with \'.hdf5\' or \'.h5\', they are stored in a single HDF5 file instead'
                            ' (Default: %(default)s).',
                            required=False,
                            default='targetFolder')
     parserOpt.add_argument('--outputFolder', '-o',
-                           help='Output folder of the significant interaction files'
+                           help='Output folder of the significant interaction files. If the name ends with \'.hdf5\' or \'.h5\', they are stored in a single HDF5 file instead'
                            ' (Default: %(default)s).',
                            required=False,
                            default='significantFiles')
@@ -166,104 +164,91 @@ This file is created by `chicViewpoint` and the parameter `--writeFileNamesToFil
     return parser
 
 
-def compute_interaction_file(pInteractionFilesList, pArgs, pViewpointObj, pBackground, pQueue=None):
+def compute_interaction_file(pInteractionFilesList, pArgs, pViewpointObj, pBackground):
     outfile_names = []
     target_outfile_names = []
-    try:
-        for interactionFile in pInteractionFilesList:
-            target_list = []
-            sample_prefix = ''
-            for sample in interactionFile:
-                # header,
-                # interaction_data:rel interaction, p-value, raw, x-fold::{-1000:[0.1, 0.01, 2.3, 5]},
-                if pArgs.interactionFileFolder != '.':
-                    absolute_sample_path = pArgs.interactionFileFolder + '/' + sample
-                else:
-                    absolute_sample_path = sample
-                data = pViewpointObj.readInteractionFileForAggregateStatistics(absolute_sample_path)
-                sample_prefix += sample.split('/')[-1].split('_')[0]
-                sample_prefix += '_'
-                # filter by x-fold over background value or loose p-value
-                # and merge neighbors. Use center position to compute new p-value.
-                if pArgs.xFoldBackground is not None:
-                    accepted_scores, merged_lines_dict = merge_neighbors_x_fold(
-                        pArgs.xFoldBackground, data, pViewpointObj, pResolution=pArgs.resolution)
-                else:
-                    accepted_scores, merged_lines_dict = merge_neighbors_loose_p_value(
-                        pArgs.loosePValue, data, pViewpointObj, pResolution=pArgs.resolution, pTruncateZeroPvalues=pArgs.truncateZeroPvalues)
-
-                # compute new p-values and filter by them
-                accepted_scores, target_lines = compute_new_p_values(
-                    accepted_scores, pBackground, pArgs.pValue, merged_lines_dict, pArgs.peakInteractionsThreshold, pViewpointObj)
-
-                # filter by new p-value
-                if len(accepted_scores) == 0:
-                    if pArgs.batchMode:
-                        with open('errorLog.txt', 'a+') as errorlog:
-                            errorlog.write('Failed for: {} and {}.\n'.format(
-                                interactionFile[0], interactionFile[1]))
-                    else:
-                        log.info('No target regions found')
-                outFileName = '.'.join(sample.split(
-                    '/')[-1].split('.')[:-1]) + '_' + pArgs.outFileNameSuffix
+    for interactionFile in pInteractionFilesList:
+        target_list = []
+        sample_prefix = ''
+        for sample in interactionFile:
+            # header,
+            # interaction_data:rel interaction, p-value, raw, x-fold::{-1000:[0.1, 0.01, 2.3, 5]},
+            if pArgs.interactionFileFolder != '.':
+                absolute_sample_path = pArgs.interactionFileFolder + '/' + sample
+            else:
+                absolute_sample_path = sample
+            data = pViewpointObj.readInteractionFileForAggregateStatistics(absolute_sample_path)
+            sample_prefix += sample.split('/')[-1].split('_')[0]
+            sample_prefix += '_'
+            # filter by x-fold over background value or loose p-value
+            # and merge neighbors. Use center position to compute new p-value.
+            if pArgs.xFoldBackground is not None:
+                accepted_scores, merged_lines_dict = merge_neighbors_x_fold(
+                    pArgs.xFoldBackground, data, pViewpointObj, pResolution=pArgs.resolution)
+            else:
+                accepted_scores, merged_lines_dict = merge_neighbors_loose_p_value(
+                    pArgs.loosePValue, data, pViewpointObj, pResolution=pArgs.resolution, pTruncateZeroPvalues=pArgs.truncateZeroPvalues)
+
+            # compute new p-values and filter by them
+            accepted_scores, target_lines = compute_new_p_values(
+                accepted_scores, pBackground, pArgs.pValue, merged_lines_dict, pArgs.peakInteractionsThreshold, pViewpointObj)
+
+            # filter by new p-value
+            if len(accepted_scores) == 0:
                 if pArgs.batchMode:
-                    outfile_names.append(outFileName)
-                outFileName = pArgs.outputFolder + '/' + outFileName
-                # write only significant lines to file
-                write(outFileName, data[0], accepted_scores)
-                target_list.append(target_lines)
-
-            target_list = [item for sublist in target_list for item in sublist]
-            log.debug('interactionFile {}'.format(interactionFile))
-            sample_name = '_'.join(interactionFile[0].split('/')[-1].split('.')[0].split('_')[1:])
-            target_name = sample_prefix + sample_name + '_target.txt'
-            target_outfile_names.append(target_name)
-            target_name = pArgs.targetFolder + '/' + target_name
-            writeTargetList(target_list, target_name, pArgs)
-        if pQueue is None:
-            return target_outfile_names
-    except Exception as exp:
-        if pQueue is None:
-            return 'Fail: ' + str(exp)
-        pQueue.put('Fail: ' + str(exp))
-        return
-    pQueue.put([outfile_names, target_outfile_names])
-    return
+                    with open('errorLog.txt', 'a+') as errorlog:
+                        errorlog.write('Failed for: {} and {}.\n'.format(
+                            interactionFile[0], interactionFile[1]))
+                else:
+                    log.info('No target regions found')
+            outFileName = '.'.join(sample.split(
+                '/')[-1].split('.')[:-1]) + '_' + pArgs.outFileNameSuffix
+            if pArgs.batchMode:
+                outfile_names.append(outFileName)
+            outFileName = pArgs.outputFolder + '/' + outFileName
+            # write only significant lines to file
+            write(outFileName, data[0], accepted_scores)
+            target_list.append(target_lines)
+
+        target_list = [item for sublist in target_list for item in sublist]
+        log.debug('interactionFile {}'.format(interactionFile))
+        sample_name = '_'.join(interactionFile[0].split('/')[-1].split('.')[0].split('_')[1:])
+        target_name = sample_prefix + sample_name + '_target.txt'
+        target_outfile_names.append(target_name)
+        target_name = pArgs.targetFolder + '/' + target_name
+        writeTargetList(target_list, target_name, pArgs)
+    viewpointStore.flush()
+    return outfile_names, target_outfile_names
 
 
 def compute_new_p_values(pData, pBackgroundModel, pPValue, pMergedLinesDict, pPeakInteractionsThreshold, pViewpointObj):
     accepted = {}
     accepted_lines = []
-    if isinstance(pPValue, float):
-        for key in pData:
-            if key in pBackgroundModel:
-                log.debug('Recompute p-values. Old: {}'.format(pData[key][-3]))
-                pData[key][-3] = 1 - cnb.cdf(float(pData[key][-1]), float(pBackgroundModel[key][0]), float(pBackgroundModel[key][1]))
-                log.debug('new {}\n\n'.format(pData[key][-3]))
-                if pData[key][-3] <= pPValue:
-                    if float(pData[key][-1]) >= pPeakInteractionsThreshold:
-                        accepted[key] = pData[key]
-                        target_content = pMergedLinesDict[key][0][:3]
-                        target_content[2] = pMergedLinesDict[key][-1][2]
-                        accepted_lines.append(target_content)
-            else:
-                log.debug('key not in background')
-    elif isinstance(pPValue, dict):
-        for key in pData:
-            if key in pBackgroundModel:
-                log.debug('Recompute p-values. Old: {}'.format(pData[key][-3]))
-
-                pData[key][-3] = 1 - cnb.cdf(float(pData[key][-1]), float(pBackgroundModel[key][0]), float(pBackgroundModel[key][1]))
-                log.debug('new {}\n\n'.format(pData[key][-3]))
-
-                if pData[key][-3] <= pPValue[key]:
-                    if float(pData[key][-1]) >= pPeakInteractionsThreshold:
-                        accepted[key] = pData[key]
-                        target_content = pMergedLinesDict[key][0][:3]
-                        target_content[2] = pMergedLinesDict[key][-1][2]
-                        accepted_lines.append(target_content)
-            else:
-                log.debug('key not in background')
+    if not isinstance(pPValue, (float, dict)):
+        return accepted, accepted_lines
+    keys = [key for key in pData if key in pBackgroundModel]
+    if len(keys) < len(pData):
+        log.debug('key not in background')
+
+    # recompute the p-values of all merged regions with one call
+    data = np.array([float(pData[key][-1]) for key in keys])
+    parameters = np.array([pBackgroundModel[key][:2] for key in keys], dtype=np.float64).reshape(-1, 2)
+    p_values = 1 - cnb.cdf(data, parameters[:, 0], parameters[:, 1])
+
+    for key, p_value in zip(keys, p_values):
+        log.debug('Recompute p-values. Old: {}'.format(pData[key][-3]))
+        pData[key][-3] = p_value
+        log.debug('new {}\n\n'.format(pData[key][-3]))
+        if isinstance(pPValue, float):
+            p_value_threshold = pPValue
+        else:
+            p_value_threshold = pPValue[key]
+        if pData[key][-3] <= p_value_threshold:
+            if float(pData[key][-1]) >= pPeakInteractionsThreshold:
+                accepted[key] = pData[key]
+                target_content = pMergedLinesDict[key][0][:3]
+                target_content[2] = pMergedLinesDict[key][-1][2]
+                accepted_lines.append(target_content)
     return accepted, accepted_lines
 
 
@@ -319,7 +304,7 @@ def merge_neighbors_loose_p_value(pLoosePValue, pData, pViewpointObj, pResolutio
 def write(pOutFileName, pHeader, pInteractionLines):
 
     # sum_of_interactions = float(pHeader.split('\t')[-1].split(' ')[-1])
-    with open(pOutFileName, 'w') as file:
+    with viewpointStore.openFile(pOutFileName, 'w') as file:
         file.write(pHeader)
         file.write(
             '#Chromosome\tStart\tEnd\tGene\tSum of interactions\tRelative position\tRelative interactions\tp-value\tx-fold\tRaw target')
@@ -334,62 +319,18 @@ def write(pOutFileName, pHeader, pInteractionLines):
 
 
 def call_multi_core(pInteractionFilesList, pArgs, pViewpointObj, pBackground):
-    outfile_names = [None] * pArgs.threads
-    target_list_name = [None] * pArgs.threads
-    interactionFilesPerThread = len(pInteractionFilesList) // pArgs.threads
-    all_data_collected = False
-    queue = [None] * pArgs.threads
-    process = [None] * pArgs.threads
-    thread_done = [False] * pArgs.threads
-
-    fail_flag = False
-    fail_message = ''
-
-    for i in range(pArgs.threads):
-
-        if i < pArgs.threads - 1:
-            interactionFileListThread = pInteractionFilesList[i * interactionFilesPerThread:(i + 1) * interactionFilesPerThread]
-        else:
-            interactionFileListThread = pInteractionFilesList[i * interactionFilesPerThread:]
-
-        queue[i] = Queue()
-        process[i] = Process(target=compute_interaction_file, kwargs=dict(
-            pInteractionFilesList=interactionFileListThread,
+    try:
+        results = workQueue.runParallel(compute_interaction_file, [pInteractionFilesList], pArgs.threads, pKwargs=dict(
             pArgs=pArgs,
             pViewpointObj=pViewpointObj,
-            pBackground=pBackground,
-            pQueue=queue[i]
-        )
-        )
-
-        process[i].start()
-
-    while not all_data_collected:
-        for i in range(pArgs.threads):
-            if queue[i] is not None and not queue[i].empty():
-                background_data_thread = queue[i].get()
-                if 'Fail:' in background_data_thread:
-                    fail_flag = True
-                    fail_message = background_data_thread[6:]
-                else:
-                    outfile_names[i], target_list_name[i] = background_data_thread
-                queue[i] = None
-                process[i].join()
-                process[i].terminate()
-                process[i] = None
-                thread_done[i] = True
-        all_data_collected = True
-        for thread in thread_done:
-            if not thread:
-                all_data_collected = False
-        time.sleep(1)
-    if fail_flag:
-        log.error(fail_message)
+            pBackground=pBackground
+        ), pName='chicSignificantInteractions')
+    except workQueue.WorkQueueError as exp:
+        log.error(exp)
         exit(1)
 
-    outfile_names = [item for sublist in outfile_names for item in sublist]
-    target_list_name = [
-        item for sublist in target_list_name for item in sublist]
+    outfile_names = workQueue.flatten([result[0] for result in results])
+    target_list_name = workQueue.flatten([result[1] for result in results])
 
     return outfile_names, target_list_name
 
@@ -421,8 +362,12 @@ def writeTargetList(pTargetList, pOutFileName, pArgs):
     header += str(pArgs.pValue)
     header += '\n#\n'
     if len(pTargetList) == 0:
-        with open(pOutFileName, 'w') as file:
+        with viewpointStore.openFile(pOutFileName, 'w') as file:
             file.write(header)
+    elif viewpointStore.isInStore(pOutFileName):
+        # same content as written by saveas
+        with viewpointStore.openFile(pOutFileName, 'w') as file:
+            file.write(header.strip() + '\n' + str(a.sort().merge(d=pArgs.resolution)))
     else:
         a.sort().merge(d=pArgs.resolution).saveas(pOutFileName, trackline=header)
 
@@ -448,18 +393,8 @@ def main(args=None):
     # args.p_value_dict = None
     # args.p_loose_value_dict = None
     # args.x_fold_dict = None
-    if not os.path.exists(args.outputFolder):
-        try:
-            os.makedirs(args.outputFolder)
-        except OSError as exc:  # Guard against race condition
-            if exc.errno != errno.EEXIST:
-                raise
-    if not os.path.exists(args.targetFolder):
-        try:
-            os.makedirs(args.targetFolder)
-        except OSError as exc:  # Guard against race condition
-            if exc.errno != errno.EEXIST:
-                raise
+    viewpointStore.createFolder(args.outputFolder)
+    viewpointStore.createFolder(args.targetFolder)
 
     if args.pValue:
         try:
@@ -509,10 +444,11 @@ def main(args=None):
                 i += 1
             interactionFileList.append(lines)
 
-        target_list_name = compute_interaction_file(
-            interactionFileList, args, viewpointObj, background_model)
-        if 'Fail: ' in target_list_name:
-            log.error(target_list_name[6:])
+        try:
+            compute_interaction_file(
+                interactionFileList, args, viewpointObj, background_model)
+        except Exception as exp:
+            log.error(str(exp))
 
     if args.batchMode:
         with open(args.writeFileNamesToFile, 'w') as nameListFile:
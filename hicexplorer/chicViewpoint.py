@@ -1,9 +1,5 @@
 import argparse
 import sys
-import os
-import errno
-from multiprocessing import Process, Queue
-import time
 import math
 import logging
 log = logging.getLogger(__name__)
@@ -13,6 +9,8 @@ import numpy as np
 import hicmatrix.HiCMatrix as hm
 from hicexplorer import utilities
 from .lib import Viewpoint
+from .lib import viewpointStore
+from .lib import workQueue
 from hicexplorer._version import __version__
 
 
@@ -90,7 +88,8 @@ $ chicViewpoint --matrices matrix1.cool matrix2.cool matrix3.cool --referencePoi
                            required=False,
                            action='store_true')
     parserOpt.add_argument('--outputFolder', '-o',
-                           help='This folder contains all created viewpoint files'
+                           help='This folder contains all created viewpoint files. If the name ends with \'.hdf5\' or \'.h5\', all viewpoint files are written '
+                           'to this single HDF5 file instead, which can be used as interaction file folder by the other chic* tools'
                            ' (Default: %(default)s).',
                            required=False,
                            default='interactionFiles')
@@ -134,90 +133,90 @@ def compute_x_fold(pDataList, pBackgroundList):
     return pDataList / pBackgroundList
 
 
-def compute_viewpoint(pViewpointObj, pArgs, pQueue, pReferencePoints, pGeneList, pMatrix, pBackgroundModel, pBackgroundModelRelativeInteractions, pOutputFolder):
+def compute_viewpoint(pReferencePoints, pGeneList, pViewpointObj, pArgs, pMatrix, pBackgroundModel, pBackgroundModelRelativeInteractions, pOutputFolder):
     file_list = []
 
-    try:
-        for i, referencePoint in enumerate(pReferencePoints):
-            # range of viewpoint with reference point in the middle in genomic units
-            # get fixateRange for relative interaction computation denominator
-            region_start_fixed, region_end_fixed, range_fixed = pViewpointObj.calculateViewpointRange(
-                referencePoint, (pArgs.fixateRange, pArgs.fixateRange))
-
-            intermediate_viewpoint, _ = pViewpointObj.computeViewpoint(
-                referencePoint, referencePoint[0], region_start_fixed, region_end_fixed)
-            denominator_relative_interactions = np.sum(intermediate_viewpoint)
-
-            # viewpoint data uses full range
-            region_start, region_end, _range = pViewpointObj.calculateViewpointRange(
-                referencePoint, pArgs.range)
-
-            data_list, index_reference_point = pViewpointObj.computeViewpoint(
-                referencePoint, referencePoint[0], region_start, region_end)
-
-            # background uses fixed range, handles fixate range implicitly by same range used in background computation
-
-            background_relative_interaction = pViewpointObj.interactionBackgroundData(
-                pBackgroundModelRelativeInteractions, _range).flatten()
-            data_list_relative = data_list
-            if len(data_list) != len(background_relative_interaction):
-                data_list, background_relative_interaction = adjustViewpointData(
-                    pViewpointObj, data_list_relative, background_relative_interaction, referencePoint, region_start, region_end)
-
-            if pArgs.averageContactBin > 0 and len(data_list) >= pArgs.averageContactBin:
-                data_list = pViewpointObj.smoothInteractionValues(
-                    data_list, pArgs.averageContactBin)
-
-            data_list_raw = np.copy(data_list)
-
-            data_list = pViewpointObj.computeRelativeValues(
-                data_list, denominator_relative_interactions)
-
-            x_fold_list = compute_x_fold(
-                data_list, background_relative_interaction)
-            p_value_list = pViewpointObj.pvalues(
-                pBackgroundModel, data_list_raw, index_reference_point)
-
-            # add values if range is larger than fixate range
-
-            region_start_range, region_end_range, _ = pViewpointObj.calculateViewpointRange(
-                referencePoint, (pArgs.range[0], pArgs.range[1]))
-
-            interaction_data = pViewpointObj.createInteractionFileData(referencePoint, referencePoint[0],
-                                                                       region_start_range, region_end_range, data_list, data_list_raw,
-                                                                       pGeneList[i], denominator_relative_interactions)
-
-            referencePointString = '_'.join(str(j) for j in referencePoint)
-
-            region_start_in_units = utilities.in_units(region_start)
-            region_end_in_units = utilities.in_units(region_end)
-            denominator_relative_interactions_str = 'Sum of interactions in fixate range: '
-            denominator_relative_interactions_str += str(
-                denominator_relative_interactions)
-            header_information = '# Interaction file, created with HiCExplorer\'s chicViewpoint version ' + \
-                __version__ + '\n# '
-            header_information += '\t'.join([pMatrix, referencePointString, str(region_start_in_units), str(
-                region_end_in_units), pGeneList[i], denominator_relative_interactions_str])
-            header_information += '\n# Chromosome\tStart\tEnd\tGene\tSum of interactions\tRelative position\tRelative Interactions\tp-value\tx-fold\tRaw\n#'
-            matrix_name = '.'.join(pMatrix.split('/')[-1].split('.')[:-1])
-            matrix_name = '_'.join(
-                [matrix_name, referencePointString, pGeneList[i]])
-            file_list.append(matrix_name + '.txt')
-
-            matrix_name = pOutputFolder + '/' + matrix_name
-            log.debug('type(p_value_list) {}'.format(type(p_value_list)))
-            log.debug('type(x_fold_list) {}'.format(type(x_fold_list)))
-            log.debug('p_value_list {}'.format(p_value_list))
-            log.debug('x_fold_list {}'.format(x_fold_list))
-
-            pViewpointObj.writeInteractionFile(
-                matrix_name, interaction_data, header_information, p_value_list, x_fold_list, pArgs.decimalPlaces)
-    except Exception as exp:
-        log.debug('Error! {}'.format(str(exp)))
-        pQueue.put('Fail: ' + str(exp))
-        return
-    pQueue.put(file_list)
-    return
+    # range of viewpoint with reference point in the middle in genomic units
+    # get fixateRange for relative interaction computation denominator
+    regions_fixed = [pViewpointObj.calculateViewpointRange(referencePoint, (pArgs.fixateRange, pArgs.fixateRange))
+                     for referencePoint in pReferencePoints]
+    # viewpoint data uses full range
+    regions = [pViewpointObj.calculateViewpointRange(referencePoint, pArgs.range)
+               for referencePoint in pReferencePoints]
+    chromosomes = [referencePoint[0] for referencePoint in pReferencePoints]
+
+    # the viewpoints of all reference points are computed together
+    intermediate_viewpoints, _ = pViewpointObj.computeViewpoints(
+        pReferencePoints, chromosomes, [region[0] for region in regions_fixed], [region[1] for region in regions_fixed])
+    data_lists, index_reference_points = pViewpointObj.computeViewpoints(
+        pReferencePoints, chromosomes, [region[0] for region in regions], [region[1] for region in regions])
+
+    for i, referencePoint in enumerate(pReferencePoints):
+        denominator_relative_interactions = np.sum(intermediate_viewpoints[i])
+
+        region_start, region_end, _range = regions[i]
+        data_list = data_lists[i]
+        index_reference_point = index_reference_points[i]
+
+        # background uses fixed range, handles fixate range implicitly by same range used in background computation
+
+        background_relative_interaction = pViewpointObj.interactionBackgroundData(
+            pBackgroundModelRelativeInteractions, _range).flatten()
+        data_list_relative = data_list
+        if len(data_list) != len(background_relative_interaction):
+            data_list, background_relative_interaction = adjustViewpointData(
+                pViewpointObj, data_list_relative, background_relative_interaction, referencePoint, region_start, region_end)
+
+        if pArgs.averageContactBin > 0 and len(data_list) >= pArgs.averageContactBin:
+            data_list = pViewpointObj.smoothInteractionValues(
+                data_list, pArgs.averageContactBin)
+
+        data_list_raw = np.copy(data_list)
+
+        data_list = pViewpointObj.computeRelativeValues(
+            data_list, denominator_relative_interactions)
+
+        x_fold_list = compute_x_fold(
+            data_list, background_relative_interaction)
+        p_value_list = pViewpointObj.pvalues(
+            pBackgroundModel, data_list_raw, index_reference_point)
+
+        # add values if range is larger than fixate range
+
+        region_start_range, region_end_range, _ = pViewpointObj.calculateViewpointRange(
+            referencePoint, (pArgs.range[0], pArgs.range[1]))
+
+        interaction_data = pViewpointObj.createInteractionFileData(referencePoint, referencePoint[0],
+                                                                   region_start_range, region_end_range, data_list, data_list_raw,
+                                                                   pGeneList[i], denominator_relative_interactions)
+
+        referencePointString = '_'.join(str(j) for j in referencePoint)
+
+        region_start_in_units = utilities.in_units(region_start)
+        region_end_in_units = utilities.in_units(region_end)
+        denominator_relative_interactions_str = 'Sum of interactions in fixate range: '
+        denominator_relative_interactions_str += str(
+            denominator_relative_interactions)
+        header_information = '# Interaction file, created with HiCExplorer\'s chicViewpoint version ' + \
+            __version__ + '\n# '
+        header_information += '\t'.join([pMatrix, referencePointString, str(region_start_in_units), str(
+            region_end_in_units), pGeneList[i], denominator_relative_interactions_str])
+        header_information += '\n# Chromosome\tStart\tEnd\tGene\tSum of interactions\tRelative position\tRelative Interactions\tp-value\tx-fold\tRaw\n#'
+        matrix_name = '.'.join(pMatrix.split('/')[-1].split('.')[:-1])
+        matrix_name = '_'.join(
+            [matrix_name, referencePointString, pGeneList[i]])
+        file_list.append(matrix_name + '.txt')
+
+        matrix_name = pOutputFolder + '/' + matrix_name
+        log.debug('type(p_value_list) {}'.format(type(p_value_list)))
+        log.debug('type(x_fold_list) {}'.format(type(x_fold_list)))
+        log.debug('p_value_list {}'.format(p_value_list))
+        log.debug('x_fold_list {}'.format(x_fold_list))
+
+        pViewpointObj.writeInteractionFile(
+            matrix_name, interaction_data, header_information, p_value_list, x_fold_list, pArgs.decimalPlaces)
+    viewpointStore.flush()
+    return file_list
 
 
 def main(args=None):
@@ -227,9 +226,6 @@ def main(args=None):
 
     referencePoints, gene_list = viewpointObj.readReferencePointFile(
         args.referencePoints)
-    referencePointsPerThread = len(referencePoints) // args.threads
-    queue = [None] * args.threads
-    process = [None] * args.threads
     file_list = []
     background_model = viewpointObj.readBackgroundDataFile(
         args.backgroundModelFile, args.range, args.fixateRange)
@@ -238,75 +234,24 @@ def main(args=None):
     # background_sum_of_densities_dict = viewpointObj.computeSumOfDensities(
     #     background_model, args, pXfoldMaxValue=args.xFoldMaxValueNB)
 
-    if not os.path.exists(args.outputFolder):
-        try:
-            os.makedirs(args.outputFolder)
-        except OSError as exc:  # Guard against race condition
-            if exc.errno != errno.EEXIST:
-                raise
-    fail_flag = False
-    fail_message = ''
+    viewpointStore.createFolder(args.outputFolder)
 
     for matrix in args.matrices:
         hic_ma = hm.hiCMatrix(matrix)
         viewpointObj.hicMatrix = hic_ma
-        file_list_sample = [None] * args.threads
-        all_data_collected = False
-
-        for i in range(args.threads):
-
-            if i < args.threads - 1:
-                referencePointsThread = referencePoints[i * referencePointsPerThread:(i + 1) * referencePointsPerThread]
-                geneListThread = gene_list[i * referencePointsPerThread:(i + 1) * referencePointsPerThread]
-            else:
-                referencePointsThread = referencePoints[i * referencePointsPerThread:]
-                geneListThread = gene_list[i * referencePointsPerThread:]
-
-            if len(referencePointsThread) == 0:
-                process[i] = None
-                queue[i] = None
-                file_list_sample[i] = []
-                continue
-            queue[i] = Queue()
-            process[i] = Process(target=compute_viewpoint, kwargs=dict(
-                pViewpointObj=viewpointObj,
-                pArgs=args,
-                pQueue=queue[i],
-                pReferencePoints=referencePointsThread,
-                pGeneList=geneListThread,
-                pMatrix=matrix,
-                pBackgroundModel=background_model,
-                pBackgroundModelRelativeInteractions=background_model_mean_values,
-                pOutputFolder=args.outputFolder
-            )
-            )
-
-            process[i].start()
-
-        while not all_data_collected:
-            for i in range(args.threads):
-                if queue[i] is not None and not queue[i].empty():
-                    file_list_ = queue[i].get()
-                    if 'Fail:' in file_list_:
-                        fail_flag = True
-                        fail_message = file_list_[6:]
-                    file_list_sample[i] = file_list_
-                    process[i].join()
-                    process[i].terminate()
-                    process[i] = None
-
-            all_data_collected = True
-
-            for i in range(args.threads):
-                if process[i] is not None:
-                    all_data_collected = False
-            time.sleep(1)
-
-        if fail_flag:
-            log.error(fail_message)
+        try:
+            file_list_sample = workQueue.flatten(workQueue.runParallel(
+                compute_viewpoint, [referencePoints, gene_list], args.threads, pKwargs=dict(
+                    pViewpointObj=viewpointObj,
+                    pArgs=args,
+                    pMatrix=matrix,
+                    pBackgroundModel=background_model,
+                    pBackgroundModelRelativeInteractions=background_model_mean_values,
+                    pOutputFolder=args.outputFolder
+                ), pName='chicViewpoint {}'.format(matrix)))
+        except workQueue.WorkQueueError as exp:
+            log.error(exp)
             exit(1)
-
-        file_list_sample = [item for sublist in file_list_sample for item in sublist]
         file_list.append(file_list_sample)
 
     log.debug('file_list {}'.format(file_list))
@@ -1,16 +1,21 @@
 import argparse
 import math
-from multiprocessing import Process, Queue
-import time
+from multiprocessing import Pool
 import logging
 log = logging.getLogger(__name__)
 
 import numpy as np
-import fit_nbinom
 
 from hicmatrix import HiCMatrix as hm
 from hicexplorer._version import __version__
 from .lib import Viewpoint
+from .lib import cnb
+from .lib import workQueue
+
+# viewpoints computed with one slice of the matrix
+REFERENCE_POINTS_PER_BATCH = 1000
+# number of collected values of a process after which the values of the same histogram bin are merged
+VALUES_BEFORE_COMPACTION = 10000000
 
 
 def parse_arguments(args=None):
@@ -71,6 +76,16 @@ $ chicViewpointBackgroundModel --matrices matrix1.cool matrix2.cool matrix3.cool
                            default=500000,
                            type=int
                            )
+    parserOpt.add_argument('--valueResolution', '-vr',
+                           help='The values of each relative distance are counted in bins of this width before the distributions are fitted. '
+                           'A bin is represented by the average of its values, therefore values that differ by more than the resolution, '
+                           'e.g. the averaged contacts of raw counts, are fitted exactly. The memory does not depend on the number of '
+                           'reference points, only on the number of bins'
+                           ' (Default: %(default)s).',
+                           required=False,
+                           default=0.01,
+                           type=float
+                           )
     parserOpt.add_argument('--help', '-h', action='help',
                            help='show this help message and exit')
 
@@ -80,45 +95,111 @@ $ chicViewpointBackgroundModel --matrices matrix1.cool matrix2.cool matrix3.cool
     return parser
 
 
-def compute_background(pReferencePoints, pViewpointObj, pArgs, pQueue):
-
-    background_model_data = {}
-    relative_positions = set()
-    try:
-        for i, referencePoint in enumerate(pReferencePoints):
-
+def histogram_bins(pValues, pResolution):
+    '''
+    Returns the histogram bin of each value, bins have the width pResolution and bin 0 holds the values <= 0,
+    such that zeros are never merged with positive values.
+
+    >>> histogram_bins(np.array([0.0, 0.004, 0.01, 0.0101, 2.5]), 0.01)
+    array([  0,   1,   1,   2, 250])
+    '''
+    return np.ceil(pValues / pResolution).astype(np.int64)
+
+
+def count_values(pRelativePositions, pBins, pCounts, pSums, pMinima, pMaxima):
+    '''
+    Merges the entries of equal (relative position, histogram bin) pairs: their counts and sums are added up and the
+    minimum and maximum of their values are kept. Returns the distinct pairs sorted by relative position and bin with
+    their counts, sums, minima and maxima. These are the statistics of the background model: the fit uses the value
+    (see bin_values) and the count of each bin, the maximum and the mean of a relative position are exact.
+
+    >>> count_values(np.array([1, 0, 1, 1]), np.array([2, 5, 2, 1]), np.array([1, 1, 2, 1]),
+    ...              np.array([2.0, 5.0, 4.0, 0.5]), np.array([2.0, 5.0, 2.0, 0.5]), np.array([2.0, 5.0, 2.0, 0.5]))
+    (array([0, 1, 1]), array([5, 1, 2]), array([1, 1, 3]), array([5. , 0.5, 6. ]), array([5. , 0.5, 2. ]), array([5. , 0.5, 2. ]))
+    '''
+    order = np.lexsort((pBins, pRelativePositions))
+    relative_positions = pRelativePositions[order]
+    bins = pBins[order]
+    if len(order) == 0:
+        return relative_positions, bins, pCounts[order], pSums[order], pMinima[order], pMaxima[order]
+    new_pair = np.concatenate([[True], (np.diff(relative_positions) != 0) | (bins[1:] != bins[:-1])])
+    pair_starts = np.flatnonzero(new_pair)
+    return relative_positions[pair_starts], bins[pair_starts], np.add.reduceat(pCounts[order], pair_starts), \
+        np.add.reduceat(pSums[order], pair_starts), np.minimum.reduceat(pMinima[order], pair_starts), \
+        np.maximum.reduceat(pMaxima[order], pair_starts)
+
+
+def bin_values(pCounts, pSums, pMinima, pMaxima):
+    '''
+    Returns the value of each histogram bin: the value of its values if they are all equal, which does not depend on
+    the order in which the bins were merged, otherwise their average.
+
+    >>> bin_values(np.array([3, 2]), np.array([0.6, 3.0]), np.array([0.2, 1.0]), np.array([0.2, 2.0]))
+    array([0.2, 1.5])
+    '''
+    return np.where(pMinima == pMaxima, pMaxima, pSums / pCounts)
+
+
+def compute_background(pReferencePoints, pViewpointObj, pArgs):
+    '''
+    Computes the smoothed viewpoints of pReferencePoints and counts per relative position the values of each
+    histogram bin of width pArgs.valueResolution. The counts are compacted while the viewpoints are computed, so the
+    memory does not grow with the number of reference points but only with the number of bins.
+    '''
+    relative_positions = [np.empty(0, dtype=np.int64)]
+    bins = [np.empty(0, dtype=np.int64)]
+    counts = [np.empty(0, dtype=np.int64)]
+    sums = [np.empty(0, dtype=np.float64)]
+    minima = [np.empty(0, dtype=np.float64)]
+    maxima = [np.empty(0, dtype=np.float64)]
+    collected_values = 0
+    for batch_start in range(0, len(pReferencePoints), REFERENCE_POINTS_PER_BATCH):
+        reference_points = pReferencePoints[batch_start:batch_start + REFERENCE_POINTS_PER_BATCH]
+        region_starts = []
+        region_ends = []
+        for referencePoint in reference_points:
             region_start, region_end, _ = pViewpointObj.calculateViewpointRange(
                 referencePoint, (pArgs.fixateRange, pArgs.fixateRange))
+            region_starts.append(region_start)
+            region_ends.append(region_end)
 
-            data_list, _ = pViewpointObj.computeViewpoint(
-                referencePoint, referencePoint[0], region_start, region_end)
+        data_lists, index_before_viewpoints = pViewpointObj.computeViewpoints(
+            reference_points, [referencePoint[0] for referencePoint in reference_points], region_starts, region_ends)
 
-            # set data in relation to viewpoint, upstream are negative values, downstream positive, zero is viewpoint
-            view_point_start, _ = pViewpointObj.getReferencePointAsMatrixIndices(
+        for referencePoint, data_list, index_before_viewpoint in zip(reference_points, data_lists, index_before_viewpoints):
+            view_point_start, view_point_end = pViewpointObj.getReferencePointAsMatrixIndices(
                 referencePoint)
-            view_point_range_start, view_point_range_end = \
-                pViewpointObj.getViewpointRangeAsMatrixIndices(
-                    referencePoint[0], region_start, region_end)
-
-            for i, data in zip(range(view_point_range_start, view_point_range_end, 1), data_list):
-                relative_position = i - view_point_start
+            # the viewpoint range is one bin shorter than a viewpoint of one bin, its last value is not used
+            length = len(data_list) if view_point_end > view_point_start else len(data_list) - 1
 
             if pArgs.averageContactBin > 0:
                 data_list = pViewpointObj.smoothInteractionValues(
                     data_list, pArgs.averageContactBin)
 
-            for i, data in zip(range(view_point_range_start, view_point_range_end, 1), data_list):
-                relative_position = i - view_point_start
-                if relative_position in background_model_data:
-                    background_model_data[relative_position].append(data)
-                else:
-                    background_model_data[relative_position] = [data]
-                    relative_positions.add(relative_position)
-    except Exception as exp:
-        pQueue.put('Fail: ' + str(exp))
-        return
-    pQueue.put([background_model_data, relative_positions])
-    return
+            # set data in relation to viewpoint, upstream are negative values, downstream positive, zero is viewpoint
+            values = np.asarray(data_list[:length], dtype=np.float64)
+            relative_positions.append(np.arange(length) - index_before_viewpoint)
+            bins.append(histogram_bins(values, pArgs.valueResolution))
+            counts.append(np.ones(length, dtype=np.int64))
+            sums.append(values)
+            minima.append(values)
+            maxima.append(values)
+            collected_values += length
+
+        if collected_values > VALUES_BEFORE_COMPACTION:
+            relative_positions, bins, counts, sums, minima, maxima = [[array] for array in count_values(
+                *[np.concatenate(arrays) for arrays in (relative_positions, bins, counts, sums, minima, maxima)])]
+            collected_values = len(relative_positions[0])
+    background_model_data = count_values(*[np.concatenate(arrays) for arrays in (relative_positions, bins, counts, sums, minima, maxima)])
+    return background_model_data
+
+
+def fit_distributions(pValues, pCounts):
+    '''
+    Fits the negative binomial distributions of several relative positions, pValues and pCounts are lists with the
+    distinct values and their counts per relative position.
+    '''
+    return [cnb.fit(values, counts) for values, counts in zip(pValues, pCounts)]
 
 
 def main(args=None):
@@ -128,7 +209,6 @@ def main(args=None):
     referencePoints, _ = viewpointObj.readReferencePointFile(
         args.referencePoints)
 
-    relative_positions = set()
     bin_size = 0
 
     # - compute for each condition (matrix):
@@ -138,104 +218,76 @@ def main(args=None):
     # for models of all conditions:
     # - compute nbinom parameters
 
-    referencePointsPerThread = len(referencePoints) // args.threads
-    queue = [None] * args.threads
-    process = [None] * args.threads
-    background_model_data = None
-    fail_flag = False
-    fail_message = ''
+    background_model_data = []
 
     for matrix in args.matrices:
         hic_ma = hm.hiCMatrix(matrix)
         viewpointObj.hicMatrix = hic_ma
 
         bin_size = hic_ma.getBinSize()
-        all_data_collected = False
-        thread_done = [False] * args.threads
-        for i in range(args.threads):
-
-            if i < args.threads - 1:
-                referencePointsThread = referencePoints[i * referencePointsPerThread:(i + 1) * referencePointsPerThread]
-            else:
-                referencePointsThread = referencePoints[i * referencePointsPerThread:]
-
-            queue[i] = Queue()
-            process[i] = Process(target=compute_background, kwargs=dict(
-                pReferencePoints=referencePointsThread,
-                pViewpointObj=viewpointObj,
-                pArgs=args,
-                pQueue=queue[i]
-            )
-            )
-
-            process[i].start()
-
-        while not all_data_collected:
-            for i in range(args.threads):
-                if queue[i] is not None and not queue[i].empty():
-                    background_data_thread = queue[i].get()
-                    if 'Fail:' in background_data_thread:
-                        fail_flag = True
-                        fail_message = background_data_thread[6:]
-                        queue[i] = None
-                        process[i].join()
-                        process[i].terminate()
-                        process[i] = None
-                        thread_done[i] = True
-                        continue
-                    background_model_data_thread, relative_positions_thread = background_data_thread
-                    if background_model_data is None:
-                        background_model_data = background_model_data_thread
-                    else:
-                        for relativePosition in background_model_data_thread:
-                            if relativePosition in background_model_data:
-                                background_model_data[relativePosition].extend(
-                                    background_model_data_thread[relativePosition])
-                            else:
-                                background_model_data[relativePosition] = background_model_data_thread[relativePosition]
-
-                    relative_positions = relative_positions.union(
-                        relative_positions_thread)
-                    queue[i] = None
-                    process[i].join()
-                    process[i].terminate()
-                    process[i] = None
-                    thread_done[i] = True
-            all_data_collected = True
-            for thread in thread_done:
-                if not thread:
-                    all_data_collected = False
-            time.sleep(1)
+        try:
+            background_model_data.extend(workQueue.runParallel(
+                compute_background, [referencePoints], args.threads, pKwargs=dict(
+                    pViewpointObj=viewpointObj,
+                    pArgs=args
+                ), pName='chicViewpointBackgroundModel {}'.format(matrix)))
+        except workQueue.WorkQueueError as exp:
+            log.error('An error occurred caused by one or many faulty reference points.')
+            log.error('Please run chicQualityControl to remove these from your reference point file: {}'.format(args.referencePoints))
+            log.error(exp)
+            exit(1)
 
         del hic_ma
         del viewpointObj.hicMatrix
 
-    if fail_flag:
-        log.error('An error occurred caused by one or many faulty reference points.')
-        log.error('Please run chicQualityControl to remove these from your reference point file: {}'.format(args.referencePoints))
-        log.error(fail_message)
-        exit(1)
+    # merge the counts of all batches and matrices
+    background_model_data = count_values(*[np.concatenate(arrays) for arrays in zip(*background_model_data)])
+
     # for models of all conditions:
     # - fit negative binomial for each relative distance
-    relative_positions = sorted(relative_positions)
+    relative_position_of_value, bins, counts, sums, minima, maxima = background_model_data
+    relative_positions = np.unique(relative_position_of_value)
+    if args.truncateZeros:
+        # bin 0 only holds the zeros
+        mask = bins > 0
+        relative_position_of_value = relative_position_of_value[mask]
+        counts = counts[mask]
+        sums = sums[mask]
+        minima = minima[mask]
+        maxima = maxima[mask]
+    values = bin_values(counts, sums, minima, maxima)
+    # the bins are sorted by relative position, positions without any value get an empty slice
+    position_starts = np.searchsorted(relative_position_of_value, relative_positions)
+    relative_positions = relative_positions.tolist()
+    values_per_position = np.split(values, position_starts[1:])
+    counts_per_position = np.split(counts, position_starts[1:])
+    sums_per_position = np.split(sums, position_starts[1:])
+    maxima_per_position = np.split(maxima, position_starts[1:])
+
+    # the relative positions are fitted independently of each other, split in one chunk per thread
+    chunk_size = int(math.ceil(len(relative_positions) / args.threads)) if len(relative_positions) > 0 else 1
+    chunks = [(values_per_position[i:i + chunk_size], counts_per_position[i:i + chunk_size])
+              for i in range(0, len(relative_positions), chunk_size)]
+    if args.threads > 1 and len(chunks) > 1:
+        pool = Pool(min(args.threads, len(chunks)))
+        fitted_chunks = pool.starmap(fit_distributions, chunks)
+        pool.close()
+        pool.join()
+    else:
+        fitted_chunks = [fit_distributions(*chunk) for chunk in chunks]
+    fitted_parameters = [parameters for chunk in fitted_chunks for parameters in chunk]
+
     nbinom_parameters = {}
     max_value = {}
     mean_value = {}
     sum_all_values = 0
-    data_of_distribution = None
-    for relative_position in relative_positions:
-
-        if args.truncateZeros:
-            data_of_distribution = np.array(background_model_data[relative_position])
-            mask = data_of_distribution > 0.0
-            data_of_distribution = data_of_distribution[mask]
-        else:
-            data_of_distribution = np.array(background_model_data[relative_position])
-        nbinom_parameters[relative_position] = fit_nbinom.fit(data_of_distribution)
+    for relative_position, counts_of_position, sums_of_position, maxima_of_position, parameters in \
+            zip(relative_positions, counts_per_position, sums_per_position, maxima_per_position, fitted_parameters):
+        nbinom_parameters[relative_position] = parameters
 
-        if len(data_of_distribution) > 0:
-            max_value[relative_position] = np.max(data_of_distribution)
-            average_value = np.average(data_of_distribution)
+        if len(counts_of_position) > 0:
+            max_value[relative_position] = np.max(maxima_of_position)
+            average_value = np.sum(sums_of_position) / np.sum(counts_of_position)
             mean_value[relative_position] = average_value
             sum_all_values += average_value
         else:
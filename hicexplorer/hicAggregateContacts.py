@@ -17,6 +17,7 @@ from hicmatrix import HiCMatrix as hm
 from hicmatrix.lib import MatrixFileHandler
 import hicexplorer.utilities
 from .utilities import check_chrom_str_bytes, change_chrom_names, toString
+from .utilities import get_bins_containing, dense_windows
 from hicexplorer._version import __version__
 
 import logging
@@ -244,10 +245,265 @@ def read_bed_per_chrom(fh, chrom_list):
     return interval
 
 
+class OnlineAggregate(object):
+    """
+    Collects submatrices like a list, but only keeps what is needed to
+    compute their sum, mean and median, such that the memory does not grow
+    with the number of submatrices:
+
+    - the running sum and sum of squares per pixel;
+    - for the median, the submatrices themselves as long as they fit into
+      `pMaxStoredBytes`. Afterwards, a histogram per pixel is kept
+      instead, with `pNumberOfBins` bins at the quantiles of the stored
+      values. Values equal to a bin edge are counted separately from the
+      values between two edges, hence the median of data with few distinct
+      values (e.g. counts) stays exact; otherwise it is interpolated.
+
+    >>> aggregate = OnlineAggregate(pMaxStoredBytes=2000)
+    >>> aggregate.extend([np.full((2, 2), value) for value in range(40)])
+    >>> len(aggregate), float(aggregate.mean()[0, 0]), float(aggregate.median()[0, 0])
+    (40, 19.5, 19.5)
+    >>> aggregate.extend([np.full((2, 2), value) for value in range(40, 101)])
+    >>> len(aggregate), float(aggregate.sum()[0, 0]), float(aggregate.median()[0, 0])
+    (101, 5050.0, 50.0)
+    """
+
+    def __init__(self, pMaxStoredBytes=2**28, pNumberOfBins=1000):
+        self.max_stored_bytes = pMaxStoredBytes
+        self.number_of_bins = pNumberOfBins
+        self.count = 0
+        self.total = None
+        self.total_of_squares = None
+        self.stored = []
+        self.edges = None
+        self.histogram = None
+        self.nan_count = None
+
+    def __len__(self):
+        return self.count
+
+    def append(self, pSubmatrix):
+        self.extend([pSubmatrix])
+
+    def extend(self, pSubmatrices):
+        submatrices = np.asarray(pSubmatrices, dtype=float)
+        if len(submatrices) == 0:
+            return
+        if self.total is None:
+            self.total = np.zeros(submatrices.shape[1:])
+            self.total_of_squares = np.zeros(submatrices.shape[1:])
+        self.count += len(submatrices)
+        self.total += submatrices.sum(axis=0)
+        self.total_of_squares += (submatrices ** 2).sum(axis=0)
+
+        if self.histogram is not None:
+            self.add_to_histogram(submatrices)
+            return
+        self.stored.extend(submatrices)
+        if len(self.stored) * submatrices[0].nbytes > self.max_stored_bytes:
+            stored = np.array(self.stored)
+            self.stored = []
+            values = stored[np.isfinite(stored)]
+            if len(values) == 0:
+                values = np.zeros(1)
+            self.edges = np.unique(np.quantile(values, np.linspace(0, 1, self.number_of_bins + 1)))
+            self.histogram = np.zeros((2 * len(self.edges) - 1, stored[0].size), dtype=np.int64)
+            self.nan_count = np.zeros(stored[0].size, dtype=np.int64)
+            self.add_to_histogram(stored)
+
+    def add_to_histogram(self, pSubmatrices):
+        values = pSubmatrices.reshape(len(pSubmatrices), -1)
+        is_nan = np.isnan(values)
+        self.nan_count += is_nan.sum(axis=0)
+        # slot 2 * i counts the values equal to edges[i], slot 2 * i + 1 the values
+        # between edges[i] and edges[i + 1]. Values outside of the edges are counted
+        # as the first or last edge.
+        edge_index = np.searchsorted(self.edges, values, side='right') - 1
+        between = (edge_index >= 0) & (edge_index < len(self.edges) - 1)
+        between[between] = self.edges[edge_index[between]] != values[between]
+        bins = 2 * np.clip(edge_index, 0, len(self.edges) - 1) + between
+        pixels = np.broadcast_to(np.arange(values.shape[1]), values.shape)
+        self.histogram += np.bincount((bins * values.shape[1] + pixels)[~is_nan],
+                                      minlength=self.histogram.size).reshape(self.histogram.shape)
+
+    def sum(self):
+        if self.count == 0:
+            return np.float64(np.nan)
+        return self.total
+
+    def mean(self):
+        if self.count == 0:
+            return np.float64(np.nan)
+        return self.total / self.count
+
+    def std(self):
+        if self.count == 0:
+            return np.float64(np.nan)
+        return np.sqrt(np.maximum(self.total_of_squares / self.count - self.mean() ** 2, 0))
+
+    def median(self):
+        if self.count == 0:
+            return np.float64(np.nan)
+        if self.histogram is None:
+            return np.median(np.array(self.stored), axis=0)
+        cumulative = np.cumsum(self.histogram, axis=0)
+        half = cumulative[-1] / 2.0
+        pixels = np.arange(self.histogram.shape[1])
+        median_bin = np.argmax(cumulative >= half, axis=0)
+        before = np.where(median_bin > 0, cumulative[median_bin - 1, pixels], 0)
+        in_bin = self.histogram[median_bin, pixels]
+        fraction = np.divide(half - before, in_bin, out=np.zeros(len(pixels)), where=in_bin > 0)
+        edge_index = median_bin // 2
+        width = np.append(np.diff(self.edges), 0)[edge_index] * (median_bin % 2)
+        median = self.edges[edge_index] + fraction * width
+        # same as np.median, any nan value results in a nan median
+        median[(self.nan_count > 0) | (cumulative[-1] == 0)] = np.nan
+        return median.reshape(self.total.shape)
+
+
+class ReservoirSample(object):
+    """
+    Keeps a uniform random sample of at most `pSize` of the appended values
+    (reservoir sampling). As long as no more than `pSize` values are
+    appended, all of them are kept in their order.
+
+    >>> sample = ReservoirSample(pSize=10)
+    >>> sample.extend(range(5))
+    >>> list(sample)
+    [0, 1, 2, 3, 4]
+    >>> sample.extend(range(5, 1000))
+    >>> len(sample), sample.count
+    (10, 1000)
+    """
+
+    def __init__(self, pSize=5000, pSeed=0):
+        self.size = pSize
+        self.count = 0
+        self.sample = []
+        self.random = np.random.RandomState(pSeed)
+
+    def __len__(self):
+        return len(self.sample)
+
+    def __iter__(self):
+        return iter(self.sample)
+
+    def append(self, pValue):
+        self.count += 1
+        if len(self.sample) < self.size:
+            self.sample.append(pValue)
+        else:
+            index = self.random.randint(self.count)
+            if index < self.size:
+                self.sample[index] = pValue
+
+    def extend(self, pValues):
+        for value in pValues:
+            self.append(value)
+
+
+def add_aggregate_entry(agg_info, key):
+    """
+    Adds the lists that collect the submatrices of `key` (a chromosome or 'genome')
+    to agg_info. If agg_info["online"] is set, the submatrices are aggregated while
+    they are added and only a sample of their diagonals is kept.
+    """
+    agg_info["agg_total"][key] = 0
+    if agg_info["online"]:
+        agg_info["agg_matrix"][key] = OnlineAggregate()
+        agg_info["agg_diagonals"][key] = ReservoirSample()
+    else:
+        agg_info["agg_matrix"][key] = []
+        agg_info["agg_diagonals"][key] = []
+    agg_info["agg_contact_position"][key] = []
+    agg_info["agg_center_values"][key] = []
+
+
+def get_region_bins(ma, chrom, regions, chrom_coord, largeRegionsOperation):
+    """
+    Maps the BED regions (start, end) of one chromosome to bins, in the same
+    way as count_contacts does with ma.getRegionBinRange, but for all regions
+    at once.
+
+    Returns
+    -------
+    first and last bin of each region and the bin that is used for the region
+    according to largeRegionsOperation. Regions that count_contacts would skip
+    have a bin of -1.
+    """
+    regions = np.array(regions, dtype=np.int64).reshape(-1, 2)
+    chr_start_bin, chr_end_bin = ma.getChrBinRange(toString(chrom))
+    intervals = ma.cut_intervals[chr_start_bin:chr_end_bin]
+    starts = np.array([interval[1] for interval in intervals])
+    ends = np.array([interval[2] for interval in intervals])
+
+    first_bin = get_bins_containing(starts, ends, regions[:, 0])
+    last_bin = get_bins_containing(starts, ends, regions[:, 1])
+    valid = (first_bin >= 0) & (last_bin >= 0) & \
+        (regions[:, 0] >= chrom_coord[chrom][0]) & (regions[:, 1] <= chrom_coord[chrom][1])
+    if largeRegionsOperation == 'first':
+        bins = first_bin
+    elif largeRegionsOperation == 'last':
+        bins = last_bin
+    elif largeRegionsOperation == 'center':
+        bins = (first_bin + last_bin) // 2
+    bins = np.where(valid, bins + chr_start_bin, -1)
+    return first_bin + chr_start_bin, last_bin + chr_start_bin, bins
+
+
+def add_submatrices(agg_info, ma, key, bin1, bin2, positions, M_half, transform, chunk_size=4096):
+    """
+    Extracts the submatrices around the contacts (bin1, bin2), `chunk_size`
+    contacts at a time, and adds the non empty ones to agg_info[...][key], as
+    count_contacts does for a single contact.
+    """
+    for chunk_start in np.arange(0, len(bin1), chunk_size):
+        chunk = slice(chunk_start, chunk_start + chunk_size)
+        submatrices = dense_windows(ma.matrix, bin1[chunk], bin2[chunk], M_half)
+        center_values = submatrices[:, M_half, M_half].copy()
+        submatrices = submatrices.astype(float, copy=False)
+        submatrices_sum = submatrices.reshape(len(submatrices), -1).sum(axis=1)
+        used = np.flatnonzero(submatrices_sum != 0)
+        agg_info["empty_mat"] += len(submatrices) - len(used)
+        agg_info["used_counter"] += len(used)
+        if len(used) == 0:
+            continue
+        # to account for the fact that submatrices close to the diagonal have more counts than
+        # submatrices far from the diagonal submatrices values are normalized using the
+        # total submatrix sum.
+        if transform == 'total-counts':
+            submatrices[used] /= submatrices_sum[used, np.newaxis, np.newaxis]
+
+        if key not in agg_info["agg_total"]:
+            add_aggregate_entry(agg_info, key)
+        agg_info["agg_total"][key] += len(used)
+        agg_info["agg_matrix"][key].extend(submatrices[used])
+        agg_info["agg_diagonals"][key].extend(np.diagonal(submatrices[used], axis1=1, axis2=2))
+        if agg_info["contact_pairs"]:
+            agg_info["agg_center_values"][key].extend(center_values[used])
+            agg_info["agg_contact_position"][key].extend([tuple(position) for position in positions[chunk][used].tolist()])
+
+
 def aggregate_contacts(bed1, bed2, agg_info, ma, M_half, largeRegionsOperation, range=None, transform=None, mode='', perChr=False):
     """
     To aggregate the contacts of desired sumatrices.
+
+    The BED regions are mapped to bins once per chromosome and the pairs of
+    regions are filtered and their submatrices extracted per pair of
+    chromosomes, in chunks of pairs. The result is the same as calling
+    count_contacts for every pair of regions.
     """
+    bins1 = {}
+    bins2 = {}
+    for chrom, regions in bed1.items():
+        bins1[chrom] = get_region_bins(ma, chrom, regions, agg_info["chrom_coord"], largeRegionsOperation)
+    for chrom, regions in bed2.items():
+        bins2[chrom] = get_region_bins(ma, chrom, regions, agg_info["chrom_coord"], largeRegionsOperation)
+    min_dist, max_dist = range.split(":")
+    min_dist_in_bins = int(min_dist) // ma.getBinSize()
+    max_dist_in_bins = int(max_dist) // ma.getBinSize()
+    num_bins = ma.matrix.shape[0]
+
     for k1, v1 in bed1.items():
         for k2, v2 in bed2.items():
             if (mode == 'inter-chr') & (k1 == k2):
@@ -257,24 +513,64 @@ def aggregate_contacts(bed1, bed2, agg_info, ma, M_half, largeRegionsOperation,
                     continue
             if (mode == 'intra-chr') & (k1 != k2):
                 continue
-            for coord1 in v1:
-                for coord2 in v2:
-                    if (k1 == k2) and (coord1 == coord2):
-                        continue
-                    interval = [(k1, coord1[0], coord1[1]), (k2, coord2[0], coord2[1])]
-                    count_contacts(interval, ma, M_half, mode, agg_info, largeRegionsOperation, range, transform, perChr)
-    # over_1_5 = 0
-    #
-
-        # if len(chrom_matrix[chrom]) == 0:
-        #     log.warn("No valid submatrices were found for chrom: {}".format(chrom))
-        #     chrom_matrix.pop(chrom)
-        # else:
-        #     log.info("Number of matrices with ratio over 1.5 at center {}, fraction w.r.t. non empty submatrices: ({:.2f})".
-        #              format(over_1_5, float(over_1_5) / len(chrom_matrix[chrom])))
-        #
-        # log.info("Number of discarded empty submatrices  {} ({:.2f})".
-        #          format(empty_mat, float(empty_mat) / counter))
+            first_bin1, last_bin1, bin_id1 = bins1[k1]
+            first_bin2, last_bin2, bin_id2 = bins2[k2]
+            regions1 = np.array(v1, dtype=np.int64)
+            regions2 = np.array(v2, dtype=np.int64)
+            if (mode == "intra-chr") and (perChr == True):  # k1 == k2
+                key = k1
+            else:
+                key = 'genome'
+
+            # all pairs of regions in the order of the BED files, in chunks of ~1M pairs
+            num_outside = 0
+            chunk_size = max(1, 2 ** 20 // len(v2))
+            for chunk_start in np.arange(0, len(v1), chunk_size):
+                idx1 = np.repeat(np.arange(chunk_start, min(len(v1), chunk_start + chunk_size)), len(v2))
+                idx2 = np.tile(np.arange(len(v2)), len(idx1) // len(v2))
+                keep = (bin_id1[idx1] >= 0) & (bin_id2[idx2] >= 0) & \
+                    ((first_bin1[idx1] != first_bin2[idx2]) | (last_bin1[idx1] != last_bin2[idx2]))
+                idx1 = idx1[keep]
+                idx2 = idx2[keep]
+                agg_info["counter"] += len(idx1)
+
+                bin1 = bin_id1[idx1]
+                bin2 = bin_id2[idx2]
+                swap = bin1 > bin2
+                bin1, bin2 = np.where(swap, bin2, bin1), np.where(swap, bin1, bin2)
+                positions = np.hstack([regions1[idx1], regions2[idx2]])
+                if k1 != k2:
+                    # the regions are swapped with the bins
+                    positions = np.where(swap[:, np.newaxis], positions[:, [2, 3, 0, 1]], positions)
+                else:
+                    if (k1 not in agg_info["agg_total"]) and (mode == "intra-chr") and (perChr == True) and len(idx1) > 0:
+                        add_aggregate_entry(agg_info, k1)
+                    in_range = (min_dist_in_bins <= bin2 - bin1) & (bin2 - bin1 <= max_dist_in_bins)
+                    bin1, bin2, positions = bin1[in_range], bin2[in_range], positions[in_range]
+
+                # keep the first occurrence of each pair of bins
+                _, first = np.unique(bin1 * num_bins + bin2, return_index=True)
+                first = np.sort(first)
+                new = np.array([pair not in agg_info["seen"] for pair in zip(bin1[first].tolist(), bin2[first].tolist())], dtype=bool)
+                first = first[new]
+                bin1, bin2, positions = bin1[first], bin2[first], positions[first]
+                agg_info["seen"].update(zip(bin1.tolist(), bin2.tolist()))
+
+                # the submatrix must not exceed the chromosome of each bin
+                inside = np.ones(len(bin1), dtype=bool)
+                for bins in [bin1, bin2]:
+                    for chrom in set([k1, k2]):
+                        chrom_bin_range = ma.getChrBinRange(toString(chrom))
+                        on_chrom = (bins >= chrom_bin_range[0]) & (bins < chrom_bin_range[1])
+                        inside[on_chrom & ((bins - M_half < chrom_bin_range[0]) | (bins + M_half >= chrom_bin_range[1]))] = False
+                num_outside += np.sum(~inside)
+                add_submatrices(agg_info, ma, key, bin1[inside], bin2[inside], positions[inside], M_half, transform)
+            if num_outside > 0:
+                log.info("{} of the given intervals exceed the chromosome range on {} or {}. "
+                         "They are skipped.".format(num_outside, k1, k2))
+
+    log.info("Number of contacts considered: {:,}, used within the given range: {:,}".format(
+        agg_info["counter"], agg_info["used_counter"]))
 
 
 def aggregate_contacts_per_row(bed1, bed2, agg_info, ma, chrom_list, M_half, largeRegionsOperation, range=None, transform=None, mode='', perChr=False):
@@ -351,11 +647,7 @@ def count_contacts(interval, ma, M_half, mode, agg_info, largeRegionsOperation,
 
     if chrom1 == chrom2:  # chrom1 == chrom2 can happen in intra or all
         if (chrom1 not in agg_info["agg_total"]) and (mode == "intra-chr") and (perChr == True):
-            agg_info["agg_total"][chrom1] = 0
-            agg_info["agg_matrix"][chrom1] = []
-            agg_info["agg_diagonals"][chrom1] = []
-            agg_info["agg_contact_position"][chrom1] = []
-            agg_info["agg_center_values"][chrom1] = []
+            add_aggregate_entry(agg_info, chrom1)
 
         min_dist, max_dist = range.split(":")
         min_dist_in_bins = int(min_dist) // bin_size
@@ -364,7 +656,7 @@ def count_contacts(interval, ma, M_half, mode, agg_info, largeRegionsOperation,
             return
     if (bin_id1, bin_id2) in agg_info["seen"]:
         return
-    agg_info["seen"].append((bin_id1, bin_id2))
+    agg_info["seen"].add((bin_id1, bin_id2))
     if bin_id1 - M_half < chrom1_bin_range[0] or bin_id1 + M_half >= chrom1_bin_range[1]:
         log.info("The given interval exceeds the chromosome range on {}. It is skipped.".format(chrom1))
         return
@@ -392,26 +684,18 @@ def count_contacts(interval, ma, M_half, mode, agg_info, largeRegionsOperation,
         mat_to_append = mat_to_append / mat_to_append.sum()
 
     if (mode == "intra-chr") and (perChr == True):  # chrom1 == chrom2
-        agg_info["agg_total"][chrom1] += 1
-        agg_info["agg_matrix"][chrom1].append(mat_to_append)
-        agg_info["agg_diagonals"][chrom1].append(mat_to_append.diagonal())
-        agg_info["agg_center_values"][chrom1].append(ma.matrix[bin_id1, bin_id2])
-        agg_info["agg_contact_position"][chrom1].append((start1, end1, start2, end2))
-
+        key = chrom1
     else:
-
+        key = 'genome'
         if 'genome' not in agg_info["agg_total"]:
-            agg_info["agg_total"]["genome"] = 0
-            agg_info["agg_matrix"]["genome"] = []
-            agg_info["agg_diagonals"]["genome"] = []
-            agg_info["agg_contact_position"]["genome"] = []
-            agg_info["agg_center_values"]["genome"] = []
+            add_aggregate_entry(agg_info, 'genome')
 
-        agg_info["agg_total"]["genome"] += 1
-        agg_info["agg_matrix"]["genome"].append(mat_to_append)
-        agg_info["agg_diagonals"]["genome"].append(mat_to_append.diagonal())
-        agg_info["agg_center_values"]["genome"].append(ma.matrix[bin_id1, bin_id2])
-        agg_info["agg_contact_position"]["genome"].append((start1, end1, start2, end2))
+    agg_info["agg_total"][key] += 1
+    agg_info["agg_matrix"][key].append(mat_to_append)
+    agg_info["agg_diagonals"][key].append(mat_to_append.diagonal())
+    if agg_info["contact_pairs"]:
+        agg_info["agg_center_values"][key].append(ma.matrix[bin_id1, bin_id2])
+        agg_info["agg_contact_position"][key].append((start1, end1, start2, end2))
 
 
 def get_outlier_indices(data, max_deviation=200):
@@ -546,19 +830,24 @@ def plot_aggregated_contacts(chrom_matrix, chrom_contact_position, cluster_ids,
         chrom_cluster_len[chrom] = []
         for cluster_number, cluster_indices in enumerate(cluster_ids[chrom]):
             # compute median values
-            if num_clusters == 1:
-                # this means no clustering
-                submatrices = np.array(chrom_matrix[chrom])
+            if isinstance(chrom_matrix[chrom], OnlineAggregate):
+                # this means no clustering, the submatrices were aggregated while they were collected
+                submatrices = chrom_matrix[chrom]
             else:
-                submatrices = np.array([chrom_matrix[chrom][x] for x in cluster_indices])
+                submatrices = OnlineAggregate(pMaxStoredBytes=np.inf)
+                if num_clusters == 1:
+                    # this means no clustering
+                    submatrices.extend(chrom_matrix[chrom])
+                else:
+                    submatrices.extend([chrom_matrix[chrom][x] for x in cluster_indices])
 
             chrom_cluster_len[chrom].append(len(cluster_ids))
 
             if args.operationType == 'median':
-                _median = np.median(submatrices, axis=0)
+                _median = submatrices.median()
                 if _median.sum() == 0 or np.isnan(_median.sum()):
                     # test if the mean matrix is not zero
-                    if np.mean(submatrices, axis=0).sum() != 0:
+                    if submatrices.mean().sum() != 0:
                         log.info("The median of the matrices is zero. Consider using "
                                  "the mean instead.")
                     else:
@@ -566,11 +855,12 @@ def plot_aggregated_contacts(chrom_matrix, chrom_contact_position, cluster_ids,
                                  "zeros or nans.")
                 chrom_avg[chrom].append(_median)
             elif args.operationType == 'mean':
-                chrom_avg[chrom].append(np.mean(submatrices, axis=0))
+                chrom_avg[chrom].append(submatrices.mean())
             else:
-                chrom_avg[chrom].append(np.sum(submatrices, axis=0))
+                chrom_avg[chrom].append(submatrices.sum())
 
-            log.info("Mean aggregate matrix values: {}".format(chrom_avg[chrom][cluster_number].mean()))
+            log.info("Mean aggregate matrix values: {}, mean standard deviation: {}".format(
+                chrom_avg[chrom][cluster_number].mean(), submatrices.std().mean()))
 
     vmin, vmax = (args.vMin, args.vMax)
     cmap = cm.get_cmap(args.colorMap)
@@ -660,7 +950,7 @@ def plot_diagnostic_heatmaps(chrom_diagonals, cluster_ids, M_half, args):
     gs_list = []
     for idx, (chrom_name, values) in enumerate(chrom_diagonals.items()):
         try:
-            heatmap = np.asarray(np.vstack(values))
+            heatmap = np.asarray(np.vstack(list(values)))
         except ValueError:
             log.error("Error computing diagnostic heatmap for chrom: {}".format(chrom_name))
             continue
@@ -773,7 +1063,7 @@ def main(args=None):
 
     agg_info = dict()
     agg_info["chrom_coord"] = chrom_coord
-    agg_info["seen"] = []
+    agg_info["seen"] = set()
     agg_info["agg_matrix"] = OrderedDict()
     agg_info["agg_total"] = {}
     agg_info["agg_diagonals"] = OrderedDict()
@@ -782,6 +1072,9 @@ def main(args=None):
     agg_info["counter"] = 0
     agg_info["used_counter"] = 0
     agg_info["empty_mat"] = 0
+    # without clustering, the submatrices do not need to be kept in memory
+    agg_info["online"] = args.kmeans is None and args.hclust is None
+    agg_info["contact_pairs"] = args.outFileContactPairs is not None
     if (args.mode == 'inter-chr') and (len(agg_info["chrom_coord"]) == 1):
         exit("Error: 'inter-chr' mode can not be applied on matrices of only one chromosme.")
     if args.row_wise:
@@ -842,4 +1135,9 @@ def main(args=None):
     # plot the diagonals
     # the diagonals plot is useful to see individual cases and if they had a contact in the center
     if args.diagnosticHeatmapFile:
+        if agg_info["online"]:
+            # only a sample of the diagonals is kept
+            cluster_ids = {}
+            for k in agg_info["agg_diagonals"].keys():
+                cluster_ids[k] = [range(len(agg_info["agg_diagonals"][k]))]
         plot_diagnostic_heatmaps(agg_info["agg_diagonals"], cluster_ids, M_half, args)
@@ -4,6 +4,10 @@ from scipy.sparse import coo_matrix, dia_matrix
 import time
 from os import unlink
 import os
+import gzip
+import heapq
+import shutil
+from tempfile import mkdtemp
 from io import StringIO
 import traceback
 import warnings
@@ -11,12 +15,19 @@ warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 
 import pysam
+import cooler
+from cooler.util import parse_cooler_uri
+import h5py
+from pysam.libcbgzf import BGZFile
+import pandas as pd
 from collections import OrderedDict
 
-from copy import deepcopy
-from ctypes import Structure, c_uint, c_ushort
+from ctypes import Structure, c_char, c_int, c_ubyte, c_uint, c_ushort
 from multiprocessing import Process, Queue
 from multiprocessing.sharedctypes import Array, RawArray
+from queue import Empty, Full
+from queue import Queue as ThreadQueue
+from threading import Event, Thread
 
 from intervaltree import IntervalTree, Interval
 
@@ -25,11 +36,10 @@ from Bio.Alphabet import generic_dna
 
 # own tools
 from hicmatrix import HiCMatrix as hm
-from hicexplorer.utilities import getUserRegion, genomicRegion
+from hicexplorer.utilities import getUserRegion, genomicRegion, toString
 from hicexplorer._version import __version__
 import hicexplorer.hicPrepareQCreport as QC
 
-from hicmatrix.lib import MatrixFileHandler
 
 from hicexplorer import hicMergeMatrixBins
 import logging
@@ -50,39 +60,565 @@ class C_Coverage(Structure):
                 ("end", c_uint)]
 
 
+class SharedRecordBatch(object):
+    """Columnar buffer of read pairs stored in multiprocessing.sharedctypes.RawArrays.
+
+       The main process fills the batch with the few fields of a pysam
+       AlignedSegment that are needed to classify a pair, the worker processes
+       read them as numpy arrays. Because the arrays are allocated before the
+       workers are started, only the batch index and the number of filled pairs
+       need to be send to a worker, no AlignedSegment is pickled.
+
+       If pSequenceLength is larger than 0, the first pSequenceLength bases of a
+       forward read, or the last pSequenceLength bases of a reverse read, are copied
+       as well. The workers use them to check for dangling ends.
+    """
+
+    columns = [('ref_id', c_int),
+               ('pos', c_int),
+               ('qlen', c_uint),
+               ('seq_len', c_uint),
+               ('is_reverse', c_ubyte),
+               ('flag', c_ushort),
+               ('mapq', c_ubyte)]
+
+    def __init__(self, pSize, pSequenceLength=0):
+        """
+        >>> batch = SharedRecordBatch(2)
+        >>> batch.size
+        2
+        >>> sorted(batch.mate(0).keys())
+        ['flag', 'is_reverse', 'mapq', 'pos', 'qlen', 'ref_id', 'seq_len']
+        >>> SharedRecordBatch(2, 4).sequence_ends(0).shape
+        (2, 4)
+        """
+        self.size = pSize
+        self.sequence_length = pSequenceLength
+        self.raw_arrays = [{}, {}]
+        for raw_mate in self.raw_arrays:
+            for name, c_type in self.columns:
+                raw_mate[name] = RawArray(c_type, pSize)
+        self.raw_sequence_ends = [RawArray(c_char, pSize * pSequenceLength) for _ in range(2)]
+        self._numpy_arrays = None
+
+    def mate(self, pMateIndex):
+        """Returns a dict with the numpy views of the columns of mate 0 or mate 1.
+           The views share the memory with the RawArrays."""
+        if self._numpy_arrays is None:
+            self._numpy_arrays = [{name: np.ctypeslib.as_array(raw_array) for name, raw_array in raw_mate.items()}
+                                  for raw_mate in self.raw_arrays]
+        return self._numpy_arrays[pMateIndex]
+
+    def sequence_ends(self, pMateIndex):
+        """Returns the stored sequence ends of mate 0 or mate 1 as uint8 array of shape (size, sequence length).
+           The sequence of a forward read is left aligned, the one of a reverse read right aligned."""
+        return np.frombuffer(self.raw_sequence_ends[pMateIndex], dtype=np.uint8).reshape(self.size, self.sequence_length)
+
+    def __getstate__(self):
+        # numpy views can not be pickled together with the RawArrays, they are recreated on access
+        state = self.__dict__.copy()
+        state['_numpy_arrays'] = None
+        return state
+
+    def fill(self, pMateBuffer1, pMateBuffer2):
+        """Copies the relevant fields of two lists of pysam AlignedSegments into the batch.
+           Returns the number of stored pairs."""
+        length = min(len(pMateBuffer1), len(pMateBuffer2), self.size)
+        sequence_length = self.sequence_length
+        for mate_index, mate_buffer in enumerate([pMateBuffer1, pMateBuffer2]):
+            columns = self.mate(mate_index)
+            ref_id = columns['ref_id']
+            pos = columns['pos']
+            qlen = columns['qlen']
+            seq_len = columns['seq_len']
+            is_reverse = columns['is_reverse']
+            flag = columns['flag']
+            mapq = columns['mapq']
+            for i in range(length):
+                mate = mate_buffer[i]
+                ref_id[i] = mate.reference_id
+                pos[i] = mate.pos
+                qlen[i] = mate.qlen
+                seq_len[i] = mate.query_length
+                is_reverse[i] = mate.is_reverse
+                flag[i] = mate.flag
+                mapq[i] = mate.mapq
+            if sequence_length:
+                sequence_ends = self.raw_sequence_ends[mate_index]
+                for i in range(length):
+                    mate = mate_buffer[i]
+                    sequence = mate.query_sequence or ''
+                    offset = i * sequence_length
+                    if mate.is_reverse:
+                        sequence = sequence[-sequence_length:].rjust(sequence_length, '\0')
+                    else:
+                        sequence = sequence[:sequence_length].ljust(sequence_length, '\0')
+                    sequence_ends[offset:offset + sequence_length] = sequence.encode('ascii')
+        return length
+
+
 class ReadPositionMatrix(object):
     """A class to check for PCR duplicates.
-       A set storing all possible
-       start sites. Checks if read is already in the set.
+       The start sites of a read pair are packed into one 64 bit integer
+       key (smaller start in the upper 32 bits). The keys are stored per
+       chromosome pair: new keys are collected in a small python set and
+       are regularly flushed into sorted numpy uint64 arrays (runs). Runs of
+       similar size are merged, such that the number of runs per chromosome
+       pair stays logarithmic in the number of keys and a lookup is a binary
+       search per run.
+
+       If pMaxMemory (in MB) is given, the largest runs are written to
+       pTmpDir and memory mapped as soon as the runs kept in memory
+       exceed this limit.
     """
 
-    def __init__(self):
+    def __init__(self, pMaxMemory=None, pTmpDir=None, pBufferSize=1e6):
         """
         >>> rp = ReadPositionMatrix()
         >>> rp.is_duplicated('1', 0, '2', 0)
         False
         >>> rp.is_duplicated('1', 0, '2', 0)
         True
+        >>> rp.is_duplicated('2', 10, '1', 20)
+        False
+        >>> rp.is_duplicated('1', 20, '2', 10)
+        True
+
+        Keys which have been flushed to the runs, or written to disk, are still found
+        >>> rp = ReadPositionMatrix(pMaxMemory=0, pBufferSize=2)
+        >>> [rp.is_duplicated('1', i, '1', i + 1) for i in range(5)]
+        [False, False, False, False, False]
+        >>> [rp.is_duplicated('1', i + 1, '1', i) for i in range(6)]
+        [True, True, True, True, True, False]
+        >>> len(rp.spilled_files) > 0
+        True
+        >>> rp.close()
         """
 
-        self.pos_matrix = set()
+        self.chrom_ids = {}
+        # (chrom id, chrom id) -> set of not yet flushed keys
+        self.pos_buffer = {}
+        # (chrom id, chrom id) -> list of sorted np.uint64 arrays
+        self.pos_runs = {}
+        self.buffer_size = int(max(1, pBufferSize))
+        self.number_buffered = 0
+        self.max_memory = None if pMaxMemory is None else pMaxMemory * 1024 * 1024
+        self.tmp_dir = pTmpDir
+        self.spill_dir = None
+        self.spill_counter = 0
+        self.spilled_files = []
 
     def is_duplicated(self, chrom1, start1, chrom2, start2):
-        if chrom1 < chrom2:
-            id_string = "{}-{}".format(chrom1, chrom2)
-        else:
-            id_string = "{}-{}".format(chrom2, chrom1)
+        chrom_pair = self._chrom_pair(chrom1, chrom2)
 
         if start1 < start2:
-            id_string += "-{}-{}".format(start1, start2)
+            key = (start1 << 32) | start2
         else:
-            id_string += "-{}-{}".format(start2, start1)
+            key = (start2 << 32) | start1
 
-        if id_string in self.pos_matrix:
+        buffer = self.pos_buffer.get(chrom_pair)
+        if buffer is None:
+            buffer = set()
+            self.pos_buffer[chrom_pair] = buffer
+        elif key in buffer:
             return True
+
+        if chrom_pair in self.pos_runs:
+            key_ = np.uint64(key)
+            for run in self.pos_runs[chrom_pair]:
+                index = run.searchsorted(key_)
+                if index < len(run) and run[index] == key_:
+                    return True
+
+        buffer.add(key)
+        self.number_buffered += 1
+        if self.number_buffered >= self.buffer_size:
+            self.flush()
+        return False
+
+    def _chrom_pair(self, chrom1, chrom2):
+        try:
+            chrom_id1 = self.chrom_ids[chrom1]
+        except KeyError:
+            chrom_id1 = self.chrom_ids.setdefault(chrom1, len(self.chrom_ids))
+        try:
+            chrom_id2 = self.chrom_ids[chrom2]
+        except KeyError:
+            chrom_id2 = self.chrom_ids.setdefault(chrom2, len(self.chrom_ids))
+        if chrom_id1 < chrom_id2:
+            return (chrom_id1, chrom_id2)
+        return (chrom_id2, chrom_id1)
+
+    def flush(self):
+        """Moves all buffered keys into sorted runs and merges runs of similar size."""
+        for chrom_pair, buffer in self.pos_buffer.items():
+            if not buffer:
+                continue
+            run = np.fromiter(buffer, dtype=np.uint64, count=len(buffer))
+            run.sort()
+            buffer.clear()
+            runs = self.pos_runs.setdefault(chrom_pair, [])
+            runs.append(run)
+            # the runs are kept in decreasing size, a new run is merged
+            # as long as it is at least half as large as its predecessor
+            while len(runs) > 1 and 2 * len(runs[-1]) >= len(runs[-2]):
+                run = runs.pop()
+                previous_run = runs.pop()
+                merged = np.concatenate((previous_run, run))
+                merged.sort(kind='mergesort')
+                runs.append(merged)
+                self._remove_spilled(previous_run)
+                self._remove_spilled(run)
+        self.number_buffered = 0
+        self.pos_buffer = {}
+
+        if self.max_memory is not None:
+            self._spill()
+
+    def _spill(self):
+        """Writes the largest in-memory runs to disk until the memory limit is reached."""
+        in_memory = [(run.nbytes, chrom_pair, i) for chrom_pair, runs in self.pos_runs.items()
+                     for i, run in enumerate(runs) if not isinstance(run, np.memmap)]
+        memory = sum(run[0] for run in in_memory)
+        in_memory.sort(reverse=True)
+        for nbytes, chrom_pair, i in in_memory:
+            if memory <= self.max_memory:
+                break
+            if self.spill_dir is None:
+                self.spill_dir = mkdtemp(prefix='hicBuildMatrix_duplicates_', dir=self.tmp_dir)
+            self.spill_counter += 1
+            file_name = os.path.abspath(os.path.join(self.spill_dir, '{}.npy'.format(self.spill_counter)))
+            np.save(file_name, self.pos_runs[chrom_pair][i])
+            self.spilled_files.append(file_name)
+            self.pos_runs[chrom_pair][i] = np.load(file_name, mmap_mode='r')
+            memory -= nbytes
+
+    def _remove_spilled(self, pRun):
+        if isinstance(pRun, np.memmap):
+            file_name = pRun.filename
+            del pRun
+            self.spilled_files.remove(file_name)
+            unlink(file_name)
+
+    def close(self):
+        """Deletes the runs written to disk."""
+        self.pos_buffer = {}
+        self.pos_runs = {}
+        self.spilled_files = []
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+
+
+class PairsFileWriter(object):
+    """Writes read pairs to a block compressed (bgzip) file in the 4DN pairs format.
+
+       The pairs are stored as upper triangle, (chr1, pos1) <= (chr2, pos2), with the chromosome
+       order given by pChromSizes. Because the file is sorted by chr1-chr2-pos1-pos2, the pairs
+       are collected in sorted runs of at most pMaxPairsInMemory pairs. The runs are written to
+       pTmpDir and merged when the file is closed.
+
+       As position the 1-based middle of the read is stored, this is the position used to assign
+       a read to a bin.
+    """
+
+    dtype = [('chrom1', np.int32), ('chrom2', np.int32), ('pos1', np.int64), ('pos2', np.int64),
+             ('strand1', 'S1'), ('strand2', 'S1')]
+
+    def __init__(self, pFileName, pChromSizes, pGenomeAssembly=None, pMaxPairsInMemory=1e7, pTmpDir=None):
+        """
+        >>> import tempfile, gzip
+        >>> _file = tempfile.NamedTemporaryFile(suffix='.pairs.gz', delete=False)
+        >>> _file.close()
+        >>> writer = PairsFileWriter(_file.name, [('chr1', 100), ('chr2', 50)], pMaxPairsInMemory=2)
+        >>> writer.add(np.array([1, 0, 0]), np.array([10, 20, 5]), np.array([False, True, False]),
+        ...            np.array([0, 0, 0]), np.array([30, 10, 5]), np.array([True, False, False]))
+        >>> writer.close()
+        >>> [line.strip() for line in gzip.open(_file.name, 'rt') if not line.startswith('#')]
+        ['.\\tchr1\\t5\\tchr1\\t5\\t+\\t+', '.\\tchr1\\t10\\tchr1\\t20\\t+\\t-', '.\\tchr1\\t30\\tchr2\\t10\\t-\\t+']
+        >>> read_pairs_file_header(_file.name)
+        ([('chr1', 100), ('chr2', 50)], ['readID', 'chr1', 'pos1', 'chr2', 'pos2', 'strand1', 'strand2'])
+        >>> os.unlink(_file.name)
+        """
+        self.file_name = pFileName
+        self.chrom_sizes = pChromSizes
+        self.genome_assembly = pGenomeAssembly
+        self.max_pairs_in_memory = int(pMaxPairsInMemory)
+        self.tmp_dir = pTmpDir
+        self.spill_dir = None
+        self.spilled_files = []
+        self.pairs = []
+        self.number_of_pairs = 0
+
+    def add(self, pChrom1, pPos1, pIsReverse1, pChrom2, pPos2, pIsReverse2):
+        """Adds the pairs given as arrays of chromosome indices, positions and strands."""
+        swap = (pChrom1 > pChrom2) | ((pChrom1 == pChrom2) & (pPos1 > pPos2))
+        pairs = np.empty(len(pChrom1), dtype=self.dtype)
+        pairs['chrom1'] = np.where(swap, pChrom2, pChrom1)
+        pairs['chrom2'] = np.where(swap, pChrom1, pChrom2)
+        pairs['pos1'] = np.where(swap, pPos2, pPos1)
+        pairs['pos2'] = np.where(swap, pPos1, pPos2)
+        pairs['strand1'] = np.where(np.where(swap, pIsReverse2, pIsReverse1), b'-', b'+')
+        pairs['strand2'] = np.where(np.where(swap, pIsReverse1, pIsReverse2), b'-', b'+')
+        self.pairs.append(pairs)
+        self.number_of_pairs += len(pairs)
+        if self.number_of_pairs >= self.max_pairs_in_memory:
+            self._spill()
+
+    def _sorted_pairs(self):
+        if self.pairs:
+            pairs = np.concatenate(self.pairs)
         else:
-            self.pos_matrix.add(id_string)
-            return False
+            pairs = np.empty(0, dtype=self.dtype)
+        self.pairs = []
+        self.number_of_pairs = 0
+        return np.sort(pairs, order=['chrom1', 'chrom2', 'pos1', 'pos2'], kind='mergesort')
+
+    def _spill(self):
+        if self.spill_dir is None:
+            self.spill_dir = mkdtemp(prefix='hicBuildMatrix_pairs_', dir=self.tmp_dir)
+        file_name = os.path.join(self.spill_dir, '{}.npy'.format(len(self.spilled_files)))
+        np.save(file_name, self._sorted_pairs())
+        self.spilled_files.append(file_name)
+
+    @staticmethod
+    def _iterate_run(pRun, pBlockSize=100000):
+        for i in range(0, len(pRun), pBlockSize):
+            block = pRun[i:i + pBlockSize]
+            yield from zip(block['chrom1'].tolist(), block['chrom2'].tolist(),
+                           block['pos1'].tolist(), block['pos2'].tolist(),
+                           block['strand1'].tolist(), block['strand2'].tolist())
+
+    def close(self):
+        """Merges the sorted runs and writes the pairs file."""
+        runs = [np.load(file_name, mmap_mode='r') for file_name in self.spilled_files]
+        runs.append(self._sorted_pairs())
+        chrom_names = [chrom for chrom, _ in self.chrom_sizes]
+
+        header = ["## pairs format v1.0",
+                  "#sorted: chr1-chr2-pos1-pos2",
+                  "#shape: upper triangle"]
+        if self.genome_assembly:
+            header.append("#genome_assembly: {}".format(self.genome_assembly))
+        for chrom, size in self.chrom_sizes:
+            header.append("#chromsize: {} {}".format(chrom, size))
+        header.append("#columns: readID chr1 pos1 chr2 pos2 strand1 strand2")
+
+        try:
+            with BGZFile(self.file_name, 'wb') as pairs_file:
+                pairs_file.write(('\n'.join(header) + '\n').encode())
+                lines = []
+                for chrom1, chrom2, pos1, pos2, strand1, strand2 in heapq.merge(*[self._iterate_run(run) for run in runs]):
+                    lines.append(".\t{}\t{}\t{}\t{}\t{}\t{}\n".format(chrom_names[chrom1], pos1, chrom_names[chrom2], pos2,
+                                                                      strand1.decode(), strand2.decode()))
+                    if len(lines) >= 100000:
+                        pairs_file.write(''.join(lines).encode())
+                        lines = []
+                pairs_file.write(''.join(lines).encode())
+        except BaseException:
+            runs = None
+            self.discard()
+            raise
+
+        runs = None
+        self._remove_spill_dir()
+
+    def discard(self):
+        """Deletes the collected pairs and a partially written pairs file, nothing is written."""
+        self.pairs = []
+        self.number_of_pairs = 0
+        self._remove_spill_dir()
+        if os.path.exists(self.file_name):
+            unlink(self.file_name)
+
+    def _remove_spill_dir(self):
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+        self.spilled_files = []
+
+
+class PixelSink(object):
+    """Collects the contacts of the interaction matrix without building a sparse matrix in memory.
+
+       Each contact (row, col) is folded into the upper triangle and stored as the key
+       min(row, col) * pMatrixSize + max(row, col). New keys are buffered and regularly
+       aggregated into sorted runs of (key, count). Runs of similar size are merged such
+       that the number of runs stays logarithmic in the number of pixels.
+
+       If pMaxMemory (in MB) is given, the largest runs are written to pTmpDir and memory
+       mapped as soon as the runs kept in memory exceed this limit. The pixels are merged
+       from all runs in row order by pixels(), which can be used by cooler.create_cooler directly.
+
+       With pBinIdMap the added bins are translated to the bins of a lower resolution matrix,
+       bins mapped to -1 are skipped.
+    """
+
+    def __init__(self, pMatrixSize, pMaxMemory=None, pTmpDir=None, pBufferSize=1e7, pBinIdMap=None):
+        """
+        >>> sink = PixelSink(4, pMaxMemory=0, pBufferSize=2)
+        >>> sink.add(np.array([0, 3, 1]), np.array([1, 0, 1]))
+        >>> sink.add(np.array([1, 0, 2]), np.array([0, 3, 3]))
+        >>> len(sink.spilled_files) > 0
+        True
+        >>> [chunk.values.tolist() for chunk in sink.pixels(pChunkSize=2)]
+        [[[0, 1, 2], [0, 3, 2]], [[1, 1, 1], [2, 3, 1]]]
+        >>> sink.to_coo().toarray()
+        array([[0, 2, 0, 2],
+               [0, 1, 0, 0],
+               [0, 0, 0, 1],
+               [0, 0, 0, 0]])
+        >>> sink.close()
+
+        >>> sink = PixelSink(2, pBinIdMap=np.array([0, 0, 1, -1]))
+        >>> sink.add(np.array([0, 1, 2, 3]), np.array([1, 2, 2, 0]))
+        >>> sink.to_coo().toarray()
+        array([[1, 1],
+               [0, 1]])
+        """
+        self.matrix_size = int(pMatrixSize)
+        self.bin_id_map = pBinIdMap
+        self.max_memory = None if pMaxMemory is None else pMaxMemory * 1024 * 1024
+        self.buffer_size = int(max(1, pBufferSize))
+        if self.max_memory is not None:
+            # the buffer holds 8 bytes per key, aggregating it needs about the same again
+            self.buffer_size = int(max(1, min(self.buffer_size, self.max_memory // 16)))
+        self.tmp_dir = pTmpDir
+        self.buffer = []
+        self.number_buffered = 0
+        # list of (keys, counts) pairs of sorted arrays, in decreasing size
+        self.runs = []
+        self.spill_dir = None
+        self.spill_counter = 0
+        self.spilled_files = []
+
+    def add(self, pRow, pCol, pData=None):
+        """Adds the contacts between the bins pRow and pCol, optionally weighted by pData."""
+        row = np.asarray(pRow, dtype=np.int64)
+        col = np.asarray(pCol, dtype=np.int64)
+        if pData is None:
+            pData = np.ones(len(row), dtype=np.int64)
+        data = np.asarray(pData, dtype=np.int64)
+        if self.bin_id_map is not None:
+            row = self.bin_id_map[row]
+            col = self.bin_id_map[col]
+            mask = (row >= 0) & (col >= 0)
+            row, col, data = row[mask], col[mask], data[mask]
+        keys = np.minimum(row, col) * self.matrix_size + np.maximum(row, col)
+        self.buffer.append((keys, data))
+        self.number_buffered += len(keys)
+        if self.number_buffered >= self.buffer_size:
+            self.flush()
+
+    @staticmethod
+    def _aggregate(pKeys, pCounts):
+        keys, inverse = np.unique(pKeys, return_inverse=True)
+        counts = np.bincount(inverse.ravel(), weights=pCounts, minlength=len(keys)).astype(np.int64)
+        return keys, counts
+
+    def flush(self):
+        """Moves all buffered contacts into a sorted run and merges runs of similar size."""
+        if self.buffer:
+            run = self._aggregate(np.concatenate([keys for keys, _ in self.buffer]),
+                                  np.concatenate([counts for _, counts in self.buffer]))
+            self.buffer = []
+            self.number_buffered = 0
+            self.runs.append(run)
+            while len(self.runs) > 1 and 2 * len(self.runs[-1][0]) >= len(self.runs[-2][0]):
+                run = self.runs.pop()
+                previous_run = self.runs.pop()
+                self.runs.append(self._aggregate(np.concatenate((previous_run[0], run[0])),
+                                                 np.concatenate((previous_run[1], run[1]))))
+                self._remove_spilled(previous_run)
+                self._remove_spilled(run)
+        if self.max_memory is not None:
+            self._spill()
+
+    def _spill(self):
+        """Writes the largest in-memory runs to disk until the memory limit is reached."""
+        in_memory = [(run[0].nbytes + run[1].nbytes, i) for i, run in enumerate(self.runs)
+                     if not isinstance(run[0], np.memmap)]
+        memory = sum(nbytes for nbytes, _ in in_memory)
+        in_memory.sort(reverse=True)
+        for nbytes, i in in_memory:
+            if memory <= self.max_memory:
+                break
+            if self.spill_dir is None:
+                self.spill_dir = mkdtemp(prefix='hicBuildMatrix_pixels_', dir=self.tmp_dir)
+            run = []
+            for array in self.runs[i]:
+                self.spill_counter += 1
+                file_name = os.path.abspath(os.path.join(self.spill_dir, '{}.npy'.format(self.spill_counter)))
+                np.save(file_name, array)
+                self.spilled_files.append(file_name)
+                run.append(np.load(file_name, mmap_mode='r'))
+            self.runs[i] = tuple(run)
+            memory -= nbytes
+
+    def _remove_spilled(self, pRun):
+        for array in pRun:
+            if isinstance(array, np.memmap):
+                file_name = array.filename
+                del array
+                self.spilled_files.remove(file_name)
+                unlink(file_name)
+
+    def pixels(self, pChunkSize=1e7):
+        """
+        Yields the pixels of the upper triangle as data frames with the columns bin1_id, bin2_id
+        and count, sorted by bin1_id and bin2_id. A chunk holds all pixels of consecutive rows,
+        about pChunkSize pixels per chunk are merged from the runs at once.
+        """
+        self.flush()
+        # position of the first key of each row within each run
+        row_keys = np.arange(self.matrix_size + 1, dtype=np.int64) * self.matrix_size
+        row_offsets = [np.searchsorted(keys, row_keys) for keys, _ in self.runs]
+        pixels_per_row = np.zeros(self.matrix_size + 1, dtype=np.int64)
+        for offsets in row_offsets:
+            pixels_per_row += offsets
+        row_limits = np.unique(np.searchsorted(pixels_per_row,
+                                               np.arange(0, pixels_per_row[-1], max(1, int(pChunkSize))),
+                                               side='right') - 1)
+        row_limits = np.append(row_limits, self.matrix_size)
+
+        for row_start, row_end in zip(row_limits[:-1], row_limits[1:]):
+            keys = []
+            counts = []
+            for (run_keys, run_counts), offsets in zip(self.runs, row_offsets):
+                keys.append(run_keys[offsets[row_start]:offsets[row_end]])
+                counts.append(run_counts[offsets[row_start]:offsets[row_end]])
+            if len(self.runs) == 1:
+                keys, counts = np.asarray(keys[0]), np.asarray(counts[0])
+            else:
+                keys, counts = self._aggregate(np.concatenate(keys), np.concatenate(counts))
+            if len(keys) == 0:
+                continue
+            yield pd.DataFrame({'bin1_id': keys // self.matrix_size,
+                                'bin2_id': keys % self.matrix_size,
+                                'count': counts}, columns=['bin1_id', 'bin2_id', 'count'])
+
+    def to_coo(self):
+        """Returns the upper triangle of the matrix as coo_matrix."""
+        row = []
+        col = []
+        data = []
+        for chunk in self.pixels():
+            row.append(chunk['bin1_id'].values)
+            col.append(chunk['bin2_id'].values)
+            data.append(chunk['count'].values)
+        if not row:
+            return coo_matrix((self.matrix_size, self.matrix_size), dtype=np.int64)
+        return coo_matrix((np.concatenate(data), (np.concatenate(row), np.concatenate(col))),
+                          shape=(self.matrix_size, self.matrix_size))
+
+    def close(self):
+        """Deletes the runs written to disk."""
+        self.buffer = []
+        self.runs = []
+        self.spilled_files = []
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
 
 
 def parse_arguments(args=None):
@@ -101,11 +637,11 @@ def parse_arguments(args=None):
 
     # define the arguments
     parserRequired.add_argument('--samFiles', '-s',
-                                help='The two PE alignment sam files to process',
+                                help='The two PE alignment sam files to process. '
+                                'Not needed if the matrix is built from a pairs file with --inputPairs.',
                                 metavar='two sam files',
                                 nargs=2,
-                                type=argparse.FileType('r'),
-                                required=True)
+                                type=argparse.FileType('r'))
 
     parserRequired.add_argument('--outFileName', '-o',
                                 help='Output file name for the Hi-C matrix.',
@@ -116,27 +652,26 @@ def parse_arguments(args=None):
     parserRequired.add_argument('--QCfolder',
                                 help='Path of folder to save the quality control data for the matrix. The log files '
                                 'produced this way can be loaded into `hicQC` in order to compare the quality of multiple '
-                                'Hi-C libraries.',
-                                metavar='FOLDER',
-                                required=True)
+                                'Hi-C libraries. Not needed if --inputPairs is used.',
+                                metavar='FOLDER')
     parserRequired.add_argument('--restrictionCutFile', '-rs',
                                 help='BED file(s) with all restriction cut sites '
                                 '(output of "hicFindRestSite" command). '
                                 'Should only contain the restriction sites of the same genome which has been used '
                                 'to generate the input sam files. Using regions of a different genome version can '
                                 'generate false results! To use more than one restriction enzyme, generate '
-                                'a restrictionCutFile for each enzyne and list them space seperated.',
+                                'a restrictionCutFile for each enzyne and list them space seperated. '
+                                'If --inputPairs is used, it is only needed to build a matrix of restriction site resolution.',
                                 type=argparse.FileType('r'),
                                 metavar='BED file',
-                                nargs='+',
-                                required=True)
+                                nargs='+')
     parserRequired.add_argument('--restrictionSequence', '-seq',
                                 help='Sequence of the restriction site, if multiple are used, '
                                 'please list them space seperated. If a dangling sequence '
-                                'is listed at the same time, please preserve the same order.',
+                                'is listed at the same time, please preserve the same order. '
+                                'Not needed if --inputPairs is used.',
                                 type=str,
-                                nargs='+',
-                                required=True)
+                                nargs='+')
 
     parserRequired.add_argument('--danglingSequence',
                                 help='Sequence left by the restriction enzyme after cutting, if multiple are used, please list them space '
@@ -148,13 +683,29 @@ def parse_arguments(args=None):
                                 'of the restriction enzyme. The dangling sequence is used to classify and report reads '
                                 'whose 5\' end starts with such sequence as dangling-end reads. A significant portion '
                                 'of dangling-end reads in a sample are indicative of a problem with the re-ligation '
-                                'step of the protocol.',
+                                'step of the protocol. Not needed if --inputPairs is used.',
                                 type=str,
-                                nargs='+',
-                                required=True)
+                                nargs='+')
 
     parserOpt = parser.add_argument_group('Optional arguments')
 
+    parserOpt.add_argument('--inputPairs',
+                           help='Build the matrix from a pairs file (4DN format) instead of two bam files, for example '
+                           'from a file created with --outPairs. The pairs are only assigned to the bins, no further '
+                           'filtering or duplicate removal is done. This allows to build matrices of different bin '
+                           'sizes without reading the bam files again. The chromosome sizes are taken from the '
+                           '#chromsize header lines or from --chromosomeSizes.',
+                           metavar='pairs file',
+                           required=False)
+
+    parserOpt.add_argument('--outPairs',
+                           help='Write all valid Hi-C pairs, i.e. all pairs added to the matrix, to a sorted and '
+                           'block compressed (bgzip) pairs file in the 4DN format. As position the middle of the read '
+                           'is stored, which is the position used to assign a read to a bin. The file can be indexed '
+                           'with pairix and used with --inputPairs.',
+                           metavar='pairs file',
+                           required=False)
+
     parserOpt.add_argument('--outBam', '-b',
                            help='Output bam file to process. Optional parameter. '
                            'A bam file containing all valid Hi-C reads can be created '
@@ -265,6 +816,14 @@ def parse_arguments(args=None):
                            default=4,
                            type=int
                            )
+    parserOpt.add_argument('--decompressionThreads',
+                           help='Number of threads used by htslib to decompress each of the two input bam files. '
+                           'The two files are read by one thread each, independent of this value.'
+                           ' (Default: %(default)s).',
+                           required=False,
+                           default=1,
+                           type=int
+                           )
     parserOpt.add_argument('--inputBufferSize',
                            help='Size of the input buffer of each thread. 400,000 read pairs per input file per thread is the default value. '
                            'Reduce this value to decrease memory usage.',
@@ -297,6 +856,30 @@ def parse_arguments(args=None):
                            'get an estimation of the duplicated reads. ',
                            action='store_true'
                            )
+    parserOpt.add_argument('--duplicationCheckMaxMemory',
+                           help='Maximum memory in MB used to store the read start positions for the identification '
+                           'of duplicated read pairs. If more memory is needed, the positions are written to the '
+                           'folder given by --duplicationCheckTmpDir and accessed from there. '
+                           'If not set, all positions are kept in memory.',
+                           required=False,
+                           type=int)
+    parserOpt.add_argument('--duplicationCheckTmpDir',
+                           help='Folder to store the read start positions if --duplicationCheckMaxMemory is exceeded'
+                           ' (Default: the systems temporary folder).',
+                           required=False,
+                           default=None)
+    parserOpt.add_argument('--matrixMaxMemory',
+                           help='Maximum memory in MB used to collect the contacts of the interaction matrix. If more '
+                           'memory is needed, the contacts are written to the folder given by --matrixTmpDir and merged '
+                           'from there at the end. Only a cool output file is written without loading the whole matrix '
+                           'into memory. If not set, all contacts are kept in memory.',
+                           required=False,
+                           type=int)
+    parserOpt.add_argument('--matrixTmpDir',
+                           help='Folder to store the contacts if --matrixMaxMemory is exceeded'
+                           ' (Default: the systems temporary folder).',
+                           required=False,
+                           default=None)
     parserOpt.add_argument('--chromosomeSizes', '-cs',
                            help=('File with the chromosome sizes for your genome. A tab-delimited two column layout \"chr_name size\" is expected'
                                  'Usually the sizes can be determined from the SAM/BAM input files, however, '
@@ -524,6 +1107,39 @@ def check_dangling_end(read, dangling_sequences):
     return False
 
 
+def check_dangling_end_batch(pSequenceEnds, pIsReverse, pDanglingSequences):
+    """
+    Same as check_dangling_end for the sequence ends stored in a SharedRecordBatch.
+    pSequenceEnds is a uint8 array with one row per read, forward reads are left,
+    reverse reads right aligned. Returns a boolean array.
+
+    >>> ends = np.frombuffer(b'agctTTAAAAAGCT', dtype=np.uint8).reshape(2, 7)
+    >>> ds = {'pat_forw': 'AGCT', 'pat_rev': 'AGCT'}
+    >>> check_dangling_end_batch(ends, np.array([False, True]), ds).tolist()
+    [True, True]
+    >>> check_dangling_end_batch(ends, np.array([True, False]), ds).tolist()
+    [False, False]
+    >>> check_dangling_end_batch(ends, np.array([False, True]), {}).tolist()
+    [False, False]
+    """
+    ds = pDanglingSequences
+    is_dangling_end = np.zeros(len(pIsReverse), dtype=bool)
+    if 'pat_forw' not in ds or 'pat_rev' not in ds:
+        return is_dangling_end
+    # upper case of the ascii letters
+    sequence_ends = np.where((pSequenceEnds >= ord('a')) & (pSequenceEnds <= ord('z')),
+                             pSequenceEnds - (ord('a') - ord('A')), pSequenceEnds)
+    pattern_forward = np.frombuffer(ds['pat_forw'].encode('ascii'), dtype=np.uint8)
+    pattern_reverse = np.frombuffer(ds['pat_rev'].encode('ascii'), dtype=np.uint8)
+    if len(pattern_forward) <= sequence_ends.shape[1]:
+        starts_with = np.all(sequence_ends[:, :len(pattern_forward)] == pattern_forward, axis=1)
+        is_dangling_end |= ~pIsReverse & starts_with
+    if len(pattern_reverse) <= sequence_ends.shape[1]:
+        ends_with = np.all(sequence_ends[:, sequence_ends.shape[1] - len(pattern_reverse):] == pattern_reverse, axis=1)
+        is_dangling_end |= pIsReverse & ends_with
+    return is_dangling_end
+
+
 def get_supplementary_alignment(read, pysam_obj):
     """Checks if a read has a supplementary alignment
     :param read pysam AlignedSegment
@@ -671,9 +1287,101 @@ def enlarge_bins(bin_intervals, chrom_sizes):
     return bin_intervals
 
 
+class BamReaderThread(Thread):
+    """Reads a bam file in a background thread.
+
+       The records are grouped with their supplementary alignments, 'not primary'
+       alignments are skipped. The groups are handed over in chunks via a bounded
+       queue, such that the reading of the two input files, and with pThreads > 1 the
+       decompression by htslib, takes place while the main process classifies
+       the read pairs. The object is an iterator over (read, supplementary list) tuples.
+
+       Besides the reading, the time the reader thread waited because the queue was full
+       (the consumer is slower) and the time the consumer waited for records
+       (the reader is slower) are recorded.
+    """
+
+    def __init__(self, pFileName, pThreads=1, pChunkSize=10000, pMaxChunks=20):
+        Thread.__init__(self)
+        self.daemon = True
+        self.file = pysam.Samfile(pFileName, 'rb', threads=pThreads)
+        self.chunk_size = pChunkSize
+        self.queue = ThreadQueue(maxsize=pMaxChunks)
+        self.stop_event = Event()
+        self.reader_wait_time = 0.0
+        self.consumer_wait_time = 0.0
+        self._chunk = []
+        self._chunk_index = 0
+        self._done = False
+
+    def run(self):
+        try:
+            iterator = iter(self.file)
+            chunk = []
+            while not self.stop_event.is_set():
+                try:
+                    read = next(iterator)
+                except StopIteration:
+                    break
+                # skip 'not primary' alignments
+                if read.flag & 256 == 256:
+                    continue
+                # check for supplementary alignments
+                try:
+                    supplementary_list = get_supplementary_alignment(read, iterator)
+                except StopIteration:
+                    supplementary_list = None
+                chunk.append((read, supplementary_list))
+                if len(chunk) >= self.chunk_size:
+                    self._put(chunk)
+                    chunk = []
+            if chunk:
+                self._put(chunk)
+            self._put(None)
+        except Exception as exp:
+            self._put(exp)
+
+    def _put(self, pItem):
+        start_time = time.time()
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(pItem, timeout=1)
+                break
+            except Full:
+                continue
+        self.reader_wait_time += time.time() - start_time
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._chunk_index >= len(self._chunk):
+            if self._done:
+                raise StopIteration
+            start_time = time.time()
+            chunk = self.queue.get()
+            self.consumer_wait_time += time.time() - start_time
+            if chunk is None:
+                self._done = True
+                raise StopIteration
+            if isinstance(chunk, Exception):
+                self._done = True
+                raise chunk
+            self._chunk = chunk
+            self._chunk_index = 0
+        self._chunk_index += 1
+        return self._chunk[self._chunk_index - 1]
+
+    def close(self):
+        self.stop_event.set()
+        self.join(timeout=10)
+        self.file.close()
+
+
 def readBamFiles(pFileOneIterator, pFileTwoIterator, pNumberOfItemsPerBuffer, pSkipDuplicationCheck, pReadPosMatrix, pRefId2name, pMinMappingQuality):
     """Read the two bam input files into n buffers each with pNumberOfItemsPerBuffer
-        with n = number of processes. The duplication check is handled here too."""
+        with n = number of processes. The duplication check is handled here too.
+        pFileOneIterator and pFileTwoIterator are BamReaderThread objects."""
     buffer_mate1 = []
     buffer_mate2 = []
     duplicated_pairs = 0
@@ -686,40 +1394,20 @@ def readBamFiles(pFileOneIterator, pFileTwoIterator, pNumberOfItemsPerBuffer, pS
     iter_num = 0
     while j < pNumberOfItemsPerBuffer:
         try:
-            mate1 = next(pFileOneIterator)
-            mate2 = next(pFileTwoIterator)
+            mate1, mate1_supplementary_list = next(pFileOneIterator)
+            mate2, mate2_supplementary_list = next(pFileTwoIterator)
         except StopIteration:
             all_data_read = True
             break
         iter_num += 1
 
-        # skip 'not primary' alignments
-        while mate1.flag & 256 == 256:
-            try:
-                mate1 = next(pFileOneIterator)
-            except StopIteration:
-                all_data_read = True
-                break
-        while mate2.flag & 256 == 256:
-            try:
-                mate2 = next(pFileTwoIterator)
-            except StopIteration:
-                all_data_read = True
-                break
-
         assert mate1.qname == mate2.qname, "FATAL ERROR {} {} " \
             "Be sure that the sam files have the same read order " \
             "If using Bowtie2 or Hisat2 add " \
             "the --reorder option".format(mate1.qname, mate2.qname)
 
-        # check for supplementary alignments
-        # (needs to be done before skipping any unmapped reads
-        # to keep the order of the two bam files in sync)
-        mate1_supplementary_list = get_supplementary_alignment(
-            mate1, pFileOneIterator)
-        mate2_supplementary_list = get_supplementary_alignment(
-            mate2, pFileTwoIterator)
-
+        # the supplementary alignments are collected by the reader
+        # threads, 'not primary' alignments are already skipped
         if mate1_supplementary_list:
             mate1 = get_correct_map(mate1, mate1_supplementary_list)
 
@@ -773,23 +1461,90 @@ def readBamFiles(pFileOneIterator, pFileTwoIterator, pNumberOfItemsPerBuffer, pS
     return buffer_mate1, buffer_mate2, False, duplicated_pairs, one_mate_unmapped, one_mate_not_unique, one_mate_low_quality, iter_num - len(buffer_mate1)
 
 
-def process_data(pMateBuffer1, pMateBuffer2, pMinMappingQuality,
+def find_bin_index(pPosition, pStart, pEnd, pBinBegin, pBinEnd):
+    """
+    Binary search of the bins containing the positions. For each position the search
+    is done between the indices pStart and pEnd (both inclusive) of the sorted bins
+    of its chromosome. A position is contained in a bin if begin <= position <= end.
+    All positions are searched at once, the search path is the same as the one of a
+    scalar binary search. Returns the bin index or -1 if no bin was found.
+
+    >>> begin = np.array([0, 10, 20, 0, 50])
+    >>> end = np.array([10, 20, 30, 40, 100])
+    >>> find_bin_index(np.array([5, 25, 35, 60, 45, 5]), np.array([0, 0, 0, 3, 3, 0]),
+    ...                np.array([2, 2, 2, 4, 4, -1]), begin, end)
+    array([ 0,  2, -1,  4, -1, -1])
+    """
+    start = np.array(pStart, dtype=np.int64)
+    end = np.array(pEnd, dtype=np.int64)
+    bin_index = np.full(len(pPosition), -1, dtype=np.int64)
+    active = np.flatnonzero(start <= end)
+    while len(active) > 0:
+        middle = (start[active] + end[active]) // 2
+        position = pPosition[active]
+        begin = pBinBegin[middle]
+        found = (begin <= position) & (position <= pBinEnd[middle])
+        bin_index[active[found]] = middle[found]
+        left = ~found & (begin > position)
+        right = ~found & ~left
+        end[active[left]] = middle[left] - 1
+        start[active[right]] = middle[right] + 1
+        active = active[~found]
+        active = active[start[active] <= end[active]]
+    return bin_index
+
+
+def get_restriction_sites_between_mates(pRfPositions, pChrom, pMate1Pos, pMate1Qlen, pMate2Pos, pMate2Qlen, pRestrictionSequence):
+    """
+    Returns the sorted restriction sites between the two mate ends. The interval used is:
+    start of fragment + length of restriction sequence
+    end of fragment - length of restriction sequence
+    the restriction sequence length is subtracted
+    such that only fragments internally containing
+    the restriction site are identified
+    """
+    if pChrom not in pRfPositions:
+        return []
+    frag_start = min(pMate1Pos, pMate2Pos) + len(pRestrictionSequence)
+    frag_end = max(pMate1Pos + pMate1Qlen, pMate2Pos + pMate2Qlen) - len(pRestrictionSequence)
+    return sorted(pRfPositions[pChrom][int(frag_start): int(frag_end)])
+
+
+def add_coverage(pCoverage, pStart, pEnd):
+    """
+    Increases the coverage by one for all indices in [pStart[i], pEnd[i]).
+    pCoverage is a synchronized multiprocessing.sharedctypes.Array, it is locked during the update.
+    """
+    length = pEnd - pStart
+    mask = length > 0
+    if not np.any(mask):
+        return
+    start = pStart[mask]
+    length = length[mask]
+    offsets = np.arange(length.sum()) - np.repeat(np.cumsum(length) - length, length)
+    indices, counts = np.unique(np.repeat(start, length) + offsets, return_counts=True)
+    with pCoverage.get_lock():
+        coverage = np.ctypeslib.as_array(pCoverage.get_obj())
+        coverage[indices] += counts.astype(coverage.dtype)
+
+
+def process_data(pRecordBatch, pBatchLength, pMinMappingQuality,
                  pKeepSelfCircles, pRestrictionSequence, pRemoveSelfLigation, pMatrixSize,
                  pRfPositions, pRefId2name,
                  pDanglingSequences, pBinsize, pResultIndex,
-                 pQueueOut, pTemplate, pOutputBamSet, pCounter,
+                 pQueueOut, pOutputBamSet, pCounter,
                  pSharedBinIntvalTree, pDictBinIntervalTreeIndex, pCoverage, pCoverageIndex,
-                 pOutputFileBufferDir, pRow, pCol, pData,
+                 pRow, pCol, pData,
                  pMaxInsertSize, pQuickQCMode):
     """
-    This function computes for a given number of elements in pMateBuffer1 and pMaterBuffer2 a partial interaction matrix.
+    This function computes for the first pBatchLength read pairs stored in pRecordBatch a partial interaction matrix.
     This function is used by multiple processes to speed up the computation.
     All partial matrices are merged in the end into one interaction matrix.
 
     Parameters
     ----------
-    pMateBuffer1 : List of n reads of type 'pysam.libcalignedsegment.AlignedSegment' of sam input file 1
-    pMateBuffer2 : List of n reads of type 'pysam.libcalignedsegment.AlignedSegment' of sam input file 2
+    pRecordBatch : SharedRecordBatch, columnar shared memory buffer with the read pairs of sam input file 1 and 2
+    pBatchLength : integer, number of read pairs stored in pRecordBatch
     pMinMappingQuality : integer, minimum mapping quality of a read
     pKeepSelfCircles : boolean, if self circles should be kept
     pRestrictionSequence : List of String, the restriction sequence
@@ -799,21 +1554,17 @@ def process_data(pMateBuffer1, pMateBuffer2, pMinMappingQuality,
     pRefId2name : Tuple, Maps a reference id to a name
     pDanglingSequences : dict, dict of dangling sequences
     pBinsize : integer, the size of the bins
-    pResultIndex : integer, number of processs, range(0, threads). Is returned via the queue to have access to the right row, col and data array after the computation.
+    pResultIndex : integer, index of the record batch. Is returned via the queue to have access to the right row, col and data array after the computation.
     pQueueOut : multiprocessing.Queue, queue to return the computed counting variables:
             one_mate_unmapped, one_mate_low_quality, one_mate_not_unique, dangling_end, self_circle, self_ligation, same_fragment,
             mate_not_close_to_rf, count_inward, count_outward, count_left, count_right, inter_chromosomal, short_range, long_range,
-            pair_added, len(pMateBuffer1), pResultIndex, pCounter
-    pTemplate : The template for the output bam file
+            pair_added, pBatchLength, pResultIndex, pCounter, out_bam_index_buffer, computation time
     pOutputBamSet : If a output bam file should be written. Depending on the input parameter '--outBam'
-    pOutputName : String, Name of the partial bam file
-    pCounter : integer, value which is returned to the main process. The main process can than write a pCounter.bam_done file
-                to signal the background process, which is merging the partial bam files into one, that this dataset can be merged.
+    pCounter : integer, value which is returned to the main process to identify the processed batch.
     pSharedBinIntvalTree : multiprocessing.sharedctype.RawArray of C_Interval, stores the interval tree in a 1D-RawArray.
     pDictBinIntervalTreeIndex : dict, stores the information at which index position a given interval starts and ends in the 1D-array 'pSharedBinIntvalTree'
     pCoverage : multiprocessing.sharedctype.Array of c_uint, Stores the coverage in a 1D-Array
     pCoverageIndex :  multiprocessing.sharedctype.RawArray of C_Coverage, stores the information in the 1D-array 'pCoverage'
-    pOutputFileBufferDir : String, the directory where the partial output bam files are buffered. Default is '/dev/shm/'
     pRow : multiprocessing.sharedctype.RawArray of c_uint, Stores the row index information. It is available for all processes and does not need to be copied.
     pCol : multiprocessing.sharedctype.RawArray of c_uint, stores the column index information. It is available for all processes and does not need to be copied.
     pData : multiprocessing.sharedctype.RawArray of c_ushort, stores a 1 for each row - column pair. It is available for all processes and does not need to be copied.
@@ -844,247 +1595,449 @@ def process_data(pMateBuffer1, pMateBuffer2, pMinMappingQuality,
         pair_added = 0
 
         iter_num = 0
-        hic_matrix = None
+        start_time = time.time()
 
         out_bam_index_buffer = []
 
-        if pMateBuffer1 is None or pMateBuffer2 is None:
+        if pRecordBatch is None or pBatchLength == 0:
 
-            pQueueOut.put([hic_matrix, [one_mate_unmapped, one_mate_low_quality, one_mate_not_unique, dangling_end, self_circle, self_ligation, same_fragment,
-                                        mate_not_close_to_rf, count_inward, count_outward,
-                                        count_left, count_right, inter_chromosomal, short_range, long_range, pair_added, iter_num, pResultIndex, out_bam_index_buffer]])
+            pQueueOut.put([[one_mate_unmapped, one_mate_low_quality, one_mate_not_unique, dangling_end, self_circle, self_ligation, same_fragment,
+                            mate_not_close_to_rf, count_inward, count_outward,
+                            count_left, count_right, inter_chromosomal, short_range, long_range, pair_added, iter_num, pResultIndex, pCounter, out_bam_index_buffer,
+                            time.time() - start_time]])
             return
 
-        while iter_num < len(pMateBuffer1) and iter_num < len(pMateBuffer2):
-            mate1 = pMateBuffer1[iter_num]
-            mate2 = pMateBuffer2[iter_num]
-            iter_num += 1
-
-            # check if reads belong to a bin
-            #
-            # pDictBinInterval stores the start and end position for each chromsome in the array 'pSharedBinIntvalTree'
-            # To get to the right interval a binary search is used.
-            mate_bins = []
-            mate_is_unasigned = False
-            for mate in [mate1, mate2]:
-                mate_ref = pRefId2name[mate.rname]
-                # find the middle genomic position of the read. This is used to
-                # find the bin it belongs to.
-                read_middle = mate.pos + int(mate.qlen / 2)
-                try:
-                    start, end = pDictBinIntervalTreeIndex[mate_ref]
-                    middle_pos = int((start + end) / 2)
-                    mate_bin = None
-                    while not start > end:
-                        if pSharedBinIntvalTree[middle_pos].begin <= read_middle and read_middle <= pSharedBinIntvalTree[middle_pos].end:
-                            mate_bin = pSharedBinIntvalTree[middle_pos]
-                            mate_is_unasigned = False
-                            break
-                        elif pSharedBinIntvalTree[middle_pos].begin > read_middle:
-                            end = middle_pos - 1
-                            middle_pos = int((start + end) / 2)
-                            mate_is_unasigned = True
-                        else:
-                            start = middle_pos + 1
-                            middle_pos = int((start + end) / 2)
-                            mate_is_unasigned = True
-
-                except KeyError:
-                    # for small contigs it can happen that they are not
-                    # in the bin_intval_tree keys if no restriction site is found
-                    # on the contig.
-                    mate_is_unasigned = True
-                    break
+        mate1 = pRecordBatch.mate(0)
+        mate2 = pRecordBatch.mate(1)
+        mate1_ref_id = mate1['ref_id'][:pBatchLength].astype(np.int64)
+        mate2_ref_id = mate2['ref_id'][:pBatchLength].astype(np.int64)
+        mate1_pos = mate1['pos'][:pBatchLength].astype(np.int64)
+        mate2_pos = mate2['pos'][:pBatchLength].astype(np.int64)
+        mate1_qlen = mate1['qlen'][:pBatchLength].astype(np.int64)
+        mate2_qlen = mate2['qlen'][:pBatchLength].astype(np.int64)
+        mate1_is_reverse = mate1['is_reverse'][:pBatchLength].astype(bool)
+        mate2_is_reverse = mate2['is_reverse'][:pBatchLength].astype(bool)
+
+        # check if reads belong to a bin
+        #
+        # pDictBinInterval stores the start and end position for each chromosome in the array 'pSharedBinIntvalTree'
+        # The bins of all reads are searched at once. As position the middle of the read is used.
+        bin_intervals = np.ctypeslib.as_array(pSharedBinIntvalTree)
+        chrom_start = np.zeros(len(pRefId2name), dtype=np.int64)
+        chrom_end = np.full(len(pRefId2name), -1, dtype=np.int64)
+        for i, chrom in enumerate(pRefId2name):
+            # for small contigs it can happen that they are not
+            # in the bin_intval_tree keys if no restriction site is found
+            # on the contig.
+            if chrom in pDictBinIntervalTreeIndex:
+                chrom_start[i], chrom_end[i] = pDictBinIntervalTreeIndex[chrom]
+
+        bin_begin = bin_intervals['begin'].astype(np.int64)
+        bin_end = bin_intervals['end'].astype(np.int64)
+        mate1_bin = find_bin_index(mate1_pos + mate1_qlen // 2, chrom_start[mate1_ref_id], chrom_end[mate1_ref_id], bin_begin, bin_end)
+        mate2_bin = find_bin_index(mate2_pos + mate2_qlen // 2, chrom_start[mate2_ref_id], chrom_end[mate2_ref_id], bin_begin, bin_end)
+
+        # if a mate is unassigned, it means it is not close
+        # to a restriction site
+        keep = (mate1_bin >= 0) & (mate2_bin >= 0)
+        mate_not_close_to_rf = int(pBatchLength - np.count_nonzero(keep))
+
+        same_chromosome = mate1_ref_id == mate2_ref_id
+        distance = np.abs(mate2_pos - mate1_pos)
+
+        # to identify 'inward' and 'outward' orientations
+        # the order or the mates in the genome has to be
+        # known.
+        """
+        outward
+        <---------------              ---------------->
 
-                # report no match case
-                if mate_bin is None:
-                    mate_is_unasigned = True
-                    break
-                mate_bin_id = mate_bin.data
-                mate_bins.append(mate_bin_id)
+        inward
+        --------------->              <----------------
 
-            # if a mate is unassigned, it means it is not close
-            # to a restriction site
-            if mate_is_unasigned is True:
-                mate_not_close_to_rf += 1
-                continue
+        same-strand-right
+        --------------->              ---------------->
 
-            # check if mates are in the same chromosome
-            if mate1.reference_id != mate2.reference_id:
-                orientation = 'diff_chromosome'
-            else:
-                # to identify 'inward' and 'outward' orientations
-                # the order or the mates in the genome has to be
-                # known.
-                if mate1.pos < mate2.pos:
-                    first_mate = mate1
-                    second_mate = mate2
-                else:
-                    first_mate = mate2
-                    second_mate = mate1
-
-                """
-                outward
-                <---------------              ---------------->
-
-                inward
-                --------------->              <----------------
-
-                same-strand-right
-                --------------->              ---------------->
-
-                same-strand-left
-                <---------------              <----------------
-                """
-
-                if not first_mate.is_reverse and second_mate.is_reverse:
-                    orientation = 'inward'
-                elif first_mate.is_reverse and not second_mate.is_reverse:
-                    orientation = 'outward'
-                elif first_mate.is_reverse and second_mate.is_reverse:
-                    orientation = 'same-strand-left'
-                else:
-                    orientation = 'same-strand-right'
-
-                # check self-circles
-                # self circles are defined as outward pairs that do not
-                # have a restriction sequence in between. The distance of < 25kb is
-                # used to only check close outward pairs as far apart pairs can not be self-circles
-                if abs(mate2.pos - mate1.pos) < 25000 and orientation == 'outward':
-                    has_rf = []
-
-                    if pRfPositions and pRestrictionSequence:
-                        # check if in between the two mate
-                        # ends the restriction fragment is found.
-                        # check for multiple restriction sequences
-                        for restrictionSequence in pRestrictionSequence:
-                            # the interval used is:
-                            # start of fragment + length of restriction sequence
-                            # end of fragment - length of restriction sequence
-                            # the restriction sequence length is subtracted
-                            # such that only fragments internally containing
-                            # the restriction site are identified
-                            frag_start = min(mate1.pos, mate2.pos) + \
-                                len(restrictionSequence)
-                            frag_end = max(mate1.pos + mate1.qlen, mate2.pos + mate2.qlen) - len(restrictionSequence)
-                            mate_ref = pRefId2name[mate1.rname]
-                            if mate_ref in pRfPositions:
-                                has_rf.extend(sorted(
-                                    pRfPositions[mate_ref][frag_start: frag_end]))
-
-                            if len(has_rf) == 0:
-                                self_circle += 1
-                                if not pKeepSelfCircles:
-                                    continue
-                if abs(mate2.pos - mate1.pos) < pMaxInsertSize and orientation == 'inward':
-                    # check for dangling ends if the restriction sequence is known and if they look
-                    # like 'same fragment'
-                    if pRestrictionSequence:
-                        if pDanglingSequences:
-
-                            # check for dangling ends in sequence. Stop check with first match
-                            one_match = False
-                            for restrictionSequence in pRestrictionSequence:
-                                if check_dangling_end(mate1, pDanglingSequences[restrictionSequence]) or \
-                                        check_dangling_end(mate2, pDanglingSequences[restrictionSequence]):
-                                    dangling_end[restrictionSequence] += 1
-                                    one_match = True
-                                    break
-                            if one_match:
-                                continue
-                    has_rf = []
-
-                    if pRfPositions and pRestrictionSequence:
-                        # check if in between the two mate
-                        # ends the restriction fragment is found.
-
-                        # the interval used is:
-                        # start of fragment + length of restriction sequence
-                        # end of fragment - length of restriction sequence
-                        # the restriction sequence length is subtracted
-                        # such that only fragments internally containing
-                        # the restriction site are identified
-
-                        for restrictionSequence in pRestrictionSequence:
-                            frag_start = min(mate1.pos, mate2.pos) + \
-                                len(restrictionSequence)
-                            frag_end = max(mate1.pos + mate1.qlen, mate2.pos + mate2.qlen) - len(restrictionSequence)
-                            mate_ref = pRefId2name[mate1.rname]
-                            if mate_ref in pRfPositions:
-                                has_rf.extend(sorted(
-                                    pRfPositions[mate_ref][frag_start: frag_end]))
-
-                    # case when there is no restriction fragment site between the
-                    # mates
+        same-strand-left
+        <---------------              <----------------
+        """
+        mate1_is_first = mate1_pos < mate2_pos
+        first_mate_is_reverse = np.where(mate1_is_first, mate1_is_reverse, mate2_is_reverse)
+        second_mate_is_reverse = np.where(mate1_is_first, mate2_is_reverse, mate1_is_reverse)
+        inward = keep & same_chromosome & ~first_mate_is_reverse & second_mate_is_reverse
+        outward = keep & same_chromosome & first_mate_is_reverse & ~second_mate_is_reverse
+        same_strand_left = keep & same_chromosome & first_mate_is_reverse & second_mate_is_reverse
+        same_strand_right = keep & same_chromosome & ~first_mate_is_reverse & ~second_mate_is_reverse
+
+        # check self-circles
+        # self circles are defined as outward pairs that do not
+        # have a restriction sequence in between. The distance of < 25kb is
+        # used to only check close outward pairs as far apart pairs can not be self-circles.
+        # Self circles are counted but, even if pKeepSelfCircles is not set, not removed.
+        if pRfPositions and pRestrictionSequence:
+            for pair_index in np.flatnonzero(outward & (distance < 25000)).tolist():
+                has_rf = []
+                # check if in between the two mate
+                # ends the restriction fragment is found.
+                # check for multiple restriction sequences
+                for restrictionSequence in pRestrictionSequence:
+                    has_rf.extend(get_restriction_sites_between_mates(pRfPositions, pRefId2name[mate1_ref_id[pair_index]],
+                                                                      mate1_pos[pair_index], mate1_qlen[pair_index],
+                                                                      mate2_pos[pair_index], mate2_qlen[pair_index],
+                                                                      restrictionSequence))
                     if len(has_rf) == 0:
-                        same_fragment += 1
-                        continue
-
-                    self_ligation += 1
-
-                    if pRemoveSelfLigation:
-                        # skip self ligations
-                        continue
-
-                # set insert size to save bam
-                mate1.isize = mate2.pos - mate1.pos
-                mate2.isize = mate1.pos - mate2.pos
+                        self_circle += 1
 
-            # if mate_bins, which is set in the previous section
-            # does not have size=2, it means that one
-            # of the exceptions happened
-            if len(mate_bins) != 2:
+        # check for dangling ends if the restriction sequence is known and if they look
+        # like 'same fragment'
+        if pRestrictionSequence and pDanglingSequences:
+            # check for dangling ends in sequence. Stop check with first match.
+            close_inward = inward & (distance < pMaxInsertSize)
+            for restrictionSequence in pRestrictionSequence:
+                candidates = np.flatnonzero(close_inward)
+                if len(candidates) == 0:
+                    break
+                is_dangling_end = np.zeros(len(candidates), dtype=bool)
+                for mate_index, mate_is_reverse in [(0, mate1_is_reverse), (1, mate2_is_reverse)]:
+                    is_dangling_end |= check_dangling_end_batch(pRecordBatch.sequence_ends(mate_index)[candidates],
+                                                                mate_is_reverse[candidates],
+                                                                pDanglingSequences[restrictionSequence])
+                dangling_end[restrictionSequence] += int(np.count_nonzero(is_dangling_end))
+                close_inward[candidates[is_dangling_end]] = False
+                keep[candidates[is_dangling_end]] = False
+
+        close_inward = keep & inward & (distance < pMaxInsertSize)
+        for pair_index in np.flatnonzero(close_inward).tolist():
+            has_rf = []
+            if pRfPositions and pRestrictionSequence:
+                # check if in between the two mate
+                # ends the restriction fragment is found.
+                for restrictionSequence in pRestrictionSequence:
+                    has_rf.extend(get_restriction_sites_between_mates(pRfPositions, pRefId2name[mate1_ref_id[pair_index]],
+                                                                      mate1_pos[pair_index], mate1_qlen[pair_index],
+                                                                      mate2_pos[pair_index], mate2_qlen[pair_index],
+                                                                      restrictionSequence))
+
+            # case when there is no restriction fragment site between the
+            # mates
+            if len(has_rf) == 0:
+                same_fragment += 1
+                keep[pair_index] = False
                 continue
 
-            # count type of pair (distance, orientation)
-            if mate1.reference_id != mate2.reference_id:
-                inter_chromosomal += 1
-
-            elif abs(mate2.pos - mate1.pos) < 20000:
-                short_range += 1
-            else:
-                long_range += 1
-
-            if orientation == 'inward':
-                count_inward += 1
-            elif orientation == 'outward':
-                count_outward += 1
-            elif orientation == 'same-strand-left':
-                count_left += 1
-            elif orientation == 'same-strand-right':
-                count_right += 1
-
-            for mate in [mate1, mate2]:
-                # fill in coverage vector
-                vec_start = int(max(0, mate.pos - mate_bin.begin) / pBinsize)
-                length_coverage = pCoverageIndex[mate_bin_id].end - \
-                    pCoverageIndex[mate_bin_id].begin
-                vec_end = min(length_coverage, int(
-                    vec_start + len(mate.seq) / pBinsize))
-                coverage_index = pCoverageIndex[mate_bin_id].begin + vec_start
-                coverage_end = pCoverageIndex[mate_bin_id].begin + vec_end
-                for i in range(coverage_index, coverage_end, 1):
-                    pCoverage[i] += 1
-
-            if not pQuickQCMode:
-                pRow[pair_added] = mate_bins[0]
-                pCol[pair_added] = mate_bins[1]
-                pData[pair_added] = np.uint8(1)
-
-            pair_added += 1
-            if pOutputBamSet:
-
-                out_bam_index_buffer.append(iter_num - 1)
+            self_ligation += 1
+
+            if pRemoveSelfLigation:
+                # skip self ligations
+                keep[pair_index] = False
+
+        # count type of pair (distance, orientation)
+        inter_chromosomal = int(np.count_nonzero(keep & ~same_chromosome))
+        short_range = int(np.count_nonzero(keep & same_chromosome & (distance < 20000)))
+        long_range = int(np.count_nonzero(keep & same_chromosome & (distance >= 20000)))
+
+        count_inward = int(np.count_nonzero(keep & inward))
+        count_outward = int(np.count_nonzero(keep & outward))
+        count_left = int(np.count_nonzero(keep & same_strand_left))
+        count_right = int(np.count_nonzero(keep & same_strand_right))
+
+        kept_pairs = np.flatnonzero(keep)
+        pair_added = len(kept_pairs)
+
+        mate1_bin_id = bin_intervals['data'][mate1_bin[kept_pairs]]
+        mate2_bin_id = bin_intervals['data'][mate2_bin[kept_pairs]]
+
+        # fill in coverage vector, the bin of the second mate is used for both mates
+        coverage_index = np.ctypeslib.as_array(pCoverageIndex)
+        coverage_begin = coverage_index['begin'][mate2_bin_id].astype(np.int64)
+        length_coverage = coverage_index['end'][mate2_bin_id].astype(np.int64) - coverage_begin
+        coverage_starts = []
+        coverage_ends = []
+        for mate_pos, mate in [(mate1_pos, mate1), (mate2_pos, mate2)]:
+            vec_start = np.maximum(0, mate_pos[kept_pairs] - bin_begin[mate2_bin[kept_pairs]]) // pBinsize
+            vec_end = np.minimum(length_coverage, vec_start + mate['seq_len'][:pBatchLength][kept_pairs].astype(np.int64) // pBinsize)
+            coverage_starts.append(coverage_begin + vec_start)
+            coverage_ends.append(coverage_begin + vec_end)
+        add_coverage(pCoverage, np.concatenate(coverage_starts), np.concatenate(coverage_ends))
+
+        if not pQuickQCMode:
+            np.ctypeslib.as_array(pRow)[:pair_added] = mate1_bin_id
+            np.ctypeslib.as_array(pCol)[:pair_added] = mate2_bin_id
+            np.ctypeslib.as_array(pData)[:pair_added] = 1
+
+        if pOutputBamSet:
+            out_bam_index_buffer = kept_pairs.tolist()
 
         pQueueOut.put([[one_mate_unmapped, one_mate_low_quality, one_mate_not_unique, dangling_end, self_circle, self_ligation, same_fragment,
                         mate_not_close_to_rf, count_inward, count_outward,
-                        count_left, count_right, inter_chromosomal, short_range, long_range, pair_added, len(pMateBuffer1), pResultIndex, pCounter, out_bam_index_buffer]])
+                        count_left, count_right, inter_chromosomal, short_range, long_range, pair_added, pBatchLength, pResultIndex, pCounter, out_bam_index_buffer,
+                        time.time() - start_time]])
     except Exception as exp:
         pQueueOut.put('Fail: ' + str(exp) + traceback.format_exc())
         return
     return
 
 
+def process_data_worker(pTaskQueue, pQueueOut, pRecordBatches, pRow, pCol, pData, pProcessDataArgs):
+    """
+    Long-lived worker of the pool used by main. The worker waits for tasks on pTaskQueue, a task is a tuple
+    (batch index, number of read pairs in the batch, counter). The read pairs are taken from
+    pRecordBatches[batch index] and the result is written to pRow, pCol and pData of the same index.
+    The static parameters of process_data are given once at the start of the process via pProcessDataArgs.
+    The worker stops if None is received.
+    """
+    while True:
+        task = pTaskQueue.get()
+        if task is None:
+            break
+        batch_index, batch_length, counter = task
+        process_data(pRecordBatch=pRecordBatches[batch_index],
+                     pBatchLength=batch_length,
+                     pResultIndex=batch_index,
+                     pQueueOut=pQueueOut,
+                     pCounter=counter,
+                     pRow=pRow[batch_index],
+                     pCol=pCol[batch_index],
+                     pData=pData[batch_index],
+                     **pProcessDataArgs)
+
+
+def read_pairs_file_header(pFileName):
+    """
+    Reads the header of a 4DN pairs file. Returns the chromosome sizes
+    as list of (chrom, size) tuples and the names of the columns.
+    """
+    chrom_sizes = []
+    columns = None
+    opener = gzip.open if pFileName.endswith('.gz') else open
+    with opener(pFileName, 'rt') as pairs_file:
+        for line in pairs_file:
+            if not line.startswith('#'):
+                break
+            if line.startswith('#chromsize:'):
+                _, chrom, size = line.split()
+                chrom_sizes.append((chrom, int(size)))
+            elif line.startswith('#columns:'):
+                columns = line.split()[1:]
+    if columns is None:
+        columns = ['readID', 'chr1', 'pos1', 'chr2', 'pos2']
+    return chrom_sizes, columns
+
+
+def read_chromosome_sizes(pFileName):
+    """Reads a tab-delimited two column file "chr_name size" and returns a list of (chr_name, size) tuples."""
+    chrom_sizes = OrderedDict()
+    with open(pFileName, 'r') as file:
+        file_ = True
+        while file_:
+            file_ = file.readline().strip()
+            if file_ != '':
+                line_split = file_.split('\t')
+                chrom_sizes[line_split[0]] = int(line_split[1])
+    return list(chrom_sizes.items())
+
+
+def get_sorted_bin_intervals(pBinIntervals):
+    """
+    Returns the bins as a list of (begin, end, bin id) tuples, sorted per chromosome,
+    and a dict which stores for each chromosome the first and the last index of its bins in this list.
+
+    >>> get_sorted_bin_intervals([('chrX', 50, 100), ('chrX', 0, 50), ('chr2', 0, 10)])
+    ([(0, 50, 1), (50, 100, 0), (0, 10, 2)], {'chrX': (0, 1), 'chr2': (2, 2)})
+    """
+    bin_intval_tree = intervalListToIntervalTree(pBinIntervals)
+    interval_array = []
+    index_dict = {}
+    end = -1
+    for seq in bin_intval_tree:
+        start = end + 1
+        interval_list = []
+        for interval in bin_intval_tree[seq]:
+            interval_list.append((interval.begin, interval.end, interval.data))
+        end = start + len(bin_intval_tree[seq]) - 1
+        index_dict[seq] = (start, end)
+        interval_list = sorted(interval_list)
+        interval_array.extend(interval_list)
+    return interval_array, index_dict
+
+
+def build_matrix_from_pairs(pArgs):
+    """
+    Builds the interaction matrix from a pairs file, as written with --outPairs. The file is read in chunks
+    of --inputBufferSize pairs, the pairs are assigned to the bins in the same way as
+    the reads of bam files.
+    """
+    log.info("reading {} to build hic_matrix\n".format(pArgs.inputPairs))
+    chrom_sizes, columns = read_pairs_file_header(pArgs.inputPairs)
+    if pArgs.chromosomeSizes is not None:
+        chrom_sizes = read_chromosome_sizes(pArgs.chromosomeSizes.name)
+    if not chrom_sizes:
+        log.error('The pairs file has no #chromsize header lines. Please define the chromosome sizes via --chromosomeSizes.')
+        exit(1)
+
+    if pArgs.binSize:
+        bin_intervals = get_bins(pArgs.binSize[0], chrom_sizes, pArgs.region)
+    else:
+        rf_interval = []
+        for restrictionCutFile in pArgs.restrictionCutFile:
+            rf_interval.extend(bed2interval_list(restrictionCutFile))
+        bin_intervals = get_rf_bins(rf_interval,
+                                    min_distance=pArgs.minDistance,
+                                    max_distance=pArgs.maxLibraryInsertSize)
+    interval_array, index_dict = get_sorted_bin_intervals(bin_intervals)
+    interval_array = np.array(interval_array, dtype=np.int64).reshape(-1, 3)
+    bin_begin = interval_array[:, 0]
+    bin_end = interval_array[:, 1]
+    bin_id = interval_array[:, 2]
+
+    chrom_names = [chrom for chrom, _ in chrom_sizes]
+    chrom_start = np.zeros(len(chrom_names) + 1, dtype=np.int64)
+    chrom_end = np.full(len(chrom_names) + 1, -1, dtype=np.int64)
+    for i, chrom in enumerate(chrom_names):
+        if chrom in index_dict:
+            chrom_start[i], chrom_end[i] = index_dict[chrom]
+
+    pixel_sinks = create_pixel_sinks(bin_intervals, pArgs)
+    pairs_read = 0
+    pair_added = 0
+    start_time = time.time()
+    pairs_reader = pd.read_csv(pArgs.inputPairs, sep='\t', comment='#', header=None,
+                               usecols=[columns.index(column) for column in ['chr1', 'pos1', 'chr2', 'pos2']],
+                               names=columns, dtype={'chr1': str, 'chr2': str, 'pos1': np.int64, 'pos2': np.int64},
+                               chunksize=pArgs.inputBufferSize)
+    for pairs in pairs_reader:
+        pairs_read += len(pairs)
+        # chromosomes not in chrom_sizes are mapped to the last, empty, entry
+        chrom1 = pd.Categorical(pairs['chr1'], categories=chrom_names).codes.astype(np.int64)
+        chrom2 = pd.Categorical(pairs['chr2'], categories=chrom_names).codes.astype(np.int64)
+        mate1_bin = find_bin_index(pairs['pos1'].values - 1, chrom_start[chrom1], chrom_end[chrom1], bin_begin, bin_end)
+        mate2_bin = find_bin_index(pairs['pos2'].values - 1, chrom_start[chrom2], chrom_end[chrom2], bin_begin, bin_end)
+        keep = (mate1_bin >= 0) & (mate2_bin >= 0)
+        pair_added += int(np.count_nonzero(keep))
+        for _, _, pixel_sink in pixel_sinks:
+            pixel_sink.add(bin_id[mate1_bin[keep]], bin_id[mate2_bin[keep]])
+        elapsed_time = time.time() - start_time
+        log.info("processing {} pairs took {:.2f} secs ({:.1f} pairs per second)\n".format(
+            pairs_read, elapsed_time, pairs_read / max(elapsed_time, 1e-9)))
+
+    log.info("{} of {} pairs added to matrix\n".format(pair_added, pairs_read))
+    # extend bins such that they are next to each other
+    bin_intervals = enlarge_bins(bin_intervals[:], chrom_sizes)
+    # the read coverage of the bins is not stored in a pairs file
+    bin_intervals = [(chrom, start, end, np.nan) for chrom, start, end in bin_intervals]
+
+    pArgs.outFileName.close()
+    unlink(pArgs.outFileName.name)
+
+    hic_metadata = {}
+    hic_metadata['statistics'] = "Pairs file\t{}\t\t\nPairs read\t{}\t\t\nHi-C contacts\t{}\t\t\n".format(
+        pArgs.inputPairs, pairs_read, pair_added)
+    if pArgs.outFileName.name.endswith('cool'):
+        save_pixel_sinks(pixel_sinks, bin_intervals, pArgs, hic_metadata)
+    else:
+        hic_matrix = pixel_sinks[0][2].to_coo()
+        dia = dia_matrix(([hic_matrix.diagonal()], [0]),
+                         shape=hic_matrix.shape)
+        hic_matrix = hic_matrix + hic_matrix.T - dia
+        hic_ma = hm.hiCMatrix()
+        hic_ma.setMatrix(hic_matrix, cut_intervals=bin_intervals)
+        save_matrix(hic_ma, pArgs, hic_metadata)
+    for _, _, pixel_sink in pixel_sinks:
+        pixel_sink.close()
+
+
+def save_matrix(pHicMatrix, pArgs, pHicMetadata):
+    """Saves the matrix as h5 or cool."""
+    pHicMetadata['matrix-generated-by'] = np.string_(
+        'HiCExplorer-' + __version__)
+    pHicMetadata['matrix-generated-by-url'] = np.string_(
+        'https://github.com/deeptools/HiCExplorer')
+    if pArgs.genomeAssembly:
+        pHicMetadata['genome-assembly'] = np.string_(pArgs.genomeAssembly)
+
+    if not pArgs.doTestRun:
+        pHicMatrix.save(pArgs.outFileName.name, pHiCInfo=pHicMetadata)
+
+
+def create_pixel_sinks(pBinIntervals, pArgs):
+    """
+    Returns a list of (resolution, bins to merge, PixelSink). The first entry collects the contacts
+    of the bins given by pBinIntervals. For a mcool output file with several --binSize values
+    one more entry per further resolution is added, its sink maps each bin to the merged bin
+    of this resolution. This way all resolutions are aggregated in the same pass over the data.
+    """
+    matrix_size = len(pBinIntervals)
+    pixel_sinks = [(pArgs.binSize[0] if pArgs.binSize else None, None,
+                    PixelSink(matrix_size, pMaxMemory=pArgs.matrixMaxMemory, pTmpDir=pArgs.matrixTmpDir))]
+    if pArgs.outFileName.name.endswith('.mcool') and pArgs.binSize is not None and len(pArgs.binSize) > 1:
+        chrom_names = [interval[0] for interval in pBinIntervals]
+        for resolution in pArgs.binSize[1:]:
+            bins_to_merge = hicMergeMatrixBins.get_bins_to_merge(chrom_names, int(resolution) // pArgs.binSize[0])
+            bin_id_map = np.full(matrix_size, -1, dtype=np.int64)
+            for merged_bin_id, bins in enumerate(bins_to_merge):
+                bin_id_map[bins] = merged_bin_id
+            pixel_sinks.append((resolution, bins_to_merge,
+                                PixelSink(len(bins_to_merge), pMaxMemory=pArgs.matrixMaxMemory,
+                                          pTmpDir=pArgs.matrixTmpDir, pBinIdMap=bin_id_map)))
+    return pixel_sinks
+
+
+def save_pixel_sinks(pPixelSinks, pBinIntervals, pArgs, pHicMetadata):
+    """
+    Writes the sinks created by create_pixel_sinks to a cool file, or, for several
+    resolutions, to the /resolutions/ groups of a mcool file.
+    """
+    if len(pPixelSinks) == 1:
+        save_pixels_as_cool(pPixelSinks[0][2], pBinIntervals, pArgs.outFileName.name, pArgs, pHicMetadata)
+        return
+    mode = 'w'
+    for resolution, bins_to_merge, pixel_sink in pPixelSinks:
+        bin_intervals = pBinIntervals
+        if bins_to_merge is not None:
+            bin_intervals = [(pBinIntervals[bins[0]][0], pBinIntervals[bins[0]][1], pBinIntervals[bins[-1]][2])
+                             for bins in bins_to_merge]
+        save_pixels_as_cool(pixel_sink, bin_intervals, pArgs.outFileName.name + '::/resolutions/' + str(resolution),
+                            pArgs, pHicMetadata, pMode=mode)
+        mode = 'a'
+
+
+def save_pixels_as_cool(pPixelSink, pBinIntervals, pCoolUri, pArgs, pHicMetadata, pMode='w'):
+    """
+    Writes the pixels collected by a PixelSink to a cool file. The pixels are streamed
+    chunk wise from the (possibly on disk) runs of the sink to cooler, such that the
+    interaction matrix is never build in memory.
+    """
+    pHicMetadata['matrix-generated-by'] = 'HiCExplorer-' + __version__
+    pHicMetadata['matrix-generated-by-url'] = 'https://github.com/deeptools/HiCExplorer'
+    if pArgs.genomeAssembly:
+        pHicMetadata['genome-assembly'] = pArgs.genomeAssembly
+
+    info = {'format': 'HDF5::Cooler',
+            'format-url': 'https://github.com/mirnylab/cooler',
+            'generated-by': 'HiCExplorer-' + __version__,
+            'generated-by-cooler-lib': 'cooler-' + cooler.__version__,
+            'tool-url': 'https://github.com/deeptools/HiCExplorer'}
+    for key in ['matrix-generated-by', 'matrix-generated-by-url', 'genome-assembly']:
+        if key in pHicMetadata:
+            info[key] = toString(pHicMetadata[key])
+    metadata = dict(info)
+    if 'statistics' in pHicMetadata:
+        metadata['statistics'] = pHicMetadata['statistics']
+
+    file_name, group_path = parse_cooler_uri(pCoolUri)
+    bins_data_frame = pd.DataFrame([interval[:3] for interval in pBinIntervals], columns=['chrom', 'start', 'end'])
+    cooler.create_cooler(cool_uri=pCoolUri,
+                         bins=bins_data_frame,
+                         pixels=pPixelSink.pixels(),
+                         mode=pMode,
+                         dtypes={'bin1_id': np.int32, 'bin2_id': np.int32, 'count': np.int32},
+                         ordered=True,
+                         metadata=metadata,
+                         temp_dir=os.path.dirname(os.path.realpath(file_name)))
+    with h5py.File(file_name, 'r+') as h5file:
+        h5file[group_path].attrs.update(info)
+
+
 def main(args=None):
     """
     Reads line by line two bam files that are not sorted.
@@ -1100,7 +2053,20 @@ def main(args=None):
     is also constructed.
     """
 
-    args = parse_arguments().parse_args(args)
+    parser = parse_arguments()
+    args = parser.parse_args(args)
+    if args.inputPairs is None:
+        missing_arguments = [name for name, value in [('--samFiles/-s', args.samFiles),
+                                                      ('--QCfolder', args.QCfolder),
+                                                      ('--restrictionCutFile/-rs', args.restrictionCutFile),
+                                                      ('--restrictionSequence/-seq', args.restrictionSequence),
+                                                      ('--danglingSequence', args.danglingSequence)] if value is None]
+        if missing_arguments:
+            parser.error('the following arguments are required: {}'.format(', '.join(missing_arguments)))
+    elif args.samFiles is not None:
+        parser.error('--samFiles and --inputPairs can not be used together')
+    elif args.binSize is None and args.restrictionCutFile is None:
+        parser.error('--inputPairs needs either --binSize or --restrictionCutFile')
     # args.outFileName.name = args.outFileName.name.strip()
     # log.debug('args.outFileName.name: {}'.format(args.outFileName.name.endswith('.h5')))
     if not args.outFileName.name.endswith('.h5') and not args.outFileName.name.endswith('.cool'):
@@ -1110,6 +2076,11 @@ def main(args=None):
     # for backwards compatibility
     if args.maxDistance is not None:
         args.maxLibraryInsertSize = args.maxDistance
+
+    if args.inputPairs is not None:
+        build_matrix_from_pairs(args)
+        return
+
     try:
         QC.make_sure_path_exists(args.QCfolder)
     except OSError:
@@ -1125,8 +2096,9 @@ def main(args=None):
 
     log.info("reading {} and {} to build hic_matrix\n".format(args.samFiles[0].name,
                                                               args.samFiles[1].name))
-    str1 = pysam.Samfile(args.samFiles[0].name, 'rb')
-    str2 = pysam.Samfile(args.samFiles[1].name, 'rb')
+    bam_reader1 = BamReaderThread(args.samFiles[0].name, pThreads=args.decompressionThreads)
+    bam_reader2 = BamReaderThread(args.samFiles[1].name, pThreads=args.decompressionThreads)
+    str1 = bam_reader1.file
 
     args.samFiles[0].close()
     args.samFiles[1].close()
@@ -1134,22 +2106,19 @@ def main(args=None):
         if args.outBam:
             args.outBam.close()
             out_bam_file = pysam.Samfile(args.outBam.name, 'wb', template=str1)
+    pairs_writer = None
+    if args.outPairs:
+        pairs_writer = PairsFileWriter(args.outPairs, list(zip(str1.references, str1.lengths)),
+                                       pGenomeAssembly=args.genomeAssembly)
 
     if args.chromosomeSizes is None:
         chrom_sizes = get_chrom_sizes(str1)
     else:
-        chrom_sizes = OrderedDict()
-        with open(args.chromosomeSizes.name, 'r') as file:
-            file_ = True
-            while file_:
-                file_ = file.readline().strip()
-                if file_ != '':
-                    line_split = file_.split('\t')
-                    chrom_sizes[line_split[0]] = int(line_split[1])
-        chrom_sizes = list(chrom_sizes.items())
+        chrom_sizes = read_chromosome_sizes(args.chromosomeSizes.name)
 
     # log.debug('chrom_sizes {}'.format(chrom_sizes))
-    read_pos_matrix = ReadPositionMatrix()
+    read_pos_matrix = ReadPositionMatrix(pMaxMemory=args.duplicationCheckMaxMemory,
+                                         pTmpDir=args.duplicationCheckTmpDir)
 
     rf_interval = []
     for restrictionCutFile in args.restrictionCutFile:
@@ -1165,24 +2134,12 @@ def main(args=None):
                                     max_distance=args.maxLibraryInsertSize)
 
     matrix_size = len(bin_intervals)
-    bin_intval_tree = intervalListToIntervalTree(bin_intervals)
     ref_id2name = str1.references
 
     # build c_type shared memory for the interval tree
-    shared_array_list = []
-    index_dict = {}
-    end = -1
-    for i, seq in enumerate(bin_intval_tree):
-        start = end + 1
-        interval_list = []
-        for interval in bin_intval_tree[seq]:
-            interval_list.append((interval.begin, interval.end, interval.data))
-        end = start + len(bin_intval_tree[seq]) - 1
-        index_dict[seq] = (start, end)
-        interval_list = sorted(interval_list)
-        shared_array_list.extend(interval_list)
+    shared_array_list, index_dict = get_sorted_bin_intervals(bin_intervals)
     shared_build_intval_tree = RawArray(C_Interval, shared_array_list)
-    bin_intval_tree = None
+    shared_array_list = None
     dangling_sequences = {}
     if args.danglingSequence:
         # build a list of dangling sequences
@@ -1221,15 +2178,29 @@ def main(args=None):
 
     # define global shared ctypes arrays for row, col and data
     args.threads = args.threads - 1
-    row = [None] * args.threads
-    col = [None] * args.threads
-    data = [None] * args.threads
-    for i in range(args.threads):
+    if args.doTestRun:
+        args.inputBufferSize = args.doTestRunLines
+
+    # Two record batches per worker: while a worker processes one batch,
+    # the main process can already fill the next one.
+    number_of_batches = 2 * args.threads
+    record_batches = [None] * number_of_batches
+    row = [None] * number_of_batches
+    col = [None] * number_of_batches
+    data = [None] * number_of_batches
+    # the workers check for dangling ends on the copied sequence ends
+    dangling_sequence_length = max([len(dangling_sequences[sequence][pattern])
+                                    for sequence in dangling_sequences
+                                    for pattern in ['pat_forw', 'pat_rev']] + [0])
+    for i in range(number_of_batches):
+        record_batches[i] = SharedRecordBatch(args.inputBufferSize, dangling_sequence_length)
         row[i] = RawArray(c_uint, args.inputBufferSize)
         col[i] = RawArray(c_uint, args.inputBufferSize)
         data[i] = RawArray(c_ushort, args.inputBufferSize)
 
     start_time = time.time()
+    bam_reader1.start()
+    bam_reader2.start()
 
     iter_num = 0
     # pair_added = 0
@@ -1259,36 +2230,75 @@ def main(args=None):
 
     pair_added = 0
 
-    # input buffer for bam files
-    buffer_workers1 = [None] * args.threads
-    buffer_workers2 = [None] * args.threads
+    # the pysam objects are only kept in the main process
+    # to write the output bam file
+    buffer_workers1 = [None] * number_of_batches
+    buffer_workers2 = [None] * number_of_batches
 
-    # output buffer to write bam with mate1 and mate2 pairs
-    process = [None] * args.threads
     all_data_processed = False
-    hic_matrix = coo_matrix((matrix_size, matrix_size), dtype='uint32')
-    queue = [None] * args.threads
-
-    all_threads_done = False
-    thread_done = [False] * args.threads
+    pixel_sinks = create_pixel_sinks(bin_intervals, args)
+
+    # start a pool of long-lived worker processes. All parameters which do not change
+    # are given once at the start, for each batch only its index is send via the task queue.
+    task_queue = Queue()
+    result_queue = Queue()
+    process_data_args = dict(
+        pMinMappingQuality=args.minMappingQuality,
+        pKeepSelfCircles=args.keepSelfCircles,
+        pRestrictionSequence=args.restrictionSequence,
+        pRemoveSelfLigation=args.removeSelfLigation,
+        pMatrixSize=matrix_size,
+        pRfPositions=rf_positions,
+        pRefId2name=ref_id2name,
+        pDanglingSequences=dangling_sequences,
+        pBinsize=binsize,
+        pOutputBamSet=args.outBam or args.outPairs,
+        pSharedBinIntvalTree=shared_build_intval_tree,
+        pDictBinIntervalTreeIndex=index_dict,
+        pCoverage=coverage,
+        pCoverageIndex=pos_coverage,
+        pMaxInsertSize=args.maxLibraryInsertSize,
+        pQuickQCMode=args.doTestRun
+    )
+    process = [None] * args.threads
+    for i in range(args.threads):
+        process[i] = Process(target=process_data_worker, kwargs=dict(
+            pTaskQueue=task_queue,
+            pQueueOut=result_queue,
+            pRecordBatches=record_batches,
+            pRow=row,
+            pCol=col,
+            pData=data,
+            pProcessDataArgs=process_data_args
+        ))
+        process[i].daemon = True
+        process[i].start()
+
+    free_batches = list(range(number_of_batches))
+    batches_in_progress = 0
     count_output = 0
     count_call_of_read_input = 0
     computed_pairs = 0
+    # time spent by the main process to read the input and to wait for
+    # the workers, and the time the workers were busy
+    read_time = 0.0
+    wait_time = 0.0
+    worker_time = 0.0
 
-    if args.doTestRun:
-        args.inputBufferSize = args.doTestRunLines
     fail_flag = False
     fail_message = ''
-    while not all_data_processed or not all_threads_done:
-
-        for i in range(args.threads):
-            if queue[i] is None and not all_data_processed:
+    try:
+        while True:
+            # fill all free batches and hand them over to the pool
+            while free_batches and not all_data_processed:
+                i = free_batches.pop()
                 count_call_of_read_input += 1
+                read_start_time = time.time()
 
                 buffer_workers1[i], buffer_workers2[i], all_data_processed, \
                     duplicated_pairs_, one_mate_unmapped_, one_mate_not_unique_, \
-                    one_mate_low_quality_, iter_num_ = readBamFiles(pFileOneIterator=str1,
-                                                                    pFileTwoIterator=str2,
+                    one_mate_low_quality_, iter_num_ = readBamFiles(pFileOneIterator=bam_reader1,
+                                                                    pFileTwoIterator=bam_reader2,
                                                                     pNumberOfItemsPerBuffer=args.inputBufferSize,
                                                                     pSkipDuplicationCheck=args.skipDuplicationCheck,
                                                                     pReadPosMatrix=read_pos_matrix,
@@ -1300,149 +2310,176 @@ def main(args=None):
                 one_mate_not_unique += one_mate_not_unique_
                 one_mate_low_quality += one_mate_low_quality_
                 iter_num += iter_num_
-                queue[i] = Queue()
-                thread_done[i] = False
-                computed_pairs += len(buffer_workers1[i])
-                # create process to compute hic matrix for this buffer
-                process[i] = Process(target=process_data, kwargs=dict(
-                    pMateBuffer1=buffer_workers1[i],
-                    pMateBuffer2=buffer_workers2[i],
-                    pMinMappingQuality=args.minMappingQuality,
-                    pKeepSelfCircles=args.keepSelfCircles,
-                    pRestrictionSequence=args.restrictionSequence,
-                    pRemoveSelfLigation=args.removeSelfLigation,
-                    pMatrixSize=matrix_size,
-                    pRfPositions=rf_positions,
-                    pRefId2name=ref_id2name,
-                    pDanglingSequences=dangling_sequences,
-                    pBinsize=binsize,
-                    pResultIndex=i,
-                    pQueueOut=queue[i],
-                    pTemplate=str1,
-                    pOutputBamSet=args.outBam,
-                    pCounter=count_output,
-                    pSharedBinIntvalTree=shared_build_intval_tree,
-                    pDictBinIntervalTreeIndex=index_dict,
-                    pCoverage=coverage,
-                    pCoverageIndex=pos_coverage,
-                    pOutputFileBufferDir="",
-                    pRow=row[i],
-                    pCol=col[i],
-                    pData=data[i],
-                    pMaxInsertSize=args.maxLibraryInsertSize,
-                    pQuickQCMode=args.doTestRun
-                ))
-                process[i].start()
+
+                if buffer_workers1[i] is None or buffer_workers2[i] is None:
+                    buffer_workers1[i] = None
+                    buffer_workers2[i] = None
+                    free_batches.append(i)
+                    read_time += time.time() - read_start_time
+                    continue
+
+                batch_length = record_batches[i].fill(buffer_workers1[i], buffer_workers2[i])
+                read_time += time.time() - read_start_time
+                computed_pairs += batch_length
+                if not args.outBam:
+                    buffer_workers1[i] = None
+                    buffer_workers2[i] = None
+                task_queue.put((i, batch_length, count_output))
+                batches_in_progress += 1
                 count_output += 1
 
-            elif queue[i] is not None and not queue[i].empty():
-                result = queue[i].get()
-                if 'Fail:' in result:
+            if batches_in_progress == 0:
+                break
+
+            wait_start_time = time.time()
+            try:
+                result = result_queue.get(timeout=5)
+            except Empty:
+                wait_time += time.time() - wait_start_time
+                if not all(worker.is_alive() for worker in process):
                     fail_flag = True
-                    fail_message = result[6:]
-                else:
-                    if result[0] is not None:
-                        elements = result[0][15]
-                        if hic_matrix is None:
-                            hic_matrix = coo_matrix(
-                                (data[i][:elements], (row[i][:elements], col[i][:elements])), shape=(matrix_size, matrix_size))
-                        else:
-                            hic_matrix += coo_matrix(
-                                (data[i][:elements], (row[i][:elements], col[i][:elements])), shape=(matrix_size, matrix_size))
-
-                        for sequence in result[0][3]:
-                            dangling_end[sequence] += result[0][3][sequence]
-                        self_circle += result[0][4]
-                        self_ligation += result[0][5]
-                        same_fragment += result[0][6]
-                        mate_not_close_to_rf += result[0][7]
-
-                        count_inward += result[0][8]
-                        count_outward += result[0][9]
-                        count_left += result[0][10]
-                        count_right += result[0][11]
-                        inter_chromosomal += result[0][12]
-                        short_range += result[0][13]
-                        long_range += result[0][14]
-
-                        pair_added += result[0][15]
-                        iter_num += result[0][16]
-
-                    for bam_index in result[0][19]:
-                        mate1 = buffer_workers1[i][bam_index]
-                        mate2 = buffer_workers2[i][bam_index]
-
-                        mate1.flag |= 0x1
-                        mate2.flag |= 0x1
-
-                        # set one read as the first in pair and the
-                        # other as second
-                        mate1.flag |= 0x40
-                        mate2.flag |= 0x80
-
-                        # set chrom of mate
-                        mate1.mrnm = mate2.rname
-                        mate2.mrnm = mate1.rname
-
-                        # set position of mate
-                        mate1.mpos = mate2.pos
-                        mate2.mpos = mate1.pos
-
-                        out_bam_file.write(mate1)
-                        out_bam_file.write(mate2)
-
-                buffer_workers1[i] = None
-                buffer_workers2[i] = None
-                queue[i] = None
-                process[i].join()
-                process[i].terminate()
-                process[i] = None
-                thread_done[i] = True
-
-                # caused by the architecture I try to display this output
-                # information after +-1e5 of 1e6 reads.
-                if iter_num % 1e6 < 100000:
-                    elapsed_time = time.time() - start_time
-                    log.info("processing {} lines took {:.2f} "
-                             "secs ({:.1f} lines per "
-                             "second)\n".format(iter_num,
-                                                elapsed_time,
-                                                iter_num / elapsed_time))
-                    log.info("{} ({:.2f}%) valid pairs added to matrix"
-                             "\n".format(pair_added, float(100 * pair_added) / iter_num))
-                if args.doTestRun and iter_num > args.doTestRunLines:
-                    log.debug(
-                        "\n## *WARNING*. Early exit because of --doTestRun parameter  ##\n\n")
-                    all_data_processed = True
-                    thread_done[i] = True
+                    fail_message = 'A worker process terminated unexpectedly.'
                     break
-            elif all_data_processed and queue[i] is None:
-                thread_done[i] = True
-            else:
-                time.sleep(1)
+                continue
+
+            wait_time += time.time() - wait_start_time
+            batches_in_progress -= 1
+            if 'Fail:' in result:
+                fail_flag = True
+                fail_message = result[6:]
+                # stop reading, the batches still in progress are collected but not used
+                all_data_processed = True
+                continue
+            if fail_flag:
+                continue
+
+            i = result[0][17]
+            elements = result[0][15]
+            worker_time += result[0][20]
+            for _, _, pixel_sink in pixel_sinks:
+                pixel_sink.add(np.frombuffer(row[i], dtype=np.uint32)[:elements],
+                               np.frombuffer(col[i], dtype=np.uint32)[:elements],
+                               np.frombuffer(data[i], dtype=np.uint16)[:elements])
+
+            for sequence in result[0][3]:
+                dangling_end[sequence] += result[0][3][sequence]
+            self_circle += result[0][4]
+            self_ligation += result[0][5]
+            same_fragment += result[0][6]
+            mate_not_close_to_rf += result[0][7]
+
+            count_inward += result[0][8]
+            count_outward += result[0][9]
+            count_left += result[0][10]
+            count_right += result[0][11]
+            inter_chromosomal += result[0][12]
+            short_range += result[0][13]
+            long_range += result[0][14]
+
+            pair_added += result[0][15]
+            iter_num += result[0][16]
+
+            if args.outBam:
+                for bam_index in result[0][19]:
+                    mate1 = buffer_workers1[i][bam_index]
+                    mate2 = buffer_workers2[i][bam_index]
+
+                    mate1.flag |= 0x1
+                    mate2.flag |= 0x1
+
+                    # set one read as the first in pair and the
+                    # other as second
+                    mate1.flag |= 0x40
+                    mate2.flag |= 0x80
+
+                    # set chrom of mate
+                    mate1.mrnm = mate2.rname
+                    mate2.mrnm = mate1.rname
+
+                    # set position of mate
+                    mate1.mpos = mate2.pos
+                    mate2.mpos = mate1.pos
+
+                    # set insert size to save bam
+                    if mate1.reference_id == mate2.reference_id:
+                        mate1.isize = mate2.pos - mate1.pos
+                        mate2.isize = mate1.pos - mate2.pos
+
+                    out_bam_file.write(mate1)
+                    out_bam_file.write(mate2)
+
+            if pairs_writer is not None:
+                kept_pairs = np.array(result[0][19], dtype=np.int64)
+                mate1 = record_batches[i].mate(0)
+                mate2 = record_batches[i].mate(1)
+                pairs_writer.add(mate1['ref_id'][kept_pairs],
+                                 mate1['pos'][kept_pairs].astype(np.int64) + mate1['qlen'][kept_pairs] // 2 + 1,
+                                 mate1['is_reverse'][kept_pairs].astype(bool),
+                                 mate2['ref_id'][kept_pairs],
+                                 mate2['pos'][kept_pairs].astype(np.int64) + mate2['qlen'][kept_pairs] // 2 + 1,
+                                 mate2['is_reverse'][kept_pairs].astype(bool))
+
+            buffer_workers1[i] = None
+            buffer_workers2[i] = None
+            free_batches.append(i)
+
+            # caused by the architecture I try to display this output
+            # information after +-1e5 of 1e6 reads.
+            if iter_num % 1e6 < 100000:
+                elapsed_time = time.time() - start_time
+                log.info("processing {} lines took {:.2f} "
+                         "secs ({:.1f} lines per "
+                         "second)\n".format(iter_num,
+                                            elapsed_time,
+                                            iter_num / elapsed_time))
+                log.info("{} ({:.2f}%) valid pairs added to matrix"
+                         "\n".format(pair_added, float(100 * pair_added) / iter_num))
+            if args.doTestRun and iter_num > args.doTestRunLines:
+                log.debug(
+                    "\n## *WARNING*. Early exit because of --doTestRun parameter  ##\n\n")
+                all_data_processed = True
+
+        # stop the worker pool
+        for i in range(args.threads):
+            task_queue.put(None)
+        for i in range(args.threads):
+            process[i].join(timeout=10)
+            if process[i].is_alive():
+                process[i].terminate()
+            process[i] = None
+        read_pos_matrix.close()
+        bam_reader1.close()
+        bam_reader2.close()
+        if pairs_writer is not None and not fail_flag:
+            pairs_writer.close()
+            pairs_writer = None
+    finally:
+        # a failed run must not leave a partial pairs file behind
+        if pairs_writer is not None:
+            pairs_writer.discard()
+
+    elapsed_time = time.time() - start_time
+    log.info("reading the input took {:.2f} secs (of which {:.2f} secs were spent waiting for "
+             "decompressed records), waiting for the workers took {:.2f} secs".format(
+                 read_time, bam_reader1.consumer_wait_time + bam_reader2.consumer_wait_time, wait_time))
+    log.info("the workers were busy for {:.2f} secs, that is {:.1f}% of the available "
+             "worker time\n".format(worker_time, 100 * worker_time / max(elapsed_time * args.threads, 1e-9)))
 
-        if all_data_processed:
-            all_threads_done = True
-            for thread in thread_done:
-                if not thread:
-                    all_threads_done = False
     if fail_flag:
+        for _, _, pixel_sink in pixel_sinks:
+            pixel_sink.close()
         log.error(fail_message)
         exit(1)
     else:
         log.debug('Parallel stuff done')
+    # cool and mcool files are written directly from the pixel sinks,
+    # all other formats need the matrix in memory
+    write_pixels = args.outFileName.name.endswith('cool')
+    hic_ma = None
     if not args.doTestRun:
-        # the resulting matrix is only filled unevenly with some pairs
-        # int the upper triangle and others in the lower triangle. To construct
-        # the definite matrix I add the values from the upper and lower triangles
-        # and subtract the diagonal to avoid double counting it.
-        # The resulting matrix is symmetric.
         if args.outBam:
             out_bam_file.close()
 
-        dia = dia_matrix(([hic_matrix.diagonal()], [0]),
-                         shape=hic_matrix.shape)
-        hic_matrix = hic_matrix + hic_matrix.T - dia
         # extend bins such that they are next to each other
         bin_intervals = enlarge_bins(bin_intervals[:], chrom_sizes)
         # compute max bin coverage
@@ -1460,8 +2497,17 @@ def main(args=None):
 
         chr_name_list, start_list, end_list = list(zip(*bin_intervals))
         bin_intervals = list(zip(chr_name_list, start_list, end_list, bin_max))
-        hic_ma = hm.hiCMatrix()
-        hic_ma.setMatrix(hic_matrix, cut_intervals=bin_intervals)
+        if not write_pixels:
+            # the sink holds the pairs folded into the upper triangle. To construct
+            # the definite matrix I add the values from the upper and lower triangles
+            # and subtract the diagonal to avoid double counting it.
+            # The resulting matrix is symmetric.
+            hic_matrix = pixel_sinks[0][2].to_coo()
+            dia = dia_matrix(([hic_matrix.diagonal()], [0]),
+                             shape=hic_matrix.shape)
+            hic_matrix = hic_matrix + hic_matrix.T - dia
+            hic_ma = hm.hiCMatrix()
+            hic_ma.setMatrix(hic_matrix, cut_intervals=bin_intervals)
 
     """
     if args.restrictionCutFile:
@@ -1579,44 +2625,14 @@ Max library insert size\t{}\t\t
 
     hic_metadata = {}
     hic_metadata['statistics'] = intermediate_qc_log.getvalue()
-    hic_metadata['matrix-generated-by'] = np.string_(
-        'HiCExplorer-' + __version__)
-    hic_metadata['matrix-generated-by-url'] = np.string_(
-        'https://github.com/deeptools/HiCExplorer')
-    if args.genomeAssembly:
-        hic_metadata['genome-assembly'] = np.string_(args.genomeAssembly)
-
     intermediate_qc_log.close()
-    if args.outFileName.name.endswith('.mcool') and args.binSize is not None and len(args.binSize) > 2:
-
-        matrixFileHandlerOutput = MatrixFileHandler(
-            pFileType='cool', pHiCInfo=hic_metadata)
-        matrixFileHandlerOutput.set_matrix_variables(hic_ma.matrix,
-                                                     hic_ma.cut_intervals,
-                                                     hic_ma.nan_bins,
-                                                     hic_ma.correction_factors,
-                                                     hic_ma.distance_counts)
-        matrixFileHandlerOutput.save(args.outFileName.name + '::/resolutions/' + str(
-            args.binSize[0]), pSymmetric=True, pApplyCorrection=False)
-
-        for resolution in args.binSize[1:]:
-            hic_matrix_to_merge = deepcopy(hic_ma)
-            _mergeFactor = int(resolution) // args.binSize[0]
-            merged_matrix = hicMergeMatrixBins.merge_bins(
-                hic_matrix_to_merge, _mergeFactor)
-            matrixFileHandlerOutput = MatrixFileHandler(
-                pFileType='cool', pAppend=True, pHiCInfo=hic_metadata)
-            matrixFileHandlerOutput.set_matrix_variables(merged_matrix.matrix,
-                                                         merged_matrix.cut_intervals,
-                                                         merged_matrix.nan_bins,
-                                                         merged_matrix.correction_factors,
-                                                         merged_matrix.distance_counts)
-            matrixFileHandlerOutput.save(args.outFileName.name + '::/resolutions/' + str(
-                resolution), pSymmetric=True, pApplyCorrection=False)
 
+    if write_pixels and not args.doTestRun:
+        save_pixel_sinks(pixel_sinks, bin_intervals, args, hic_metadata)
     else:
-        if not args.doTestRun:
-            hic_ma.save(args.outFileName.name, pHiCInfo=hic_metadata)
+        save_matrix(hic_ma, args, hic_metadata)
+    for _, _, pixel_sink in pixel_sinks:
+        pixel_sink.close()
 
 
 class Tester(object):
@@ -4,14 +4,18 @@ warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 import argparse
 from past.builtins import zip
-from scipy.sparse import lil_matrix
+import multiprocessing
+import cooler
+from cooler.util import parse_cooler_uri
+import h5py
 
-from hicexplorer.iterativeCorrection import iterativeCorrection
+from hicexplorer.iterativeCorrection import iterativeCorrection, iterativeCorrectionCool, cool_marginals
 from hicmatrix import HiCMatrix as hm
 from hicexplorer._version import __version__
 from hicexplorer.utilities import toString
-from hicexplorer.utilities import convertNansToZeros, convertInfsToZeros
+from hicexplorer.utilities import convertNansToZeros, convertInfsToZeros, convertNansToOnes
 from hicexplorer.utilities import check_cooler
+from hicexplorer.utilities import block_diagonal_matrix
 
 # Knight-Ruiz algorithm:
 from krbalancing import *
@@ -235,6 +239,31 @@ def correct_subparser():
                            'of chromosomes and/or translocations.',
                            action='store_true')
 
+    parserOpt.add_argument('--threads',
+                           help='Number of threads used for the iterative correction. '
+                           'With --perchr, the number of chromosomes corrected in parallel '
+                           'by ICE or KR. Only for ICE or --perchr!'
+                           ' (Default: %(default)s).',
+                           type=int,
+                           metavar='INT',
+                           default=1)
+
+    parserOpt.add_argument('--outOfCore',
+                           help='Balance a cool matrix without loading it into memory. '
+                           'The pixels are read in chunks for each iteration and only '
+                           'the weight column of the output cool file is written. '
+                           'With --threads, the chunks are processed by that many processes. '
+                           'Only for ICE and cool input and output files, the input '
+                           'matrix must be stored in the symmetric-upper mode!',
+                           action='store_true')
+
+    parserOpt.add_argument('--chunkSize',
+                           help='Number of pixels read at once with --outOfCore'
+                           ' (Default: %(default)s).',
+                           type=int,
+                           metavar='INT',
+                           default=10000000)
+
     parserOpt.add_argument('--verbose',
                            help='Print processing status.',
                            action='store_true')
@@ -246,11 +275,49 @@ def correct_subparser():
 def iterative_correction(matrix, args):
     corrected_matrix, correction_factors = iterativeCorrection(matrix,
                                                                M=args.iterNum,
-                                                               verbose=args.verbose)
+                                                               verbose=args.verbose,
+                                                               threads=args.threads)
 
     return corrected_matrix, correction_factors
 
 
+def correct_chromosome(pArgs):
+    """
+    Corrects the submatrix of a chromosome with ICE or KR. The
+    corrected matrix is only returned if requested. If the correction
+    fails, the returned correction factors are None.
+    Defined at module level such that it can be used by a multiprocessing pool.
+    """
+    submatrix, correction_method, iter_num, verbose, threads, return_matrix = pArgs
+    if correction_method == 'ICE':
+        # the iterative correction exits on failure, which would
+        # leave a multiprocessing pool waiting for the result
+        try:
+            corrected_matrix, correction_factors = iterativeCorrection(submatrix, M=iter_num,
+                                                                       verbose=verbose,
+                                                                       threads=threads)
+        except SystemExit:
+            return None, None
+    else:
+        # Set the kr matrix along with its correction factors vector
+        assert(correction_method == 'KR')
+        log.debug("Loading a float sparse matrix for KR balancing")
+        kr = kr_balancing(submatrix.shape[0],
+                          submatrix.shape[1],
+                          submatrix.count_nonzero(),
+                          submatrix.indptr.astype(np.int64, copy=False),
+                          submatrix.indices.astype(np.int64, copy=False),
+                          submatrix.data.astype(np.float64, copy=False))
+        kr.computeKR()
+        corrected_matrix = None
+        if return_matrix:
+            corrected_matrix = kr.get_normalised_matrix(True)
+        correction_factors = kr.get_normalisation_vector(False).todense()
+    if not return_matrix:
+        corrected_matrix = None
+    return corrected_matrix, correction_factors
+
+
 def fill_gaps(hic_ma, failed_bins, fill_contiguous=False):
     """ try to fill-in the failed_bins the matrix by adding the
     average values of the neighboring rows and cols. The idea
@@ -588,11 +655,69 @@ def filter_by_zscore(hic_ma, lower_threshold, upper_threshold, perchr=False):
     return sorted(to_remove)
 
 
+def correct_out_of_core(args):
+    """
+    Iterative correction of a cool file without loading the matrix. The bins
+    are filtered like for the in-memory correction and the correction
+    factors are written as the weight column of the output cool file, with
+    ones for the filtered bins like for the in-memory correction.
+    """
+    if args.correctionMethod != 'ICE' or not check_cooler(args.matrix) or \
+            not args.outFileName.endswith('.cool'):
+        log.error('--outOfCore is only supported for ICE with cool input and output files.')
+        sys.exit(1)
+    if args.perchr or args.chromosomes or args.transCutoff or \
+            args.sequencedCountCutoff or args.inflationCutoff:
+        log.error('--outOfCore does not support --perchr, --chromosomes, --transCutoff, '
+                  '--sequencedCountCutoff or --inflationCutoff.')
+        sys.exit(1)
+    if not args.filterThreshold:
+        log.error('min and max filtering thresholds should be set')
+        sys.exit(1)
+    cooler_file = cooler.Cooler(args.matrix)
+    if cooler_file.storage_mode != 'symmetric-upper':
+        log.error("--outOfCore needs a cool file with the 'symmetric-upper' storage mode, "
+                  "the storage mode of {} is '{}'.".format(args.matrix, cooler_file.storage_mode))
+        sys.exit(1)
+
+    nbins = cooler_file.info['nbins']
+    row_sum, diagonal, _ = cool_marginals(args.matrix, np.ones(nbins), chunk_size=args.chunkSize)
+    zero_bins = np.flatnonzero(row_sum == 0)
+    log.info("Removing {} zero value bins".format(len(zero_bins)))
+
+    non_zero_bins = np.flatnonzero(row_sum != 0)
+    mad = MAD(row_sum[non_zero_bins] - diagonal[non_zero_bins])
+    outlier_regions = non_zero_bins[mad.is_outlier(args.filterThreshold[0], args.filterThreshold[1])]
+    pct_outlier = 100 * float(len(outlier_regions)) / len(non_zero_bins)
+    log.info("Bins that are MAD outliers ({:.2f}%) out of {}: {}".format(
+        pct_outlier, len(non_zero_bins), len(outlier_regions)))
+
+    total_bias = iterativeCorrectionCool(args.matrix, bad_bins=np.concatenate([zero_bins, outlier_regions]),
+                                         M=args.iterNum, verbose=args.verbose,
+                                         skip_diagonal=args.skipDiagonal, chunk_size=args.chunkSize,
+                                         processes=args.threads)
+
+    if args.matrix != args.outFileName:
+        cooler.fileops.cp(args.matrix, args.outFileName, overwrite=True)
+    weight = convertNansToOnes(total_bias)
+    cool_path, group_path = parse_cooler_uri(args.outFileName)
+    with h5py.File(cool_path, 'r+') as h5file:
+        bins = h5file[group_path]['bins']
+        if 'weight' in bins:
+            log.warning('The existing weight column is replaced.')
+            del bins['weight']
+        bins.create_dataset('weight', data=weight, compression='gzip', compression_opts=6)
+
+
 def main(args=None):
     args = parse_arguments().parse_args(args)
     if args.verbose:
         log.setLevel(logging.INFO)
 
+    if 'outOfCore' in args and args.outOfCore:
+        correct_out_of_core(args)
+        return
+
     # args.chromosomes
     if check_cooler(args.matrix) and args.chromosomes is not None and len(args.chromosomes) == 1:
         ma = hm.hiCMatrix(args.matrix, pChrnameList=toString(args.chromosomes))
@@ -687,39 +812,36 @@ def main(args=None):
             pre_row_sum = np.asarray(ma.matrix.sum(axis=1)).flatten()
 
     correction_factors = []
-    corrected_matrix = lil_matrix(ma.matrix.shape)
+    corrected_matrix = None
     if args.perchr:
         # normalize each chromosome independently
-        for chrname in list(ma.interval_trees):
-            chr_range = ma.getChrBinRange(chrname)
-            chr_submatrix = ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
-            if args.correctionMethod == 'ICE':
-                _matrix, _corr_factors = iterative_correction(
-                    chr_submatrix, args)
-                corrected_matrix[chr_range[0]:chr_range[1],
-                                 chr_range[0]:chr_range[1]] = _matrix
-                correction_factors.append(_corr_factors)
-            else:
-                # Set the kr matrix along with its correction factors vector
-                assert(args.correctionMethod == 'KR')
-                log.debug("Loading a float sparse matrix for KR balancing")
-                kr = kr_balancing(chr_submatrix.shape[0],
-                                  chr_submatrix.shape[1],
-                                  chr_submatrix.count_nonzero(),
-                                  chr_submatrix.indptr.astype(
-                                      np.int64, copy=False),
-                                  chr_submatrix.indices.astype(
-                                      np.int64, copy=False),
-                                  chr_submatrix.data.astype(np.float64, copy=False))
-                kr.computeKR()
-                if args.outFileName.endswith('.h5'):
-                    corrected_matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]] = kr.get_normalised_matrix(True)
-                # correction_factors.append(np.true_divide(1,
-                #                                          kr.get_normalisation_vector(False).todense()))
-                correction_factors.append(
-                    kr.get_normalisation_vector(False).todense())
-
-        correction_factors = np.concatenate(correction_factors)
+        chr_ranges = sorted([ma.getChrBinRange(chrname) for chrname in list(ma.interval_trees)])
+        # the corrected matrix is only needed for h5 files or to compute the inflation,
+        # cool files store the raw matrix and the correction factors
+        return_matrix = args.outFileName.endswith('.h5') or \
+            bool(args.correctionMethod == 'ICE' and args.inflationCutoff and args.inflationCutoff > 0)
+        # the chromosomes are corrected in parallel by a pool of processes, if
+        # there is only one chromosome its correction uses the threads instead
+        use_pool = args.threads > 1 and len(chr_ranges) > 1
+        tasks = [(ma.matrix[start:end, start:end], args.correctionMethod, args.iterNum,
+                  args.verbose, 1 if use_pool else args.threads, return_matrix)
+                 for start, end in chr_ranges]
+        if use_pool:
+            pool = multiprocessing.Pool(min(args.threads, len(tasks)))
+            results = pool.map(correct_chromosome, tasks)
+            pool.close()
+            pool.join()
+        else:
+            results = [correct_chromosome(task) for task in tasks]
+        del tasks
+        if any(_corr_factors is None for _, _corr_factors in results):
+            sys.exit(1)
+
+        correction_factors = np.concatenate([_corr_factors for _, _corr_factors in results])
+        if return_matrix:
+            corrected_matrix = block_diagonal_matrix([_matrix for _matrix, _ in results],
+                                                     chr_ranges, ma.matrix.shape)
+        del results
 
     else:
         if args.correctionMethod == 'ICE':
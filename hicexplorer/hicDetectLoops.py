@@ -1,11 +1,11 @@
 import argparse
-from multiprocessing import Process, Queue
-from multiprocessing.sharedctypes import Array, RawArray
-from copy import deepcopy
+import os
+import shutil
+from multiprocessing import Pool
+from queue import Queue as ResultQueue
+from tempfile import mkdtemp
 import logging
 log = logging.getLogger(__name__)
-import time
-import gc
 import cooler
 import numpy as np
 from scipy.sparse import csr_matrix, triu
@@ -24,7 +24,7 @@ from inspect import currentframe
 import traceback
 
 
-from hicexplorer.utilities import obs_exp_matrix, obs_exp_matrix_non_zero
+from hicexplorer.utilities import obs_exp_matrix, obs_exp_matrix_non_zero, row_col_of_values, ranksums_rows
 
 
 def get_linenumber():
@@ -94,17 +94,18 @@ Computes enriched regions (peaks) or long range contacts on the given contact ma
                            nargs='+')
 
     parserOpt.add_argument('--threads', '-t',
-                           help='Number of threads to use, the parallelization is implemented per chromosome'
+                           help='Total number of processes to use. The chromosomes are split into small tasks '
+                           '(groups of distances, tiles of candidates along the diagonal) which are shared by all processes'
                            ' (Default: %(default)s).',
                            required=False,
                            default=4,
                            type=int
                            )
     parserOpt.add_argument('--threadsPerChromosome', '-tpc',
-                           help='Number of threads to use per parallel thread processing a chromosome. E.g. --threads = 4 and --threadsPerChromosome = 4 makes 4 * 4 = 16 threads in total'
-                           ' (Default: %(default)s).',
+                           help='Deprecated, use --threads to set the total number of processes. '
+                           'If set, --threads * --threadsPerChromosome processes are used.',
                            required=False,
-                           default=4,
+                           default=None,
                            type=int
                            )
     parserOpt.add_argument('--expected', '-exp',
@@ -117,6 +118,11 @@ Computes enriched regions (peaks) or long range contacts on the given contact ma
                            default="mean",
                            choices=['mean', 'mean_nonzero', 'mean_nonzero_ligation']
                            )
+    parserOpt.add_argument('--tmpDir',
+                           help='Folder to store the obs/exp matrices of the chromosomes while they are processed. '
+                           'The files are removed at the end (Default: the systems temporary folder).',
+                           required=False,
+                           default=None)
     parserOpt.add_argument('--help', '-h', action='help',
                            help='show this help message and exit')
 
@@ -126,307 +132,338 @@ Computes enriched regions (peaks) or long range contacts on the given contact ma
     return parser
 
 
-def create_distance_distribution(pDataObsExp, pDistances, pWindowSize, pMinDistance, pMaxDistance, pQueue):
-    pGenomicDistanceDistributionObsExp = {}
-    pGenomicDistanceDistributionPosition = {}
-    try:
-        for distance in range(pMinDistance, pMaxDistance, 1):
-            mask = pDistances == distance
+# fitted negative binomial parameters per distance, keyed by the matrix
+# and the distance. Repeated runs on the same matrix, e.g. from
+# hicHyperoptDetectLoops, only need to fit the distributions once.
+nbinom_parameters_cache = {}
 
-            pGenomicDistanceDistributionObsExp[distance] = pDataObsExp[mask]
-            pGenomicDistanceDistributionPosition[distance] = np.argwhere(mask == True).flatten()
-    except Exception as exp:
-        pQueue.put('Fail: ' + str(exp) + traceback.format_exc())
-        return
-    pQueue.put([pGenomicDistanceDistributionPosition, pGenomicDistanceDistributionObsExp])
-    return
 
+def distance_segments(pDistances):
+    """
+        Groups the values of a matrix by their distance to the main diagonal with one stable sort.
 
-def compute_p_values_mask(pGenomicDistanceDistributionsObsExp, pGenomicDistanceDistributionsKeyList,
-                          pPValuePreselection, pGenomicDistanceDistributionPosition, pResolution,
-                          pMinimumInteractionsThreshold, pObsExpThreshold, pQueue):
+        Input:
+            - pDistances: numpy array, distance to the main diagonal of each value
 
-    try:
-        true_values = []
-        if len(pGenomicDistanceDistributionsKeyList) == 0:
-            pQueue.put(true_values)
-            return
+        Returns:
+            - The permutation sorting the values by distance, the order within one distance is kept
+            - The distances present in pDistances
+            - The start position of each distance in the sorted order, with the number of values appended
+
+        >>> order, distances, starts = distance_segments(np.array([2, 0, 2, 1, 0]))
+        >>> order
+        array([1, 4, 3, 0, 2])
+        >>> distances
+        array([0, 1, 2])
+        >>> starts
+        array([0, 2, 3, 5])
+    """
+    order = np.argsort(pDistances, kind='stable')
+    sorted_distances = pDistances[order]
+    starts = np.flatnonzero(np.diff(sorted_distances)) + 1
+    starts = np.concatenate(([0], starts, [len(order)]))
+    return order, sorted_distances[starts[:-1]], starts
 
-        float_dict = isinstance(pPValuePreselection, float)
-        for i, key in enumerate(pGenomicDistanceDistributionsKeyList):
 
-            data_obs_exp = np.array(pGenomicDistanceDistributionsObsExp[key])
-            # do not fit and not compute any p-value if all values on this distance are small than the pMinimumInteractionsThreshold
-            mask = data_obs_exp >= pObsExpThreshold
-            nbinom_parameters = fit_nbinom.fit(data_obs_exp)
+def fit_nbinom_segments(pSegments):
+    """
+        Fits a negative binomial distribution to each of the given arrays.
+        Returns a list of (size, prob) tuples.
+    """
+    nbinom_parameters = []
+    for segment in pSegments:
+        parameters = fit_nbinom.fit(segment)
+        nbinom_parameters.append((parameters['size'], parameters['prob']))
+    return nbinom_parameters
 
-            p_value = 1 - cnb.cdf(data_obs_exp[mask], nbinom_parameters['size'], nbinom_parameters['prob'])
 
-            if float_dict:
-                mask_distance = p_value <= pPValuePreselection
-            else:
-                key_genomic = int(key * pResolution)
-                mask_distance = p_value <= pPValuePreselection[key_genomic]
-            j = 0
-            for k, value in enumerate(mask):
-                if value:
-                    if mask_distance[j]:
-                        true_values.append(pGenomicDistanceDistributionPosition[key][k])
-                    j += 1
-    except Exception as exp:
-        pQueue.put('Fail: ' + str(exp) + traceback.format_exc())
-        return
-    pQueue.put(true_values)
-    return
-
-
-def compute_long_range_contacts(pHiCMatrix, pObsExpMatrix, pWindowSize,
-                                pPValue, pPeakWindowSize,
-                                pPValuePreselection,
-                                pMinimumInteractionsThreshold,
-                                pObsExpThreshold, pThreads):
+def p_value_thresholds(pPValuePreselection, pDistances, pResolution, pSegments):
     """
-        This function computes the loops by:
-            - decreasing the search space by removing values with p-values > pPValuePreselection
-            - decreasing the search space with the pMaximumInteractionPercentageThreshold: removes all values with less interactions as maximum value of their distance  * pMaximumInteractionPercentageThreshold
-            - calls neighborhood_merge to merging candidates which share a neighborhood to one candidate
-            - calling candidate_region_test to test the neighborhood of a candidate against its peak to detect significant peaks
+        Returns the p-value threshold of the preselection for each distance in pSegments, NaN for the others.
 
         Input:
-            - pHiCMatrix: original interaction matrix for neighborhood and peak region subset selection
-            - pWindowSize: integer, the size of (2*pWindowSize)^2 around a candidate defines its neighborhood. It is used for
-                    a) merging candidates and their neighborhoods to one candidate per neighborhood which appear in this region.
-                    b) same neighborhood is used to test the peak region against the neighborhood for significant difference (candidate_region_test)
-            - pMinimumInteractionsThreshold: float, remove candidates with less interactions
-            - pPValue: float, test rejection level for H0 and FDR correction
-            - pPValuePreselection: float, p-value for negative binomial
-            - pPeakWindowSize: integer, size of the peak region: (2*pPeakWindowSize)^2. Needs to be smaller than pWindowSize
+            - pPValuePreselection: float or dict of genomic distance to p-value
+            - pDistances: numpy array, distances in bins
+            - pResolution: integer, bin size of the matrix
+            - pSegments: indices of pDistances which need a threshold
 
-        Returns:
-            - A list of detected loops [(x,y)] and x, y are matrix index values
-            - An associated list of p-values
+        >>> p_value_thresholds({0: 0.1, 10: 0.2, 20: 0.3}, np.array([0, 1, 2]), 10, [1, 2])
+        array([nan, 0.2, 0.3])
+    """
+    if isinstance(pPValuePreselection, float):
+        return np.full(len(pDistances), pPValuePreselection)
+    p_value_threshold = np.full(len(pDistances), np.nan)
+    for i in pSegments:
+        p_value_threshold[i] = pPValuePreselection[int(pDistances[i] * pResolution)]
+    return p_value_threshold
+
+
+def shared_matrix_files(pPrefix):
+    """
+        Returns the file names of the arrays stored by prepare_chromosome for one chromosome.
     """
-    # pObsExpMatrix.eliminate_zeros()
-    # pHiCMatrix.matrix.eliminate_zeros()
-    instances, features = pObsExpMatrix.nonzero()
-    distance = np.absolute(instances - features)
-    mask_interactions_hard_threshold = pHiCMatrix.matrix.data >= pMinimumInteractionsThreshold
+    return {name: pPrefix + '_' + name + '.npy' for name in ('data', 'indices', 'indptr', 'order', 'sorted', 'starts', 'interactions')}
 
+
+def load_shared_matrix(pPrefix, pShape):
+    """
+        Returns the obs/exp csr_matrix of a chromosome stored by prepare_chromosome. The arrays are memory mapped,
+        all processes share the same memory and nothing is copied.
+    """
+    files = shared_matrix_files(pPrefix)
+    return csr_matrix((np.load(files['data'], mmap_mode='r'),
+                       np.load(files['indices'], mmap_mode='r'),
+                       np.load(files['indptr'], mmap_mode='r')), shape=pShape, copy=False)
+
+
+def prepare_chromosome(pRegion, pArgs, pIsCooler, pPrefix):
+    """
+        Loads one chromosome, keeps the upper triangle without the main diagonal up to pArgs.maxLoopDistance
+        and computes the obs/exp matrix. The obs/exp matrix is stored as CSR arrays in files starting with pPrefix
+        to be shared with the other processes, together with its values grouped by distance.
+
+        Input:
+            - pRegion: Chromosome name
+            - pArgs: Argparser object
+            - pIsCooler: True / False if matrix is stored in a .cool file
+            - pPrefix: path prefix of the files of this chromosome
+
+        Returns:
+            - None if the chromosome has no values to test, otherwise a dict with the shape, the bin size and the
+              bins of the chromosome, the distances present in the matrix, the number of values per distance and
+              which distances have values above pArgs.obsExpThreshold
+    """
+    if pIsCooler:
+        hic_matrix = hm.hiCMatrix(pMatrixFile=pArgs.matrix, pChrnameList=[pRegion], pDistance=pArgs.maxLoopDistance, pNoIntervalTree=True, pUpperTriangleOnly=True)
+    else:
+        hic_matrix = hm.hiCMatrix(pMatrixFile=pArgs.matrix, pChrnameList=[pRegion], pDistance=pArgs.maxLoopDistance, pNoIntervalTree=False, pUpperTriangleOnly=False)
+        # cooler files load only what is necessary.
+        hic_matrix.keepOnlyTheseChr([pRegion])
+        max_loop_distance = pArgs.maxLoopDistance / hic_matrix.getBinSize()
+        instances, features = hic_matrix.matrix.nonzero()
+        distances = np.absolute(instances - features)
+        mask = distances > max_loop_distance
+        hic_matrix.matrix.data[mask] = 0
+        hic_matrix.matrix.eliminate_zeros()
+
+    if len(hic_matrix.matrix.data) == 0:
+        return None
+    if hic_matrix.matrix.shape[0] < 5 or hic_matrix.matrix.shape[1] < 5:
+        return None
+
+    matrix = triu(hic_matrix.matrix, format='csr')
+    matrix.eliminate_zeros()
+
+    # delete main diagonal
+    instances, features = matrix.nonzero()
+    matrix.data[instances == features] = 0
+    matrix.eliminate_zeros()
     del instances
     del features
-    queue = [None] * pThreads
-    process = [None] * pThreads
-    genomic_distance_distributions_thread = None
-    genomic_distance_distributions_obs_exp_thread = None
-
-    pGenomicDistanceDistributionPosition_thread = None
-    all_data_collected = False
-    thread_done = [False] * pThreads
-    min_distance = distance.min()
-    max_distance = distance.max()
-    len_distance = len(distance)
-
-    distances_per_threads = (max_distance - min_distance) // pThreads
-    for i in range(pThreads):
-
-        if i < pThreads - 1:
-            min_distance_thread = min_distance + (i * distances_per_threads)
-            max_distance_thread = min_distance + ((i + 1) * distances_per_threads)
-        else:
-            min_distance_thread = min_distance + (i * distances_per_threads)
-            max_distance_thread = max_distance + 1
-        queue[i] = Queue()
-        process[i] = Process(target=create_distance_distribution, kwargs=dict(
-            pDataObsExp=pObsExpMatrix.data,
-            pDistances=distance,
-            pWindowSize=pWindowSize,
-            pMinDistance=min_distance_thread,
-            pMaxDistance=max_distance_thread,
-            pQueue=queue[i]
-        )
-        )
-
-        process[i].start()
-
-    del pHiCMatrix.matrix
-    del distance
-    # genomic_distance_distributions = {}
-    genomic_distance_distributions_obs_exp = {}
-    pGenomicDistanceDistributionPosition = {}
-    fail_flag = False
-    fail_message = ''
-    while not all_data_collected:
-        for i in range(pThreads):
-            if queue[i] is not None and not queue[i].empty():
-                queue_data = queue[i].get()
-                if 'Fail:' in queue_data:
-                    fail_flag = True
-                    fail_message = queue_data
-                else:
-                    pGenomicDistanceDistributionPosition_thread, \
-                        genomic_distance_distributions_obs_exp_thread = queue_data
-
-                    pGenomicDistanceDistributionPosition = {**pGenomicDistanceDistributionPosition, **pGenomicDistanceDistributionPosition_thread}
-                    del pGenomicDistanceDistributionPosition_thread
-
-                    genomic_distance_distributions_obs_exp = {**genomic_distance_distributions_obs_exp, **genomic_distance_distributions_obs_exp_thread}
-                    del genomic_distance_distributions_obs_exp_thread
-
-                queue[i] = None
-                process[i].join()
-                process[i].terminate()
-                process[i] = None
-                thread_done[i] = True
-        all_data_collected = True
-        for thread in thread_done:
-            if not thread:
-                all_data_collected = False
-        time.sleep(1)
-
-    if fail_flag:
-        return fail_message, None
-    mask = [False] * len_distance
-    genomic_distance_distributions_thread = (len(genomic_distance_distributions_obs_exp) // pThreads) + 1
-
-    queue = [None] * pThreads
-    process = [None] * pThreads
-    all_data_collected = False
-    thread_done = [False] * pThreads
-    genomic_keys_list = sorted(list(genomic_distance_distributions_obs_exp.keys()))
-
-    for i in range(pThreads):
-
-        if i < pThreads - 1:
-            genomic_distance_keys_thread = genomic_keys_list[i * genomic_distance_distributions_thread:(i + 1) * genomic_distance_distributions_thread]
-        else:
-            genomic_distance_keys_thread = genomic_keys_list[i * genomic_distance_distributions_thread:]
-        if len(genomic_distance_keys_thread) == 0:
-
-            process[i] = None
-            queue[i] = None
-            thread_done[i] = True
-            continue
-        else:
-            queue[i] = Queue()
-            process[i] = Process(target=compute_p_values_mask, kwargs=dict(
-                pGenomicDistanceDistributionsObsExp=genomic_distance_distributions_obs_exp,
-                pGenomicDistanceDistributionsKeyList=genomic_distance_keys_thread,
-                pPValuePreselection=pPValuePreselection,
-                pGenomicDistanceDistributionPosition=pGenomicDistanceDistributionPosition,
-                pResolution=pHiCMatrix.getBinSize(),
-                pMinimumInteractionsThreshold=pMinimumInteractionsThreshold,
-                pObsExpThreshold=pObsExpThreshold,
-                pQueue=queue[i]
-            )
-            )
-
-            process[i].start()
-            del genomic_distance_keys_thread
-
-    del genomic_distance_distributions_obs_exp
-    del pGenomicDistanceDistributionPosition
-    del genomic_keys_list
-
-    while not all_data_collected:
-        for i in range(pThreads):
-            if queue[i] is not None and not queue[i].empty():
-                mask_threads = queue[i].get()
-                if 'Fail: ' in mask_threads:
-                    fail_flag = True
-                    fail_message = mask_threads
-                else:
-                    for index in mask_threads:
-                        mask[index] = True
-                    del mask_threads
-                queue[i] = None
-                process[i].join()
-                process[i].terminate()
-                process[i] = None
-                thread_done[i] = True
-        all_data_collected = True
-        for thread in thread_done:
-            if not thread:
-                all_data_collected = False
-        time.sleep(1)
-
-    if fail_flag:
-        return fail_message, None
-    mask = np.logical_and(mask, mask_interactions_hard_threshold)
-    instances, features = pObsExpMatrix.nonzero()
-
-    instances = instances[mask]
-    features = features[mask]
-
-    if len(features) == 0:
-        return None, None
-    candidates = np.array([*zip(instances, features)])
 
+    if pArgs.expected == 'mean':
+        obs_exp_csr_matrix = obs_exp_matrix(matrix, pInplace=False, pToEpsilon=True)
+    elif pArgs.expected == 'mean_nonzero':
+        obs_exp_csr_matrix = obs_exp_matrix_non_zero(matrix, ligation_factor=False, pInplace=False, pToEpsilon=True)
+    elif pArgs.expected == 'mean_nonzero_ligation':
+        obs_exp_csr_matrix = obs_exp_matrix_non_zero(matrix, ligation_factor=True, pInplace=False, pToEpsilon=True)
+
+    if not isinstance(obs_exp_csr_matrix, csr_matrix):
+        return None
+    obs_exp_csr_matrix.eliminate_zeros()
+    if len(matrix.data) != len(obs_exp_csr_matrix.data):
+        return None
+
+    instances, features = obs_exp_csr_matrix.nonzero()
+    order, distances, starts = distance_segments(np.absolute(instances - features))
     del instances
     del features
-    del mask
+    sorted_obs_exp = obs_exp_csr_matrix.data[order]
+    above_threshold = sorted_obs_exp >= pArgs.obsExpThreshold
+
+    files = shared_matrix_files(pPrefix)
+    np.save(files['data'], obs_exp_csr_matrix.data)
+    np.save(files['indices'], obs_exp_csr_matrix.indices)
+    np.save(files['indptr'], obs_exp_csr_matrix.indptr)
+    np.save(files['order'], order)
+    np.save(files['sorted'], sorted_obs_exp)
+    np.save(files['starts'], starts)
+    np.save(files['interactions'], matrix.data >= pArgs.peakInteractionsThreshold)
+
+    return {'shape': obs_exp_csr_matrix.shape,
+            'bin_size': hic_matrix.getBinSize(),
+            'cut_intervals': hic_matrix.cut_intervals,
+            'distances': distances,
+            'segment_lengths': np.diff(starts),
+            # only distances with values above the threshold need a fitted distribution
+            'fit_segment': np.add.reduceat(above_threshold, starts[:-1]) > 0 if len(order) > 0 else np.zeros(0, dtype=bool)}
+
+
+def fit_distances(pPrefix, pSegments):
+    """
+        Fits the negative binomial distribution of the obs/exp values of the distances pSegments of a chromosome
+        stored by prepare_chromosome. Returns a list of (size, prob) tuples.
+    """
+    files = shared_matrix_files(pPrefix)
+    sorted_obs_exp = np.load(files['sorted'], mmap_mode='r')
+    starts = np.load(files['starts'])
+    return fit_nbinom_segments([np.array(sorted_obs_exp[starts[i]:starts[i + 1]]) for i in pSegments])
 
-    candidates, _ = neighborhood_merge(
-        candidates, pWindowSize, pObsExpMatrix, pThreads)
 
-    if 'Fail: ' in candidates:
-        return candidates, None
-    if len(candidates) == 0:
-        return None, None
-    candidates, p_value_list = candidate_region_test(
-        pObsExpMatrix, candidates, pWindowSize, pPValue,
-        pPeakWindowSize, pThreads)
+def preselect_candidates(pPrefix, pSize, pProb, pPValueThreshold, pObsExpThreshold):
+    """
+        Preselects the candidates of a chromosome stored by prepare_chromosome: a value is kept if it has at least
+        peakInteractionsThreshold interactions, an obs/exp value of at least pObsExpThreshold and the p-value of the
+        negative binomial distribution fitted to all values of its distance is at most the p-value threshold of the distance.
 
-    return candidates, p_value_list
+        Input:
+            - pPrefix: path prefix of the files of the chromosome
+            - pSize, pProb: numpy arrays, parameters of the negative binomial distribution per distance
+            - pPValueThreshold: numpy array, p-value threshold per distance
+            - pObsExpThreshold: float, minimal obs/exp value of a candidate
 
+        Returns:
+            - numpy array of the candidates [(x, y)] in row major order
+    """
+    files = shared_matrix_files(pPrefix)
+    sorted_obs_exp = np.load(files['sorted'], mmap_mode='r')
+    segment_lengths = np.diff(np.load(files['starts']))
 
-def neighborhood_merge_thread(pCandidateList, pWindowSize, pInteractionCountMatrix, pQueue):
+    mask = sorted_obs_exp >= pObsExpThreshold
+    p_value = 1 - cnb.cdf(sorted_obs_exp[mask], np.repeat(pSize, segment_lengths)[mask],
+                          np.repeat(pProb, segment_lengths)[mask])
+    mask[mask] = p_value <= np.repeat(pPValueThreshold, segment_lengths)[mask]
+    del p_value
 
-    try:
-        new_candidate_list = []
+    candidate_mask = np.zeros(len(mask), dtype=bool)
+    candidate_mask[np.load(files['order'])] = mask
+    candidate_mask &= np.load(files['interactions'])
 
-        if len(pCandidateList) == 0:
-            pQueue.put(new_candidate_list)
-            return
-        x_max = pInteractionCountMatrix.shape[0]
-        y_max = pInteractionCountMatrix.shape[1]
+    indptr = np.load(files['indptr'])
+    instances = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))[candidate_mask]
+    features = np.load(files['indices'], mmap_mode='r')[candidate_mask]
+    return np.array([*zip(instances, features)])
 
-        for candidate in pCandidateList:
 
-            if (candidate[0] - pWindowSize) > 0:
-                start_x = candidate[0] - pWindowSize
-            else:
-                start_x = 0
+def merge_candidates(pPrefix, pShape, pCandidates, pWindowSize):
+    """
+        Runs neighborhood_merge on the obs/exp matrix of a chromosome stored by prepare_chromosome.
+    """
+    return neighborhood_merge(pCandidates, pWindowSize, load_shared_matrix(pPrefix, pShape))
 
-            if (candidate[1] - pWindowSize) > 0:
-                start_y = candidate[1] - pWindowSize
-            else:
-                start_y = 0
 
-            end_x = candidate[0] + pWindowSize + 1 if candidate[0] + \
-                pWindowSize + 1 < x_max else x_max
+def test_candidates(pPrefix, pShape, pCandidates, pWindowSize, pPValue, pPeakWindowSize):
+    """
+        Runs candidate_region_test on the obs/exp matrix of a chromosome stored by prepare_chromosome.
+    """
+    return candidate_region_test(load_shared_matrix(pPrefix, pShape), pCandidates, pWindowSize, pPValue, pPeakWindowSize)
+
+
+def split_into_tiles(pCandidates, pThreads):
+    """
+        Splits the candidates, sorted in row major order, into tiles of consecutive candidates along the diagonal.
+        There are enough tiles to keep pThreads processes busy while no tile gets too large.
+
+        >>> [len(tile) for tile in split_into_tiles(np.arange(10), 2)]
+        [2, 2, 1, 1, 1, 1, 1, 1]
+    """
+    number_of_tiles = max(pThreads * 4, len(pCandidates) // 1000)
+    number_of_tiles = max(1, min(number_of_tiles, len(pCandidates)))
+    return np.array_split(pCandidates, number_of_tiles)
+
 
-            end_y = candidate[1] + pWindowSize + 1 if candidate[1] + \
-                pWindowSize + 1 < y_max else y_max
+def neighborhood_slices(pCandidate, pWindowSize, pShape):
+    """
+        Returns the row and column slice of the (2*pWindowSize + 1)^2 neighborhood of a candidate,
+        clipped to the matrix borders.
+    """
+    if (pCandidate[0] - pWindowSize) > 0:
+        start_x = pCandidate[0] - pWindowSize
+    else:
+        start_x = 0
 
-            neighborhood = pInteractionCountMatrix[start_x:end_x,
-                                                   start_y:end_y].toarray().flatten()
+    if (pCandidate[1] - pWindowSize) > 0:
+        start_y = pCandidate[1] - pWindowSize
+    else:
+        start_y = 0
 
-            if len(neighborhood) > 0 and np.max(neighborhood) == pInteractionCountMatrix[candidate[0], candidate[1]]:
-                new_candidate_list.append(candidate)
+    end_x = pCandidate[0] + pWindowSize + 1 if pCandidate[0] + \
+        pWindowSize + 1 < pShape[0] else pShape[0]
 
-            del neighborhood
-        del pCandidateList
-    except Exception as exp:
-        pQueue.put('Fail: ' + str(exp) + traceback.format_exc())
-        return
-    pQueue.put(new_candidate_list)
-    return
+    end_y = pCandidate[1] + pWindowSize + 1 if pCandidate[1] + \
+        pWindowSize + 1 < pShape[1] else pShape[1]
+    return slice(start_x, end_x), slice(start_y, end_y)
 
 
-def neighborhood_merge(pCandidates, pWindowSize, pInteractionCountMatrix, pThreads):
+def candidate_neighborhoods(pMatrix, pCandidates, pWindowSize, pMaxTileSize=2**22):
+    """
+        Returns the (2*pWindowSize + 1)^2 neighborhoods of all candidates as one array of shape
+        (number of candidates, 2*pWindowSize + 1, 2*pWindowSize + 1) and a mask of the candidates whose
+        neighborhood lies completely inside the matrix. The neighborhoods of the other candidates are not set.
+
+        The values are taken from dense tiles of the diagonals around the candidates: a tile holds the rows of
+        a group of candidates and the diagonals from the smallest candidate distance - 2*pWindowSize to the
+        largest + 2*pWindowSize. A tile has at most pMaxTileSize values.
+
+        >>> matrix = csr_matrix(np.arange(1, 37, dtype=float).reshape(6, 6))
+        >>> neighborhoods, inside = candidate_neighborhoods(matrix, np.array([[2, 3], [0, 1], [3, 3]]), 1, pMaxTileSize=12)
+        >>> inside
+        array([ True, False,  True])
+        >>> neighborhoods[0]
+        array([[ 9., 10., 11.],
+               [15., 16., 17.],
+               [21., 22., 23.]])
+        >>> neighborhoods[2]
+        array([[15., 16., 17.],
+               [21., 22., 23.],
+               [27., 28., 29.]])
+    """
+    candidates = np.asarray(pCandidates).reshape(-1, 2)
+    window_length = 2 * pWindowSize + 1
+    neighborhoods = np.zeros((len(candidates), window_length, window_length), dtype=pMatrix.dtype)
+    x = candidates[:, 0].astype(np.int64)
+    y = candidates[:, 1].astype(np.int64)
+    inside = (x - pWindowSize >= 0) & (y - pWindowSize >= 0) & \
+        (x + pWindowSize + 1 <= pMatrix.shape[0]) & (y + pWindowSize + 1 <= pMatrix.shape[1])
+    if not np.any(inside):
+        return neighborhoods, inside
+
+    index = np.flatnonzero(inside)
+    index = index[np.argsort(x[index], kind='stable')]
+    sorted_rows = x[index]
+    distance = y[index] - sorted_rows
+    lowest_diagonal = distance.min() - 2 * pWindowSize
+    tile_width = distance.max() - distance.min() + 4 * pWindowSize + 1
+    rows_per_tile = max(window_length, pMaxTileSize // tile_width)
+
+    window_offset = np.arange(window_length) - pWindowSize
+    tile_start = 0
+    while tile_start < len(index):
+        # the candidates of one tile cover at most rows_per_tile rows
+        tile_end = np.searchsorted(sorted_rows, sorted_rows[tile_start] + rows_per_tile - window_length + 1)
+        tile_end = max(tile_end, tile_start + 1)
+        tile_index = index[tile_start:tile_end]
+        first_row = x[tile_index[0]] - pWindowSize
+        last_row = x[tile_index[-1]] + pWindowSize + 1
+
+        rows_tile = pMatrix[first_row:last_row]
+        row, column = row_col_of_values(rows_tile)
+        diagonal = column - (row + first_row) - lowest_diagonal
+        keep = (diagonal >= 0) & (diagonal < tile_width)
+        tile = np.zeros((last_row - first_row, tile_width), dtype=pMatrix.dtype)
+        tile[row[keep], diagonal[keep]] = rows_tile.data[keep]
+
+        rows = x[tile_index][:, None, None] + window_offset[None, :, None]
+        columns = y[tile_index][:, None, None] + window_offset[None, None, :]
+        neighborhoods[tile_index] = tile[rows - first_row, columns - rows - lowest_diagonal]
+        tile_start = tile_end
+    return neighborhoods, inside
+
+
+def neighborhood_merge(pCandidates, pWindowSize, pInteractionCountMatrix):
     """
         Clusters candidates together to one candidate if they share / overlap their neighborhood.
-        Implemented in an iterative way, the candidate with the highest interaction count is accepted as candidate for the neighborhood.
+        A candidate is kept if it has the highest interaction count of its neighborhood.
 
         Input:
             - pCandidates: List of candidates
@@ -434,330 +471,203 @@ def neighborhood_merge(pCandidates, pWindowSize, pInteractionCountMatrix, pThrea
             - pInteractionCountMatrix: csr_matrix: The interaction count matrix
 
         Returns:
-            - Reduced list of candidates with no more overlapping neighborhoods
+            - Reduced array of candidates with no more overlapping neighborhoods
     """
-    log.debug('pCandidates {}'.format(pCandidates[:10]))
-    new_candidate_list = []
-
-    new_candidate_list_threads = [None] * pThreads
-    interactionFilesPerThread = len(pCandidates) // pThreads
-    all_data_collected = False
-    queue = [None] * pThreads
-    process = [None] * pThreads
-    thread_done = [False] * pThreads
-    for i in range(pThreads):
-
-        if i < pThreads - 1:
-            candidateThread = pCandidates[i * interactionFilesPerThread:(i + 1) * interactionFilesPerThread]
-        else:
-            candidateThread = pCandidates[i * interactionFilesPerThread:]
-        queue[i] = Queue()
-        process[i] = Process(target=neighborhood_merge_thread, kwargs=dict(
-            pCandidateList=candidateThread,
-            pWindowSize=pWindowSize,
-            pInteractionCountMatrix=pInteractionCountMatrix,
-            pQueue=queue[i]
-        )
-        )
-        if len(candidateThread) == 0:
-            process[i] = None
-            queue[i] = None
-            thread_done[i] = True
-
-            new_candidate_list_threads[i] = []
-            continue
-        else:
-            process[i].start()
-        del candidateThread
-    del pInteractionCountMatrix
-    fail_flag = False
-    fail_message = ''
-    while not all_data_collected:
-        for i in range(pThreads):
-            if queue[i] is not None and not queue[i].empty():
-                new_candidate_list_threads[i] = queue[i].get()
-                if 'Fail: ' in new_candidate_list_threads[i]:
-                    fail_flag = True
-                    fail_message = new_candidate_list_threads[i]
-                queue[i] = None
-                process[i].join()
-                process[i].terminate()
-                process[i] = None
-                thread_done[i] = True
-        all_data_collected = True
-        for thread in thread_done:
-            if not thread:
-                all_data_collected = False
-        time.sleep(1)
-    if fail_flag:
-        return fail_message
-    new_candidate_list = [item for sublist in new_candidate_list_threads for item in sublist]
-    del new_candidate_list_threads
-    return new_candidate_list, True
-
-
-def candidate_region_test_thread(pHiCMatrix, pCandidates, pWindowSize, pPValue,
-                                 pPeakWindowSize, pQueue):
-    try:
-        mask = []
-        pvalues = []
-        if len(pCandidates) == 0:
-            pQueue.put([mask, pvalues])
-            return
-        x_max = pHiCMatrix.shape[0]
-        y_max = pHiCMatrix.shape[1]
-        for i, candidate in enumerate(pCandidates):
-
-            if (candidate[0] - pWindowSize) > 0:
-                start_x = candidate[0] - pWindowSize
-            else:
-                start_x = 0
-
-            if (candidate[1] - pWindowSize) > 0:
-                start_y = candidate[1] - pWindowSize
-            else:
-                start_y = 0
+    candidates = np.asarray(pCandidates).reshape(-1, 2)
+    if len(candidates) == 0:
+        return candidates
 
-            end_x = candidate[0] + pWindowSize + 1 if candidate[0] + \
-                pWindowSize + 1 < x_max else x_max
+    neighborhoods, inside = candidate_neighborhoods(pInteractionCountMatrix, candidates, pWindowSize)
+    keep = np.zeros(len(candidates), dtype=bool)
+    keep[inside] = neighborhoods[inside].max(axis=(1, 2)) == neighborhoods[inside, pWindowSize, pWindowSize]
 
-            end_y = candidate[1] + pWindowSize + 1 if candidate[1] + \
-                pWindowSize + 1 < y_max else y_max
+    # neighborhoods at the border of the matrix are clipped
+    for i in np.flatnonzero(~inside):
+        candidate = candidates[i]
+        slice_x, slice_y = neighborhood_slices(candidate, pWindowSize, pInteractionCountMatrix.shape)
+        neighborhood = pInteractionCountMatrix[slice_x, slice_y].toarray().flatten()
+        keep[i] = len(neighborhood) > 0 and np.max(neighborhood) == pInteractionCountMatrix[candidate[0], candidate[1]]
+    return candidates[keep]
 
-            neighborhood = pHiCMatrix[start_x:end_x,
-                                      start_y:end_y].toarray()
-            if len(neighborhood) == 0:
-                mask.append(False)
-                del neighborhood
-                continue
-            # get index of original candidate
-            peak_region = np.array(np.where(neighborhood == pHiCMatrix[candidate[0], candidate[1]])).flatten()
-
-            if pPeakWindowSize > pWindowSize:
-                log.warning('Neighborhood window size ({}) needs to be larger than peak width({}).'.format(
-                    pWindowSize, pPeakWindowSize))
-                return None, None
-
-            peak = neighborhood[peak_region[0] - pPeakWindowSize:peak_region[0] + pPeakWindowSize + 1,
-                                peak_region[1] - pPeakWindowSize:peak_region[1] + pPeakWindowSize + 1].flatten()
-
-            background = []
-            # top to peak
-            background.extend(
-                list(neighborhood[:peak_region[0] - pPeakWindowSize, :].flatten()))
-            # from peak to bottom
-            background.extend(
-                list(neighborhood[peak_region[0] + pPeakWindowSize + 1:, :].flatten()))
-
-            # right middle
-            background.extend(
-                list(neighborhood[peak_region[0] - pPeakWindowSize:peak_region[0] + pPeakWindowSize + 1, peak_region[1] + pPeakWindowSize + 1:].flatten()))
-            # left middle
-            background.extend(
-                list(neighborhood[peak_region[0] - pPeakWindowSize:peak_region[0] + pPeakWindowSize + 1, :peak_region[1] - pPeakWindowSize].flatten()))
-            background = np.array(background)
-
-            if len(background) < pWindowSize:
-                mask.append(False)
-                del peak
-                del background
-                continue
-            if len(peak) < pWindowSize:
-                mask.append(False)
-                del peak
-                del background
-                continue
-            if np.mean(peak) < np.mean(background):
-                mask.append(False)
-                del peak
-                del background
-                continue
-            if np.max(peak) < np.max(background):
-                mask.append(False)
-                del peak
-                del background
-                continue
 
-            donut_test_data = []
-            horizontal = []
-            # top middle
-            horizontal.extend(neighborhood[:peak_region[0] - pPeakWindowSize, peak_region[1] - pPeakWindowSize:peak_region[1] + pPeakWindowSize + 1].flatten())
-            # bottom middle
-            horizontal.extend(neighborhood[peak_region[0] + pPeakWindowSize + 1:, peak_region[1] - pPeakWindowSize:peak_region[1] + pPeakWindowSize + 1].flatten())
-            horizontal = np.array(horizontal).flatten()
-
-            vertical = []
-            # left
-            vertical.extend(neighborhood[peak_region[0] - pPeakWindowSize:peak_region[0] + pPeakWindowSize + 1, :peak_region[1] - pPeakWindowSize].flatten())
-            # right
-            vertical.extend(neighborhood[peak_region[0] - pPeakWindowSize:peak_region[0] + pPeakWindowSize + 1, peak_region[1] + pPeakWindowSize + 1:].flatten())
-            vertical = np.array(vertical).flatten()
-
-            # bottom left
-            bottom_left_corner = []
-            bottom_left_corner.extend(neighborhood[peak_region[0]:, :peak_region[1] - pPeakWindowSize].flatten())
-            bottom_left_corner.extend(neighborhood[peak_region[0] + pPeakWindowSize + 1:, peak_region[1] - pPeakWindowSize:peak_region[1] + 1].flatten())
-            # bottom_left_corner = np.array(bottom_left_corner).flatten()
-            donut_test_data.append(bottom_left_corner)
-            donut_test_data.append(horizontal)
-            donut_test_data.append(vertical)
-
-            del neighborhood
-
-            # test vertical, horizontal, bottom left corner and neighborhood vs peak with wilcoxon-rank-sum test
-            accept_count = 0
-            for data in donut_test_data:
-                statistic, significance_level_test1 = ranksums(sorted(peak), sorted(data))
-                if significance_level_test1 <= pPValue:
-                    accept_count += 1
-            if accept_count >= 3:
-                statistic, significance_level = ranksums(sorted(peak), sorted(background))
-                if significance_level <= pPValue:
-                    mask.append(True)
-                    pvalues.append(significance_level)
-                    del peak
-                    del background
-                    del donut_test_data
-                    continue
-                else:
-                    mask.append(False)
-                    del peak
-                    del background
-                    del donut_test_data
-                    continue
-            else:
-                mask.append(False)
-                del peak
-                del background
-                del donut_test_data
-                continue
-    except Exception as exp:
-        pQueue.put('Fail: ' + str(exp) + traceback.format_exc())
-        return
-    del pHiCMatrix
-    del pCandidates
-    pQueue.put([mask, pvalues])
-    return
+def test_neighborhood(pNeighborhood, pValue, pWindowSize, pPValue, pPeakWindowSize):
+    """
+        Tests the peak of one candidate against its neighborhood, see candidate_region_test.
+        Returns None if the candidate is rejected, otherwise its p-value.
+    """
+    if len(pNeighborhood) == 0:
+        return None
+    # get index of original candidate
+    peak_region = np.array(np.where(pNeighborhood == pValue)).flatten()
+
+    peak = pNeighborhood[peak_region[0] - pPeakWindowSize:peak_region[0] + pPeakWindowSize + 1,
+                         peak_region[1] - pPeakWindowSize:peak_region[1] + pPeakWindowSize + 1].flatten()
+
+    background = []
+    # top to peak
+    background.extend(
+        list(pNeighborhood[:peak_region[0] - pPeakWindowSize, :].flatten()))
+    # from peak to bottom
+    background.extend(
+        list(pNeighborhood[peak_region[0] + pPeakWindowSize + 1:, :].flatten()))
+
+    # right middle
+    background.extend(
+        list(pNeighborhood[peak_region[0] - pPeakWindowSize:peak_region[0] + pPeakWindowSize + 1, peak_region[1] + pPeakWindowSize + 1:].flatten()))
+    # left middle
+    background.extend(
+        list(pNeighborhood[peak_region[0] - pPeakWindowSize:peak_region[0] + pPeakWindowSize + 1, :peak_region[1] - pPeakWindowSize].flatten()))
+    background = np.array(background)
+
+    if len(background) < pWindowSize:
+        return None
+    if len(peak) < pWindowSize:
+        return None
+    if np.mean(peak) < np.mean(background):
+        return None
+    if np.max(peak) < np.max(background):
+        return None
+
+    donut_test_data = []
+    horizontal = []
+    # top middle
+    horizontal.extend(pNeighborhood[:peak_region[0] - pPeakWindowSize, peak_region[1] - pPeakWindowSize:peak_region[1] + pPeakWindowSize + 1].flatten())
+    # bottom middle
+    horizontal.extend(pNeighborhood[peak_region[0] + pPeakWindowSize + 1:, peak_region[1] - pPeakWindowSize:peak_region[1] + pPeakWindowSize + 1].flatten())
+    horizontal = np.array(horizontal).flatten()
+
+    vertical = []
+    # left
+    vertical.extend(pNeighborhood[peak_region[0] - pPeakWindowSize:peak_region[0] + pPeakWindowSize + 1, :peak_region[1] - pPeakWindowSize].flatten())
+    # right
+    vertical.extend(pNeighborhood[peak_region[0] - pPeakWindowSize:peak_region[0] + pPeakWindowSize + 1, peak_region[1] + pPeakWindowSize + 1:].flatten())
+    vertical = np.array(vertical).flatten()
+
+    # bottom left
+    bottom_left_corner = []
+    bottom_left_corner.extend(pNeighborhood[peak_region[0]:, :peak_region[1] - pPeakWindowSize].flatten())
+    bottom_left_corner.extend(pNeighborhood[peak_region[0] + pPeakWindowSize + 1:, peak_region[1] - pPeakWindowSize:peak_region[1] + 1].flatten())
+    donut_test_data.append(bottom_left_corner)
+    donut_test_data.append(horizontal)
+    donut_test_data.append(vertical)
+
+    # test vertical, horizontal, bottom left corner and neighborhood vs peak with wilcoxon-rank-sum test
+    accept_count = 0
+    for data in donut_test_data:
+        statistic, significance_level_test1 = ranksums(sorted(peak), sorted(data))
+        if significance_level_test1 <= pPValue:
+            accept_count += 1
+    if accept_count >= 3:
+        statistic, significance_level = ranksums(sorted(peak), sorted(background))
+        if significance_level <= pPValue:
+            return significance_level
+    return None
+
+
+def neighborhood_regions(pWindowSize, pPeakWindowSize):
+    """
+        Returns the flat indices of the peak, background, bottom left corner, horizontal and vertical
+        region of a (2*pWindowSize + 1)^2 neighborhood with the peak in its center, in the same order
+        as test_neighborhood collects them.
+
+        >>> regions = neighborhood_regions(2, 1)
+        >>> regions['peak']
+        array([ 6,  7,  8, 11, 12, 13, 16, 17, 18])
+        >>> regions['horizontal']
+        array([ 1,  2,  3, 21, 22, 23])
+    """
+    window_length = 2 * pWindowSize + 1
+    center = pWindowSize
+
+    def region(pRowStart, pRowEnd, pColumnStart, pColumnEnd):
+        return (np.arange(pRowStart, pRowEnd)[:, None] * window_length + np.arange(pColumnStart, pColumnEnd)[None, :]).flatten()
+
+    peak_start = center - pPeakWindowSize
+    peak_end = center + pPeakWindowSize + 1
+    return {'peak': region(peak_start, peak_end, peak_start, peak_end),
+            'background': np.concatenate([region(0, peak_start, 0, window_length),
+                                          region(peak_end, window_length, 0, window_length),
+                                          region(peak_start, peak_end, peak_end, window_length),
+                                          region(peak_start, peak_end, 0, peak_start)]),
+            'bottom_left_corner': np.concatenate([region(center, window_length, 0, peak_start),
+                                                  region(peak_end, window_length, peak_start, center + 1)]),
+            'horizontal': np.concatenate([region(0, peak_start, peak_start, peak_end),
+                                          region(peak_end, window_length, peak_start, peak_end)]),
+            'vertical': np.concatenate([region(peak_start, peak_end, 0, peak_start),
+                                        region(peak_start, peak_end, peak_end, window_length)])}
 
 
 def candidate_region_test(pHiCMatrix, pCandidates, pWindowSize, pPValue,
-                          pPeakWindowSize, pThreads):
+                          pPeakWindowSize):
     """
         Tests if a candidate is having a significant peak compared to its neighborhood.
-            - smoothes neighborhood in x an y orientation
-            - remove candidate if smoothed peak value < pMinimumInteractionsThreshold
             - reject candidate if:
                 - mean(peak) < mean(background)
                 - max(peak) < max(background)
-            - Test background vs peak with Mann-Whitney rank test and reject H0 if pvalue < pPValue
-                - Size of background is: (2*pWindowSize)^2 - (2*pPeakWindowSize)^2
-            - Apply multi-test Bonferonni based on pPValue
+            - Test peak vs. the bottom left corner, the horizontal and the vertical region of the neighborhood
+              with the Wilcoxon rank-sum test, all three tests need a p-value <= pPValue
+            - Test background vs peak with Wilcoxon rank-sum test and reject H0 if pvalue < pPValue
+                - Size of background is: (2*pWindowSize + 1)^2 - (2*pPeakWindowSize + 1)^2
+
+        The neighborhoods of all candidates inside the matrix with a unique maximum in the center are tested
+        together on arrays, the others one by one.
 
         Input:
             - pHiCMatrix: csr_matrix, interaction matrix to extract candidate neighborhood
             - pCandidates: list of candidates to test for enrichment
             - pWindowSize: integer, size of neighborhood (2*pWindowSize)^2
-            - pPValue: float, significance level for Mann-Whitney rank test
-            - pMinimumInteractionsThreshold: integer, if smoothed candidate interaction count is less, it will be removed
+            - pPValue: float, significance level for Wilcoxon rank-sum test
             - pPeakWindowSize: size of peak region (2*pPeakWindowSize)^2
 
         Returns:
-            - List of accepted candidates
-            - List of associated p-values
+            - Array of accepted candidates
+            - Array of associated p-values
     """
+    candidates = np.asarray(pCandidates).reshape(-1, 2)
+    p_values = np.full(len(candidates), np.nan)
+    if len(candidates) == 0:
+        return candidates, p_values
+
+    neighborhoods, inside = candidate_neighborhoods(pHiCMatrix, candidates, pWindowSize)
+    neighborhoods = neighborhoods.reshape(len(candidates), -1)
+    center = pWindowSize * (2 * pWindowSize + 1) + pWindowSize
+    unique_peak = np.sum(neighborhoods == neighborhoods[:, center:center + 1], axis=1) == 1
+    batch = inside & unique_peak
+
+    regions = neighborhood_regions(pWindowSize, pPeakWindowSize)
+    if len(regions['background']) >= pWindowSize and len(regions['peak']) >= pWindowSize:
+        index = np.flatnonzero(batch)
+        peak = neighborhoods[index][:, regions['peak']]
+        background = neighborhoods[index][:, regions['background']]
+        accepted = (np.mean(peak, axis=1) >= np.mean(background, axis=1)) & \
+            (np.max(peak, axis=1) >= np.max(background, axis=1))
+        for name in ['bottom_left_corner', 'horizontal', 'vertical']:
+            if not np.any(accepted):
+                break
+            accepted[accepted] = ranksums_rows(peak[accepted], neighborhoods[index[accepted]][:, regions[name]]) <= pPValue
+        if np.any(accepted):
+            p_value = ranksums_rows(peak[accepted], background[accepted])
+            p_values[index[accepted]] = np.where(p_value <= pPValue, p_value, np.nan)
 
-    mask = []
-    pvalues = []
-    log.debug('candidate_region_test initial: {}'.format(len(pCandidates)))
-
-    if len(pCandidates) == 0:
-        return None, None
-
-    pCandidates = np.array(pCandidates)
-
-    mask = []
+    # clipped neighborhoods at the border and neighborhoods with several maxima
+    for i in np.flatnonzero(~batch):
+        candidate = candidates[i]
+        slice_x, slice_y = neighborhood_slices(candidate, pWindowSize, pHiCMatrix.shape)
+        p_value = test_neighborhood(pHiCMatrix[slice_x, slice_y].toarray(), pHiCMatrix[candidate[0], candidate[1]],
+                                    pWindowSize, pPValue, pPeakWindowSize)
+        if p_value is not None:
+            p_values[i] = p_value
 
-    mask_thread = [None] * pThreads
-    pvalues_thread = [None] * pThreads
+    mask = ~np.isnan(p_values)
+    return candidates[mask], p_values[mask]
 
-    interactionFilesPerThread = len(pCandidates) // pThreads
-    all_data_collected = False
-    queue = [None] * pThreads
-    process = [None] * pThreads
-    thread_done = [False] * pThreads
-    for i in range(pThreads):
 
-        if i < pThreads - 1:
-            candidateThread = pCandidates[i * interactionFilesPerThread:(i + 1) * interactionFilesPerThread]
-        else:
-            candidateThread = pCandidates[i * interactionFilesPerThread:]
-        queue[i] = Queue()
-        process[i] = Process(target=candidate_region_test_thread, kwargs=dict(
-            pHiCMatrix=pHiCMatrix,
-            pCandidates=candidateThread,
-            pWindowSize=pWindowSize,
-            pPValue=pPValue,
-            pPeakWindowSize=pPeakWindowSize,
-            pQueue=queue[i]
-
-        )
-        )
-        if len(candidateThread) == 0:
-            process[i] = None
-            queue[i] = None
-            thread_done[i] = True
-            pvalues_thread[i] = []
-            mask_thread[i] = []
-            continue
-        else:
-            process[i].start()
-
-    fail_flag = False
-    fail_message = ''
-    while not all_data_collected:
-        for i in range(pThreads):
-            if queue[i] is not None and not queue[i].empty():
-                result_thread = queue[i].get()
-                if 'Fail: ' in result_thread:
-                    fail_flag = True
-                    fail_message = result_thread
-                else:
-                    mask_thread[i], pvalues_thread[i] = result_thread
-                queue[i] = None
-                process[i].join()
-                process[i].terminate()
-                process[i] = None
-                thread_done[i] = True
-        all_data_collected = True
-        for thread in thread_done:
-            if not thread:
-                all_data_collected = False
-        time.sleep(1)
-
-    if fail_flag:
-        return fail_message, None
-    mask = [item for sublist in mask_thread for item in sublist]
-    pvalues = [item for sublist in pvalues_thread for item in sublist]
-    del mask_thread
-    del pvalues_thread
-    if mask is not None and len(mask) == 0:
-        return None, None
-    mask = np.array(mask)
-    pCandidates = pCandidates[mask]
-    pvalues = np.array(pvalues)
-
-    if len(pCandidates) == 0:
-        return None, None
-
-    return pCandidates, pvalues
-
-
-def cluster_to_genome_position_mapping(pHicMatrix, pCandidates, pPValueList, pMaxLoopDistance):
+def cluster_to_genome_position_mapping(pCutIntervals, pCandidates, pPValueList, pMaxLoopDistance):
     """
         Maps the computed enriched loops from matrix index values to genomic locations.
 
         Input:
-            - pHicMatrix: hicmatrix object
+            - pCutIntervals: bins of the matrix
             - pCandidates: List of detect loops
             - pPValueList: Associated p-values of loops
             - pMaxLoopDistance: integer, exclude detected loops if (x - y) has a larger distance
@@ -766,8 +676,8 @@ def cluster_to_genome_position_mapping(pHicMatrix, pCandidates, pPValueList, pMa
     """
     mapped_cluster = []
     for i, candidate in enumerate(pCandidates):
-        chr_x, start_x, end_x, _ = pHicMatrix.getBinPos(candidate[0])
-        chr_y, start_y, end_y, _ = pHicMatrix.getBinPos(candidate[1])
+        chr_x, start_x, end_x, _ = pCutIntervals[candidate[0]]
+        chr_y, start_y, end_y, _ = pCutIntervals[candidate[1]]
         distance = abs(int(start_x) - int(start_y))
         if pMaxLoopDistance is not None and distance > pMaxLoopDistance:
             continue
@@ -792,149 +702,177 @@ def write_bedgraph(pLoops, pOutFileName, pStartRegion=None, pEndRegion=None):
                 fh.write("%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % loop_item)
 
 
-def compute_loops(pHiCMatrix, pRegion, pArgs, pIsCooler, pQueue=None):
+def compute_loops(pChromosomes, pArgs, pIsCooler, pPValuePreselection, pThreads):
     """
-        Master function to compute the loops for one chromosome.
-            - Removes all regions greater maxLoopSize
-            - Calls
-            - Writes computed loops to a bedgraph file
+        Computes the loops of all given chromosomes with pThreads processes.
+
+        The loop detection of a chromosome is split into steps:
+            - prepare_chromosome: load the chromosome and compute the obs/exp matrix
+            - fit_distances: fit a negative binomial distribution per distance, one task per group of distances
+            - preselect_candidates: preselect the candidates by their p-value
+            - merge_candidates: merge candidates sharing a neighborhood, one task per tile of candidates along the diagonal
+            - test_candidates: test the peak regions against their neighborhood, one task per tile of candidates
+        The tasks of all chromosomes are served by one pool of worker processes, a free worker takes the next task,
+        so a large chromosome is processed by all workers and not by one.
+        The obs/exp matrix of a chromosome is written once to a scratch directory in --tmpDir and memory mapped by the workers,
+        only the lists of candidates are send to them. At most pThreads chromosomes are processed at the same time.
 
         Input:
-            - pHiCMatrix: Hi-C interaction matrix object
-            - pRegion: Chromosome name
+            - pChromosomes: list of chromosome names, the order defines the processing order
             - pArgs: Argparser object
             - pIsCooler: True / False if matrix is stored in a .cool file
-            - pQueue: Queue object for multiprocessing communication with parent process
+            - pPValuePreselection: float or dict of genomic distance to p-value
+            - pThreads: integer, number of worker processes. With one thread all tasks are computed in this process.
+
+        Returns:
+            - List of detect loops in genomic coordinate format, ordered as pChromosomes, or a 'Fail: ' message.
     """
+    scratch_dir = mkdtemp(prefix='hicDetectLoops_', dir=pArgs.tmpDir)
+    pool = None
+    fail_message = None
     try:
-
-        if pQueue is not None:
-            if pIsCooler:
-                pHiCMatrix = hm.hiCMatrix(pMatrixFile=pArgs.matrix, pChrnameList=[pRegion], pDistance=pArgs.maxLoopDistance, pNoIntervalTree=True, pUpperTriangleOnly=False)
-            else:
-                pHiCMatrix = hm.hiCMatrix(pMatrixFile=pArgs.matrix, pChrnameList=[pRegion], pDistance=pArgs.maxLoopDistance, pNoIntervalTree=False, pUpperTriangleOnly=False)
-
-        if not pIsCooler:
-            # cooler files load only what is necessary.
-            pHiCMatrix.keepOnlyTheseChr([pRegion])
-            max_loop_distance = pArgs.maxLoopDistance / pHiCMatrix.getBinSize()
-            instances, features = pHiCMatrix.matrix.nonzero()
-            distances = np.absolute(instances - features)
-            mask = distances > max_loop_distance
-            pHiCMatrix.matrix.data[mask] = 0
-            pHiCMatrix.matrix.eliminate_zeros()
-
-        if len(pHiCMatrix.matrix.data) == 0:
-            pQueue.put([None])
-            return
-
-        if pHiCMatrix.matrix.shape[0] < 5 or pHiCMatrix.matrix.shape[1] < 5:
-            log.debug('Computed loops for {}: 0'.format(pRegion))
-
-            if pQueue is None:
-                return None
-            else:
-                pQueue.put([None])
-                return
-        if pArgs.windowSize is None:
-            bin_size = pHiCMatrix.getBinSize()
-            if 0 < bin_size <= 5000:
-                pArgs.windowSize = 10
-            elif 5000 < bin_size <= 10000:
-                pArgs.windowSize = 5
-            elif 10000 < bin_size <= 25000:
-                pArgs.windowSize = 5
-            elif 25000 < bin_size <= 50000:
-                pArgs.windowSize = 5
-            else:
-                pArgs.windowSize = 5
-            log.debug('Setting window size to: {}'.format(pArgs.windowSize))
-        if pArgs.peakWidth is None:
-            pArgs.peakWidth = pArgs.windowSize - 3
-        log.debug('Setting peak width to: {}'.format(pArgs.peakWidth))
-        pHiCMatrix.matrix = triu(pHiCMatrix.matrix, format='csr')
-        pHiCMatrix.matrix.eliminate_zeros()
-        # log.debug('candidates region {} {}'.format(
-        #     pRegion, len(pHiCMatrix.matrix.data)))
-
-        # delete main diagonal
-        instances, features = pHiCMatrix.matrix.nonzero()
-        distances = np.absolute(instances - features)
-        mask = distances == 0
-        pHiCMatrix.matrix.data[mask] = 0
-        pHiCMatrix.matrix.eliminate_zeros()
-
-        del instances
-        del features
-        del mask
-        del distances
-
-        if pArgs.expected == 'mean':
-            obs_exp_csr_matrix = obs_exp_matrix(pHiCMatrix.matrix, pInplace=False, pToEpsilon=True, pThreads=pArgs.threadsPerChromosome)
-        elif pArgs.expected == 'mean_nonzero':
-            obs_exp_csr_matrix = obs_exp_matrix_non_zero(pHiCMatrix.matrix, ligation_factor=False, pInplace=False, pToEpsilon=True, pThreads=pArgs.threadsPerChromosome)
-
-        elif pArgs.expected == 'mean_nonzero_ligation':
-            obs_exp_csr_matrix = obs_exp_matrix_non_zero(pHiCMatrix.matrix, ligation_factor=True, pInplace=False, pToEpsilon=True, pThreads=pArgs.threadsPerChromosome)
-
-        if not isinstance(obs_exp_csr_matrix, csr_matrix):
-            if pQueue is None:
-                return None
-            else:
-                pQueue.put([None])
-                return
-        pHiCMatrix.matrix.eliminate_zeros()
-        obs_exp_csr_matrix.eliminate_zeros()
-        if len(pHiCMatrix.matrix.data) != len(obs_exp_csr_matrix.data):
-            if pQueue is None:
-                return None
+        results = ResultQueue()
+        if pThreads > 1:
+            pool = Pool(pThreads)
+        matrix_file = pArgs.matrix.split('::')[0]
+        matrix_time = os.path.getmtime(matrix_file)
+
+        def submit(pStep, pIndex, pPart, pFunction, *pArguments):
+            if pool is None:
+                try:
+                    results.put((pStep, pIndex, pPart, pFunction(*pArguments)))
+                except Exception as exp:
+                    results.put(('fail', pIndex, pPart, 'Fail: ' + str(exp) + traceback.format_exc()))
             else:
-                pQueue.put([None])
-                return
-        # handle pValuePreselection
-        try:
-            pArgs.pValuePreselection = float(pArgs.pValuePreselection)
-        except Exception:
-            pArgs.pValuePreselection = read_threshold_file(pArgs.pValuePreselection)
-
-        candidates, pValueList = compute_long_range_contacts(pHiCMatrix,
-                                                             obs_exp_csr_matrix,
-                                                             pArgs.windowSize,
-                                                             pArgs.pValue,
-                                                             pArgs.peakWidth,
-                                                             pArgs.pValuePreselection,
-                                                             pArgs.peakInteractionsThreshold,
-                                                             pArgs.obsExpThreshold,
-                                                             pArgs.threadsPerChromosome)
-
-        if candidates is None:
-            log.info('Computed loops for {}: 0'.format(pRegion))
-            if pQueue is None:
-                return None
-            else:
-                pQueue.put([None])
-                return
-        elif 'Fail: ' in candidates and pQueue is not None:
-            pQueue.put(candidates)
-            return
-        elif 'Fail: ' in candidates and pQueue is None:
-            return candidates
-        mapped_loops = cluster_to_genome_position_mapping(
-            pHiCMatrix, candidates, pValueList, pArgs.maxLoopDistance)
-        del pHiCMatrix
-        del candidates
-        log.debug('Computed loops for {}: {}'.format(pRegion, len(mapped_loops)))
-    except Exception as exp:
-        if pQueue is not None:
-            pQueue.put('Fail: ' + str(exp) + traceback.format_exc())
-            return
-        else:
-            return 'Fail: ' + str(exp) + traceback.format_exc()
-    if pQueue is None:
-        return mapped_loops
-    else:
-        pQueue.put([mapped_loops])
-    return
+                pool.apply_async(pFunction, pArguments,
+                                 callback=lambda pResult: results.put((pStep, pIndex, pPart, pResult)),
+                                 error_callback=lambda pException: results.put(
+                                     ('fail', pIndex, pPart, 'Fail: ' + str(pException) + ''.join(traceback.format_exception(type(pException), pException, pException.__traceback__)))))
+
+        chromosomes = [{'region': region,
+                        'prefix': os.path.join(scratch_dir, str(i)),
+                        # the fitted distributions depend only on the obs/exp values of the chromosome
+                        'cache_key': (matrix_file, matrix_time, region, pArgs.expected, pArgs.maxLoopDistance),
+                        'loops': None} for i, region in enumerate(pChromosomes)]
+        next_chromosome = 0
+        chromosomes_done = 0
+
+        def start_chromosome():
+            nonlocal next_chromosome
+            if next_chromosome < len(chromosomes):
+                chromosome = chromosomes[next_chromosome]
+                submit('prepare', next_chromosome, 0, prepare_chromosome, chromosome['region'], pArgs, pIsCooler, chromosome['prefix'])
+                next_chromosome += 1
+
+        def submit_tiles(pStep, pIndex, pFunction, pCandidates, *pArguments):
+            chromosome = chromosomes[pIndex]
+            tiles = split_into_tiles(pCandidates, pThreads)
+            chromosome['parts'] = [None] * len(tiles)
+            chromosome['pending'] = len(tiles)
+            for part, tile in enumerate(tiles):
+                submit(pStep, pIndex, part, pFunction, chromosome['prefix'], chromosome['shape'], tile, *pArguments)
+
+        def submit_preselection(pIndex):
+            chromosome = chromosomes[pIndex]
+            submit('preselect', pIndex, 0, preselect_candidates, chromosome['prefix'],
+                   chromosome['size'], chromosome['prob'], chromosome['p_value_threshold'], pArgs.obsExpThreshold)
+
+        for _ in range(pThreads):
+            start_chromosome()
+
+        while chromosomes_done < len(chromosomes):
+            step, index, part, result = results.get()
+            if step == 'fail':
+                fail_message = result
+                break
+            chromosome = chromosomes[index]
+            finished = False
+
+            if step == 'prepare':
+                if result is None:
+                    finished = True
+                else:
+                    chromosome.update(result)
+                    distances = chromosome['distances']
+                    fit_segment = np.flatnonzero(chromosome['fit_segment'])
+                    chromosome['p_value_threshold'] = p_value_thresholds(pPValuePreselection, distances,
+                                                                         chromosome['bin_size'], fit_segment)
+                    chromosome['size'] = np.full(len(distances), np.nan)
+                    chromosome['prob'] = np.full(len(distances), np.nan)
+                    cache = nbinom_parameters_cache.setdefault(chromosome['cache_key'], {})
+                    to_fit = []
+                    for i in fit_segment:
+                        if distances[i] in cache:
+                            chromosome['size'][i], chromosome['prob'][i] = cache[distances[i]]
+                        else:
+                            to_fit.append(i)
+                    if len(to_fit) == 0:
+                        submit_preselection(index)
+                    else:
+                        groups = np.array_split(to_fit, min(len(to_fit), pThreads * 4))
+                        chromosome['pending'] = len(groups)
+                        for group in groups:
+                            submit('fit', index, group, fit_distances, chromosome['prefix'], group)
+
+            elif step == 'fit':
+                cache = nbinom_parameters_cache[chromosome['cache_key']]
+                for i, parameters in zip(part, result):
+                    chromosome['size'][i], chromosome['prob'][i] = parameters
+                    cache[chromosome['distances'][i]] = parameters
+                chromosome['pending'] -= 1
+                if chromosome['pending'] == 0:
+                    submit_preselection(index)
+
+            elif step == 'preselect':
+                if len(result) == 0:
+                    finished = True
+                else:
+                    submit_tiles('merge', index, merge_candidates, result, pArgs.windowSize)
+
+            elif step == 'merge':
+                chromosome['parts'][part] = result
+                chromosome['pending'] -= 1
+                if chromosome['pending'] == 0:
+                    candidates = np.array([candidate for tile in chromosome['parts'] for candidate in tile])
+                    if len(candidates) == 0:
+                        finished = True
+                    else:
+                        submit_tiles('test', index, test_candidates, candidates,
+                                     pArgs.windowSize, pArgs.pValue, pArgs.peakWidth)
+
+            elif step == 'test':
+                chromosome['parts'][part] = result
+                chromosome['pending'] -= 1
+                if chromosome['pending'] == 0:
+                    candidates = np.concatenate([tile[0] for tile in chromosome['parts']])
+                    p_values = np.concatenate([tile[1] for tile in chromosome['parts']])
+                    chromosome['loops'] = cluster_to_genome_position_mapping(
+                        chromosome['cut_intervals'], candidates, p_values, pArgs.maxLoopDistance)
+                    finished = True
+
+            if finished:
+                log.debug('Computed loops for {}: {}'.format(
+                    chromosome['region'], 0 if chromosome['loops'] is None else len(chromosome['loops'])))
+                for file_name in shared_matrix_files(chromosome['prefix']).values():
+                    if os.path.exists(file_name):
+                        os.remove(file_name)
+                # free the memory of this chromosome, only the loops are kept
+                chromosomes[index] = {'loops': chromosome['loops']}
+                chromosomes_done += 1
+                start_chromosome()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    if fail_message is not None:
+        return fail_message
+    mapped_loops = []
+    for chromosome in chromosomes:
+        if chromosome['loops'] is not None:
+            mapped_loops.extend(chromosome['loops'])
+    return mapped_loops
 
 
 def read_threshold_file(pFile):
@@ -959,20 +897,18 @@ def main(args=None):
         log.error('The window size ({}) must be larger than the peakWidth ({})'.format(args.windowSize, args.peakWidth))
         exit(1)
     is_cooler = check_cooler(args.matrix)
-    if args.threadsPerChromosome < 1:
-        args.threadsPerChromosome = 1
-
-    mapped_loops = []
-
-    if not is_cooler:
-        hic_matrix = hm.hiCMatrix(args.matrix)
-        matrix = deepcopy(hic_matrix.matrix)
-        cut_intervals = deepcopy(hic_matrix.cut_intervals)
+    if args.threads < 1:
+        args.threads = 1
+    threads = args.threads
+    if args.threadsPerChromosome is not None:
+        log.warning('--threadsPerChromosome is deprecated, --threads sets the total number of processes. '
+                    'Using {} * {} processes.'.format(args.threads, args.threadsPerChromosome))
+        threads = args.threads * max(1, args.threadsPerChromosome)
 
     if args.chromosomes is None:
         # get all chromosomes from cooler file
         if not is_cooler:
-            chromosomes_list = list(hic_matrix.chrBinBoundaries)
+            chromosomes_list = list(hm.hiCMatrix(args.matrix).chrBinBoundaries)
         else:
             chromosome_sizes = cooler.Cooler(args.matrix).chromsizes
 
@@ -1002,90 +938,19 @@ def main(args=None):
     else:
         chromosomes_list = args.chromosomes
 
-    if len(chromosomes_list) < args.threads:
-        args.threads = len(chromosomes_list)
-    if len(chromosomes_list) == 1:
-        single_core = True
-    else:
-        single_core = False
-
-    fail_flag = False
-    fail_message = ''
-    if single_core:
-        for chromosome in chromosomes_list:
-            if is_cooler:
-                hic_matrix = hm.hiCMatrix(
-                    pMatrixFile=args.matrix, pChrnameList=[chromosome], pDistance=args.maxLoopDistance, pNoIntervalTree=True, pUpperTriangleOnly=True)
-            else:
-                hic_matrix.setMatrix(
-                    deepcopy(matrix), deepcopy(cut_intervals))
-                hic_matrix.keepOnlyTheseChr([chromosome])
-            loops = compute_loops(hic_matrix, chromosome, args, is_cooler)
-            if loops is None:
-                log.error('No loops could be detected. Please change your input parameters, use a matrix with a better read coverage or contact the develops on https://github.com/deeptools/HiCExplorer/issues')
-                exit(1)
-            if 'Fail: ' in loops:
-                log.error(loops[6:])
-                exit(1)
-            if loops is not None:
-                mapped_loops.extend(loops)
-    else:
-        queue = [None] * args.threads
-        process = [None] * args.threads
-        all_data_processed = False
-        all_threads_done = False
-        thread_done = [False] * args.threads
-        count_call_of_read_input = 0
-        while not all_data_processed or not all_threads_done:
-            for i in range(args.threads):
-                if queue[i] is None and not all_data_processed:
-                    if count_call_of_read_input >= len(chromosomes_list):
-                        all_data_processed = True
-                        continue
-                    queue[i] = Queue()
-                    thread_done[i] = False
-                    process[i] = Process(target=compute_loops, kwargs=dict(
-                        pHiCMatrix=args.matrix,
-                        pRegion=chromosomes_list[count_call_of_read_input],
-                        pArgs=args,
-                        pIsCooler=is_cooler,
-                        pQueue=queue[i]
-                    ))
-                    process[i].start()
-
-                    if count_call_of_read_input < len(chromosomes_list):
-                        count_call_of_read_input += 1
-                    else:
-                        all_data_processed = True
-                elif queue[i] is not None and not queue[i].empty():
-                    result = queue[i].get()
-                    if result is not None and 'Fail: ' in result:
-                        fail_flag = True
-                        fail_message = result
-                    if result[0] is not None:
-                        mapped_loops.extend(result[0])
-
-                    queue[i] = None
-                    process[i].join()
-                    process[i].terminate()
-                    process[i] = None
-                    thread_done[i] = True
-                elif all_data_processed and queue[i] is None:
-                    thread_done[i] = True
-                else:
-                    time.sleep(1)
+    # handle pValuePreselection
+    try:
+        p_value_preselection = float(args.pValuePreselection)
+    except Exception:
+        p_value_preselection = read_threshold_file(args.pValuePreselection)
 
-            if all_data_processed:
-                all_threads_done = True
-                for thread in thread_done:
-                    if not thread:
-                        all_threads_done = False
+    mapped_loops = compute_loops(chromosomes_list, args, is_cooler, p_value_preselection, threads)
 
-    if fail_flag:
-        if fail_message is not None:
-            log.error(fail_message[6:])
-        else:
-            log.error('An error occurred.')
+    if 'Fail: ' in mapped_loops:
+        log.error(mapped_loops[6:])
+        exit(1)
+    if len(mapped_loops) == 0 and len(chromosomes_list) == 1:
+        log.error('No loops could be detected. Please change your input parameters, use a matrix with a better read coverage or contact the develops on https://github.com/deeptools/HiCExplorer/issues')
         exit(1)
     if len(mapped_loops) > 0:
         write_bedgraph(mapped_loops, args.outFileName)
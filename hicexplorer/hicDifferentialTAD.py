@@ -5,8 +5,12 @@ import argparse
 from multiprocessing import Process, Queue
 import time
 import traceback
+from collections import OrderedDict
 import logging
 log = logging.getLogger(__name__)
+import cooler
+import h5py
+from scipy.sparse import csr_matrix, tril, triu
 from hicmatrix import HiCMatrix as hm
 
 from hicexplorer.utilities import check_cooler
@@ -73,6 +77,130 @@ def readDomainBoundaries(pFile):
     return domains_df
 
 
+class CoolRegion():
+    '''
+    A region of one chromosome with the same matrix and bin indices as hm.hiCMatrix(pMatrixFile, pChrnameList=[region]).
+    '''
+
+    def __init__(self, pChromosome, pMatrix, pBinStarts, pBinEnds):
+        self.chromosome = pChromosome
+        self.matrix = pMatrix
+        self.binStarts = pBinStarts
+        self.binEnds = pBinEnds
+
+    def getRegionBinRange(self, pChromosome, pStart, pEnd):
+        '''
+        Returns the indices of the bins containing pStart and pEnd, or None if one of them is not part of the region.
+        '''
+        if str(pChromosome) != self.chromosome:
+            raise ValueError('chromosome: {} name not found in matrix, valid name is: {}'.format(pChromosome, self.chromosome))
+        bin_indices = np.searchsorted(self.binStarts, [int(pStart), int(pEnd)], side='right') - 1
+        for bin_index, position in zip(bin_indices, [int(pStart), int(pEnd)]):
+            if bin_index < 0 or position >= self.binEnds[bin_index]:
+                log.error('Position {}:{} is not part of the region'.format(pChromosome, position))
+                return None
+        return bin_indices[0], bin_indices[1]
+
+
+class CoolRegionReader():
+    '''
+    Reads regions of a cool file as hm.hiCMatrix(pMatrixFile, pChrnameList=[region]) does, but keeps the file open
+    and reads the interactions of each chromosome only once: all interactions up to the size of the largest requested
+    region (the band around the main diagonal) are kept in memory and the regions are sliced out of it.
+    At most pMaxChromosomes bands are kept, the least recently used one is removed first.
+    '''
+
+    def __init__(self, pMatrixFile, pMaxChromosomes=2):
+        file_path, group_path = cooler.util.parse_cooler_uri(pMatrixFile)
+        self.h5File = h5py.File(file_path, 'r')
+        self.cooler = cooler.Cooler(self.h5File[group_path])
+        self.maxChromosomes = pMaxChromosomes
+        # chromosome: (first bin of the chromosome, number of diagonals, band as symmetric csr matrix)
+        self.bands = OrderedDict()
+
+        bins = self.cooler.bins()[:]
+        self.binStarts = bins['start'].values
+        self.binEnds = bins['end'].values
+        # the correction factors are applied like the hicmatrix library does it for the 'weight' column
+        self.correctionFactors = bins['weight'].values if 'weight' in bins else None
+        self.symmetricUpper = self.cooler.storage_mode == 'symmetric-upper'
+
+    def close(self):
+        self.bands.clear()
+        self.h5File.close()
+
+    def getBand(self, pChromosome, pDiagonals):
+        '''
+        Returns the first bin of the chromosome and the interactions of all bins which are less than pDiagonals bins apart.
+        '''
+        if pChromosome in self.bands and self.bands[pChromosome][1] >= pDiagonals:
+            self.bands.move_to_end(pChromosome)
+            return self.bands[pChromosome][0], self.bands[pChromosome][2]
+        if pChromosome in self.bands:
+            # a wider band is needed, double the width to read a chromosome only a few times
+            pDiagonals = max(pDiagonals, 2 * self.bands[pChromosome][1])
+            del self.bands[pChromosome]
+
+        chromosome_start, chromosome_end = self.cooler.extent(pChromosome)
+        number_of_bins = chromosome_end - chromosome_start
+        step = max(1, number_of_bins // 32)
+        rows = []
+        columns = []
+        data = []
+        selector = self.cooler.matrix(balance=False, as_pixels=True)
+        for row_start in range(chromosome_start, chromosome_end, step):
+            pixels = selector[row_start:min(row_start + step, chromosome_end), chromosome_start:chromosome_end]
+            distance = pixels['bin2_id'].values - pixels['bin1_id'].values
+            if self.symmetricUpper:
+                mask = (distance >= 0) & (distance < pDiagonals)
+            else:
+                mask = np.abs(distance) < pDiagonals
+            rows.append(pixels['bin1_id'].values[mask] - chromosome_start)
+            columns.append(pixels['bin2_id'].values[mask] - chromosome_start)
+            data.append(pixels['count'].values[mask])
+        rows = np.concatenate(rows)
+        columns = np.concatenate(columns)
+        data = np.concatenate(data)
+        if self.symmetricUpper:
+            # fill the lower triangle like cooler does for a region of the main diagonal
+            off_diagonal = rows != columns
+            rows, columns = np.concatenate([rows, columns[off_diagonal]]), np.concatenate([columns, rows[off_diagonal]])
+            data = np.concatenate([data, data[off_diagonal]])
+        band = csr_matrix((data, (rows, columns)), shape=(number_of_bins, number_of_bins))
+
+        self.bands[pChromosome] = (chromosome_start, pDiagonals, band)
+        if len(self.bands) > self.maxChromosomes:
+            self.bands.popitem(last=False)
+        return chromosome_start, band
+
+    def getRegion(self, pChromosome, pStart, pEnd):
+        '''
+        Returns the region pChromosome:pStart-pEnd as CoolRegion.
+        '''
+        pChromosome = str(pChromosome)
+        region_start, region_end = self.cooler.extent('{}:{}-{}'.format(pChromosome, pStart, pEnd))
+        chromosome_start, band = self.getBand(pChromosome, region_end - region_start)
+        matrix = band[region_start - chromosome_start:region_end - chromosome_start,
+                      region_start - chromosome_start:region_end - chromosome_start]
+
+        matrix.eliminate_zeros()
+        if self.correctionFactors is not None and len(matrix.data) > 1:
+            correction_factors = self.correctionFactors[region_start:region_end]
+            if np.sum(np.isnan(correction_factors)) != len(correction_factors):
+                matrix.data = matrix.data.astype(float)
+                instances, features = matrix.nonzero()
+                instances_factors = correction_factors[instances]
+                instances_factors *= correction_factors[features]
+                matrix.data *= instances_factors
+        mask = np.isnan(matrix.data)
+        matrix.data[mask] = 0
+        matrix.eliminate_zeros()
+        if tril(matrix, k=-1).sum() == 0:
+            matrix = matrix + triu(matrix, 1).T
+
+        return CoolRegion(pChromosome, matrix, self.binStarts[region_start:region_end], self.binEnds[region_start:region_end])
+
+
 def computeDifferentialTADs(pMatrixTarget, pMatrixControl, pDomainList, pCoolOrH5, pPValue, pThreadId, pQueue):
     try:
         accepted_inter_left = []
@@ -100,180 +228,187 @@ def computeDifferentialTADs(pMatrixTarget, pMatrixControl, pDomainList, pCoolOrH
                 old_chromosome = pDomainList[j][0]
         tads_per_chromosome.append(per_chromosome)
         log.debug('tads_per_chromosome {}'.format(len(tads_per_chromosome)))
-        for chromosome_list in tads_per_chromosome:
-
-            for i, row in enumerate(chromosome_list):
-
-                if pThreadId is None:
-                    log.debug('first thread')
-                    if i == len(chromosome_list) - 1:
-                        continue
-                elif pThreadId == True:
-                    log.debug('middle thread')
-
-                    if i == 0 or i == len(chromosome_list) - 1:
-                        continue
-                elif pThreadId == False:
-                    log.debug('last thread')
-
-                    if i == 0:
-                        continue
-
-                if i - 1 >= 0:
-                    chromosom = chromosome_list[i - 1][0]
-                    start = chromosome_list[i - 1][1]
-                else:
-                    chromosom = chromosome_list[i][0]
-                    start = chromosome_list[i][1]
-                if i + 1 < len(chromosome_list):
-                    end = chromosome_list[i + 1][2]
-                else:
-                    end = chromosome_list[i][2]
-                # midpos = row[1] + ((row[2] - row[1]) / 2)
-
-                if pCoolOrH5:
-
-                    # # get intra-TAD data
-                    hic_matrix_target = hm.hiCMatrix(
-                        pMatrixFile=pMatrixTarget, pChrnameList=[str(row[0]) + ':' + str(row[1]) + '-' + str(row[2])])
-                    hic_matrix_control = hm.hiCMatrix(
-                        pMatrixFile=pMatrixControl, pChrnameList=[str(row[0]) + ':' + str(row[1]) + '-' + str(row[2])])
-                    matrix_target = hic_matrix_target.matrix.toarray()
-                    matrix_control = hic_matrix_control.matrix.toarray()
-
-                    hic_matrix_target_inter_tad = hm.hiCMatrix(
-                        pMatrixFile=pMatrixTarget, pChrnameList=[str(chromosom) + ':' + str(start) + '-' + str(end)])
-                    hic_matrix_control_inter_tad = hm.hiCMatrix(
-                        pMatrixFile=pMatrixControl, pChrnameList=[str(chromosom) + ':' + str(start) + '-' + str(end)])
-
-                    matrix_target_inter_tad = hic_matrix_target_inter_tad.matrix
-                    matrix_control_inter_tad = hic_matrix_control_inter_tad.matrix
-
-                else:
-                    # in case of h5 pMatrixTarget is already a HiCMatrix object
-                    hic_matrix_target = pMatrixTarget
-                    hic_matrix_control = pMatrixControl
-                    hic_matrix_target_inter_tad = pMatrixTarget
-                    hic_matrix_control_inter_tad = pMatrixControl
-                    indices_target = hic_matrix_target.getRegionBinRange(str(row[0]), row[1], row[2])
-                    indices_control = hic_matrix_control.getRegionBinRange(str(row[0]), row[1], row[2])
-
-                    matrix_target = hic_matrix_target.matrix[indices_target[0]:indices_target[1], indices_target[0]:indices_target[1]].toarray()
-                    matrix_control = hic_matrix_control.matrix[indices_control[0]:indices_control[1], indices_control[0]:indices_control[1]].toarray()
-                    matrix_target_inter_tad = pMatrixTarget.matrix
-                    matrix_control_inter_tad = pMatrixControl.matrix
-
-                matrix_target = matrix_target.flatten()
-                matrix_control = matrix_control.flatten()
-                # tad_midpoint = hic_matrix_target_inter_tad.getRegionBinRange(str(row[0]), midpos, midpos)[0]
-
-                # if i - 1 >= 0:
-                # get index position left tad with tad
-                left_boundary_index_target = hic_matrix_target_inter_tad.getRegionBinRange(str(chromosom), row[1], row[1])[0]
-                left_boundary_index_control = hic_matrix_control_inter_tad.getRegionBinRange(str(chromosom), row[1], row[1])[0]
-                if pCoolOrH5:
-                    outer_left_boundary_index_target = 0
-                    outer_left_boundary_index_control = 0
-
-                    outer_right_boundary_index_control = -1
-                    outer_right_boundary_index_target = -1
-
-                else:
-                    outer_left_boundary_index_target = hic_matrix_target_inter_tad.getRegionBinRange(str(chromosom), start, end)[0]
-                    outer_left_boundary_index_control = hic_matrix_control_inter_tad.getRegionBinRange(str(chromosom), start, end)[0]
-
-                    outer_right_boundary_index_control = hic_matrix_control_inter_tad.getRegionBinRange(str(chromosom), start, end)[1]
-                    outer_right_boundary_index_target = hic_matrix_target_inter_tad.getRegionBinRange(str(chromosom), start, end)[1]
-
-                if i + 1 < len(chromosome_list) and not pCoolOrH5:
+        region_reader_target = None
+        region_reader_control = None
+        try:
+            if pCoolOrH5:
+                region_reader_target = CoolRegionReader(pMatrixTarget)
+                region_reader_control = CoolRegionReader(pMatrixControl)
+            for chromosome_list in tads_per_chromosome:
+
+                for i, row in enumerate(chromosome_list):
+
+                    if pThreadId is None:
+                        log.debug('first thread')
+                        if i == len(chromosome_list) - 1:
+                            continue
+                    elif pThreadId == True:
+                        log.debug('middle thread')
+
+                        if i == 0 or i == len(chromosome_list) - 1:
+                            continue
+                    elif pThreadId == False:
+                        log.debug('last thread')
+
+                        if i == 0:
+                            continue
+
+                    if i - 1 >= 0:
+                        chromosom = chromosome_list[i - 1][0]
+                        start = chromosome_list[i - 1][1]
+                    else:
+                        chromosom = chromosome_list[i][0]
+                        start = chromosome_list[i][1]
+                    if i + 1 < len(chromosome_list):
+                        end = chromosome_list[i + 1][2]
+                    else:
+                        end = chromosome_list[i][2]
+                    # midpos = row[1] + ((row[2] - row[1]) / 2)
+
+                    if pCoolOrH5:
+
+                        # # get intra-TAD data
+                        hic_matrix_target = region_reader_target.getRegion(row[0], row[1], row[2])
+                        hic_matrix_control = region_reader_control.getRegion(row[0], row[1], row[2])
+                        matrix_target = hic_matrix_target.matrix.toarray()
+                        matrix_control = hic_matrix_control.matrix.toarray()
+
+                        hic_matrix_target_inter_tad = region_reader_target.getRegion(chromosom, start, end)
+                        hic_matrix_control_inter_tad = region_reader_control.getRegion(chromosom, start, end)
+
+                        matrix_target_inter_tad = hic_matrix_target_inter_tad.matrix
+                        matrix_control_inter_tad = hic_matrix_control_inter_tad.matrix
+
+                    else:
+                        # in case of h5 pMatrixTarget is already a HiCMatrix object
+                        hic_matrix_target = pMatrixTarget
+                        hic_matrix_control = pMatrixControl
+                        hic_matrix_target_inter_tad = pMatrixTarget
+                        hic_matrix_control_inter_tad = pMatrixControl
+                        indices_target = hic_matrix_target.getRegionBinRange(str(row[0]), row[1], row[2])
+                        indices_control = hic_matrix_control.getRegionBinRange(str(row[0]), row[1], row[2])
+
+                        matrix_target = hic_matrix_target.matrix[indices_target[0]:indices_target[1], indices_target[0]:indices_target[1]].toarray()
+                        matrix_control = hic_matrix_control.matrix[indices_control[0]:indices_control[1], indices_control[0]:indices_control[1]].toarray()
+                        matrix_target_inter_tad = pMatrixTarget.matrix
+                        matrix_control_inter_tad = pMatrixControl.matrix
+
+                    matrix_target = matrix_target.flatten()
+                    matrix_control = matrix_control.flatten()
+                    # tad_midpoint = hic_matrix_target_inter_tad.getRegionBinRange(str(row[0]), midpos, midpos)[0]
+
+                    # if i - 1 >= 0:
                     # get index position left tad with tad
-                    right_boundary_index_target = hic_matrix_target_inter_tad.getRegionBinRange(str(chromosom), row[2], row[2])[0]
-                    right_boundary_index_control = hic_matrix_control_inter_tad.getRegionBinRange(str(chromosom), row[2], row[2])[0]
-                elif i + 1 < len(chromosome_list) - 1:
-                    right_boundary_index_target = hic_matrix_target_inter_tad.getRegionBinRange(str(chromosom), row[2], row[2])[0]
-                    right_boundary_index_control = hic_matrix_control_inter_tad.getRegionBinRange(str(chromosom), row[2], row[2])[0]
-
-                if i - 1 >= 0 and i + 1 < len(chromosome_list):
-                    intertad_left_target = matrix_target_inter_tad[outer_left_boundary_index_target:left_boundary_index_target, left_boundary_index_target:right_boundary_index_target].toarray()
-                    intertad_right_target = matrix_target_inter_tad[left_boundary_index_target:right_boundary_index_target, right_boundary_index_target:outer_right_boundary_index_target].toarray()
-                    intertad_left_control = matrix_control_inter_tad[outer_left_boundary_index_control:left_boundary_index_control, left_boundary_index_control:right_boundary_index_control].toarray()
-                    intertad_right_control = matrix_control_inter_tad[left_boundary_index_control:right_boundary_index_control, right_boundary_index_control:outer_right_boundary_index_control].toarray()
-
-                elif i - 1 < 0 and i + 1 < len(chromosome_list):
-                    intertad_right_target = matrix_target_inter_tad[left_boundary_index_target:right_boundary_index_target, right_boundary_index_target:outer_right_boundary_index_target].toarray()
-                    intertad_right_control = matrix_control_inter_tad[left_boundary_index_control:right_boundary_index_control, right_boundary_index_control:outer_right_boundary_index_control].toarray()
-
-                elif i - 1 > 0 and i + 1 >= len(chromosome_list):
-                    intertad_left_target = matrix_target_inter_tad[outer_left_boundary_index_target:left_boundary_index_target, left_boundary_index_target:right_boundary_index_target].toarray()
-                    intertad_left_control = matrix_control_inter_tad[outer_left_boundary_index_control:left_boundary_index_control, left_boundary_index_control:right_boundary_index_control].toarray()
-
-                significance_level_left = None
-                significance_level_right = None
-                statistic_left = None
-                statistic_right = None
-
-                if i - 1 >= 0 and i + 1 < len(chromosome_list):
-                    intertad_left_target = intertad_left_target.flatten()
-                    intertad_left_control = intertad_left_control.flatten()
-                    intertad_right_target = intertad_right_target.flatten()
-                    intertad_right_control = intertad_right_control.flatten()
-
-                    statistic_left, significance_level_left = ranksums(intertad_left_target, intertad_left_control)
-                    statistic_right, significance_level_right = ranksums(intertad_right_target, intertad_right_control)
-                elif i - 1 < 0 and i + 1 < len(chromosome_list):
-                    intertad_right_target = intertad_right_target.flatten()
-                    intertad_right_control = intertad_right_control.flatten()
-                    statistic_right, significance_level_right = ranksums(intertad_right_target, intertad_right_control)
-                elif i - 1 > 0 and i + 1 >= len(chromosome_list):
-                    intertad_left_target = intertad_left_target.flatten()
-                    intertad_left_control = intertad_left_control.flatten()
-                    log.debug('intertad_left_target {}'.format(intertad_left_target))
-                    log.debug('intertad_left_control {}'.format(intertad_left_control))
-
-                    statistic_left, significance_level_left = ranksums(intertad_left_target, intertad_left_control)
-
-                # log.debug('matrix_target {}'.format(matrix_target))
-                # log.debug('matrix_control {}'.format(matrix_control))
-
-                statistic, significance_level = ranksums(matrix_target, matrix_control)
-                log.debug('statistic {}, significance_level {}'.format(statistic, significance_level))
-                log.debug('right statistic {}, significance_level {}'.format(statistic_right, significance_level_right))
-                log.debug('left statistic {}, significance_level {}'.format(statistic_left, significance_level_left))
-
-                p_values = []
-                if significance_level_left is None or np.isnan(significance_level_left):
-                    accepted_inter_left.append(0)
-                    p_values.append(np.nan)
-                elif significance_level_left <= pPValue:
-                    accepted_inter_left.append(1)
-                    p_values.append(significance_level_left)
-                else:
-                    accepted_inter_left.append(0)
-                    p_values.append(significance_level_left)
-
-                if significance_level_right is None or np.isnan(significance_level_right):
-                    accepted_inter_right.append(0)
-                    p_values.append(np.nan)
-                elif significance_level_right <= pPValue:
-                    accepted_inter_right.append(1)
-                    p_values.append(significance_level_right)
-                else:
-                    accepted_inter_right.append(0)
-                    p_values.append(significance_level_right)
-
-                if significance_level is None or np.isnan(significance_level):
-                    accepted_intra.append(0)
-                    p_values.append(np.nan)
-                elif significance_level <= pPValue:
-                    accepted_intra.append(1)
-                    p_values.append(significance_level)
-                else:
-                    accepted_intra.append(0)
-                    p_values.append(significance_level)
-
-                p_values_list.append(p_values)
-
-                rows.append(row)
+                    left_boundary_index_target = hic_matrix_target_inter_tad.getRegionBinRange(str(chromosom), row[1], row[1])[0]
+                    left_boundary_index_control = hic_matrix_control_inter_tad.getRegionBinRange(str(chromosom), row[1], row[1])[0]
+                    if pCoolOrH5:
+                        outer_left_boundary_index_target = 0
+                        outer_left_boundary_index_control = 0
+
+                        outer_right_boundary_index_control = -1
+                        outer_right_boundary_index_target = -1
+
+                    else:
+                        outer_left_boundary_index_target = hic_matrix_target_inter_tad.getRegionBinRange(str(chromosom), start, end)[0]
+                        outer_left_boundary_index_control = hic_matrix_control_inter_tad.getRegionBinRange(str(chromosom), start, end)[0]
+
+                        outer_right_boundary_index_control = hic_matrix_control_inter_tad.getRegionBinRange(str(chromosom), start, end)[1]
+                        outer_right_boundary_index_target = hic_matrix_target_inter_tad.getRegionBinRange(str(chromosom), start, end)[1]
+
+                    if i + 1 < len(chromosome_list) and not pCoolOrH5:
+                        # get index position left tad with tad
+                        right_boundary_index_target = hic_matrix_target_inter_tad.getRegionBinRange(str(chromosom), row[2], row[2])[0]
+                        right_boundary_index_control = hic_matrix_control_inter_tad.getRegionBinRange(str(chromosom), row[2], row[2])[0]
+                    elif i + 1 < len(chromosome_list) - 1:
+                        right_boundary_index_target = hic_matrix_target_inter_tad.getRegionBinRange(str(chromosom), row[2], row[2])[0]
+                        right_boundary_index_control = hic_matrix_control_inter_tad.getRegionBinRange(str(chromosom), row[2], row[2])[0]
+
+                    if i - 1 >= 0 and i + 1 < len(chromosome_list):
+                        intertad_left_target = matrix_target_inter_tad[outer_left_boundary_index_target:left_boundary_index_target, left_boundary_index_target:right_boundary_index_target].toarray()
+                        intertad_right_target = matrix_target_inter_tad[left_boundary_index_target:right_boundary_index_target, right_boundary_index_target:outer_right_boundary_index_target].toarray()
+                        intertad_left_control = matrix_control_inter_tad[outer_left_boundary_index_control:left_boundary_index_control, left_boundary_index_control:right_boundary_index_control].toarray()
+                        intertad_right_control = matrix_control_inter_tad[left_boundary_index_control:right_boundary_index_control, right_boundary_index_control:outer_right_boundary_index_control].toarray()
+
+                    elif i - 1 < 0 and i + 1 < len(chromosome_list):
+                        intertad_right_target = matrix_target_inter_tad[left_boundary_index_target:right_boundary_index_target, right_boundary_index_target:outer_right_boundary_index_target].toarray()
+                        intertad_right_control = matrix_control_inter_tad[left_boundary_index_control:right_boundary_index_control, right_boundary_index_control:outer_right_boundary_index_control].toarray()
+
+                    elif i - 1 > 0 and i + 1 >= len(chromosome_list):
+                        intertad_left_target = matrix_target_inter_tad[outer_left_boundary_index_target:left_boundary_index_target, left_boundary_index_target:right_boundary_index_target].toarray()
+                        intertad_left_control = matrix_control_inter_tad[outer_left_boundary_index_control:left_boundary_index_control, left_boundary_index_control:right_boundary_index_control].toarray()
+
+                    significance_level_left = None
+                    significance_level_right = None
+                    statistic_left = None
+                    statistic_right = None
+
+                    if i - 1 >= 0 and i + 1 < len(chromosome_list):
+                        intertad_left_target = intertad_left_target.flatten()
+                        intertad_left_control = intertad_left_control.flatten()
+                        intertad_right_target = intertad_right_target.flatten()
+                        intertad_right_control = intertad_right_control.flatten()
+
+                        statistic_left, significance_level_left = ranksums(intertad_left_target, intertad_left_control)
+                        statistic_right, significance_level_right = ranksums(intertad_right_target, intertad_right_control)
+                    elif i - 1 < 0 and i + 1 < len(chromosome_list):
+                        intertad_right_target = intertad_right_target.flatten()
+                        intertad_right_control = intertad_right_control.flatten()
+                        statistic_right, significance_level_right = ranksums(intertad_right_target, intertad_right_control)
+                    elif i - 1 > 0 and i + 1 >= len(chromosome_list):
+                        intertad_left_target = intertad_left_target.flatten()
+                        intertad_left_control = intertad_left_control.flatten()
+                        log.debug('intertad_left_target {}'.format(intertad_left_target))
+                        log.debug('intertad_left_control {}'.format(intertad_left_control))
+
+                        statistic_left, significance_level_left = ranksums(intertad_left_target, intertad_left_control)
+
+                    # log.debug('matrix_target {}'.format(matrix_target))
+                    # log.debug('matrix_control {}'.format(matrix_control))
+
+                    statistic, significance_level = ranksums(matrix_target, matrix_control)
+                    log.debug('statistic {}, significance_level {}'.format(statistic, significance_level))
+                    log.debug('right statistic {}, significance_level {}'.format(statistic_right, significance_level_right))
+                    log.debug('left statistic {}, significance_level {}'.format(statistic_left, significance_level_left))
+
+                    p_values = []
+                    if significance_level_left is None or np.isnan(significance_level_left):
+                        accepted_inter_left.append(0)
+                        p_values.append(np.nan)
+                    elif significance_level_left <= pPValue:
+                        accepted_inter_left.append(1)
+                        p_values.append(significance_level_left)
+                    else:
+                        accepted_inter_left.append(0)
+                        p_values.append(significance_level_left)
+
+                    if significance_level_right is None or np.isnan(significance_level_right):
+                        accepted_inter_right.append(0)
+                        p_values.append(np.nan)
+                    elif significance_level_right <= pPValue:
+                        accepted_inter_right.append(1)
+                        p_values.append(significance_level_right)
+                    else:
+                        accepted_inter_right.append(0)
+                        p_values.append(significance_level_right)
+
+                    if significance_level is None or np.isnan(significance_level):
+                        accepted_intra.append(0)
+                        p_values.append(np.nan)
+                    elif significance_level <= pPValue:
+                        accepted_intra.append(1)
+                        p_values.append(significance_level)
+                    else:
+                        accepted_intra.append(0)
+                        p_values.append(significance_level)
+
+                    p_values_list.append(p_values)
+
+                    rows.append(row)
+        finally:
+            # the cool files are closed also if a region fails
+            for region_reader in [region_reader_target, region_reader_control]:
+                if region_reader is not None:
+                    region_reader.close()
     except Exception as exp:
         pQueue.put('Fail: ' + str(exp) + traceback.format_exc())
         return
@@ -14,6 +14,7 @@ import numpy as np
 import multiprocessing
 from hicexplorer._version import __version__
 from hicexplorer.utilities import toString, toBytes, check_chrom_str_bytes
+from hicexplorer.utilities import ranksums_rows, get_bins_containing
 
 from past.builtins import zip
 from past.builtins import map
@@ -264,6 +265,254 @@ def get_cut_weight(hic_matrix, cut, window_len, return_mean=False):
         return hic_matrix.matrix[left_idx:cut, cut:right_idx].todense().A1
 
 
+def get_chromosome_bins(hic_matrix, chrom):
+    """
+    Returns the first bin id of the chromosome and the start and end
+    positions of all its bins
+    """
+    chr_start_bin, chr_end_bin = hic_matrix.chrBinBoundaries[toString(chrom)]
+    chrom_intervals = hic_matrix.cut_intervals[chr_start_bin:chr_end_bin]
+    starts = np.array([interval[1] for interval in chrom_intervals])
+    ends = np.array([interval[2] for interval in chrom_intervals])
+    return chr_start_bin, starts, ends
+
+
+def get_diamond_borders(starts, ends, cuts, window_lengths):
+    """
+    Vectorized version of get_idx_of_bins_at_given_distance for the bins
+    of one chromosome. `cuts` are relative to the first bin of the
+    chromosome and so are the returned left and right indices, which have
+    the shape (len(cuts), len(window_lengths)). Indices for which
+    get_idx_of_bins_at_given_distance would fail are set to -1.
+
+    >>> starts = np.arange(0, 100, 10)
+    >>> get_diamond_borders(starts, starts + 10, np.array([0, 5, 9]), [20, 40])
+    (array([[0, 0],
+           [3, 1],
+           [7, 5]]), array([[2, 4],
+           [7, 9],
+           [9, 9]]))
+    """
+    window_lengths = np.asarray(window_lengths)
+    left_start = np.maximum(0, starts[cuts, np.newaxis] - window_lengths)
+    right_end = np.minimum(ends[-1], ends[cuts, np.newaxis] + window_lengths) - 1
+    return get_bins_containing(starts, ends, left_start), get_bins_containing(starts, ends, right_end)
+
+
+def summed_area_table(pArray):
+    """
+    Returns the 2D prefix sum of `pArray` padded with a leading row and
+    column of zeros, such that the sum of pArray[a:b, c:d] is
+    table[b, d] - table[a, d] - table[b, c] + table[a, c]
+
+    >>> table = summed_area_table(np.arange(12).reshape(3, 4))
+    >>> float(table[3, 4] - table[1, 4] - table[3, 2] + table[1, 2])
+    34.0
+    """
+    table = np.zeros((pArray.shape[0] + 1, pArray.shape[1] + 1))
+    table[1:, 1:] = np.cumsum(np.cumsum(pArray, axis=0, dtype=np.float64), axis=1)
+    return table
+
+
+def get_cut_weights(hic_matrix, cuts, window_lengths, max_tile_size=512):
+    """
+    Vectorized version of get_cut_weight(..., return_mean=True) for a
+    consecutive range of bins of one chromosome and all window lengths
+    at once.
+
+    Instead of slicing and densifying the sparse matrix for every cut and
+    window length, the band of the matrix that is covered by the diamonds
+    is densified tile by tile (each tile holds at most `max_tile_size` cuts)
+    and all diamond means are looked up in the summed area table of the tile.
+
+    Parameters
+    ----------
+    hic_matrix Hi-C matrix object
+    cuts consecutive bin ids, all on the same chromosome
+    window_lengths list of window lengths in bp
+
+    Returns
+    -------
+    array of shape (len(cuts), len(window_lengths)). Cases for which get_cut_weight
+    returns None are set to NaN. As for the mean of get_cut_weight, diamonds with
+    NaN values, or with both inf and -inf values, are NaN and other diamonds with
+    inf or -inf values are inf or -inf.
+    """
+    cuts = np.asarray(cuts)
+    chr_start_bin, starts, ends = get_chromosome_bins(hic_matrix, hic_matrix.cut_intervals[cuts[0]][0])
+    left_idx, right_idx = get_diamond_borders(starts, ends, cuts - chr_start_bin, window_lengths)
+    undefined = (left_idx < 0) | (right_idx < 0)
+    left_idx = np.where(undefined, cuts[:, np.newaxis], left_idx + chr_start_bin)
+    right_idx = np.where(undefined, cuts[:, np.newaxis], right_idx + chr_start_bin)
+
+    weights = np.empty((len(cuts), len(window_lengths)))
+    for tile_start in range(0, len(cuts), max_tile_size):
+        tile = slice(tile_start, tile_start + max_tile_size)
+        tile_cuts = cuts[tile, np.newaxis]
+        tile_left = left_idx[tile]
+        tile_right = right_idx[tile]
+        row_start = tile_left.min()
+        col_start = tile_cuts[0, 0]
+        dense = hic_matrix.matrix[row_start:tile_cuts[-1, 0], col_start:tile_right.max()].toarray()
+
+        rows = (tile_left - row_start, tile_cuts - row_start)
+        cols = (tile_cuts - col_start, tile_right - col_start)
+
+        def diamond_sum(pArray):
+            table = summed_area_table(pArray)
+            return table[rows[1], cols[1]] - table[rows[0], cols[1]] - table[rows[1], cols[0]] + table[rows[0], cols[0]]
+
+        not_finite = ~np.isfinite(dense)
+        has_not_finite = not_finite.any()
+        size = (tile_cuts - tile_left) * (tile_right - tile_cuts)
+        if has_not_finite:
+            num_nan = diamond_sum(np.isnan(dense))
+            num_posinf = diamond_sum(np.isposinf(dense))
+            num_neginf = diamond_sum(np.isneginf(dense))
+            dense[not_finite] = 0
+        # empty diamonds have a weight of 0, as in get_cut_weight
+        mean = np.divide(diamond_sum(dense), size, out=np.zeros(size.shape), where=size > 0)
+        if has_not_finite:
+            mean[num_posinf > 0] = np.inf
+            mean[num_neginf > 0] = -np.inf
+            mean[(num_nan > 0) | ((num_posinf > 0) & (num_neginf > 0))] = np.nan
+        weights[tile] = mean
+
+    weights[undefined] = np.nan
+    return weights
+
+
+def get_diamond_values(band, cuts, left_idx, height, width):
+    """
+    Returns the values of equally shaped diamonds, one row per diamond, as
+    get_cut_weight does for matrix[left_idx:cut, cut:cut + width] with
+    height = cut - left_idx. The values are read from the band array of a
+    chromosome, in which band[i, k] = matrix[i, i + k].
+
+    >>> band = np.array([[0, 1, 2], [0, 3, 4], [0, 5, 6], [0, 7, 0]])
+    >>> get_diamond_values(band, np.array([1, 2]), np.array([0, 1]), 1, 2)
+    array([[1, 2],
+           [3, 4]])
+    """
+    rows = left_idx[:, np.newaxis, np.newaxis] + np.arange(height)[:, np.newaxis]
+    cols = cuts[:, np.newaxis, np.newaxis] + np.arange(width)
+    return band[rows, cols - rows].reshape(len(cuts), height * width)
+
+
+def diamond_ranksums(band, left_idx, right_idx, x_cuts, y_cuts):
+    """
+    Wilcoxon rank sum test of the diamond at each of the `x_cuts` against the
+    diamond at the corresponding `y_cuts`. Diamonds of the same shape are
+    tested together. Returns the p-values.
+    """
+    pvalues = np.empty(len(x_cuts))
+    if len(x_cuts) == 0:
+        return pvalues
+    shapes = np.stack([x_cuts - left_idx[x_cuts], right_idx[x_cuts] - x_cuts,
+                       y_cuts - left_idx[y_cuts], right_idx[y_cuts] - y_cuts], axis=1)
+    unique_shapes, group = np.unique(shapes, axis=0, return_inverse=True)
+    group = group.reshape(-1)
+    for group_id, (x_height, x_width, y_height, y_width) in enumerate(unique_shapes):
+        members = group == group_id
+        x = get_diamond_values(band, x_cuts[members], left_idx[x_cuts[members]], x_height, x_width)
+        y = get_diamond_values(band, y_cuts[members], left_idx[y_cuts[members]], y_height, y_width)
+        pvalues[members] = ranksums_rows(x, y)
+    return pvalues
+
+
+# Hi-C matrix of a worker process of HicFindTads.min_pvalue,
+# set by the pool initializer
+_worker_hic_matrix = None
+
+
+def _init_boundary_pvalues_worker(hic_matrix):
+    global _worker_hic_matrix
+    _worker_hic_matrix = hic_matrix
+
+
+def compute_boundary_pvalues_wrapper(args):
+    return compute_boundary_pvalues(_worker_hic_matrix, *args)
+
+
+def get_band(matrix, start, end, width):
+    """
+    Returns the dense band of the rows start:end of the upper triangle of a
+    sparse matrix, in which band[i, k] = matrix[start + i, start + i + k]
+    for 0 <= k < width.
+
+    >>> matrix = sparse.csr_matrix(np.arange(16).reshape(4, 4))
+    >>> get_band(matrix, 1, 3, 2)
+    array([[ 5,  6],
+           [10, 11]])
+    """
+    sub_matrix = matrix[start:end, start:min(end + width - 1, matrix.shape[1])].tocoo()
+    distance = sub_matrix.col - sub_matrix.row
+    keep = (distance >= 0) & (distance < width)
+    band = np.zeros((end - start, width), dtype=sub_matrix.dtype)
+    band[sub_matrix.row[keep], distance[keep]] = sub_matrix.data[keep]
+    return band
+
+
+def compute_boundary_pvalues(hic_matrix, chrom, cuts, window_len, chunk_size=10000):
+    """
+    Compares the diamond of each putative boundary with the diamonds
+    window_len upstream and downstream of it, see HicFindTads.min_pvalue.
+    The boundaries are processed in chunks of `chunk_size` bins and all
+    diamonds of a chunk are read from a dense band of the matrix rows
+    they cover.
+
+    Parameters
+    ----------
+    hic_matrix Hi-C matrix object
+    chrom chromosome name
+    cuts bin ids of the boundaries, all on `chrom`
+    window_len window length in bp
+    chunk_size number of bins per chunk
+
+    Returns
+    -------
+    array with the smaller of both rank sum p-values for each boundary, NaN if any
+    of the diamonds is empty
+    """
+    chr_start_bin, starts, ends = get_chromosome_bins(hic_matrix, chrom)
+    bins = np.arange(len(starts))
+    left_idx, right_idx = get_diamond_borders(starts, ends, bins, [window_len])
+    left_idx = left_idx[:, 0]
+    right_idx = right_idx[:, 0]
+    # diamonds that get_cut_weight can not compute are treated as empty
+    undefined = (left_idx < 0) | (right_idx < 0)
+    left_idx[undefined] = bins[undefined]
+    right_idx[undefined] = bins[undefined]
+    is_empty = (bins - left_idx) * (right_idx - bins) == 0
+
+    cuts = np.asarray(cuts) - chr_start_bin
+    left_cuts = left_idx[cuts]
+    right_cuts = right_idx[cuts]
+    testable = ~(is_empty[cuts] | is_empty[left_cuts] | is_empty[right_cuts])
+
+    pvalues = np.full(len(cuts), np.nan)
+    testable_idx = np.flatnonzero(testable)
+    chunk_ids = cuts[testable_idx] // chunk_size
+    for chunk_id in np.unique(chunk_ids):
+        chunk = testable_idx[chunk_ids == chunk_id]
+        # all bins whose diamond is tested in this chunk
+        chunk_bins = np.concatenate([cuts[chunk], left_cuts[chunk], right_cuts[chunk]])
+        start = left_idx[chunk_bins].min()
+        end = chunk_bins.max() + 1
+        width = (right_idx[chunk_bins] - left_idx[chunk_bins]).max()
+        band = get_band(hic_matrix.matrix, chr_start_bin + start, chr_start_bin + end, width)
+
+        # bin ids relative to the first row of the band
+        chunk_left_idx = left_idx[start:end] - start
+        chunk_right_idx = right_idx[start:end] - start
+        chunk_cuts = cuts[chunk] - start
+        pvalue_left = diamond_ranksums(band, chunk_left_idx, chunk_right_idx, chunk_cuts, left_cuts[chunk] - start)
+        pvalue_right = diamond_ranksums(band, chunk_left_idx, chunk_right_idx, chunk_cuts, right_cuts[chunk] - start)
+        # same as min(pvalue_left, pvalue_right) for each boundary
+        pvalues[chunk] = np.where(pvalue_right < pvalue_left, pvalue_right, pvalue_left)
+    return pvalues
+
+
 def get_triangle(hic_matrix, cut, window_len, return_mean=False):
     """
     like get_cut_weight which is the 'diamond' representing the counts
@@ -333,27 +582,25 @@ def compute_matrix(bins_list, min_win_size=8, max_win_size=50, step_len=2):
                 matrix in *bedgraph matrix* format
     :return: (chrom, start, end, matrix)
     """
-    global hic_ma
     positions_array = []
     cond_matrix = []
     incremental_step = get_incremental_step_size(min_win_size, max_win_size, step_len)
-    # if type(next(iter(self.interval_trees))) is np.bytes_:
-    #     chrname = toBytes(chrname)
-    # else:
-    #     chrname = toString(chrname)
-    # print("cut_intervals", hic_ma.cut_intervals)
-    for cut in bins_list:
-        chrom, chr_start, chr_end, _ = hic_ma.cut_intervals[cut]
+    bins_list = np.asarray(bins_list)
+    chromosome_start_bins = [start for start, _ in hic_ma.chrBinBoundaries.values()]
+    # split the bins into runs of consecutive bins on the same chromosome
+    breaks = np.flatnonzero((np.diff(bins_list) != 1) | np.isin(bins_list[1:], chromosome_start_bins)) + 1
+    for cuts in np.split(bins_list, breaks):
+        if len(cuts) == 0:
+            continue
         # get conductance
         # for multiple window lengths at a time
-        mult_matrix = [get_cut_weight(hic_ma, cut, depth, return_mean=True) for depth in incremental_step]
-        if any(x is None or np.isnan(x) for x in mult_matrix):
-            # skip problematic cases
-            continue
-
-        cond_matrix.append(mult_matrix)
-
-        positions_array.append((chrom, chr_start, chr_end))
+        mult_matrix = get_cut_weights(hic_ma, cuts, incremental_step)
+        # skip problematic cases
+        valid = ~np.isnan(mult_matrix).any(axis=1)
+        cond_matrix.append(mult_matrix[valid])
+        for cut in cuts[valid]:
+            chrom, chr_start, chr_end, _ = hic_ma.cut_intervals[cut]
+            positions_array.append((chrom, chr_start, chr_end))
     chrom, chr_start, chr_end = zip(*positions_array)
     cond_matrix = np.vstack(cond_matrix)
 
@@ -1203,7 +1450,8 @@ class HicFindTads(object):
     def min_pvalue(self, min_idx):
         """
         For each putative local minima, find the -window_len diammond and the +window_len diamond
-        and compare with the local minima using wilcoxon rank sum.
+        and compare with the local minima using wilcoxon rank sum. The chromosomes are processed
+        in parallel, see compute_boundary_pvalues.
 
         Parameters
         ----------
@@ -1216,73 +1464,55 @@ class HicFindTads(object):
         """
 
         log.info("Computing p-values for window length: {}\n".format(self.min_depth))
-        pvalues = []
         chrom = self.bedgraph_matrix['chrom']
         chr_start = self.bedgraph_matrix['chr_start']
         chr_end = self.bedgraph_matrix['chr_end']
         window_len = self.min_depth
+        min_idx_array = np.asarray(min_idx, dtype=int)
 
-        from scipy.stats import ranksums
-
-        new_min_idx = []
-        for idx in min_idx:
-
-            matrix_idx = self.hic_ma.getRegionBinRange(chrom[idx], chr_start[idx], chr_end[idx])
-            if matrix_idx is None:
+        # the boundaries of each chromosome are tested by one task
+        TASKS = []
+        task_positions = []
+        for chrom_name in np.unique(chrom[min_idx_array]):
+            if toString(chrom_name) not in self.hic_ma.chrBinBoundaries:
                 continue
-            else:
-                matrix_idx = matrix_idx[0]
-
-            new_min_idx += [idx]
-            min_chr, min_start, min_end, _ = self.hic_ma.getBinPos(matrix_idx)
-            assert toString(chrom[idx]) == toString(min_chr) and chr_start[idx] == min_start and chr_end[idx] == min_end
-            left_idx, right_idx = get_idx_of_bins_at_given_distance(self.hic_ma, matrix_idx, window_len)
-
-            left = get_cut_weight(self.hic_ma, left_idx, window_len)
-            right = get_cut_weight(self.hic_ma, right_idx, window_len)
-            boundary = get_cut_weight(self.hic_ma, matrix_idx, window_len)
-
-            if left is None:
-                left = []
-            if right is None:
-                right = []
-
-            if len(left) == 0 and len(right) == 0:
-                pval = np.nan
-
-            elif boundary is None or len(boundary) == 0 or len(left) == 0 or len(right) == 0:
-                pval = np.nan
-
-            else:
-
-                try:
-                    pval1 = ranksums(boundary, left)[1]
-                    pval2 = ranksums(boundary, right)[1]
-                    pval = min(pval1, pval2)
-                except ValueError:
-                    # this condition happens when boundary, left and right are only composed of 'zeros'
-                    pval = np.nan
-            pvalues += [pval]
+            positions = np.flatnonzero(chrom[min_idx_array] == chrom_name)
+            chr_start_bin, starts, ends = get_chromosome_bins(self.hic_ma, chrom_name)
+            matrix_idx = get_bins_containing(starts, ends, chr_start[min_idx_array[positions]])
+            positions = positions[matrix_idx >= 0]
+            matrix_idx = matrix_idx[matrix_idx >= 0]
+            assert np.all(starts[matrix_idx] == chr_start[min_idx_array[positions]]) and \
+                np.all(ends[matrix_idx] == chr_end[min_idx_array[positions]])
+            TASKS.append((chrom_name, matrix_idx + chr_start_bin, window_len))
+            task_positions.append(positions)
+
+        if self.num_processors > 1 and len(TASKS) > 1:
+            # the matrix is handed to each worker once by the pool initializer
+            pool = multiprocessing.Pool(min(self.num_processors, len(TASKS)),
+                                        initializer=_init_boundary_pvalues_worker, initargs=(self.hic_ma,))
+            res = pool.map_async(compute_boundary_pvalues_wrapper, TASKS).get(9999999)
+            pool.close()
+        else:
+            res = [compute_boundary_pvalues(self.hic_ma, *task) for task in TASKS]
 
-        assert len(pvalues) == len(new_min_idx)
+        pvalues = np.full(len(min_idx_array), np.nan)
+        found = np.zeros(len(min_idx_array), dtype=bool)
+        for positions, _pvalues in zip(task_positions, res):
+            pvalues[positions] = _pvalues
+            found[positions] = True
+        new_min_idx = [idx for idx, is_found in zip(min_idx, found) if is_found]
+        pvalues = pvalues[found]
 
         # fdr
         if self.correct_for_multiple_testing == 'fdr':
 
-            pvalues = np.array([e if ~np.isnan(e) else 1 for e in pvalues])
-            pvalues_ = sorted(pvalues)
-            largest_p_i = 0
-            for i, p in enumerate(pvalues_):
-                if p <= (self.threshold_comparisons * (i + 1) / len(pvalues_)):
-                    if p >= largest_p_i:
-                        largest_p_i = p
-            self.pvalueFDR = largest_p_i
+            pvalues[np.isnan(pvalues)] = 1
+            pvalues_ = np.sort(pvalues)
+            passed = pvalues_ <= self.threshold_comparisons * np.arange(1, len(pvalues_) + 1) / len(pvalues_)
+            self.pvalueFDR = pvalues_[passed].max() if passed.any() else 0
         elif self.correct_for_multiple_testing == 'bonferroni':
-            # bonferroni correction
-            pvalues = np.array(pvalues) * len(pvalues)
-            to_one_index_values = np.array([e > 1 if ~np.isnan(e) else False for e in pvalues])
-            if len(to_one_index_values) > 0:
-                pvalues[to_one_index_values] = 1
+            # bonferroni correction, NaN values are kept
+            pvalues = np.minimum(pvalues * len(pvalues), 1)
 
         return OrderedDict(zip(new_min_idx, pvalues))
 
@@ -102,10 +102,10 @@ def objective(pArgs):
         return 1
     outfile_loop = NamedTemporaryFile()
     args = "--matrix {} -o {} -pit {} -oet {} --windowSize {} --peakWidth {} -pp {} -p {} " \
-        "--maxLoopDistance {}  -t {} -tpc {}".format(
+        "--maxLoopDistance {}  -t {}".format(
             pArgs['matrixFile'], outfile_loop.name,
             pArgs['pit'], pArgs['oet'], pArgs['windowSize'], pArgs['peakWidth'], pArgs['pp'], pArgs['p'],
-            pArgs['maxLoopDistance'], pArgs['threads'], pArgs['threads']).split()
+            pArgs['maxLoopDistance'], pArgs['threads']).split()
     hicDetectLoops.main(args)
 
     error_score = compute_score(outfile_loop.name, pArgs['proteinFile'], pArgs['maximumNumberOfLoops'], pArgs['resolution'])
@@ -184,6 +184,48 @@ def running_window_merge(hic_matrix, num_bins):
     return hic_matrix
 
 
+def get_bins_to_merge(ref_name_list, num_bins):
+    """
+    Groups consecutive bins of the same chromosome into groups of num_bins bins.
+    A group at the end of a chromosome with less than num_bins / 2 bins is skipped,
+    except for the last chromosome.
+
+    Parameters
+    ----------
+
+    ref_name_list : chromosome name of each bin, sorted by chromosome
+
+    num_bins : number of consecutive bins to merge.
+
+    Returns
+    -------
+
+    A list with the list of bin indices of each new bin.
+
+    >>> get_bins_to_merge(['a'] * 5 + ['b'] * 4 + ['c'], 4)
+    [[0, 1, 2, 3], [5, 6, 7, 8], [9]]
+    """
+    bins_to_merge = []
+    prev_ref = ref_name_list[0]
+
+    idx_start = 0
+    count = 0
+    for idx, ref in enumerate(ref_name_list):
+        if (count > 0 and count % num_bins == 0) or ref != prev_ref:
+            if count < num_bins / 2:
+                log.debug("{} has few bins ({}). Skipping it\n".format(prev_ref, count))
+            else:
+                bins_to_merge.append(list(range(idx_start, idx)))
+            idx_start = idx
+            count = 0
+
+        prev_ref = ref
+        count += 1
+    bins_to_merge.append(list(range(idx_start, idx + 1)))
+
+    return bins_to_merge
+
+
 def merge_bins(hic, num_bins):
     """
     Merge the bins using the specified number of bins. This
@@ -235,31 +277,13 @@ def merge_bins(hic, num_bins):
     hic = remove_nans_if_needed(hic)
     # get the bins to merge
     ref_name_list, start_list, end_list, coverage_list = zip(*hic.cut_intervals)
-    new_bins = []
-    bins_to_merge = []
-    prev_ref = ref_name_list[0]
+    bins_to_merge = get_bins_to_merge(ref_name_list, num_bins)
 
     # prepare new intervals
-    idx_start = 0
-    new_start = start_list[0]
-    count = 0
-    for idx, ref in enumerate(ref_name_list):
-        if (count > 0 and count % num_bins == 0) or ref != prev_ref:
-            if count < num_bins / 2:
-                log.debug("{} has few bins ({}). Skipping it\n".format(prev_ref, count))
-            else:
-                coverage = np.mean(coverage_list[idx_start:idx])
-                new_bins.append((ref_name_list[idx_start], new_start, end_list[idx - 1], coverage))
-                bins_to_merge.append(list(range(idx_start, idx)))
-            idx_start = idx
-            new_start = start_list[idx]
-            count = 0
-
-        prev_ref = ref
-        count += 1
-    coverage = np.mean(coverage_list[idx_start:])
-    new_bins.append((ref, new_start, end_list[idx], coverage))
-    bins_to_merge.append(list(range(idx_start, idx + 1)))
+    new_bins = []
+    for bins in bins_to_merge:
+        coverage = np.mean(coverage_list[bins[0]:bins[-1] + 1])
+        new_bins.append((ref_name_list[bins[0]], start_list[bins[0]], end_list[bins[-1]], coverage))
 
     hic.matrix = reduce_matrix(hic.matrix, bins_to_merge, diagonal=True)
     hic.matrix.eliminate_zeros()
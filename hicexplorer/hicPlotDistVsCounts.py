@@ -8,6 +8,7 @@ import argparse
 
 from hicmatrix import HiCMatrix
 from hicexplorer._version import __version__
+from hicexplorer.utilities import diagonal_lengths
 
 import matplotlib
 matplotlib.use('Agg')
@@ -225,6 +226,8 @@ def compute_distance_mean(hicmat, maxdepth=None, perchr=False):
         distance_len = np.bincount(dist_list)
         # compute the average for each distance
         mat_size = submatrix.shape[0]
+        # number of values on each diagonal of the chromosomes
+        diagonal_length_per_distance = diagonal_lengths(chrom_sizes[chrname], len(sum_counts))
         # compute mean value for each distance
         mu = {}
         zero_value_bins = []
@@ -257,8 +260,7 @@ def compute_distance_mean(hicmat, maxdepth=None, perchr=False):
 
                 # idx - 1 because earlier the values where
                 # shifted.
-                diagonal_length = sum([size - (bin_dist_plus_one - 1) for size in chrom_sizes[chrname]
-                                       if size > (bin_dist_plus_one - 1)])
+                diagonal_length = diagonal_length_per_distance[bin_dist_plus_one - 1]
 
             # the diagonal length should contain the number of values at a certain distance.
             # If the matrix is dense, the distance_len[bin_dist_plus_one] correctly contains the number of values
@@ -3,13 +3,14 @@ warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 import argparse
 
-from scipy.sparse import csr_matrix, lil_matrix
+from scipy.sparse import csr_matrix
 import numpy as np
 
 from hicmatrix import HiCMatrix as hm
 from hicexplorer._version import __version__
 from hicexplorer.utilities import obs_exp_matrix_lieberman, obs_exp_matrix_non_zero, obs_exp_matrix
 from hicexplorer.utilities import convertNansToZeros, convertInfsToZeros
+from hicexplorer.utilities import block_diagonal_matrix
 
 
 import logging
@@ -82,6 +83,19 @@ def parse_arguments(args=None):
                            'not valid for obs_exp_lieberman.',
                            action='store_true')
 
+    parserOpt.add_argument('--maxDistance',
+                           help='Only the values up to this genomic distance (in bp) from the '
+                           'diagonal are stored. Only used for obs_exp and obs_exp_non_zero. '
+                           'By default all values are stored.',
+                           type=int,
+                           default=None)
+    parserOpt.add_argument('--dataType',
+                           help='Data type of the obs/exp values of obs_exp and obs_exp_non_zero. '
+                           'float32 halves the memory of the transformed matrix. If not set, '
+                           'obs_exp keeps the type of the input matrix and obs_exp_non_zero uses float32.',
+                           choices=['float32', 'float64'],
+                           default=None)
+
     parserOpt.add_argument("--help", "-h", action="help", help="Show this help message and exit.")
 
     parserOpt.add_argument('--version', action='version',
@@ -109,9 +123,9 @@ def _pearson(pSubmatrix):
     return pearson_correlation_matrix  # .todense()
 
 
-def _obs_exp(pSubmatrix):
+def _obs_exp(pSubmatrix, pDataType=None, pMaxDistance=None):
 
-    obs_exp_matrix_ = obs_exp_matrix(pSubmatrix)
+    obs_exp_matrix_ = obs_exp_matrix(pSubmatrix, pDataType=pDataType, pMaxDistance=pMaxDistance)
     obs_exp_matrix_ = convertNansToZeros(csr_matrix(obs_exp_matrix_))
     obs_exp_matrix_ = convertInfsToZeros(csr_matrix(obs_exp_matrix_))
     # log.error('obs_exp_matrix_.data {}'.format(obs_exp_matrix_.data))
@@ -121,9 +135,12 @@ def _obs_exp(pSubmatrix):
     return obs_exp_matrix_  # .todense()
 
 
-def _obs_exp_non_zero(pSubmatrix, ligation_factor):
+def _obs_exp_non_zero(pSubmatrix, ligation_factor, pDataType=None, pMaxDistance=None):
 
-    obs_exp_matrix_ = obs_exp_matrix_non_zero(pSubmatrix, ligation_factor)
+    if pDataType is None:
+        pDataType = np.float32
+    obs_exp_matrix_ = obs_exp_matrix_non_zero(pSubmatrix, ligation_factor, pDataType=pDataType,
+                                              pMaxDistance=pMaxDistance)
     obs_exp_matrix_ = convertNansToZeros(csr_matrix(obs_exp_matrix_))
     obs_exp_matrix_ = convertInfsToZeros(csr_matrix(obs_exp_matrix_))
     # if len(obs_exp_matrix_.data) == 0:
@@ -148,7 +165,15 @@ def main(args=None):
         if args.chromosomes:
             hic_ma.keepOnlyTheseChr(args.chromosomes)
 
-    trasf_matrix = lil_matrix(hic_ma.matrix.shape)
+    data_type = None if args.dataType is None else np.dtype(args.dataType).type
+    max_distance = None
+    if args.maxDistance is not None:
+        max_distance = args.maxDistance // hic_ma.getBinSize()
+
+    # the transformed matrices of each chromosome and their bin ranges,
+    # they are assembled to a block diagonal matrix at the end
+    chromosome_matrices = []
+    chromosome_ranges = []
 
     if args.method == 'obs_exp':
         if args.perChromosome:
@@ -157,14 +182,10 @@ def main(args=None):
                 chr_range = hic_ma.getChrBinRange(chrname)
                 submatrix = hic_ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
                 submatrix.astype(float)
-                submatrix_chr = _obs_exp(submatrix)
-                if len(submatrix_chr.data) == 0:
-                    submatrix_chr = lil_matrix(submatrix_chr.shape)
-                else:
-                    submatrix_chr = lil_matrix(submatrix_chr)
-                trasf_matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]] = submatrix_chr
+                chromosome_matrices.append(_obs_exp(submatrix, data_type, max_distance))
+                chromosome_ranges.append(chr_range)
         else:
-            submatrix = _obs_exp(hic_ma.matrix)
+            submatrix = _obs_exp(hic_ma.matrix, data_type, max_distance)
             trasf_matrix = csr_matrix(submatrix)
 
     elif args.method == 'obs_exp_non_zero':
@@ -175,14 +196,10 @@ def main(args=None):
                 submatrix = hic_ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
                 submatrix.astype(float)
 
-                submatrix_chr = _obs_exp_non_zero(submatrix, args.ligation_factor)
-                if len(submatrix_chr.data) == 0:
-                    submatrix_chr = lil_matrix(submatrix_chr.shape)
-                else:
-                    submatrix_chr = lil_matrix(submatrix_chr)
-                trasf_matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]] = submatrix_chr
+                chromosome_matrices.append(_obs_exp_non_zero(submatrix, args.ligation_factor, data_type, max_distance))
+                chromosome_ranges.append(chr_range)
         else:
-            submatrix = _obs_exp_non_zero(hic_ma.matrix, args.ligation_factor)
+            submatrix = _obs_exp_non_zero(hic_ma.matrix, args.ligation_factor, data_type, max_distance)
             trasf_matrix = csr_matrix(submatrix)
     elif args.method == 'obs_exp_lieberman':
         length_chromosome = 0
@@ -195,13 +212,8 @@ def main(args=None):
             submatrix = hic_ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
             submatrix.astype(float)
 
-            submatrix_chr = _obs_exp_lieberman(submatrix, length_chromosome, chromosome_count)
-            if len(submatrix_chr.data) == 0:
-                submatrix_chr = lil_matrix(submatrix_chr.shape)
-            else:
-                submatrix_chr = lil_matrix(submatrix_chr)
-            trasf_matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]] = submatrix_chr
-        trasf_matrix = trasf_matrix.tocsr()
+            chromosome_matrices.append(_obs_exp_lieberman(submatrix, length_chromosome, chromosome_count))
+            chromosome_ranges.append(chr_range)
         # log.debug('type: {}'.format(type(trasf_matrix)))
     elif args.method == 'pearson':
         if args.perChromosome:
@@ -211,13 +223,8 @@ def main(args=None):
 
                 submatrix.astype(float)
 
-                submatrix_chr = _pearson(submatrix.todense())
-                if len(submatrix_chr.data) == 0:
-                    submatrix_chr = lil_matrix(submatrix_chr.shape)
-                else:
-                    submatrix_chr = lil_matrix(submatrix_chr)
-
-                trasf_matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]] = submatrix_chr
+                chromosome_matrices.append(_pearson(submatrix.todense()))
+                chromosome_ranges.append(chr_range)
         else:
             trasf_matrix = csr_matrix(_pearson(hic_ma.matrix.todense()))
 
@@ -230,18 +237,17 @@ def main(args=None):
 
                 submatrix.astype(float)
 
-                # corrmatrix =
-
-                submatrix_chr = np.cov(submatrix.todense())
-                if len(submatrix_chr.data) == 0:
-                    submatrix_chr = lil_matrix(submatrix_chr.shape)
-                else:
-                    submatrix_chr = lil_matrix(submatrix_chr)
-                trasf_matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]] = submatrix_chr
+                chromosome_matrices.append(np.cov(submatrix.todense()))
+                chromosome_ranges.append(chr_range)
         else:
             corrmatrix = np.cov(hic_ma.matrix.todense())
             trasf_matrix = csr_matrix(corrmatrix)
 
+    if len(chromosome_ranges) > 0:
+        trasf_matrix = block_diagonal_matrix(chromosome_matrices, chromosome_ranges, hic_ma.matrix.shape)
+        trasf_matrix.eliminate_zeros()
+        del chromosome_matrices
+
     # log.debug('trasf_matrix {}'.format(trasf_matrix))
 
     if args.perChromosome:
@@ -2,12 +2,86 @@ import warnings
 warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 import numpy as np
+from scipy.sparse import csc_matrix, csr_matrix, tril, triu
+from concurrent.futures import ThreadPoolExecutor
+from ctypes import c_double
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+import cooler
 import time
 import logging
 log = logging.getLogger(__name__)
 
 
-def iterativeCorrection(matrix, v=None, M=50, tolerance=1e-5, verbose=False):
+def split_rows_by_nnz(matrix, parts):
+    """
+    Splits the rows of a csr matrix into at most `parts` consecutive
+    blocks with roughly the same number of non zero elements.
+    Returns the list of (start row, end row) tuples.
+
+    >>> matrix = csr_matrix(np.array([[1, 1, 1, 1], [0, 1, 0, 0], [0, 0, 1, 1], [0, 0, 0, 1]]))
+    >>> split_rows_by_nnz(matrix, 2)
+    [(0, 1), (1, 4)]
+    >>> split_rows_by_nnz(matrix, 1)
+    [(0, 4)]
+    """
+    limits = np.searchsorted(matrix.indptr, np.linspace(0, matrix.nnz, parts + 1)[1:-1])
+    limits = np.unique(np.concatenate([[0], np.clip(limits, 0, matrix.shape[0]), [matrix.shape[0]]]))
+    return list(zip(limits[:-1].tolist(), limits[1:].tolist()))
+
+
+def _compressed_view(matrix_class, data, indices, indptr, shape):
+    # the arrays are set directly, the constructor would copy
+    # slices of arrays which are much smaller than the full array
+    view = matrix_class(shape, dtype=data.dtype)
+    view.data = data
+    view.indices = indices
+    view.indptr = indptr
+    return view
+
+
+def _row_block(matrix, start, end):
+    """
+    Returns the rows start:end of a csr matrix without copying its data and indices
+
+    >>> matrix = csr_matrix(np.array([[1., 2, 0], [0, 3, 4], [0, 0, 5]]))
+    >>> block = _row_block(matrix, 1, 3)
+    >>> block.toarray()
+    array([[0., 3., 4.],
+           [0., 0., 5.]])
+    >>> np.shares_memory(block.data, matrix.data)
+    True
+    """
+    indptr = matrix.indptr[start:end + 1]
+    return _compressed_view(csr_matrix, matrix.data[indptr[0]:indptr[-1]], matrix.indices[indptr[0]:indptr[-1]],
+                            indptr - indptr[0], (end - start, matrix.shape[1]))
+
+
+def _block_product(block, start, end, x):
+    # the product of the upper triangle block and its transpose with x.
+    # scipy releases the GIL for the sparse matrix vector products,
+    # such that the blocks are computed in parallel by the threads
+    block_transposed = _compressed_view(csc_matrix, block.data, block.indices, block.indptr,
+                                        (block.shape[1], block.shape[0]))
+    return start, end, block.dot(x), block_transposed.dot(x[start:end])
+
+
+def _block_rows(block, start):
+    return np.repeat(np.arange(start, start + block.shape[0]), np.diff(block.indptr))
+
+
+def _block_max(block, start, x):
+    if block.nnz == 0:
+        return 0.0
+    return (block.data * x[_block_rows(block, start)] * x[block.indices]).max()
+
+
+def _block_scale(block, start, x):
+    block.data *= x[_block_rows(block, start)]
+    block.data *= x[block.indices]
+
+
+def iterativeCorrection(matrix, v=None, M=50, tolerance=1e-5, verbose=False, threads=1):
     """
     adapted from cytonised version in mirnylab
     original code from: ultracorrectSymmetricWithVector
@@ -16,9 +90,26 @@ def iterativeCorrection(matrix, v=None, M=50, tolerance=1e-5, verbose=False):
     Main method for correcting DS and SS read data.
     Possibly excludes diagonal.
     By default does iterative correction, but can perform an M-time correction
+
+    Only the upper triangle of the symmetric matrix is used during the iterations
+    and the matrix is never rescaled. Instead, with x = 1 / bias, the row sums of the
+    corrected matrix are computed as x * (U x + U^T x - diag(U) x) from the upper
+    triangle U. The sparse matrix vector products are computed in parallel by
+    `threads` threads on blocks of rows with a similar number of elements.
+
     :param matrix: a scipy sparse matrix
     :param tolerance: Tolerance is the maximum allowed relative
                       deviation of the marginals.
+    :param threads: number of threads used for the matrix vector products.
+
+    >>> matrix = csr_matrix(np.array([[1., 2, 0], [2, 0, 4], [0, 4, 6]]))
+    >>> corrected, bias = iterativeCorrection(matrix, M=500, threads=2)
+    >>> row_sum = np.asarray(corrected.sum(axis=1)).flatten()
+    >>> np.round(row_sum / row_sum[0], 4)
+    array([1., 1., 1.])
+    >>> corrected_1, bias_1 = iterativeCorrection(matrix, M=500, threads=1)
+    >>> np.allclose(bias, bias_1)
+    True
     """
     if verbose:
         log.setLevel(logging.INFO)
@@ -29,58 +120,268 @@ def iterativeCorrection(matrix, v=None, M=50, tolerance=1e-5, verbose=False):
         log.warn("[iterative correction] the matrix contains nans, they will be replaced by zeros.")
         matrix.data[np.isnan(matrix.data)] = 0
 
-    matrix = matrix.astype(float)
-    W = matrix.tocoo()
-
-    if np.abs(matrix - matrix.T).mean() / (1. * np.abs(matrix.mean())) > 1e-10:
+    matrix = matrix.tocsr()
+    upper = triu(matrix, format='csr').astype(float)
+    upper.sort_indices()
+    # |A - A^T| is twice the difference between the upper and the transposed lower triangle
+    difference = triu(matrix, k=1, format='csr') - tril(matrix, k=-1, format='csr').T
+    if 2 * np.abs(difference).sum() / (1. * np.abs(matrix.sum())) > 1e-10:
         raise ValueError("Please provide symmetric matrix!")
+    del difference
+    diagonal = upper.diagonal()
+    max_value = upper.data.max() if upper.nnz else 0
+
+    threads = max(1, int(threads))
+    row_blocks = [(start, end, _row_block(upper, start, end)) for start, end in split_rows_by_nnz(upper, threads)]
+    pool = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+
+    def map_blocks(function, *args):
+        if pool is None:
+            return [function(block, start, *args) for start, end, block in row_blocks]
+        return list(pool.map(lambda row_block: function(row_block[2], row_block[0], *args), row_blocks))
+
+    def inverse_bias():
+        x = np.zeros(len(total_bias))
+        mask = total_bias != 0
+        x[mask] = 1.0 / total_bias[mask]
+        return x
+
+    def matrix_vector_product(x):
+        product = -diagonal * x
+        if pool is None:
+            results = [_block_product(block, start, end, x) for start, end, block in row_blocks]
+        else:
+            results = list(pool.map(lambda row_block: _block_product(row_block[2], row_block[0], row_block[1], x),
+                                    row_blocks))
+        for start, end, upper_product, lower_product in results:
+            product[start:end] += upper_product
+            product += lower_product
+        return product
+
+    start_time = time.time()
+    log.info("starting iterative correction")
+    try:
+        for iternum in range(M):
+            iternum += 1
+            iteration_start_time = time.time()
+            x = inverse_bias()
+            s = x * matrix_vector_product(x)
+            mask = (s == 0)
+            s = s / np.mean(s[~mask])
+
+            total_bias *= s
+            deviation = np.abs(s - 1).max()
+
+            # the values of the corrected matrix are bounded by max_value * max(x)^2,
+            # the exact maximum is only computed if this bound is too large
+            x = inverse_bias()
+            if max_value * x.max() ** 2 > 1e100 and max(map_blocks(_block_max, x)) > 1e100:
+                log.error("*Error* matrix correction is producing extremely large values. "
+                          "This is often caused by bins of low counts. Use a more stringent "
+                          "filtering of bins.")
+                exit(1)
+            if verbose:
+                log.info("pass {} took {:.3f} secs, max delta - 1 = {}".format(
+                    iternum, time.time() - iteration_start_time, deviation))
+                if iternum % 5 == 0:
+                    end_time = time.time()
+                    estimated = (float(M - iternum) * (end_time - start_time)) / iternum
+                    m, sec = divmod(estimated, 60)
+                    h, m = divmod(m, 60)
+                    log.info("pass {} Estimated time {:.0f}:{:.0f}:{:.0f}".format(iternum, h, m, sec))
+
+            if deviation < tolerance:
+                log.info("[iterative correction] {} iterations used\n".format(iternum + 1))
+                break
+
+        # scale the total bias such that the sum is 1.0
+        corr = total_bias[total_bias != 0].mean()
+        total_bias /= corr
+
+        # scale the full matrix once with the final bias
+        del row_blocks, upper
+        corrected_matrix = matrix.astype(float)
+        corrected_matrix.sort_indices()
+        row_blocks = [(start, end, _row_block(corrected_matrix, start, end))
+                      for start, end in split_rows_by_nnz(corrected_matrix, threads)]
+        map_blocks(_block_scale, inverse_bias())
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    if np.any(corrected_matrix.data > 1e10):
+        log.error("*Error* matrix correction produced extremely large values. "
+                  "This is often caused by bins of low counts. Use a more stringent "
+                  "filtering of bins.")
+        exit(1)
+
+    return corrected_matrix, total_bias
+
+
+# the scaling vector x of cool_marginals. It is shared with the processes of the
+# pool through a RawArray given to the pool initializer, such that it is not
+# pickled for every chunk.
+_shared_x = None
+
+
+def _init_cool_marginal_worker(shared_x):
+    global _shared_x
+    _shared_x = shared_x
+
+
+def _cool_marginal_chunk(cool_uri, lo, hi, x, skip_diagonal):
+    """
+    Computes the marginals of the chunk lo:hi of the pixels of a cool file scaled
+    by x_i * x_j, together with the diagonal and the maximal scaled value.
+    """
+    cooler_file = cooler.Cooler(cool_uri)
+    with cooler_file.open('r') as h5:
+        bin1 = h5['pixels/bin1_id'][lo:hi]
+        bin2 = h5['pixels/bin2_id'][lo:hi]
+        values = h5['pixels/count'][lo:hi].astype(float)
+    values[np.isnan(values) | np.isinf(values)] = 0
+    n = len(x)
+    on_diagonal = bin1 == bin2
+    diagonal = np.bincount(bin1[on_diagonal], weights=values[on_diagonal], minlength=n)
+    if skip_diagonal:
+        values[on_diagonal] = 0
+    values *= x[bin1] * x[bin2]
+    marginal = np.bincount(bin1, weights=values, minlength=n)
+    values[on_diagonal] = 0
+    marginal += np.bincount(bin2, weights=values, minlength=n)
+    max_value = values.max() if len(values) else 0
+    if skip_diagonal is False and on_diagonal.any():
+        max_value = max(max_value, (diagonal * x * x).max())
+    return marginal, diagonal, max_value
+
+
+def _cool_marginal_chunk_shared(args):
+    cool_uri, lo, hi, skip_diagonal = args
+    return _cool_marginal_chunk(cool_uri, lo, hi, np.frombuffer(_shared_x), skip_diagonal)
+
+
+def cool_marginal_pool(nbins, processes):
+    """
+    Returns a multiprocessing pool for cool_marginals together with the
+    shared array of nbins doubles the scaling vector is written to.
+    """
+    shared_x = RawArray(c_double, nbins)
+    pool = multiprocessing.Pool(processes, initializer=_init_cool_marginal_worker, initargs=(shared_x,))
+    return pool, shared_x
+
 
+def cool_marginals(cool_uri, x, skip_diagonal=False, chunk_size=1e7, pool=None, shared_x=None):
+    """
+    Returns the row sums of the symmetric matrix stored in the cool file after scaling each
+    pixel (i, j) by x_i * x_j, the (unscaled) diagonal and the maximal scaled value.
+    The pixels are read in chunks of chunk_size. With a pool and its shared array
+    created by cool_marginal_pool, the chunks are processed in parallel and x is
+    copied once to the shared array.
+
+    Only the upper triangle of the matrix is read, the cool file needs to be stored
+    in the 'symmetric-upper' mode.
+    """
+    cooler_file = cooler.Cooler(cool_uri)
+    if cooler_file.storage_mode != 'symmetric-upper':
+        raise ValueError("The cool matrix is stored as '{}', the correction needs a "
+                         "'symmetric-upper' matrix.".format(cooler_file.storage_mode))
+    nnz = cooler_file.info['nnz']
+    chunk_size = int(max(1, chunk_size))
+    chunks = [(lo, min(lo + chunk_size, nnz)) for lo in range(0, nnz, chunk_size)]
+    if pool is not None:
+        np.frombuffer(shared_x)[:] = x
+        results = pool.map(_cool_marginal_chunk_shared, [(cool_uri, lo, hi, skip_diagonal) for lo, hi in chunks])
+    else:
+        results = (_cool_marginal_chunk(cool_uri, lo, hi, x, skip_diagonal) for lo, hi in chunks)
+
+    marginal = np.zeros(len(x))
+    diagonal = np.zeros(len(x))
+    max_value = 0
+    for _marginal, _diagonal, _max_value in results:
+        marginal += _marginal
+        diagonal += _diagonal
+        max_value = max(max_value, _max_value)
+    return marginal, diagonal, max_value
+
+
+def iterativeCorrectionCool(cool_uri, bad_bins=None, M=50, tolerance=1e-5, verbose=False,
+                            skip_diagonal=False, chunk_size=1e7, processes=1):
+    """
+    Iterative correction of the matrix stored in a cool file without loading it.
+    In each iteration, the marginals of the corrected matrix are computed from chunks
+    of chunk_size pixels read from the file, with processes > 1 the chunks are processed
+    by a multiprocessing pool. The iterations are the same as in iterativeCorrection.
+
+    :param cool_uri: file name or uri of the cool matrix
+    :param bad_bins: bins excluded from the correction. Their bias is nan.
+    :param skip_diagonal: if set, the diagonal is not used for the correction.
+
+    Returns the bias vector, the matrix is corrected by dividing the counts by bias_i * bias_j.
+    """
+    if verbose:
+        log.setLevel(logging.INFO)
+
+    nbins = cooler.Cooler(cool_uri).info['nbins']
+    active = np.ones(nbins, dtype=bool)
+    if bad_bins is not None:
+        active[bad_bins] = False
+    total_bias = active.astype(float)
+
+    pool, shared_x = cool_marginal_pool(nbins, processes) if processes > 1 else (None, None)
     start_time = time.time()
     log.info("starting iterative correction")
-    for iternum in range(M):
-        iternum += 1
-        s = np.array(W.sum(axis=1)).flatten()
-        mask = (s == 0)
-        s = s / np.mean(s[~mask])
-
-        total_bias *= s
-        deviation = np.abs(s - 1).max()
-
-        s = 1.0 / s
-
-        # The following code  is an optimization of this
-        # for i in range(N):
-        #     for j in range(N):
-        #         W[i,j] = W[i,j] / (s[i] * s[j])
-
-        W.data *= np.take(s, W.row)
-        W.data *= np.take(s, W.col)
-        if np.any(W.data > 1e100):
-            log.error("*Error* matrix correction is producing extremely large values. "
-                      "This is often caused by bins of low counts. Use a more stringent "
-                      "filtering of bins.")
-            exit(1)
-        if verbose:
-            if iternum % 5 == 0:
-                end_time = time.time()
-                estimated = (float(M - iternum) * (end_time - start_time)) / iternum
-                m, sec = divmod(estimated, 60)
-                h, m = divmod(m, 60)
-                log.info("pass {} Estimated time {:.0f}:{:.0f}:{:.0f}".format(iternum, h, m, sec))
-                log.info("max delta - 1 = {} ".format(deviation))
-
-        if deviation < tolerance:
-            log.info("[iterative correction] {} iterations used\n".format(iternum + 1))
-            break
-
-    # scale the total bias such that the sum is 1.0
-    corr = total_bias[total_bias != 0].mean()
-    total_bias /= corr
-    W.data = W.data * corr * corr
-    if np.any(W.data > 1e10):
+    try:
+        for iternum in range(M):
+            iternum += 1
+            iteration_start_time = time.time()
+            x = np.zeros(nbins)
+            x[total_bias != 0] = 1.0 / total_bias[total_bias != 0]
+            s, _, max_value = cool_marginals(cool_uri, x, skip_diagonal=skip_diagonal,
+                                             chunk_size=chunk_size, pool=pool, shared_x=shared_x)
+            # the matrix values of the last iteration are checked with the
+            # marginal computation of the next one
+            if max_value > 1e100:
+                log.error("*Error* matrix correction is producing extremely large values. "
+                          "This is often caused by bins of low counts. Use a more stringent "
+                          "filtering of bins.")
+                exit(1)
+            mask = (s == 0)
+            s = s / np.mean(s[~mask])
+
+            total_bias *= s
+            deviation = np.abs(s[active] - 1).max()
+            if verbose:
+                log.info("pass {} took {:.3f} secs, max delta - 1 = {}".format(
+                    iternum, time.time() - iteration_start_time, deviation))
+                if iternum % 5 == 0:
+                    end_time = time.time()
+                    estimated = (float(M - iternum) * (end_time - start_time)) / iternum
+                    m, sec = divmod(estimated, 60)
+                    h, m = divmod(m, 60)
+                    log.info("pass {} Estimated time {:.0f}:{:.0f}:{:.0f}".format(iternum, h, m, sec))
+
+            if deviation < tolerance:
+                log.info("[iterative correction] {} iterations used\n".format(iternum + 1))
+                break
+
+        # scale the total bias such that the sum is 1.0
+        corr = total_bias[total_bias != 0].mean()
+        total_bias /= corr
+
+        x = np.zeros(nbins)
+        x[total_bias != 0] = 1.0 / total_bias[total_bias != 0]
+        _, _, max_value = cool_marginals(cool_uri, x, skip_diagonal=skip_diagonal, chunk_size=chunk_size,
+                                         pool=pool, shared_x=shared_x)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if max_value > 1e10:
         log.error("*Error* matrix correction produced extremely large values. "
                   "This is often caused by bins of low counts. Use a more stringent "
                   "filtering of bins.")
         exit(1)
 
-    return W.tocsr(), total_bias
+    total_bias[~active] = np.nan
+    return total_bias
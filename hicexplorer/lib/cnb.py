@@ -9,6 +9,8 @@ import sys
 from scipy.stats import nbinom
 from scipy.special import gammaln
 from scipy import special
+from scipy.special import psi
+from scipy.optimize import fmin_l_bfgs_b
 
 
 def pdf(pX, pR, pP):
@@ -27,3 +29,58 @@ def cdf(pX, pR, pP):
     # if pX == 0:
     # return 0
     return special.betainc(pR, pX + 1, pP)
+
+
+def fit(pX, pCounts=None):
+    """
+    Fits the size and probability of a NB distribution to the values pX which occur pCounts times each.
+    This is the maximum likelihood estimation of fit_nbinom.fit, but the likelihood is computed on the distinct
+    values only, which makes it independent of the number of observations.
+
+    >>> values = np.array([0.0, 1.0, 2.0, 5.0])
+    >>> counts = np.array([3, 1, 2, 1])
+    >>> weighted = fit(values, counts)
+    >>> repeated = fit(np.repeat(values, counts))
+    >>> bool(np.isclose(weighted['size'], repeated['size']) and np.isclose(weighted['prob'], repeated['prob']))
+    True
+    """
+    infinitesimal = np.finfo(float).eps
+    pX = np.asarray(pX, dtype=float)
+    if pCounts is None:
+        pCounts = np.ones(len(pX))
+    pCounts = np.asarray(pCounts, dtype=float)
+
+    number_of_values = pCounts.sum()
+    sum_of_values = np.sum(pCounts * pX)
+    log_factorial = np.sum(pCounts * gammaln(pX + 1))
+
+    def log_likelihood(pParams):
+        r, p = pParams
+        # MLE estimate based on the formula by Adamidis, 'An EM algorithm for estimating negative binomial parameters'
+        # Australian & New Zealand Journal of Statistics Volume 41, Issue 2, 1999
+        result = np.sum(pCounts * gammaln(pX + r)) \
+            - log_factorial \
+            - number_of_values * gammaln(r) \
+            + number_of_values * r * np.log(p) \
+            + sum_of_values * np.log(1 - (p if p < 1 else 1 - infinitesimal))
+        return -result
+
+    def log_likelihood_deriv(pParams):
+        r, p = pParams
+        p_derivative = number_of_values * r / p - sum_of_values / (1 - (p if p < 1 else 1 - infinitesimal))
+        r_derivative = np.sum(pCounts * psi(pX + r)) - number_of_values * psi(r) + number_of_values * np.log(p)
+        return np.array([-r_derivative, -p_derivative])
+
+    # reasonable initial values (from fitdistr function in R)
+    if number_of_values > 0:
+        mean = sum_of_values / number_of_values
+        variance = np.sum(pCounts * (pX - mean) ** 2) / number_of_values
+    else:
+        mean = variance = np.nan
+    size = (mean ** 2) / (variance - mean) if variance > mean else 10
+    # convert mu/size parameterization to prob/size
+    prob = size / ((size + mean) if size + mean != 0 else 1)
+
+    bounds = [(infinitesimal, None), (infinitesimal, 1)]
+    params = fmin_l_bfgs_b(log_likelihood, x0=np.array([size, prob]), fprime=log_likelihood_deriv, bounds=bounds)[0]
+    return {'size': params[0], 'prob': params[1]}
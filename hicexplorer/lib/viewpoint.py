@@ -11,6 +11,7 @@ from scipy.special import gammaln
 from scipy import special
 
 from hicexplorer.lib import cnb
+from hicexplorer.lib import viewpointStore
 
 
 class Viewpoint():
@@ -79,7 +80,22 @@ class Viewpoint():
         p_score = {}
         interaction_file_data = {}
         genomic_coordinates = {}
-        with open(pBedFile) as fh:
+        if viewpointStore.isInStore(pBedFile):
+            header, columns = viewpointStore.readColumns(pBedFile, [-5, -4, -3])
+            header = header.splitlines(True)
+            if columns is not None and len(header) >= 2:
+                # the numeric columns are read as they are stored, the coordinates as strings and
+                # the raw lines only if they are accessed
+                relative_positions, relative_interactions, p_scores = columns
+                relative_positions = relative_positions.astype(int).tolist()
+                interaction_data = dict(zip(relative_positions, relative_interactions.astype(float).tolist()))
+                p_score = dict(zip(relative_positions, p_scores.astype(float).tolist()))
+                interaction_file_data = viewpointStore.TableRows(pBedFile, relative_positions)
+                coordinates = viewpointStore.readColumns(pBedFile, [0, 1, 2], pDecode=True)[1]
+                genomic_coordinates = dict(zip(relative_positions, np.stack(coordinates, axis=1).tolist()))
+                return header[1], interaction_data, p_score, interaction_file_data, genomic_coordinates
+
+        with viewpointStore.openFile(pBedFile) as fh:
             fh.readline()
             header = fh.readline()
             for line in fh.readlines():
@@ -112,7 +128,17 @@ class Viewpoint():
         # use header info to store reference point, and based matrix
         interaction_data = {}
         interaction_file_data = {}
-        with open(pBedFile) as fh:
+        if viewpointStore.isInStore(pBedFile):
+            header, columns = viewpointStore.readColumns(pBedFile, [-5, -4, -3, -1, -2])
+            header = header.splitlines(True)
+            if columns is not None and len(header) >= 3:
+                # the numeric columns are read as they are stored, the raw lines only if they are accessed
+                relative_positions = columns[0].astype(int).tolist()
+                interaction_data = dict(zip(relative_positions, np.stack(columns[1:], axis=1).astype(float)))
+                interaction_file_data = viewpointStore.TableRows(pBedFile, relative_positions)
+                return header[1], interaction_data, interaction_file_data
+
+        with viewpointStore.openFile(pBedFile) as fh:
             fh.readline()
             header = fh.readline()
             fh.readline()
@@ -180,7 +206,7 @@ class Viewpoint():
         Relative number of interactions, p-values based on negative binomial distribution per relative distance, raw interaction data
         '''
 
-        with open((pBedFile + '.txt').strip(), 'w') as fh:
+        with viewpointStore.openFile((pBedFile + '.txt').strip(), 'w') as fh:
             fh.write('{}\n'.format(pHeader))
             for j, interaction in enumerate(pData):
                 fh.write("{}\t{}\t{}\t{}\t{}\t{}\t{:.{decimal_places}f}\t{:.{decimal_places}f}\t{:.{decimal_places}f}\t{:.{decimal_places}f}\n".
@@ -196,42 +222,61 @@ class Viewpoint():
         All interactions with the reference point of one relative distance to it are summed up,
         if the reference point is larger than one bin of the Hi-C matrix, it is considered as one bin and the values are summed together.
         '''
-        view_point_start, view_point_end = self.getReferencePointAsMatrixIndices(
-            pReferencePoint)
-
-        view_point_range = self.getViewpointRangeAsMatrixIndices(
-            pChromViewpoint, pRegion_start, pRegion_end)
-        view_point_range = list(view_point_range)
-        view_point_range[1] += 1
-
-        elements_of_viewpoint = (view_point_range[1] - view_point_range[0])
-        data_list = np.zeros(elements_of_viewpoint)
-        _view_point_start = view_point_start
-
-        while _view_point_start <= view_point_end:
-            chrom, start, end, _ = self.hicMatrix.getBinPos(_view_point_start)
-            for j, idx in zip(range(elements_of_viewpoint), range(view_point_range[0], view_point_range[1], 1)):
-                data_list[j] += self.hicMatrix.matrix[_view_point_start, idx]
-
-            _view_point_start += 1
-
-        elements_of_viewpoint = elements_of_viewpoint - \
-            (view_point_end - view_point_start)
-        data_list_new = np.zeros(elements_of_viewpoint)
-
-        index_before_viewpoint = view_point_start - view_point_range[0]
+        data_lists, index_before_viewpoints = self.computeViewpoints(
+            [pReferencePoint], [pChromViewpoint], [pRegion_start], [pRegion_end])
+        return data_lists[0], index_before_viewpoints[0]
 
-        # elements before the viewpoint
-        data_list_new[0:index_before_viewpoint] = data_list[0:index_before_viewpoint]
-
-        # summation because the viewpoint can not be only one bin but can contain multiple
-        data_list_new[index_before_viewpoint] = np.sum(
-            data_list[index_before_viewpoint: index_before_viewpoint + view_point_end - view_point_start + 1])
+    def computeViewpoints(self, pReferencePoints, pChromViewpoints, pRegion_starts, pRegion_ends):
+        '''
+        Computes the viewpoints of many reference points at once, see computeViewpoint. The rows of all
+        reference points are taken in one slice of the sparse matrix and summed up per reference point.
 
-        # elements after the viewpoint
-        data_list_new[index_before_viewpoint + 1:] = data_list[index_before_viewpoint +
-                                                               view_point_end - view_point_start + 1:]
-        return data_list_new, index_before_viewpoint
+        Returns a list with the viewpoint of each reference point (the lengths differ at the chromosome borders)
+        and an array with the index of the reference point within each viewpoint.
+        '''
+        number_of_viewpoints = len(pReferencePoints)
+        view_point_starts = np.zeros(number_of_viewpoints, dtype=np.int64)
+        view_point_ends = np.zeros(number_of_viewpoints, dtype=np.int64)
+        range_starts = np.zeros(number_of_viewpoints, dtype=np.int64)
+        range_ends = np.zeros(number_of_viewpoints, dtype=np.int64)
+        for i, reference_point in enumerate(pReferencePoints):
+            view_point_starts[i], view_point_ends[i] = self.getReferencePointAsMatrixIndices(
+                reference_point)
+            range_starts[i], range_ends[i] = self.getViewpointRangeAsMatrixIndices(
+                pChromViewpoints[i], pRegion_starts[i], pRegion_ends[i])
+        range_ends += 1
+
+        # one row slice with the rows of all reference points, row i of a reference point is
+        # at rows_offset[j] + i of the slice
+        rows_per_viewpoint = view_point_ends - view_point_starts + 1
+        rows_offset = np.concatenate([[0], np.cumsum(rows_per_viewpoint)])
+        viewpoint_of_row = np.repeat(np.arange(number_of_viewpoints), rows_per_viewpoint)
+        rows = view_point_starts[viewpoint_of_row] + np.arange(rows_offset[-1]) - rows_offset[viewpoint_of_row]
+        submatrix = self.hicMatrix.matrix[rows, :].tocsr()
+        submatrix.sum_duplicates()
+
+        viewpoint_of_element = viewpoint_of_row[np.repeat(np.arange(len(rows)), np.diff(submatrix.indptr))]
+        columns = submatrix.indices - range_starts[viewpoint_of_element]
+        lengths = range_ends - range_starts
+        in_range = (columns >= 0) & (columns < lengths[viewpoint_of_element])
+
+        # all viewpoints are stored one after another in a flat array
+        data_offset = np.concatenate([[0], np.cumsum(lengths)])
+        data = np.bincount(data_offset[viewpoint_of_element[in_range]] + columns[in_range],
+                           weights=submatrix.data[in_range], minlength=data_offset[-1])
+
+        index_before_viewpoints = view_point_starts - range_starts
+        data_lists = []
+        for i in range(number_of_viewpoints):
+            data_list = data[data_offset[i]:data_offset[i + 1]]
+            index_before_viewpoint = index_before_viewpoints[i]
+            index_after_viewpoint = index_before_viewpoint + rows_per_viewpoint[i]
+
+            # summation because the viewpoint can not be only one bin but can contain multiple
+            data_lists.append(np.concatenate([data_list[:index_before_viewpoint],
+                                              [np.sum(data_list[index_before_viewpoint:index_after_viewpoint])],
+                                              data_list[index_after_viewpoint:]]))
+        return data_lists, index_before_viewpoints
 
     def createInteractionFileData(self, pReferencePoint, pChromViewpoint, pRegion_start, pRegion_end, pInteractionData, pInteractionDataRaw, pGene, pSumOfInteractions):
         '''
@@ -313,13 +358,17 @@ class Viewpoint():
         if pWindowSize % 2 == 0:
             window_size_upstream -= 1
 
-        average_contacts = np.zeros(len(pData))
+        data = np.ascontiguousarray(pData, dtype=np.float64)
+        average_contacts = np.zeros(len(data))
 
-        # add upstream and downstream, handle regular case
-        for i in range(window_size_upstream, len(pData) - window_size):
-            start = i - window_size_upstream
-            end = i + window_size + 1
-            average_contacts[i] = np.mean(pData[start:end])
+        # add upstream and downstream, handle regular case: the mean of all windows of
+        # length window_size_upstream + window_size + 1, as a strided view on the data
+        window_length = window_size_upstream + window_size + 1
+        number_of_windows = len(data) - window_length + 1
+        if number_of_windows > 0:
+            windows = np.lib.stride_tricks.as_strided(data, shape=(number_of_windows, window_length),
+                                                      strides=(data.strides[0], data.strides[0]), writeable=False)
+            average_contacts[window_size_upstream:len(data) - window_size] = windows.mean(axis=1)
 
         # handle border conditions
         for i in range(window_size):
@@ -328,8 +377,8 @@ class Viewpoint():
                 start = 0
             end = i + window_size + 1
 
-            average_contacts[i] = np.mean(pData[start:end])
-            average_contacts[-(i + 1)] = np.mean(pData[-end:])
+            average_contacts[i] = np.mean(data[start:end])
+            average_contacts[-(i + 1)] = np.mean(data[-end:])
 
         # average_contacts = average_contacts
         return average_contacts
@@ -601,7 +650,7 @@ class Viewpoint():
         # for bed_file in pDifferentialHighlightFiles:
         _, reference_point_start, reference_point_end = pViewpoint.split('_')
 
-        with open(pDifferentialHighlightFiles) as fh:
+        with viewpointStore.openFile(pDifferentialHighlightFiles) as fh:
             # skip header
             for line in fh.readlines():
                 if line.startswith('#'):
@@ -638,33 +687,35 @@ class Viewpoint():
             return None
         return highlight_areas_list
 
+    def backgroundModelParameters(self, pBackgroundModel, pRelativeDistances):
+        '''
+        Returns the parameters of the background model for each of the given relative distances as an array
+        with one row per distance. Distances which are not in the background model use the parameters of the
+        smallest (upstream) or largest (downstream) relative distance.
+        '''
+        keys = np.array(sorted(pBackgroundModel))
+        parameters = np.array([pBackgroundModel[key] for key in keys], dtype=np.float64)
+        relative_distances = np.asarray(pRelativeDistances)
+
+        indices = np.minimum(np.searchsorted(keys, relative_distances), len(keys) - 1)
+        not_in_model = keys[indices] != relative_distances
+        indices[not_in_model & (relative_distances < 0)] = 0
+        indices[not_in_model & (relative_distances >= 0)] = len(keys) - 1
+        return parameters[indices]
+
     def pvalues(self, pBackgroundModel, pDataList, pIndexReferencePoint):
-        # cdf
-        p_value_list = []
-
-        for i, data_element in enumerate(pDataList):
-            relative_distance = i - pIndexReferencePoint
-            # check if relative distance is available.
-            # if not, use either min or max key for the distribution
-            if relative_distance not in pBackgroundModel:
-                if relative_distance < 0:
-                    relative_distance = min(pBackgroundModel.keys())
-                else:
-                    relative_distance = max(pBackgroundModel.keys())
-            if data_element == 0.0:
-                p_value_list.append(0.0)
-            else:
-                p_value_list.append(cnb.cdf(data_element, pBackgroundModel[relative_distance][0], pBackgroundModel[relative_distance][1]))
+        data = np.asarray(pDataList, dtype=np.float64)
+        parameters = self.backgroundModelParameters(pBackgroundModel, np.arange(len(data)) - pIndexReferencePoint)
 
-        # for reason I do not understand atm the values needs to be inverted again, it seems it is not enough to do this in try/catch region
-        p_value_list = np.array(p_value_list, dtype=np.float64)
+        # cdf
+        p_value_list = cnb.cdf(data, parameters[:, 0], parameters[:, 1])
+        p_value_list[data == 0.0] = 0.0
 
         p_value_list = 1 - p_value_list
 
         # remove possible occuring nan with a p-value of 1
         mask = np.isnan(p_value_list)
         mask_inf = np.isinf(p_value_list)
-        p_value_list = np.array(p_value_list)
         mask = np.logical_or(mask, mask_inf)
         p_value_list[mask] = 1.0
         return p_value_list
@@ -804,7 +855,7 @@ class Viewpoint():
         else:
             log.debug('viewpoint_split {}, file: {}'.format(viewpoint_split, pSignificantFile))
             return None, None
-        with open(pSignificantFile) as fh:
+        with viewpointStore.openFile(pSignificantFile) as fh:
             # skip header
             for line in fh.readlines():
                 if line.startswith('#'):
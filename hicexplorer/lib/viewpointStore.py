@@ -0,0 +1,378 @@
+"""
+A viewpoint store is a single HDF5 file which replaces a folder of the tab delimited files of the chic* tools
+(interaction files, significant interactions, target lists, aggregated and differential files).
+Every tool accepts a store in place of a folder if its name ends with '.hdf5' or '.h5', and the files are
+addressed as usual by '<store>/<file name>'.
+
+Each file, i.e. one reference point of one sample, is a group of the store, named by the file name:
+- 'header': the leading lines starting with '#'
+- 'columns': the remaining lines with one dataset per tab delimited field, named by the index of the field and
+  missing if there are no lines. Numeric fields are stored as int64 or float64 datasets with the 'format' attribute
+  that writes them back as in the file, all other fields as strings.
+Files which can not be represented as a table are stored as 'text'. The columns of a file can be read on their own
+and without parsing the text with readColumns(), and the rows by key with TableRows, which converts a row to
+strings only when it is accessed.
+
+HDF5 files can not be written by several processes at once, therefore all writes are collected per process and
+written together by flush(), which takes an exclusive lock on '<store>.lock'. A store can not be read and written
+in the same run.
+"""
+
+import os
+import io
+import fcntl
+from collections.abc import Mapping
+
+import numpy as np
+import h5py
+
+import logging
+log = logging.getLogger(__name__)
+
+STORE_SUFFIXES = ('.hdf5', '.h5')
+
+# files waiting to be written per store: {store: {name: (header, table, text)}}
+_pending = {}
+# open stores for reading per process: {(process id, store): h5py.File}
+_open_stores = {}
+FLUSH_THRESHOLD = 1000
+
+
+def isStore(pPath):
+    '''
+    Returns True if pPath is a viewpoint store.
+    '''
+    return pPath is not None and pPath.endswith(STORE_SUFFIXES)
+
+
+def splitPath(pPath):
+    '''
+    Splits a path of a file within a viewpoint store into the store and the file name.
+    For all other paths (None, pPath) is returned.
+    '''
+    folder, name = os.path.split(pPath)
+    if isStore(folder):
+        return folder, name
+    return None, pPath
+
+
+def isInStore(pPath):
+    return splitPath(pPath)[0] is not None
+
+
+def createFolder(pFolder):
+    '''
+    Creates the folder pFolder, or the folder containing the viewpoint store pFolder.
+    '''
+    if isStore(pFolder):
+        pFolder = os.path.dirname(pFolder)
+    if pFolder != '' and not os.path.exists(pFolder):
+        os.makedirs(pFolder, exist_ok=True)
+
+
+def textToTable(pText):
+    '''
+    Splits the content of a tab delimited file into the header lines starting with '#' and a table
+    of strings. If the remaining lines are not a table, (header, None) is returned.
+    '''
+    lines = pText.split('\n')
+    trailing_newline = lines[-1] == ''
+    if trailing_newline:
+        lines = lines[:-1]
+    header_length = 0
+    while header_length < len(lines) and lines[header_length].startswith('#'):
+        header_length += 1
+    header = ''.join(line + '\n' for line in lines[:header_length])
+    rows = [line.split('\t') for line in lines[header_length:]]
+    if len(rows) > 0 and not trailing_newline:
+        return header, None
+    if len(rows) > 0 and (len(set(len(row) for row in rows)) > 1 or any(row[0].startswith('#') for row in rows)):
+        return header, None
+    if not trailing_newline:
+        # only header lines, the last one without a new line
+        header = header[:-1]
+    if len(rows) == 0:
+        return header, np.empty((0, 0), dtype=str)
+    return header, np.array(rows, dtype=str)
+
+
+def tableToText(pHeader, pTable):
+    return pHeader + ''.join('\t'.join(row) + '\n' for row in pTable.tolist())
+
+
+def encodeColumn(pColumn):
+    '''
+    Returns the values of a column of strings as int64 or float64 array, together with the format that writes them
+    back unchanged. If there is no such format, the encoded strings and None are returned.
+
+    >>> encodeColumn(np.array(['1', '-20']))
+    (array([  1, -20]), '%d')
+    >>> encodeColumn(np.array(['0.50', '12.25']))
+    (array([ 0.5 , 12.25]), '%.2f')
+    >>> encodeColumn(np.array(['chr1', '12']))
+    (array([b'chr1', b'12'], dtype='|S4'), None)
+    '''
+    if len(pColumn) > 0:
+        try:
+            values = pColumn.astype(np.int64)
+            if np.array_equal(values.astype(str), pColumn):
+                return values, '%d'
+        except (ValueError, OverflowError):
+            pass
+        try:
+            values = pColumn.astype(np.float64)
+        except ValueError:
+            values = None
+        if values is not None and np.all(np.char.find(pColumn, '.') >= 0):
+            decimals = np.unique(np.char.str_len(np.char.rpartition(pColumn, '.')[:, 2]))
+            lengths = np.unique(np.char.str_len(pColumn))
+            formats = ['%.{}f'.format(decimals[0])]
+            if len(lengths) == 1:
+                formats.append('%{}.{}f'.format(lengths[0], decimals[0]))
+            for value_format in formats:
+                if len(decimals) == 1 and np.array_equal(np.char.mod(value_format, values), pColumn):
+                    return values, value_format
+    return np.char.encode(pColumn, 'utf-8'), None
+
+
+def decodeColumn(pValues, pFormat):
+    '''
+    Returns the column of strings of values encoded by encodeColumn.
+    '''
+    if pFormat is None:
+        return np.char.decode(pValues, 'utf-8')
+    return np.char.mod(pFormat, pValues)
+
+
+def writeFile(pPath, pText):
+    '''
+    Queues the content of a file to be written to its viewpoint store with the next flush().
+    '''
+    store, name = splitPath(pPath)
+    header, table = textToTable(pText)
+    if table is None:
+        entry = (None, None, pText)
+    else:
+        entry = (header, table, None)
+    if store not in _pending:
+        _pending[store] = {}
+    _pending[store][name] = entry
+    if len(_pending[store]) >= FLUSH_THRESHOLD:
+        flush(store)
+
+
+def flush(pStore=None):
+    '''
+    Writes all queued files to their viewpoint stores, or only those of pStore.
+    '''
+    stores = [pStore] if pStore is not None else list(_pending)
+    for store in stores:
+        entries = _pending.pop(store, None)
+        if not entries:
+            continue
+        closeStore(store)
+        with open(store + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with h5py.File(store, 'a') as store_file:
+                    for name, (header, table, text) in entries.items():
+                        if name in store_file:
+                            del store_file[name]
+                        group = store_file.create_group(name)
+                        if text is not None:
+                            group.create_dataset('text', data=text, dtype=h5py.string_dtype())
+                            continue
+                        group.create_dataset('header', data=header, dtype=h5py.string_dtype())
+                        if table.size == 0:
+                            continue
+                        columns = group.create_group('columns')
+                        for index in range(table.shape[1]):
+                            values, value_format = encodeColumn(table[:, index])
+                            dataset = columns.create_dataset(str(index), data=values)
+                            if value_format is not None:
+                                dataset.attrs['format'] = value_format
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def toString(pValue):
+    if isinstance(pValue, bytes):
+        return pValue.decode('utf-8')
+    return pValue
+
+
+def getStore(pStore):
+    '''
+    Returns the viewpoint store opened for reading. Stores are kept open per process as long as they are not changed.
+    '''
+    key = (os.getpid(), pStore)
+    stat = os.stat(pStore)
+    version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    if key in _open_stores and _open_stores[key][1] != version:
+        closeStore(pStore)
+    if key not in _open_stores:
+        _open_stores[key] = (h5py.File(pStore, 'r'), version)
+    return _open_stores[key][0]
+
+
+def closeStore(pStore):
+    store_file = _open_stores.pop((os.getpid(), pStore), None)
+    if store_file is not None:
+        store_file[0].close()
+
+
+def getGroup(pPath):
+    '''
+    Returns the group of a file within a viewpoint store, or its pending entry (header, table, text) if it is not
+    written yet.
+    '''
+    store, name = splitPath(pPath)
+    if name in _pending.get(store, {}):
+        return _pending[store][name]
+    store_file = getStore(store)
+    if name not in store_file:
+        raise IOError('{} does not exist in {}'.format(name, store))
+    return store_file[name]
+
+
+def readEntry(pPath):
+    '''
+    Returns the header, table and text of a file within a viewpoint store, either the table and header or the text are None.
+    '''
+    group = getGroup(pPath)
+    if isinstance(group, tuple):
+        return group
+    if 'text' in group:
+        return None, None, toString(group['text'][()])
+    header = toString(group['header'][()])
+    if 'columns' not in group:
+        return header, np.empty((0, 0), dtype=str), None
+    columns = group['columns']
+    table = np.stack([decodeColumn(columns[str(index)][()], columns[str(index)].attrs.get('format'))
+                      for index in range(len(columns))], axis=1)
+    return header, table, None
+
+
+def readColumns(pPath, pColumns, pDecode=False):
+    '''
+    Returns the header and the columns pColumns (negative indices count from the last column) of a file within a
+    viewpoint store. Numeric columns are returned as int64 or float64 arrays, all others as arrays of strings. With
+    pDecode, all columns are returned as strings as they are written in the file. Only the requested columns are read
+    from the store. The columns are None if the file is not a table.
+    '''
+    group = getGroup(pPath)
+    if isinstance(group, tuple) or 'text' in group:
+        header, table = readTable(pPath)
+        if table is None:
+            return header, None
+        if table.size == 0:
+            return header, [np.empty(0, dtype=str) for _ in pColumns]
+        columns = []
+        for index in pColumns:
+            values, value_format = (None, None) if pDecode else encodeColumn(table[:, index])
+            columns.append(values if value_format is not None else table[:, index])
+        return header, columns
+
+    header = toString(group['header'][()])
+    if 'columns' not in group:
+        return header, [np.empty(0, dtype=str) for _ in pColumns]
+    datasets = group['columns']
+    columns = []
+    for index in pColumns:
+        dataset = datasets[str(index % len(datasets))]
+        if pDecode or dataset.attrs.get('format') is None:
+            columns.append(decodeColumn(dataset[()], dataset.attrs.get('format')))
+        else:
+            columns.append(dataset[()])
+    return header, columns
+
+
+class TableRows(Mapping):
+    '''
+    The rows of a file within a viewpoint store as lists of strings by key, pKeys holds the key of each row.
+    The columns are read from the store on the first access and a row is converted to strings only when it is
+    accessed, the same list is returned on every access.
+    '''
+
+    def __init__(self, pPath, pKeys):
+        self.path = pPath
+        self.index = {key: row for row, key in enumerate(pKeys)}
+        self.columns = None
+        self.rows = {}
+
+    def readColumns(self):
+        group = getGroup(self.path)
+        if isinstance(group, tuple) or 'text' in group:
+            table = readTable(self.path)[1]
+            self.columns = [(table[:, index], None) for index in range(table.shape[1])]
+        elif 'columns' not in group:
+            self.columns = []
+        else:
+            datasets = group['columns']
+            self.columns = [(datasets[str(index)][()], datasets[str(index)].attrs.get('format'))
+                            for index in range(len(datasets))]
+
+    def __getitem__(self, pKey):
+        if pKey not in self.rows:
+            row = self.index[pKey]
+            if self.columns is None:
+                self.readColumns()
+            self.rows[pKey] = [toString(values[row]) if value_format is None else value_format % values[row]
+                               for values, value_format in self.columns]
+        return self.rows[pKey]
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+
+def readTable(pPath):
+    '''
+    Returns the header and the table of strings of a file within a viewpoint store.
+    The table is None if the file is not a table.
+    '''
+    header, table, text = readEntry(pPath)
+    if table is None:
+        return textToTable(text)
+    return header, table
+
+
+def readFile(pPath):
+    '''
+    Returns the content of a file within a viewpoint store.
+    '''
+    header, table, text = readEntry(pPath)
+    if text is not None:
+        return text
+    return tableToText(header, table)
+
+
+class StoreFileWriter(io.StringIO):
+    '''
+    File object which writes its content to the viewpoint store when it is closed.
+    '''
+
+    def __init__(self, pPath):
+        super().__init__()
+        self.path = pPath
+
+    def close(self):
+        if not self.closed:
+            writeFile(self.path, self.getvalue())
+        super().close()
+
+
+def openFile(pPath, pMode='r'):
+    '''
+    Opens a file in a folder or in a viewpoint store. Files in a store are read and written as
+    text files, the written files are stored with the next flush().
+    '''
+    if not isInStore(pPath):
+        return open(pPath, pMode)
+    if pMode == 'r':
+        return io.StringIO(readFile(pPath))
+    if pMode == 'w':
+        return StoreFileWriter(pPath)
+    raise ValueError('Files in a viewpoint store can only be opened for reading or writing, not with mode {}'.format(pMode))
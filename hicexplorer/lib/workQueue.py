@@ -0,0 +1,171 @@
+"""
+Work queue for the chic* tools. The items to process (reference points, interaction files, ...) are split into small
+batches which are handed out to the worker processes as soon as they are idle, so a few slow items do not stall a
+whole process. The results are returned in the order of the batches.
+
+The worker function and its keyword arguments are inherited by the worker processes when they are started, only the
+batch indices and the results are sent between the processes.
+"""
+
+import math
+import time
+import queue
+import traceback
+from multiprocessing import Process, Queue
+
+import logging
+log = logging.getLogger(__name__)
+
+# number of batches per thread, more batches balance the work better but have more overhead
+BATCHES_PER_THREAD = 8
+# seconds between two progress reports
+REPORT_INTERVAL = 30
+
+
+class WorkQueueError(Exception):
+    '''
+    Raised if the worker function failed for a batch or a worker process died.
+    '''
+
+
+def getBatches(pNumberOfItems, pThreads, pBatchSize=None):
+    '''
+    Returns the (start, end) index ranges of the batches.
+
+    >>> getBatches(10, 2, pBatchSize=4)
+    [(0, 4), (4, 8), (8, 10)]
+    >>> len(getBatches(1000, 4))
+    32
+    >>> getBatches(0, 4)
+    []
+    '''
+    if pBatchSize is None:
+        pBatchSize = int(math.ceil(pNumberOfItems / (pThreads * BATCHES_PER_THREAD)))
+    pBatchSize = max(1, pBatchSize)
+    return [(start, min(start + pBatchSize, pNumberOfItems)) for start in range(0, pNumberOfItems, pBatchSize)]
+
+
+def _worker(pFunction, pItemLists, pKwargs, pBatches, pTaskQueue, pResultQueue):
+    while True:
+        batch_index = pTaskQueue.get()
+        if batch_index is None:
+            return
+        start, end = pBatches[batch_index]
+        try:
+            result = pFunction(*[items[start:end] for items in pItemLists], **pKwargs)
+        except Exception:
+            pResultQueue.put((batch_index, False, traceback.format_exc()))
+            return
+        pResultQueue.put((batch_index, True, result))
+
+
+class _Progress():
+
+    def __init__(self, pName, pNumberOfItems):
+        self.name = pName
+        self.numberOfItems = pNumberOfItems
+        self.itemsDone = 0
+        self.startTime = time.time()
+        self.lastReport = self.startTime
+
+    def update(self, pItems):
+        self.itemsDone += pItems
+        now = time.time()
+        if now - self.lastReport >= REPORT_INTERVAL:
+            self.lastReport = now
+            log.info('{}: {} of {} items done, {:.1f} items/s'.format(
+                self.name, self.itemsDone, self.numberOfItems, self.itemsDone / (now - self.startTime)))
+
+    def finish(self):
+        elapsed_time = time.time() - self.startTime
+        log.info('{}: {} items done in {:.1f}s, {:.1f} items/s'.format(
+            self.name, self.itemsDone, elapsed_time, self.itemsDone / max(elapsed_time, 1e-9)))
+
+
+def runParallel(pFunction, pItemLists, pThreads, pKwargs=None, pBatchSize=None, pName=None):
+    '''
+    Calls pFunction(*batches, **pKwargs) for small batches of the items with pThreads processes. pItemLists is a list
+    of lists which are split into batches in the same way; lists shorter than the first one, e.g. empty ones, give
+    shorter batches. Returns the results of all calls in the order of the batches.
+
+    Raises WorkQueueError with the traceback of the worker if pFunction fails for a batch.
+
+    >>> runParallel(sum, [list(range(10))], 2, pBatchSize=4)
+    [6, 22, 17]
+    >>> def parse(pValues):
+    ...     return [int(value) for value in pValues]
+    >>> try:
+    ...     runParallel(parse, [['1', '2', 'x']], 2, pBatchSize=1)
+    ... except WorkQueueError as exp:
+    ...     print(str(exp).splitlines()[-1])
+    ValueError: invalid literal for int() with base 10: 'x'
+    '''
+    if pKwargs is None:
+        pKwargs = {}
+    if pName is None:
+        pName = pFunction.__name__
+    batches = getBatches(len(pItemLists[0]), pThreads, pBatchSize)
+    progress = _Progress(pName, len(pItemLists[0]))
+    results = [None] * len(batches)
+
+    if pThreads <= 1 or len(batches) <= 1:
+        for batch_index, (start, end) in enumerate(batches):
+            try:
+                results[batch_index] = pFunction(*[items[start:end] for items in pItemLists], **pKwargs)
+            except Exception:
+                raise WorkQueueError(traceback.format_exc())
+            progress.update(end - start)
+        progress.finish()
+        return results
+
+    task_queue = Queue()
+    result_queue = Queue()
+    for batch_index in range(len(batches)):
+        task_queue.put(batch_index)
+    processes = []
+    for _ in range(min(pThreads, len(batches))):
+        task_queue.put(None)
+        processes.append(Process(target=_worker, kwargs=dict(
+            pFunction=pFunction,
+            pItemLists=pItemLists,
+            pKwargs=pKwargs,
+            pBatches=batches,
+            pTaskQueue=task_queue,
+            pResultQueue=result_queue
+        )))
+    for process in processes:
+        process.start()
+
+    try:
+        batches_done = 0
+        while batches_done < len(batches):
+            try:
+                batch_index, success, result = result_queue.get(timeout=1)
+            except queue.Empty:
+                for process in processes:
+                    if process.exitcode is not None and process.exitcode != 0:
+                        raise WorkQueueError('{}: a worker process died with exit code {}'.format(pName, process.exitcode))
+                continue
+            if not success:
+                raise WorkQueueError(result)
+            results[batch_index] = result
+            batches_done += 1
+            start, end = batches[batch_index]
+            progress.update(end - start)
+    finally:
+        for process in processes:
+            if batches_done < len(batches):
+                process.terminate()
+            process.join()
+    progress.finish()
+    return results
+
+
+def flatten(pResults):
+    '''
+    Concatenates the lists returned per batch to one list.
+
+    >>> flatten([[1, 2], [], [3]])
+    [1, 2, 3]
+    '''
+    return [item for result in pResults for item in result]
@@ -77,12 +77,13 @@ def test_regular_mode_chi2():
 def test_batch_mode_fisher():
 
     output_folder = mkdtemp(prefix="output_")
+    rejected_file_names = mkdtemp(prefix="rejected_") + '/rejected_H0.txt'
 
-    args = "--interactionFile {} -iff {} --alpha {} --statisticTest {} --outputFolder {} -bm -t {}\
+    args = "--interactionFile {} -iff {} --alpha {} --statisticTest {} --outputFolder {} -bm -t {} -r {}\
         ".format(ROOT + 'chicAggregateStatistic/batch_mode_file_names.txt',
                  ROOT + 'chicAggregateStatistic/batch_mode',
                  0.5, 'fisher',
-                 output_folder, 1).split()
+                 output_folder, 1, rejected_file_names).split()
     chicDifferentialTest.main(args)
 
     assert are_files_equal(ROOT + "chicDifferentialTest/batch_mode_fisher/FL-E13-5_MB-E10-5_chr1_chr1_14300280_14300280_Eya1_H0_accepted.txt",
@@ -113,12 +114,13 @@ def test_batch_mode_fisher():
 def test_batch_mode_chi2():
 
     output_folder = mkdtemp(prefix="output_")
+    rejected_file_names = mkdtemp(prefix="rejected_") + '/rejected_H0.txt'
 
-    args = "--interactionFile {} -iff {} --alpha {} --statisticTest {} --outputFolder {} -bm -t {}\
+    args = "--interactionFile {} -iff {} --alpha {} --statisticTest {} --outputFolder {} -bm -t {} -r {}\
         ".format(ROOT + 'chicAggregateStatistic/batch_mode_file_names.txt',
                  ROOT + 'chicAggregateStatistic/batch_mode',
                  0.5, 'chi2',
-                 output_folder, 1).split()
+                 output_folder, 1, rejected_file_names).split()
     chicDifferentialTest.main(args)
 
     assert are_files_equal(ROOT + "chicDifferentialTest/batch_mode_chi2/FL-E13-5_MB-E10-5_chr1_chr1_14300280_14300280_Eya1_H0_accepted.txt",
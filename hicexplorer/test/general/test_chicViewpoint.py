@@ -1,4 +1,8 @@
 from hicexplorer import chicViewpoint
+from hicexplorer.lib import Viewpoint
+from hicexplorer.lib import viewpointStore
+import hicmatrix.HiCMatrix as hm
+import numpy as np
 from tempfile import NamedTemporaryFile, mkdtemp
 import os
 import pytest
@@ -83,6 +87,63 @@ def test_one_matrix():
                ) == set(os.listdir(output_folder))
 
 
+def test_one_matrix_store():
+    output_folder = mkdtemp(prefix="output_")
+    store = output_folder + '/interactionFiles.hdf5'
+    args = "--matrices {} --referencePoints {} --backgroundModel {} --range {} {} -o {} -t {}".format(ROOT + 'FL-E13-5_chr1.cool',
+                                                                                                      ROOT + 'referencePoints_chicViewpoint.bed',
+                                                                                                      ROOT + 'background.txt',
+                                                                                                      200000, 200000,
+                                                                                                      store, 1).split()
+    chicViewpoint.main(args)
+
+    for file_name in os.listdir(ROOT + "chicViewpoint/output_2/"):
+        with open(output_folder + '/' + file_name, 'w') as file:
+            file.write(viewpointStore.openFile(store + '/' + file_name).read())
+        assert are_files_equal(ROOT + "chicViewpoint/output_2/" + file_name,
+                               output_folder + '/' + file_name, skip=4)
+
+    header, interaction_data, _, _, _ = Viewpoint().readInteractionFile(store + '/FL-E13-5_chr1_chr1_4487435_4487435_Sox17.txt')
+    header_file, interaction_data_file, _, _, _ = Viewpoint().readInteractionFile(output_folder + '/FL-E13-5_chr1_chr1_4487435_4487435_Sox17.txt')
+    assert header == header_file
+    assert interaction_data == interaction_data_file
+
+
+def test_viewpoint_store_columns():
+    import h5py
+    store = mkdtemp(prefix="store_") + '/interactionFiles.hdf5'
+    text = '# header\n#chrom\tstart\tvalue\tscore\n' \
+        'chr1\t100\t0.500000\t   1.25000\n' \
+        'chr1\t-200\t12.250000\t  10.00000\n'
+    viewpointStore.writeFile(store + '/viewpoint.txt', text)
+    viewpointStore.flush()
+
+    # numeric columns are stored typed, the file is written back unchanged
+    with h5py.File(store, 'r') as store_file:
+        columns = store_file['viewpoint.txt/columns']
+        assert columns['0'].dtype.kind == 'S'
+        assert columns['1'].dtype == np.int64
+        assert columns['2'].dtype == np.float64 and columns['3'].dtype == np.float64
+    assert viewpointStore.readFile(store + '/viewpoint.txt') == text
+
+    header, columns = viewpointStore.readColumns(store + '/viewpoint.txt', [1, -1, 0])
+    assert header == '# header\n#chrom\tstart\tvalue\tscore\n'
+    assert columns[0].tolist() == [100, -200]
+    assert columns[1].tolist() == [1.25, 10.0]
+    assert columns[2].tolist() == ['chr1', 'chr1']
+    _, columns = viewpointStore.readColumns(store + '/viewpoint.txt', [1, 2], pDecode=True)
+    assert columns[0].tolist() == ['100', '-200']
+    assert columns[1].tolist() == ['0.500000', '12.250000']
+
+    # the rows are converted to strings when they are accessed
+    rows = viewpointStore.TableRows(store + '/viewpoint.txt', [100, -200])
+    assert list(rows) == [100, -200] and rows.columns is None
+    assert rows[-200] == ['chr1', '-200', '12.250000', '  10.00000']
+    assert rows[-200] is rows[-200]
+    assert 100 not in rows.rows
+    viewpointStore.closeStore(store)
+
+
 def test_two_matrices_writeFileName():
     outfile = NamedTemporaryFile(suffix='.txt', delete=False)
     outfile_name_list = NamedTemporaryFile(suffix='.txt', delete=False)
@@ -174,3 +235,35 @@ def test_two_matrices_writeFileName_crash():
 
     assert set(os.listdir(ROOT + "chicViewpoint/output_3/")
                ) == set(os.listdir(output_folder))
+
+
+def test_compute_viewpoints():
+    hic_ma = hm.hiCMatrix(ROOT + 'FL-E13-5_chr1.cool')
+    viewpointObj = Viewpoint(hic_ma)
+    reference_points = [('chr1', '4487435'), ('chr1', '14300280', '14310280'), ('chr1', '19093103')]
+    regions = [viewpointObj.calculateViewpointRange((point[0], point[1], point[-1]), (200000, 200000))
+               for point in reference_points]
+    data_lists, index_before_viewpoints = viewpointObj.computeViewpoints(reference_points, ['chr1'] * 3,
+                                                                         [region[0] for region in regions],
+                                                                         [region[1] for region in regions])
+
+    for reference_point, region, data_list, index_before_viewpoint in zip(reference_points, regions, data_lists, index_before_viewpoints):
+        view_point_start, view_point_end = viewpointObj.getReferencePointAsMatrixIndices(reference_point)
+        range_start, range_end = viewpointObj.getViewpointRangeAsMatrixIndices('chr1', region[0], region[1])
+        expected = hic_ma.matrix[view_point_start:view_point_end + 1, range_start:range_end + 1].toarray().sum(axis=0)
+        viewpoint_sum = expected[view_point_start - range_start:view_point_end - range_start + 1].sum()
+        expected = np.concatenate([expected[:view_point_start - range_start], [viewpoint_sum], expected[view_point_end - range_start + 1:]])
+
+        assert index_before_viewpoint == view_point_start - range_start
+        assert np.allclose(data_list, expected)
+        assert np.allclose(viewpointObj.computeViewpoint(reference_point, 'chr1', region[0], region[1])[0], expected)
+
+
+def test_smooth_interaction_values():
+    viewpointObj = Viewpoint()
+    data = np.array([0, 4, 2, 0, 0, 0, 9, 1, 3, 5], dtype=float)
+    smoothed = viewpointObj.smoothInteractionValues(data, 3)
+
+    assert np.allclose(smoothed[1:-1], [np.mean(data[i - 1:i + 2]) for i in range(1, len(data) - 1)])
+    assert np.allclose(smoothed[[0, -1]], [np.mean(data[:2]), np.mean(data[-2:])])
+    assert smoothed[4] == 0.0
@@ -106,3 +106,45 @@ def test_compute_background_functional_fail():
 
     assert are_files_equal(ROOT + 'background.txt',
                            outfile.name, delta=700, skip=1)
+
+
+def test_compute_background_compaction(monkeypatch):
+    # viewpoints in small batches and merged values after each batch give the same distributions
+    outfile = NamedTemporaryFile(suffix='.txt', delete=False)
+    outfile.close()
+    args = "--matrices {} {} --referencePoints {} -o {} -t {}".format(ROOT + 'FL-E13-5_chr1.cool', ROOT + 'MB-E10-5_chr1.cool',
+                                                                      ROOT + 'referencePoints.bed', outfile.name, 2).split()
+    chicViewpointBackgroundModel.main(args)
+    background_uncompacted = np.loadtxt(outfile.name, skiprows=1)
+
+    monkeypatch.setattr(chicViewpointBackgroundModel, 'REFERENCE_POINTS_PER_BATCH', 7)
+    monkeypatch.setattr(chicViewpointBackgroundModel, 'VALUES_BEFORE_COMPACTION', 1000)
+    chicViewpointBackgroundModel.main(args)
+
+    background = np.loadtxt(ROOT + 'background.txt', skiprows=1)
+    background_outfile = np.loadtxt(outfile.name, skiprows=1)
+    assert background.shape == background_outfile.shape
+    # relative position, max value and mean value do not depend on the fit of the distributions
+    assert np.allclose(background[:, [0, 3, 4]], background_outfile[:, [0, 3, 4]])
+    # the fitted size and prob of the negative binomial distributions do not depend on the compaction
+    assert np.allclose(background_uncompacted[:, [1, 2]], background_outfile[:, [1, 2]])
+
+
+def test_histogram_fit():
+    # the fit of the averaged values of the histogram bins equals the fit of all values
+    from hicexplorer.lib import cnb
+    random_state = np.random.RandomState(0)
+    values = random_state.negative_binomial(3, 0.2, size=20000) + random_state.uniform(0, 0.001, size=20000)
+    relative_positions = np.zeros(len(values), dtype=np.int64)
+    _, bins, counts, sums, minima, maxima = chicViewpointBackgroundModel.count_values(
+        relative_positions, chicViewpointBackgroundModel.histogram_bins(values, 0.01),
+        np.ones(len(values), dtype=np.int64), values, values, values)
+    assert len(bins) < 200
+    assert minima.min() == values.min() and maxima.max() == values.max()
+    assert np.isclose(sums.sum() / counts.sum(), values.mean())
+
+    expected = cnb.fit(values)
+    fitted = cnb.fit(chicViewpointBackgroundModel.bin_values(counts, sums, minima, maxima), counts)
+    assert np.isclose(fitted['size'], expected['size'], rtol=1e-3)
+    assert np.isclose(fitted['prob'], expected['prob'], rtol=1e-3)
+    assert np.isclose(fitted['size'], 3, rtol=0.1) and np.isclose(fitted['prob'], 0.2, rtol=0.1)
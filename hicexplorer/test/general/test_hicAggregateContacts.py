@@ -356,3 +356,77 @@ def test_hicAggregateContacts_row_wise_inter():
     assert res is None, res
 
     os.remove(outfile_aggregate_row_wise.name)
+
+
+def get_agg_info(pChromCoord, pOnline):
+    from collections import OrderedDict
+    return {"chrom_coord": pChromCoord, "seen": set(), "agg_matrix": OrderedDict(), "agg_total": {},
+            "online": pOnline, "contact_pairs": True,
+            "agg_diagonals": OrderedDict(), "agg_contact_position": {}, "agg_center_values": {},
+            "counter": 0, "used_counter": 0, "empty_mat": 0}
+
+
+@pytest.mark.skipif(LOW_MEMORY > memory,
+                    reason="Travis has too less memory to run it.")
+def test_aggregate_contacts_equals_count_contacts():
+    import numpy as np
+    from hicmatrix import HiCMatrix as hm
+
+    ma = hm.hiCMatrix(ROOT + "small_test_matrix_50kb_res.h5")
+    chrom_coord = {}
+    for chrom in ma.getChrNames():
+        first, last = ma.getChrBinRange(chrom)
+        chrom_coord[chrom] = (ma.getBinPos(first)[1], ma.getBinPos(last - 1)[2])
+    with open(ROOT + "hicAggregateContacts/test_regions.bed") as bed_file:
+        bed = hicexplorer.hicAggregateContacts.read_bed_per_chrom(bed_file, ma.getChrNames())
+
+    agg_infos = [get_agg_info(chrom_coord, pOnline=False) for _ in range(2)]
+    hicexplorer.hicAggregateContacts.aggregate_contacts(bed, bed, agg_infos[0], ma, 5, 'center', '100000:5000000',
+                                                        'total-counts', mode='all')
+    for k1, v1 in bed.items():
+        for k2, v2 in bed.items():
+            for coord1 in v1:
+                for coord2 in v2:
+                    if (k1 == k2) and (coord1 == coord2):
+                        continue
+                    interval = [(k1, coord1[0], coord1[1]), (k2, coord2[0], coord2[1])]
+                    hicexplorer.hicAggregateContacts.count_contacts(interval, ma, 5, 'all', agg_infos[1], 'center',
+                                                                    '100000:5000000', 'total-counts')
+
+    for key in ["counter", "used_counter", "empty_mat", "agg_total", "agg_contact_position", "agg_center_values"]:
+        assert agg_infos[0][key] == agg_infos[1][key]
+    assert agg_infos[0]["agg_total"]["genome"] > 0
+    assert np.array_equal(np.array(agg_infos[0]["agg_matrix"]["genome"]), np.array(agg_infos[1]["agg_matrix"]["genome"]))
+    # the diagonals are 1D arrays instead of the 1 x n matrices of count_contacts
+    assert all(type(diagonal) is np.ndarray and diagonal.shape == (11,) for diagonal in agg_infos[0]["agg_diagonals"]["genome"])
+    assert np.array_equal(np.vstack(agg_infos[0]["agg_diagonals"]["genome"]), np.vstack(agg_infos[1]["agg_diagonals"]["genome"]))
+
+
+@pytest.mark.skipif(LOW_MEMORY > memory,
+                    reason="Travis has too less memory to run it.")
+def test_aggregate_contacts_online():
+    # the online aggregates of the default mode equal the aggregates of the stored submatrices
+    import numpy as np
+    from hicmatrix import HiCMatrix as hm
+
+    ma = hm.hiCMatrix(ROOT + "small_test_matrix_50kb_res.h5")
+    chrom_coord = {}
+    for chrom in ma.getChrNames():
+        first, last = ma.getChrBinRange(chrom)
+        chrom_coord[chrom] = (ma.getBinPos(first)[1], ma.getBinPos(last - 1)[2])
+    with open(ROOT + "hicAggregateContacts/test_regions.bed") as bed_file:
+        bed = hicexplorer.hicAggregateContacts.read_bed_per_chrom(bed_file, ma.getChrNames())
+
+    agg_infos = [get_agg_info(chrom_coord, pOnline=online) for online in [True, False]]
+    for agg_info in agg_infos:
+        hicexplorer.hicAggregateContacts.aggregate_contacts(bed, bed, agg_info, ma, 5, 'center', '100000:5000000',
+                                                            'total-counts', mode='intra-chr', perChr=True)
+    online, stored = agg_infos
+    assert list(online["agg_matrix"]) == list(stored["agg_matrix"])
+    for key, aggregate in online["agg_matrix"].items():
+        submatrices = np.array(stored["agg_matrix"][key])
+        assert isinstance(aggregate, hicexplorer.hicAggregateContacts.OnlineAggregate)
+        assert len(aggregate) == len(submatrices) > 0
+        np.testing.assert_allclose(aggregate.mean(), submatrices.mean(axis=0), rtol=1e-10)
+        np.testing.assert_allclose(aggregate.median(), np.median(submatrices, axis=0), rtol=1e-10)
+        assert len(online["agg_diagonals"][key]) == min(len(submatrices), online["agg_diagonals"][key].size)
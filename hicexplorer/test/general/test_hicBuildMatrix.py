@@ -65,6 +65,61 @@ def test_build_matrix(capsys):
     # os.unlink("/tmp/test.bam")
 
 
+def test_build_matrix_duplication_check_max_memory(capsys):
+    outfile = NamedTemporaryFile(suffix='.h5', delete=False)
+    outfile.close()
+    qc_folder = mkdtemp(prefix="testQC_")
+    tmp_dir = mkdtemp(prefix="test_duplicates_")
+    args = "-s {} {} --outFileName {} -bs 5000 --QCfolder {} --threads 4 \
+            --duplicationCheckMaxMemory 0 --duplicationCheckTmpDir {} --inputBufferSize 10000 \
+            --restrictionSequence GATC --danglingSequence GATC -rs {}".format(sam_R1, sam_R2,
+                                                                              outfile.name, qc_folder,
+                                                                              tmp_dir, dpnii_file).split()
+    compute(hicBuildMatrix.main, args, 5)
+    test = hm.hiCMatrix(ROOT + "small_test_matrix_parallel_one_rc.h5")
+    new = hm.hiCMatrix(outfile.name)
+    nt.assert_equal(test.matrix.data, new.matrix.data)
+    nt.assert_equal(test.cut_intervals, new.cut_intervals)
+    assert are_files_equal(ROOT + "QC/QC.log", qc_folder + "/QC.log")
+    # the positions written to disk are removed
+    assert os.listdir(tmp_dir) == []
+
+    os.unlink(outfile.name)
+    shutil.rmtree(qc_folder)
+    shutil.rmtree(tmp_dir)
+
+
+def test_build_matrix_pairs(capsys):
+    outfile = NamedTemporaryFile(suffix='.h5', delete=False)
+    outfile.close()
+    outfile_pairs = NamedTemporaryFile(suffix='.pairs.gz', delete=False)
+    outfile_pairs.close()
+    outfile_from_pairs = NamedTemporaryFile(suffix='.h5', delete=False)
+    outfile_from_pairs.close()
+    qc_folder = mkdtemp(prefix="testQC_")
+    args = "-s {} {} --outFileName {} -bs 5000 --QCfolder {} --threads 4 --outPairs {} \
+            --restrictionSequence GATC --danglingSequence GATC -rs {}".format(sam_R1, sam_R2,
+                                                                              outfile.name, qc_folder,
+                                                                              outfile_pairs.name, dpnii_file).split()
+    compute(hicBuildMatrix.main, args, 5)
+
+    args = "--inputPairs {} --outFileName {} -bs 5000".format(outfile_pairs.name, outfile_from_pairs.name).split()
+    compute(hicBuildMatrix.main, args, 5)
+
+    test = hm.hiCMatrix(ROOT + "small_test_matrix_parallel_one_rc.h5")
+    new = hm.hiCMatrix(outfile.name)
+    new_from_pairs = hm.hiCMatrix(outfile_from_pairs.name)
+    nt.assert_equal(test.matrix.data, new.matrix.data)
+    nt.assert_equal(new.matrix.data, new_from_pairs.matrix.data)
+    nt.assert_equal(new.matrix.indices, new_from_pairs.matrix.indices)
+    nt.assert_equal([x[:3] for x in new.cut_intervals], [x[:3] for x in new_from_pairs.cut_intervals])
+
+    os.unlink(outfile.name)
+    os.unlink(outfile_pairs.name)
+    os.unlink(outfile_from_pairs.name)
+    shutil.rmtree(qc_folder)
+
+
 def test_build_matrix_restriction_enzyme(capsys):
     outfile = NamedTemporaryFile(suffix='.h5', delete=False)
     outfile.close()
@@ -159,6 +214,32 @@ def test_build_matrix_cooler():
     shutil.rmtree(qc_folder)
 
 
+def test_build_matrix_cooler_max_memory():
+    outfile = NamedTemporaryFile(suffix='.cool', delete=False)
+    outfile.close()
+    qc_folder = mkdtemp(prefix="testQC_")
+    tmp_dir = mkdtemp(prefix="test_pixels_")
+    args = "-s {} {} --outFileName {} -bs 5000 --QCfolder {} --threads 4 \
+            --matrixMaxMemory 0 --matrixTmpDir {} --inputBufferSize 10000 \
+            --restrictionSequence GATC --danglingSequence GATC -rs {}".format(sam_R1, sam_R2,
+                                                                              outfile.name, qc_folder,
+                                                                              tmp_dir, dpnii_file).split()
+    compute(hicBuildMatrix.main, args, 5)
+
+    test = hm.hiCMatrix(ROOT + "small_test_matrix_parallel.h5")
+    new = hm.hiCMatrix(outfile.name)
+
+    nt.assert_equal(test.matrix.data, new.matrix.data)
+    nt.assert_equal([x[:3] for x in new.cut_intervals], [x[:3] for x in test.cut_intervals])
+    assert are_files_equal(ROOT + "QC/QC.log", qc_folder + "/QC.log")
+    # the contacts written to disk are removed
+    assert os.listdir(tmp_dir) == []
+
+    os.unlink(outfile.name)
+    shutil.rmtree(qc_folder)
+    shutil.rmtree(tmp_dir)
+
+
 def test_build_matrix_cooler_metadata():
     outfile = NamedTemporaryFile(suffix='.cool', delete=False)
     outfile.close()
@@ -264,6 +345,26 @@ def test_build_matrix_cooler_multiple():
     shutil.rmtree(qc_folder)
 
 
+def test_build_matrix_cooler_two_resolutions():
+    outfile = NamedTemporaryFile(suffix='.mcool', delete=False)
+    outfile.close()
+    qc_folder = mkdtemp(prefix="testQC_")
+    args = "-s {} {} --outFileName {} -bs 5000 10000 --QCfolder {} --threads 4 \
+            --restrictionSequence GATC --danglingSequence GATC -rs {}".format(sam_R1, sam_R2,
+                                                                              outfile.name, qc_folder,
+                                                                              dpnii_file).split()
+    compute(hicBuildMatrix.main, args, 5)
+
+    for resolution in ['5000', '10000']:
+        test = hm.hiCMatrix(ROOT + "hicBuildMatrix/multi_small_test_matrix.mcool::/resolutions/" + resolution)
+        new = hm.hiCMatrix(outfile.name + '::/resolutions/' + resolution)
+        nt.assert_equal(test.matrix.data, new.matrix.data)
+        nt.assert_equal([x[:3] for x in new.cut_intervals], [x[:3] for x in test.cut_intervals])
+
+    os.unlink(outfile.name)
+    shutil.rmtree(qc_folder)
+
+
 def test_build_matrix_rf():
     outfile = NamedTemporaryFile(suffix='.h5', delete=False)
     outfile.close()
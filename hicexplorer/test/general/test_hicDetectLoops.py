@@ -1,10 +1,18 @@
+import os
 import os.path
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, mkdtemp
 from psutil import virtual_memory
 import logging
 log = logging.getLogger(__name__)
 
+import numpy as np
+import numpy.testing as nt
+from scipy.sparse import triu
+from scipy.stats import ranksums
+from hicmatrix import HiCMatrix as hm
+
 from hicexplorer import hicDetectLoops
+from hicexplorer.utilities import obs_exp_matrix, ranksums_rows
 from hicexplorer.test.test_compute_function import compute
 
 mem = virtual_memory()
@@ -81,6 +89,20 @@ def test_main_cool_chromosomes_single_core():
         ROOT + "hicDetectLoops/loops.bedgraph", outfile_loop_cool.name, delta=0)
 
 
+def test_main_cool_chromosomes_tmp_dir():
+    outfile_loop_cool = NamedTemporaryFile(suffix='.bedgraph', delete=True)
+    tmp_dir = mkdtemp(prefix='hicDetectLoops_test_')
+
+    args = "--matrix {} -o {} --maxLoopDistance 3000000 -pit 1 -w 5 -pw 2 -p 0.5 -pp 0.55 --chromosomes 1 2 -t 2 --tmpDir {}".format(
+        ROOT + "hicDetectLoops/GSE63525_GM12878_insitu_primary_2_5mb.cool", outfile_loop_cool.name, tmp_dir).split()
+    compute(hicDetectLoops.main, args, 5)
+    assert are_files_equal(
+        ROOT + "hicDetectLoops/loops.bedgraph", outfile_loop_cool.name, delta=0)
+    # the scratch directory is created in --tmpDir and removed at the end
+    assert os.listdir(tmp_dir) == []
+    os.rmdir(tmp_dir)
+
+
 def test_main_cool_chromosomes_threads_inner_threads():
     outfile_loop_cool = NamedTemporaryFile(suffix='.bedgraph', delete=True)
 
@@ -90,3 +112,61 @@ def test_main_cool_chromosomes_threads_inner_threads():
     compute(hicDetectLoops.main, args, 5)
     assert are_files_equal(
         ROOT + "hicDetectLoops/loops.bedgraph", outfile_loop_cool.name, delta=0)
+
+
+def test_main_cool_threads_equal_single_process():
+    outfile_loop_single = NamedTemporaryFile(suffix='.bedgraph', delete=True)
+    outfile_loop_threads = NamedTemporaryFile(suffix='.bedgraph', delete=True)
+
+    args = "--matrix {} -o {} --maxLoopDistance 80000000 -pit 1 -w 4 -pw 1 -p 0.5 -pp 0.55 --chromosomes 1 2 3 -t {}"
+    compute(hicDetectLoops.main, args.format(ROOT + "hicDetectLoops/GSE63525_GM12878_insitu_primary_2_5mb.cool",
+                                             outfile_loop_single.name, 1).split(), 5)
+    compute(hicDetectLoops.main, args.format(ROOT + "hicDetectLoops/GSE63525_GM12878_insitu_primary_2_5mb.cool",
+                                             outfile_loop_threads.name, 3).split(), 5)
+    with open(outfile_loop_single.name) as loops_single, open(outfile_loop_threads.name) as loops_threads:
+        loops = loops_single.readlines()
+        assert len(loops) > 0
+        assert loops == loops_threads.readlines()
+
+
+def test_ranksums_rows():
+    rng = np.random.RandomState(42)
+    # integer values to have ties within and between the rows
+    x = rng.randint(0, 10, size=(200, 9)).astype(float)
+    y = rng.randint(0, 10, size=(200, 30)).astype(float)
+    expected = [ranksums(x_row, y_row)[1] for x_row, y_row in zip(x, y)]
+    nt.assert_allclose(ranksums_rows(x, y), expected, rtol=1e-12)
+
+
+def test_candidate_region_test_equal_single_candidates():
+    window_size = 4
+    peak_window_size = 1
+    p_value = 0.5
+    hic_matrix = hm.hiCMatrix(ROOT + "hicDetectLoops/GSE63525_GM12878_insitu_primary_2_5mb.cool",
+                              pChrnameList=['1'])
+    matrix = obs_exp_matrix(hic_matrix.matrix.astype(float), pInplace=False)
+
+    # candidates close to the diagonal and at the borders of the matrix
+    row, col = triu(matrix, k=1).nonzero()
+    rng = np.random.RandomState(42)
+    candidates = np.array([row, col]).T[rng.choice(len(row), size=min(len(row), 3000), replace=False)]
+    candidates = np.concatenate([candidates, [[0, 2], [matrix.shape[0] - 2, matrix.shape[0] - 1]]])
+
+    accepted, p_values = hicDetectLoops.candidate_region_test(matrix, candidates, window_size, p_value,
+                                                              peak_window_size)
+
+    # each candidate tested on its own
+    expected_accepted = []
+    expected_p_values = []
+    for candidate in candidates:
+        slice_x, slice_y = hicDetectLoops.neighborhood_slices(candidate, window_size, matrix.shape)
+        candidate_p_value = hicDetectLoops.test_neighborhood(matrix[slice_x, slice_y].toarray(),
+                                                             matrix[candidate[0], candidate[1]],
+                                                             window_size, p_value, peak_window_size)
+        if candidate_p_value is not None:
+            expected_accepted.append(candidate)
+            expected_p_values.append(candidate_p_value)
+
+    assert len(expected_accepted) > 0
+    nt.assert_equal(accepted, np.array(expected_accepted).reshape(-1, 2))
+    nt.assert_allclose(p_values, expected_p_values, rtol=1e-10)
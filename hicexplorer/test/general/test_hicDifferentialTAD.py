@@ -1,10 +1,13 @@
 import os.path
 from tempfile import NamedTemporaryFile
+from multiprocessing import Queue
 from psutil import virtual_memory
 import pytest
+import numpy as np
 import logging
 log = logging.getLogger(__name__)
 
+from hicmatrix import HiCMatrix as hm
 from hicexplorer import hicDifferentialTAD
 from hicexplorer.test.test_compute_function import compute
 
@@ -283,3 +286,43 @@ def test_cool_all_one_core_all_multichr_chromosome():
         1, outfile_pref.name, 'all', 'all'
     ).split()
     compute(hicDifferentialTAD.main, args, 5)
+
+
+def test_cool_region_reader():
+    matrix = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_data/hicCorrectMatrix/kr_full.cool")
+    region_reader = hicDifferentialTAD.CoolRegionReader(matrix, pMaxChromosomes=1)
+    # the second region needs a wider band, the last ones evict the first chromosome
+    regions = [('chr3L', 100000, 150000), ('chr3L', 50000, 250000), ('chr3L', 120000, 130000),
+               ('chr2L', 0, 100000), ('chr3L', 1000000, 1100000)]
+    for chromosome, start, end in regions:
+        hic_matrix = hm.hiCMatrix(pMatrixFile=matrix, pChrnameList=['{}:{}-{}'.format(chromosome, start, end)])
+        region = region_reader.getRegion(chromosome, start, end)
+        assert np.allclose(hic_matrix.matrix.toarray(), region.matrix.toarray(), equal_nan=True)
+        for position in [start, (start + end) // 2, end - 1]:
+            assert hic_matrix.getRegionBinRange(chromosome, position, position) == region.getRegionBinRange(chromosome, position, position)
+        assert region.getRegionBinRange(chromosome, end + 10000, end + 10000) is None
+    assert list(region_reader.bands) == ['chr3L']
+    region_reader.close()
+
+
+def test_computeDifferentialTADs_closes_readers(monkeypatch):
+    # the cool files are closed also if reading a region fails
+    closed = []
+
+    class FailingRegionReader:
+        def __init__(self, pMatrixFile):
+            self.matrixFile = pMatrixFile
+
+        def getRegion(self, pChromosome, pStart, pEnd):
+            raise ValueError('region failed')
+
+        def close(self):
+            closed.append(self.matrixFile)
+
+    monkeypatch.setattr(hicDifferentialTAD, 'CoolRegionReader', FailingRegionReader)
+    queue = Queue()
+    domains = [['chr1', 0, 100], ['chr1', 100, 200], ['chr1', 200, 300]]
+    hicDifferentialTAD.computeDifferentialTADs('target.cool', 'control.cool', domains, True, 0.05, None, queue)
+    result = queue.get(timeout=5)
+    assert result.startswith('Fail: region failed')
+    assert sorted(closed) == ['control.cool', 'target.cool']
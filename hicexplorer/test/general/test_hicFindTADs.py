@@ -6,6 +6,7 @@ from hicmatrix import HiCMatrix as hm
 from tempfile import mkdtemp
 import shutil
 import os
+import numpy as np
 import numpy.testing as nt
 from hicexplorer.test.test_compute_function import compute
 
@@ -121,3 +122,57 @@ def test_find_TADs_none():
     assert are_files_equal(ROOT + "find_TADs/None/multiNone_score.bedgraph", tad_folder + "/test_multiNone_score.bedgraph")
 
     shutil.rmtree(tad_folder)
+
+
+def test_get_cut_weights():
+    hic_ma = hm.hiCMatrix(ROOT + 'find_TADs/None/multiNone_zscore_matrix.h5')
+    hic_ma.matrix = hicFindTADs.sparse.triu(hic_ma.matrix, k=0, format='csr')
+    window_lengths = hicFindTADs.get_incremental_step_size(60000, 180000, 20000)
+    for chrom in list(hic_ma.chrBinBoundaries)[:2]:
+        start, end = hic_ma.chrBinBoundaries[chrom]
+        cuts = list(range(start, min(end, start + 300)))
+        weights = hicFindTADs.get_cut_weights(hic_ma, cuts, window_lengths, max_tile_size=64)
+        expected = [[hicFindTADs.get_cut_weight(hic_ma, cut, window_len, return_mean=True)
+                     for window_len in window_lengths] for cut in cuts]
+        nt.assert_allclose(weights, np.array(expected, dtype=float), rtol=1e-10, atol=1e-12)
+
+
+def test_get_cut_weights_not_finite():
+    # diamonds with inf values keep an inf weight, diamonds with NaN values a NaN weight
+    hic_ma = hm.hiCMatrix(ROOT + 'find_TADs/None/multiNone_zscore_matrix.h5')
+    hic_ma.matrix = hicFindTADs.sparse.triu(hic_ma.matrix, k=0, format='csr')
+    hic_ma.matrix.data[::50] = np.inf
+    hic_ma.matrix.data[10::200] = -np.inf
+    hic_ma.matrix.data[20::300] = np.nan
+    window_lengths = hicFindTADs.get_incremental_step_size(60000, 180000, 20000)
+    chrom = list(hic_ma.chrBinBoundaries)[0]
+    start, end = hic_ma.chrBinBoundaries[chrom]
+    cuts = list(range(start, min(end, start + 300)))
+    weights = hicFindTADs.get_cut_weights(hic_ma, cuts, window_lengths, max_tile_size=64)
+    expected = np.array([[hicFindTADs.get_cut_weight(hic_ma, cut, window_len, return_mean=True)
+                          for window_len in window_lengths] for cut in cuts], dtype=float)
+    assert np.isinf(expected).any() and np.isnan(expected).any()
+    nt.assert_allclose(weights, expected, rtol=1e-10, atol=1e-12)
+
+
+def test_compute_boundary_pvalues():
+    # compares the chunked p-values with a per boundary rank sum test
+    from scipy.stats import ranksums
+    hic_ma = hm.hiCMatrix(ROOT + 'find_TADs/None/multiNone_zscore_matrix.h5')
+    hic_ma.matrix = hicFindTADs.sparse.triu(hic_ma.matrix, k=0, format='csr')
+    window_len = 60000
+    for chrom in list(hic_ma.chrBinBoundaries)[:2]:
+        start, end = hic_ma.chrBinBoundaries[chrom]
+        cuts = np.arange(start, min(end, start + 300))
+        pvalues = hicFindTADs.compute_boundary_pvalues(hic_ma, chrom, cuts, window_len, chunk_size=64)
+        expected = []
+        for cut in cuts:
+            left_idx, right_idx = hicFindTADs.get_idx_of_bins_at_given_distance(hic_ma, cut, window_len)
+            boundary = hicFindTADs.get_cut_weight(hic_ma, cut, window_len)
+            left = hicFindTADs.get_cut_weight(hic_ma, left_idx, window_len)
+            right = hicFindTADs.get_cut_weight(hic_ma, right_idx, window_len)
+            if any(diamond is None or len(diamond) == 0 for diamond in (boundary, left, right)):
+                expected.append(np.nan)
+            else:
+                expected.append(min(ranksums(boundary, left)[1], ranksums(boundary, right)[1]))
+        nt.assert_allclose(pvalues, expected, rtol=1e-10)
@@ -2,8 +2,12 @@ import warnings
 warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 from hicexplorer import hicTransform
+from hicexplorer.utilities import obs_exp_matrix, obs_exp_matrix_non_zero
 from hicmatrix import HiCMatrix as hm
+import numpy as np
 import numpy.testing as nt
+import pytest
+from scipy.sparse import triu
 
 from tempfile import NamedTemporaryFile
 import os
@@ -182,3 +186,45 @@ def test_hic_transfer_covariance_perChromosome():
     new = hm.hiCMatrix(outfile.name)
     nt.assert_array_almost_equal(test.matrix.data, new.matrix.data, decimal=DELTA_DECIMAL)
     os.unlink(outfile.name)
+
+
+@pytest.mark.parametrize("method", ['obs_exp', 'obs_exp_non_zero'])
+def test_hic_transfer_obs_exp_max_distance_data_type(method):
+    outfile = NamedTemporaryFile(suffix='obs_exp_.cool', delete=False)
+    outfile.close()
+    outfile_band = NamedTemporaryFile(suffix='obs_exp_band.cool', delete=False)
+    outfile_band.close()
+
+    max_distance_bins = 10
+    bin_size = hm.hiCMatrix(original_matrix_cool).getBinSize()
+    args = "--matrix {} --outFileName {} --method {} --dataType float64".format(original_matrix_cool, outfile.name,
+                                                                                method).split()
+    compute(hicTransform.main, args, 5)
+    args = "--matrix {} --outFileName {} --method {} --dataType float32 "\
+           "--maxDistance {}".format(original_matrix_cool, outfile_band.name, method,
+                                     max_distance_bins * bin_size).split()
+    compute(hicTransform.main, args, 5)
+
+    full = triu(hm.hiCMatrix(outfile.name).matrix).tocoo()
+    band = triu(hm.hiCMatrix(outfile_band.name).matrix).tocsr()
+    assert np.all(np.abs(band.tocoo().row - band.tocoo().col) <= max_distance_bins)
+    in_band = np.abs(full.row - full.col) <= max_distance_bins
+    nt.assert_allclose(np.asarray(band[full.row[in_band], full.col[in_band]]).flatten(),
+                       full.data[in_band], rtol=1e-5)
+    assert np.count_nonzero(band.data) == np.count_nonzero(full.data[in_band])
+
+    os.unlink(outfile.name)
+    os.unlink(outfile_band.name)
+
+
+def test_obs_exp_max_distance_data_type():
+    matrix = hm.hiCMatrix(original_matrix_cool).matrix[:500, :500].astype(np.float64)
+    max_distance = 5
+    for function, kwargs in [(obs_exp_matrix, {}), (obs_exp_matrix_non_zero, {'ligation_factor': True})]:
+        full = function(matrix, pInplace=False, pDataType=np.float64, **kwargs)
+        band = function(matrix, pInplace=False, pDataType=np.float32, pMaxDistance=max_distance, **kwargs)
+        assert band.dtype == np.float32
+        full_band = triu(full, k=-max_distance) - triu(full, k=max_distance + 1)
+        nt.assert_allclose(band.toarray(), full_band.toarray(), rtol=1e-5)
+        # the input matrix is not modified without pInplace
+        nt.assert_equal(matrix.data, hm.hiCMatrix(original_matrix_cool).matrix[:500, :500].data)
@@ -0,0 +1,80 @@
+from hicexplorer.lib import workQueue
+from multiprocessing import Queue
+import os
+import time
+import pytest
+
+
+def sleep_and_return(pItems, pOffsets, pSleep=0.0):
+    # later batches finish first
+    time.sleep(pSleep * (10 - pItems[0]))
+    return [item + offset for item, offset in zip(pItems, pOffsets)]
+
+
+def fail_for_five(pItems):
+    if 5 in pItems:
+        raise ValueError('item five failed')
+    return pItems
+
+
+def exit_for_five(pItems):
+    if 5 in pItems:
+        os._exit(3)
+    return pItems
+
+
+def test_getBatches():
+    batches = workQueue.getBatches(101, 3)
+    assert batches[0][0] == 0 and batches[-1][1] == 101
+    assert all(end == start for (_, end), (start, _) in zip(batches[:-1], batches[1:]))
+    assert len(batches) <= 3 * workQueue.BATCHES_PER_THREAD
+    assert workQueue.getBatches(3, 8) == [(0, 1), (1, 2), (2, 3)]
+
+
+@pytest.mark.parametrize("threads", [1, 3])
+def test_runParallel_order(threads):
+    # the results are returned in the order of the batches, not in the order they are finished
+    items = list(range(10))
+    results = workQueue.runParallel(sleep_and_return, [items, [100] * 10], threads,
+                                    pKwargs=dict(pSleep=0.02), pBatchSize=2)
+    assert results == [[100, 101], [102, 103], [104, 105], [106, 107], [108, 109]]
+    assert workQueue.flatten(results) == list(range(100, 110))
+
+
+def test_runParallel_shorter_item_list():
+    results = workQueue.runParallel(sleep_and_return, [list(range(4)), []], 2, pBatchSize=2)
+    assert results == [[], []]
+
+
+@pytest.mark.parametrize("threads", [1, 3])
+def test_runParallel_error(threads):
+    # the traceback of the failed batch is raised in the calling process
+    with pytest.raises(workQueue.WorkQueueError) as exp:
+        workQueue.runParallel(fail_for_five, [list(range(10))], threads, pBatchSize=2)
+    assert 'ValueError: item five failed' in str(exp.value)
+
+
+def test_runParallel_worker_died():
+    with pytest.raises(workQueue.WorkQueueError) as exp:
+        workQueue.runParallel(exit_for_five, [list(range(10))], 3, pBatchSize=2)
+    assert 'exit code 3' in str(exp.value)
+
+
+def test_worker():
+    # a worker processes batches until it gets None and stops at the first failure
+    batches = [(0, 2), (2, 4), (4, 6)]
+    task_queue = Queue()
+    result_queue = Queue()
+    for batch_index in [0, 2, None]:
+        task_queue.put(batch_index)
+    workQueue._worker(fail_for_five, [[0, 1, 2, 3, 5, 6]], {}, batches, task_queue, result_queue)
+    assert result_queue.get(timeout=5) == (0, True, [0, 1])
+    batch_index, success, result = result_queue.get(timeout=5)
+    assert (batch_index, success) == (2, False)
+    assert 'ValueError: item five failed' in result
+    assert task_queue.get(timeout=5) is None
+
+    for batch_index in [1, None]:
+        task_queue.put(batch_index)
+    workQueue._worker(fail_for_five, [[0, 1, 2, 3, 5, 6]], {}, batches, task_queue, result_queue)
+    assert result_queue.get(timeout=5) == (1, True, [2, 3])
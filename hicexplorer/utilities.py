@@ -8,17 +8,22 @@ from matplotlib import use as mplt_use
 mplt_use('Agg')
 from unidecode import unidecode
 import cooler
-from copy import deepcopy
-import time
-from multiprocessing import Process, Queue
-import traceback
+from scipy.sparse import csr_matrix, coo_matrix
+from scipy.stats import rankdata, norm
+from hicexplorer.lib import viewpointStore
 import logging
 log = logging.getLogger(__name__)
 
 
 def readBed(pBedFile):
+    if viewpointStore.isInStore(pBedFile):
+        _, columns = viewpointStore.readColumns(pBedFile, [0, 1, 2])
+        if columns is not None:
+            chrom, start, end = [column.astype(str).tolist() for column in columns]
+            return list(zip(chrom, start, end))
+
     viewpoints = []
-    with open(pBedFile, 'r') as file:
+    with viewpointStore.openFile(pBedFile, 'r') as file:
         for line in file.readlines():
             if line.startswith('#'):
                 continue
@@ -248,23 +253,83 @@ def getUserRegion(chromSizes, regionString, max_chunk_size=1e6):
     return (chromSizes, regionStart, regionEnd, int(chunkSize))
 
 
+def sum_per_distance(pRow, pCol, pData, pSize, pChromosomeStarts=None, pPerChromosome=False):
+    """
+        Returns the sum of the values and the number of values per
+        distance abs(row - col) for the distances 0 to pSize - 1.
+        Both are computed with one pass over the values by np.bincount.
+
+        If the first bin of each chromosome is given by pChromosomeStarts,
+        only intra-chromosomal values are considered. With pPerChromosome,
+        the sums and numbers are computed for each chromosome and returned
+        as arrays with one row per chromosome, otherwise they are summed
+        over all chromosomes.
+
+    >>> row = np.array([0, 0, 1, 2, 3, 0])
+    >>> col = np.array([0, 1, 2, 2, 4, 4])
+    >>> data = np.array([1., 2, 3, 4, 5, 6])
+    >>> sums, counts = sum_per_distance(row, col, data, 5)
+    >>> sums, counts
+    (array([ 5., 10.,  0.,  0.,  6.]), array([2, 3, 0, 0, 1]))
+    >>> sums, counts = sum_per_distance(row, col, data, 3, pChromosomeStarts=[0, 3])
+    >>> sums, counts
+    (array([ 5., 10.,  0.]), array([2, 3, 0]))
+    >>> sums, counts = sum_per_distance(row, col, data, 3, pChromosomeStarts=[0, 3], pPerChromosome=True)
+    >>> sums
+    array([[5., 5., 0.],
+           [0., 5., 0.]])
+    """
+    distance = np.absolute(np.asarray(pRow, dtype=np.int64) - np.asarray(pCol, dtype=np.int64))
+    data = np.asarray(pData, dtype=np.float64)
+    if pChromosomeStarts is not None:
+        chromosome_starts = np.asarray(pChromosomeStarts)
+        chromosome = np.searchsorted(chromosome_starts, pRow, side='right') - 1
+        intra_chromosomal = chromosome == np.searchsorted(chromosome_starts, pCol, side='right') - 1
+        distance = distance[intra_chromosomal]
+        data = data[intra_chromosomal]
+        if pPerChromosome:
+            number_of_chromosomes = len(chromosome_starts)
+            # index the distances of each chromosome in its own row
+            distance += chromosome[intra_chromosomal] * pSize
+            sums = np.bincount(distance, weights=data, minlength=number_of_chromosomes * pSize).astype(np.float64, copy=False)
+            counts = np.bincount(distance, minlength=number_of_chromosomes * pSize)
+            return sums.reshape(number_of_chromosomes, pSize), counts.reshape(number_of_chromosomes, pSize)
+
+    # without values, bincount returns integers
+    sums = np.bincount(distance, weights=data, minlength=pSize)[:pSize].astype(np.float64, copy=False)
+    counts = np.bincount(distance, minlength=pSize)[:pSize]
+    return sums, counts
+
+
+def diagonal_lengths(pChromosomeSizes, pSize):
+    """
+        Returns the number of intra-chromosomal bins at the distances
+        0 to pSize - 1 of the upper triangle of a matrix with chromosomes
+        of the given sizes (in bins), i.e. sum(max(size - distance, 0)).
+
+    >>> diagonal_lengths([3, 2], 4)
+    array([5, 3, 1, 0])
+    """
+    sizes = np.asarray(pChromosomeSizes, dtype=np.int64)
+    chromosomes_per_size = np.bincount(sizes, minlength=pSize)
+    size = np.arange(len(chromosomes_per_size))
+    # number of chromosomes and their summed sizes for all chromosomes larger than a distance
+    larger_chromosomes = chromosomes_per_size.sum() - np.cumsum(chromosomes_per_size)
+    larger_chromosomes_size = (size * chromosomes_per_size).sum() - np.cumsum(size * chromosomes_per_size)
+    return (larger_chromosomes_size - size * larger_chromosomes)[:pSize]
+
+
 def expected_interactions_in_distance(pLength_chromosome, pChromosome_count, pSubmatrix):
     """
         Computes the function I_chrom(s) for a given chromosome.
     """
-    expected_interactions = np.zeros(pSubmatrix.shape[0])
-    row, col = pSubmatrix.nonzero()
-    distance = np.absolute(row - col)
-
-    for i, distance_ in enumerate(distance):
-        expected_interactions[distance_] += pSubmatrix.data[i]
+    submatrix = pSubmatrix.tocoo()
+    expected_interactions, _ = sum_per_distance(submatrix.row, submatrix.col, submatrix.data, pSubmatrix.shape[0])
 
     count_times_i = np.arange(float(len(expected_interactions)))
-    pChromosome_count = np.int(pChromosome_count)
-    pLength_chromosome = np.int(pLength_chromosome)
-    count_times_i *= pChromosome_count
-    count_times_i -= pLength_chromosome
-    count_times_i *= np.int(-1)
+    count_times_i *= int(pChromosome_count)
+    count_times_i -= int(pLength_chromosome)
+    count_times_i *= -1
 
     expected_interactions /= count_times_i
     # log.debug('exp_obs_matrix_lieberman {}'.format(expected_interactions))
@@ -276,16 +341,8 @@ def expected_interactions_non_zero(pSubmatrix):
     """
         Computes the expected number of interactions per distance
     """
-
-    expected_interactions = np.zeros(pSubmatrix.shape[0])
-    row, col = pSubmatrix.nonzero()
-    distance = np.absolute(row - col)
-
-    occurences = np.zeros(pSubmatrix.shape[0])
-    # data_type = type(pSubmatrix.data[0])
-    for i, distance_ in enumerate(distance):
-        expected_interactions[distance_] += pSubmatrix.data[i]
-        occurences[distance_] += 1
+    submatrix = pSubmatrix.tocoo()
+    expected_interactions, occurences = sum_per_distance(submatrix.row, submatrix.col, submatrix.data, pSubmatrix.shape[0])
     expected_interactions /= occurences
 
     mask = np.isnan(expected_interactions)
@@ -296,96 +353,17 @@ def expected_interactions_non_zero(pSubmatrix):
     return expected_interactions
 
 
-def expected_interactions_thread(pData, pDistances, pMinDistance, pMaxDistance, pSize, pQueue):
-    try:
-        expected_interactions = np.zeros(pSize)
-
-        for i in range(pMinDistance, pMaxDistance, 1):
-            mask = pDistances == i
-            expected_interactions[i] = np.sum(pData[mask])
-
-        pQueue.put(expected_interactions)
-        return
-    except Exception as exp:
-        pQueue.put('Fail: ' + str(exp) + traceback.format_exc())
-        return
-
-
-def expected_interactions(pSubmatrix, pThreads=None):
+def expected_interactions(pSubmatrix):
     """
-        Computes the expected number of interactions per distance
+        Computes the expected number of interactions per distance.
+        The sums per distance are computed in one pass over the non-zero
+        values.
     """
-    expected_interactions = np.zeros(pSubmatrix.shape[0])
-
-    row, col = pSubmatrix.nonzero()
-    distance = np.absolute(row - col)
-    occurrences = np.arange(pSubmatrix.shape[0] + 1, 1, -1)
-    # occurences = np.zeros(pSubmatrix.shape[0])
-
-    if len(distance) == 0:
+    submatrix = pSubmatrix.tocoo()
+    if submatrix.nnz == 0:
         return None
-    min_distance = distance.min()
-    max_distance = distance.max()
-    # time_start = time.time()
-    if pThreads is not None and pThreads:
-        queue = [None] * pThreads
-        process = [None] * pThreads
-        distances_per_threads = (max_distance - min_distance) // pThreads
-        all_data_collected = False
-        thread_done = [False] * pThreads
-
-        for i in range(pThreads):
-
-            if i < pThreads - 1:
-                min_distance_thread = min_distance + (i * distances_per_threads)
-                max_distance_thread = min_distance + ((i + 1) * distances_per_threads)
-            else:
-                min_distance_thread = min_distance + (i * distances_per_threads)
-                max_distance_thread = max_distance + 1
-            queue[i] = Queue()
-            process[i] = Process(target=expected_interactions_thread, kwargs=dict(
-                pData=pSubmatrix.data,
-                pDistances=distance,
-                pMinDistance=min_distance_thread,
-                pMaxDistance=max_distance_thread,
-                pSize=pSubmatrix.shape[0],
-                pQueue=queue[i]
-            )
-            )
-
-            process[i].start()
-        fail_flag = False
-        fail_message = ''
-        while not all_data_collected:
-            for i in range(pThreads):
-                if queue[i] is not None and not queue[i].empty():
-                    expected_interactions_thread_ = queue[i].get()
-                    if 'Fail: ' in expected_interactions_thread_:
-                        fail_flag = True
-                        fail_message = expected_interactions_thread_
-                    else:
-                        expected_interactions += expected_interactions_thread_
-                    queue[i] = None
-                    process[i].join()
-                    process[i].terminate()
-                    process[i] = None
-                    thread_done[i] = True
-            all_data_collected = True
-            for thread in thread_done:
-                if not thread:
-                    all_data_collected = False
-            time.sleep(1)
-        if fail_flag:
-            return fail_message
-    else:
-
-        for i in range(min_distance, max_distance + 1, 1):
-            mask = distance == i
-            expected_interactions[i] = np.sum(pSubmatrix.data[mask])
-    # log.info('exp inter: {}'.format(time.time() - time_start))
-    # for i, distance_ in enumerate(distance):
-    #     expected_interactions[distance_] += pSubmatrix.data[i]
-        # occurences[distance_] += 1
+    expected_interactions, _ = sum_per_distance(submatrix.row, submatrix.col, submatrix.data, pSubmatrix.shape[0])
+    occurrences = np.arange(pSubmatrix.shape[0] + 1, 1, -1)
     expected_interactions /= occurrences
 
     mask = np.isnan(expected_interactions)
@@ -393,12 +371,6 @@ def expected_interactions(pSubmatrix, pThreads=None):
     mask = np.isinf(expected_interactions)
     expected_interactions[mask] = 0
 
-    del row
-    del col
-    del distance
-    del occurrences
-    del mask
-
     return expected_interactions
 
 # def expected_interactions(pSubmatrix):
@@ -437,7 +409,103 @@ def obs_exp_matrix_lieberman(pSubmatrix, pLength_chromosome, pChromosome_count):
     return pSubmatrix
 
 
-def obs_exp_matrix_non_zero(pSubmatrix, ligation_factor=False, pInplace=True, pToEpsilon=False, pThreads=None):
+def row_col_of_values(pMatrix):
+    """
+        Returns the row and column index of each stored value of a
+        csr matrix, in the order of pMatrix.data.
+
+    >>> from scipy.sparse import csr_matrix
+    >>> row_col_of_values(csr_matrix(np.array([[1, 0, 2], [0, 0, 3], [4, 0, 0]])))
+    (array([0, 0, 1, 2]), array([0, 2, 2, 0], dtype=int32))
+    """
+    row = np.repeat(np.arange(pMatrix.shape[0]), np.diff(pMatrix.indptr))
+    return row, pMatrix.indices
+
+
+def ranksums_rows(pX, pY):
+    """
+        Wilcoxon rank-sum test of each row of pX against the same row of pY, computed like scipy.stats.ranksums.
+        Returns the p-values.
+
+        >>> from scipy.stats import ranksums
+        >>> x = np.array([[1., 5., 7.], [2., 2., 3.]])
+        >>> y = np.array([[2., 3., 4., 0.], [2., 6., 1., 8.]])
+        >>> bool(np.all(ranksums_rows(x, y) == [ranksums(x[0], y[0])[1], ranksums(x[1], y[1])[1]]))
+        True
+    """
+    n1 = pX.shape[1]
+    n2 = pY.shape[1]
+    ranked = rankdata(np.concatenate((pX, pY), axis=1), axis=1)
+    s = np.sum(ranked[:, :n1], axis=1)
+    expected = n1 * (n1 + n2 + 1) / 2.0
+    z = (s - expected) / np.sqrt(n1 * n2 * (n1 + n2 + 1) / 12.0)
+    return 2 * norm.sf(np.abs(z))
+
+
+def get_bins_containing(pStarts, pEnds, pPositions):
+    """
+    Returns for every position the index of the bin that contains it, or
+    -1 if the position falls outside of all bins. This is the vectorized
+    counterpart of `hic_matrix.getRegionBinRange(chrom, pos, pos + 1)[0]`
+    for the (sorted) bins of one chromosome.
+
+    >>> starts = np.array([0, 10, 20, 40])
+    >>> ends = np.array([10, 20, 30, 50])
+    >>> get_bins_containing(starts, ends, np.array([0, 9, 10, 35, 49, 50]))
+    array([ 0,  0,  1, -1,  3, -1])
+    """
+    idx = np.searchsorted(pStarts, pPositions, side='right') - 1
+    valid = (idx >= 0) & (pPositions < pEnds[np.clip(idx, 0, None)])
+    return np.where(valid, idx, -1)
+
+
+def dense_windows(pMatrix, pRows, pCols, pHalfWidth):
+    """
+    Returns the dense windows pMatrix[row - pHalfWidth:row + pHalfWidth + 1, col - pHalfWidth:col + pHalfWidth + 1]
+    of a csr matrix for all (row, col) in zip(pRows, pCols) as one array of shape
+    (len(pRows), 2 * pHalfWidth + 1, 2 * pHalfWidth + 1). All windows need to be inside of the matrix.
+
+    The values of each window row are found with a binary search in the sorted
+    column indices of the matrix row, so only the rows covered by the windows
+    are read and no window is sliced on its own.
+
+    >>> matrix = csr_matrix(np.arange(25).reshape(5, 5))
+    >>> dense_windows(matrix, np.array([1, 3]), np.array([2, 3]), 1)[1]
+    array([[12, 13, 14],
+           [17, 18, 19],
+           [22, 23, 24]])
+    """
+    size = 2 * pHalfWidth + 1
+    windows = np.zeros((len(pRows), size, size), dtype=pMatrix.dtype)
+    if len(pRows) == 0:
+        return windows
+    if not pMatrix.has_canonical_format:
+        pMatrix.sum_duplicates()
+
+    # one entry per row of each window
+    window_id = np.repeat(np.arange(len(pRows)), size)
+    window_row = np.tile(np.arange(size), len(pRows))
+    rows = np.asarray(pRows, dtype=np.int64)[window_id] - pHalfWidth + window_row
+    first_col = np.asarray(pCols, dtype=np.int64)[window_id] - pHalfWidth
+    lower = np.empty(len(rows), dtype=np.int64)
+    upper = np.empty(len(rows), dtype=np.int64)
+    order = np.argsort(rows, kind='stable')
+    unique_rows, row_start = np.unique(rows[order], return_index=True)
+    for row, entries in zip(unique_rows, np.split(order, row_start[1:])):
+        begin, end = pMatrix.indptr[row], pMatrix.indptr[row + 1]
+        row_indices = pMatrix.indices[begin:end]
+        lower[entries] = begin + np.searchsorted(row_indices, first_col[entries])
+        upper[entries] = begin + np.searchsorted(row_indices, first_col[entries] + size)
+
+    counts = upper - lower
+    entry = np.repeat(np.arange(len(counts)), counts)
+    positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + lower[entry]
+    windows[window_id[entry], window_row[entry], pMatrix.indices[positions] - first_col[entry]] = pMatrix.data[positions]
+    return windows
+
+
+def obs_exp_matrix_non_zero(pSubmatrix, ligation_factor=False, pInplace=True, pToEpsilon=False,
+                            pDataType=np.float32, pMaxDistance=None):
     """
         Creates normalized contact matrix M* by
         dividing each entry by the gnome-wide
@@ -448,40 +516,72 @@ def obs_exp_matrix_non_zero(pSubmatrix, ligation_factor=False, pInplace=True, pT
         exp_i,j = exp_i,j * sum(row(i)) * sum(row(j)) / sum(matrix)
         This factor has been used by Homer software to correct for the effect
         of proximity ligation
+
+        The values are of type pDataType. If pMaxDistance is given, only the
+        values up to this distance (in bins) from the diagonal are returned.
+        Without pInplace, a new matrix is returned and pSubmatrix is not copied.
+
+    >>> from scipy.sparse import csr_matrix
+    >>> matrix = csr_matrix(np.array([[2., 4, 0], [4, 6, 3], [0, 3, 2]]))
+    >>> obs_exp_matrix_non_zero(matrix, pInplace=False).toarray()
+    array([[0.6       , 1.1428572 , 0.        ],
+           [1.1428572 , 1.8       , 0.85714287],
+           [0.        , 0.85714287, 0.6       ]], dtype=float32)
+    >>> obs_exp_matrix_non_zero(matrix, pInplace=False, pMaxDistance=0).toarray()
+    array([[0.6, 0. , 0. ],
+           [0. , 1.8, 0. ],
+           [0. , 0. , 0.6]], dtype=float32)
     """
-    if pInplace:
-        submatrix = pSubmatrix
-    else:
-        submatrix = deepcopy(pSubmatrix)
+    submatrix = pSubmatrix.tocsr()
     expected_interactions_in_distance = expected_interactions_non_zero(submatrix)
 
-    row_sums = np.array(submatrix.sum(axis=1).T).flatten()
-    total_interactions = submatrix.sum()
-
-    row, col = submatrix.nonzero()
-
-    submatrix.data = submatrix.data.astype(np.float32)
-
-    for i in range(len(row)):
-        expected = expected_interactions_in_distance[np.absolute(row[i] - col[i])]
-        if ligation_factor:
-            expected *= row_sums[row[i]] * row_sums[col[i]] / total_interactions
+    row, col = row_col_of_values(submatrix)
+    distance = np.absolute(row - col)
+    expected = expected_interactions_in_distance[distance]
+    if ligation_factor:
+        row_sums = np.array(submatrix.sum(axis=1).T).flatten()
+        total_interactions = submatrix.sum()
+        expected *= row_sums[row] * row_sums[col] / total_interactions
+    del row, col
 
-        submatrix.data[i] /= expected
+    data = submatrix.data.astype(pDataType)
+    data /= expected
+    del expected
 
     if pToEpsilon:
         epsilon = 0.000000001
     else:
         epsilon = 0
-    mask = np.isnan(submatrix.data)
-    submatrix.data[mask] = epsilon
-    mask = np.isinf(submatrix.data)
-    submatrix.data[mask] = epsilon
-    submatrix.eliminate_zeros()
-    return submatrix
+    data[~np.isfinite(data)] = epsilon
+
+    keep = data != 0
+    if pMaxDistance is not None:
+        keep &= distance <= pMaxDistance
+    del distance
+
+    if pInplace:
+        submatrix.data = data
+        if not keep.all():
+            submatrix.data[~keep] = 0
+            submatrix.eliminate_zeros()
+        return submatrix
+    return _matrix_with_values(submatrix, data, keep)
 
 
-def obs_exp_matrix(pSubmatrix, pInplace=True, pToEpsilon=False, pThreads=None):
+def _matrix_with_values(pMatrix, pData, pKeep):
+    """
+        Returns a new csr matrix with the structure of pMatrix,
+        the values pData and only the values where pKeep is True.
+    """
+    if pKeep.all():
+        return csr_matrix((pData, pMatrix.indices.copy(), pMatrix.indptr.copy()), shape=pMatrix.shape)
+    # the number of kept values before each row start
+    kept_values = np.concatenate([[0], np.cumsum(pKeep)])
+    indptr = kept_values[pMatrix.indptr].astype(pMatrix.indptr.dtype)
+    return csr_matrix((pData[pKeep], pMatrix.indices[pKeep], indptr), shape=pMatrix.shape)
+
+
+def obs_exp_matrix(pSubmatrix, pInplace=True, pToEpsilon=False, pDataType=None, pMaxDistance=None):
     """
         Creates normalized contact matrix M* by
         dividing each entry by the gnome-wide
@@ -489,42 +589,75 @@ def obs_exp_matrix(pSubmatrix, pInplace=True, pToEpsilon=False, pThreads=None):
         that genomic distance.
         exp_i,j = sum(interactions at distance abs(i-j)) / number of non-zero
         interactions at abs(i-j)
+
+        The values keep the type of pSubmatrix, unless pDataType is given.
+        If pMaxDistance is given, only the values up to this distance
+        (in bins) from the diagonal are returned.
+        Without pInplace, a new matrix is returned and pSubmatrix is not copied.
+
+    >>> from scipy.sparse import csr_matrix
+    >>> matrix = csr_matrix(np.array([[2., 4, 0], [4, 6, 3], [0, 3, 2]]))
+    >>> np.round(obs_exp_matrix(matrix, pInplace=False).toarray(), 2)
+    array([[0.8 , 0.86, 0.  ],
+           [0.86, 2.4 , 0.64],
+           [0.  , 0.64, 0.8 ]])
+    >>> obs_exp_matrix(matrix, pInplace=False, pMaxDistance=0, pDataType=np.float32).toarray()
+    array([[0.8, 0. , 0. ],
+           [0. , 2.4, 0. ],
+           [0. , 0. , 0.8]], dtype=float32)
     """
-    # time_start = time.time()
-    expected_interactions_in_distance_ = expected_interactions(pSubmatrix, pThreads)
+    submatrix = pSubmatrix.tocsr()
+    expected_interactions_in_distance_ = expected_interactions(submatrix)
     if expected_interactions_in_distance_ is None:
         return None
-    # log.info('time exp: {}'.format(time.time() - time_start))
-    # time_start = time.time()
-
-    row, col = pSubmatrix.nonzero()
-    distance = np.ceil(np.absolute(row - col) / 2).astype(np.int32)
-    if not pInplace:
-        pSubmatrix_copy = deepcopy(pSubmatrix)
-    if len(pSubmatrix.data) > 0:
-        data_type = type(pSubmatrix.data[0])
 
-        expected = expected_interactions_in_distance_[distance]
-        if pInplace:
-            pSubmatrix.data = pSubmatrix.data.astype(np.float32)
-            pSubmatrix.data /= expected
-            pSubmatrix.data = convertInfsToZeros_ArrayFloat(pSubmatrix.data, pToEpsilon).astype(data_type)
-        else:
-            pSubmatrix_copy.data = pSubmatrix_copy.data.astype(np.float32)
-            pSubmatrix_copy.data /= expected
-            pSubmatrix_copy.data = convertInfsToZeros_ArrayFloat(pSubmatrix_copy.data, pToEpsilon).astype(data_type)
-        del expected
+    row, col = row_col_of_values(submatrix)
+    distance = np.absolute(row - col)
+    del row, col
+    if pDataType is None and len(submatrix.data) > 0:
+        pDataType = type(submatrix.data[0])
 
+    data = submatrix.data.astype(np.float32)
+    data /= expected_interactions_in_distance_[np.ceil(distance / 2).astype(np.int32)]
+    data = convertInfsToZeros_ArrayFloat(data, pToEpsilon).astype(pDataType, copy=False)
     del expected_interactions_in_distance_
-    del row
-    del col
+
+    keep = np.ones(len(data), dtype=bool)
+    if pMaxDistance is not None:
+        keep = distance <= pMaxDistance
     del distance
-    # log.info('test obs/exp: {}'.format(time.time() - time_start))
 
     if pInplace:
-        return pSubmatrix
-    else:
-        return pSubmatrix_copy
+        submatrix.data = data
+        if not keep.all():
+            submatrix.data[~keep] = 0
+            submatrix.eliminate_zeros()
+        return submatrix
+    return _matrix_with_values(submatrix, data, keep)
+
+
+def block_diagonal_matrix(pMatrices, pRanges, pShape):
+    """
+    Builds a csr matrix of shape pShape with the given matrices as diagonal blocks
+    at the (start, end) bin ranges.
+
+    >>> blocks = [csr_matrix(np.array([[1, 2], [2, 3]])), csr_matrix(np.array([[4]]))]
+    >>> block_diagonal_matrix(blocks, [(0, 2), (3, 4)], (4, 4)).toarray()
+    array([[1, 2, 0, 0],
+           [2, 3, 0, 0],
+           [0, 0, 0, 0],
+           [0, 0, 0, 4]])
+    """
+    instances = []
+    features = []
+    data = []
+    for matrix, (start, _) in zip(pMatrices, pRanges):
+        matrix = coo_matrix(matrix)
+        instances.append(matrix.row.astype(np.int64) + start)
+        features.append(matrix.col.astype(np.int64) + start)
+        data.append(matrix.data)
+    return coo_matrix((np.concatenate(data), (np.concatenate(instances), np.concatenate(features))),
+                      shape=pShape).tocsr()
 
 
 def toString(s):